@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+"""
+Latency of GET, POST and DELETE on /api/2/inf/claritynow as concurrency grows.
+
+Usage::
+
+    python benchmarks/api_load.py [--url http://localhost:5000] [--requests 400]
+
+Without ``--url`` the API is served in this process by a threaded WSGI server,
+and publishing a task is simulated with ``--publish-latency`` milliseconds of
+delay (a slow broker), and creates and deletes aren't rate limited. Point
+``--url`` at a real deployment (i.e. uWSGI with different
+VLAB_CLARITYNOW_API_PROCESSES/THREADS) to compare serving modes; run it with
+VLAB_CLARITYNOW_CREATES_PER_MINUTE=0 and VLAB_CLARITYNOW_DELETES_PER_MINUTE=0,
+otherwise most requests are answered with 429.
+"""
+import time
+import uuid
+import logging
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import ujson
+from flask import Flask
+from werkzeug.serving import make_server
+from vlab_api_common.http_auth import generate_v2_test_token
+
+from vlab_claritynow_api.lib import admission
+from vlab_claritynow_api.lib.views import ClarityNowView, claritynow
+
+
+CONCURRENCY = (1, 10, 50, 100, 200)
+BODIES = {'GET': None,
+          'POST': {'name': 'loadTest', 'image': '1.0.0', 'network': 'someLAN'},
+          'DELETE': {'name': 'loadTest'}}
+
+
+class FakeTask(object):
+    """Stands in for celery.result.AsyncResult"""
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+
+    def ready(self):
+        # No worker runs the tasks
+        return False
+
+
+class FakeCelery(object):
+    """Stands in for the Celery app; publishing takes ``latency`` seconds
+
+    There's no shared result store (like ``rpc://``), so request ids are only
+    remembered by this process.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.backend = None
+
+    def send_task(self, name, args):
+        time.sleep(self.latency)
+        return FakeTask()
+
+
+def serve(publish_latency):
+    """Run the API in a background thread
+
+    :Returns: Tuple - (URL, server)
+    """
+    # Hundreds of requests from one user would otherwise be mostly 429s
+    claritynow.RATE_LIMITS = admission.RateLimits({})
+    app = Flask(__name__)
+    app.celery_app = FakeCelery(publish_latency)
+    ClarityNowView.register(app)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    server.request_queue_size = max(CONCURRENCY)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port), server
+
+
+def call(url, method, token):
+    """Make one request, and return how long it took in milliseconds"""
+    body = BODIES[method]
+    data = ujson.dumps(body).encode() if body else None
+    headers = {'X-Auth': token, 'Content-Type': 'application/json'}
+    if method == 'POST':
+        # Every create is new, so none are answered from an earlier request
+        headers['X-REQUEST-ID'] = str(uuid.uuid4())
+    req = urllib.request.Request('{}/api/2/inf/claritynow'.format(url), data=data, method=method,
+                                 headers=headers)
+    started = time.time()
+    with urllib.request.urlopen(req) as resp:
+        resp.read()
+    return (time.time() - started) * 1000
+
+
+def percentile(values, pct):
+    """Nearest rank percentile"""
+    ordered = sorted(values)
+    idx = max(0, int(round(pct / 100.0 * len(ordered))) - 1)
+    return ordered[idx]
+
+
+def run(url, method, concurrency, total, token):
+    """Make ``total`` requests, ``concurrency`` at a time"""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(lambda _: call(url, method, token), range(total)))
+    return {'p50_ms': round(percentile(latencies, 50), 2),
+            'p99_ms': round(percentile(latencies, 99), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default=None)
+    parser.add_argument('--requests', type=int, default=400, help='Requests per method, per concurrency level')
+    parser.add_argument('--publish-latency', type=float, default=20, help='Milliseconds; only used without --url')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    server = None
+    url = args.url
+    if url is None:
+        url, server = serve(args.publish_latency / 1000.0)
+    token = generate_v2_test_token(username='bob')
+    report = {}
+    try:
+        for method in BODIES.keys():
+            report[method] = {}
+            for concurrency in CONCURRENCY:
+                total = max(args.requests, concurrency)
+                report[method][concurrency] = run(url, method, concurrency, total, token)
+    finally:
+        if server is not None:
+            server.shutdown()
+    print(ujson.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: UTF-8 -*-
+"""
+How long a uWSGI worker of the API takes to import the app, and how much memory
+that costs.
+
+Usage::
+
+    python benchmarks/api_startup.py [--repeat 5]
+
+With ``lazy-apps``, every uWSGI worker imports ``app.py`` for itself after it's
+forked, so this is paid once per process on every (re)start. Each measurement
+is a new Python process that imports the app and reports the time it took, its
+resident memory, and if the vSphere libraries or ``pkg_resources`` were
+loaded. For comparison, the same is done with those libraries imported as well,
+which is what the API used to load.
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+import ujson
+
+
+MEASURE = """
+import sys, time, resource, ujson
+started = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+took = time.perf_counter() - started
+with open('/proc/self/status') as the_file:
+    rss_kb = [int(x.split()[1]) for x in the_file if x.startswith('VmRSS:')][0]
+print(ujson.dumps({'seconds': took,
+                   'rss_mb': rss_kb / 1024,
+                   'modules': len(sys.modules),
+                   'pyVmomi': 'pyVmomi' in sys.modules,
+                   'pkg_resources': 'pkg_resources' in sys.modules}))
+"""
+CASES = [('python only', []),
+         ('API app', ['vlab_claritynow_api.app']),
+         ('API app + vSphere + pkg_resources', ['pkg_resources', 'vlab_inf_common.vmware', 'vlab_claritynow_api.app'])]
+
+
+def measure(modules, repeat):
+    """Import some modules in fresh processes, and average what it cost
+
+    :Returns: Dictionary
+    """
+    env = dict(os.environ)
+    # Don't leave metrics files around, or publish anything
+    env['VLAB_CLARITYNOW_METRICS_DIR'] = ''
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE] + modules, env=env)
+        runs.append(ujson.loads(output.decode().strip().split('\n')[-1]))
+    return {'seconds': round(sum(x['seconds'] for x in runs) / repeat, 3),
+            'rss_mb': round(sum(x['rss_mb'] for x in runs) / repeat, 1),
+            'modules': runs[-1]['modules'],
+            'pyVmomi': runs[-1]['pyVmomi'],
+            'pkg_resources': runs[-1]['pkg_resources']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Processes to average over')
+    args = parser.parse_args()
+
+    print('{:>36} {:>9} {:>8} {:>8} {:>8} {:>14}'.format('imports', 'seconds', 'RSS MB', 'modules', 'pyVmomi', 'pkg_resources'))
+    for name, modules in CASES:
+        result = measure(modules, args.repeat)
+        print('{:>36} {:>9.3f} {:>8.1f} {:>8} {:>8} {:>14}'.format(name, result['seconds'], result['rss_mb'],
+                                                                   result['modules'], str(result['pyVmomi']),
+                                                                   str(result['pkg_resources'])))
+
+
+if __name__ == '__main__':
+    main()
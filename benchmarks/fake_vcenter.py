@@ -0,0 +1,586 @@
+# -*- coding: UTF-8 -*-
+"""
+A simulated vCenter server, for benchmarking the worker without real hardware.
+
+``FakeVCenter`` stands in for the SOAP connection that pyVmomi talks over, so
+the worker code under test, pyVmomi and ``vlab_inf_common`` all run unmodified:
+every method call and property read on a managed object is one "round trip"
+to the fake, which sleeps for the configured latency and counts it.
+
+What's modeled:
+
+- SOAP round trip latency, for every method call and property read
+- vCenter tasks (power, reconfigure, clone, destroy, ...) that take a while
+- VMs that only get an IP (and VMware Tools) a while after being powered on
+- Guest operations (commands run inside a VM) that take a while
+- The PropertyCollector, container views and the search index
+
+The inventory is one datacenter, with every user's folder under
+``INF_VCENTER_TOP_LVL_DIR`` and every network on one distributed switch.
+"""
+import time
+import uuid
+import itertools
+import threading
+import collections
+from datetime import datetime, timezone
+
+from pyVmomi import vim, vmodl
+from vlab_inf_common.vmware import vCenter
+
+from vlab_claritynow_api.lib import const
+
+
+PC = vmodl.query.PropertyCollector
+
+
+class Latency(object):
+    """How slow the simulated vCenter is
+
+    :param rtt: Seconds for every SOAP round trip
+    :type rtt: Float
+
+    :param task: Seconds for a vCenter task (power on, reconfigure, ...) to complete
+    :type task: Float
+
+    :param boot: Seconds after power on until the VM has an IP and VMware Tools is running
+    :type boot: Float
+
+    :param guest_op: Seconds for a command run inside a VM to exit
+    :type guest_op: Float
+    """
+    def __init__(self, rtt=0.005, task=0.5, boot=2.0, guest_op=0.5):
+        self.rtt = rtt
+        self.task = task
+        self.boot = boot
+        self.guest_op = guest_op
+
+    def as_dict(self):
+        """The latency settings, for saving next to results
+
+        :Returns: Dictionary
+        """
+        return {'rtt': self.rtt, 'task': self.task, 'boot': self.boot, 'guest_op': self.guest_op}
+
+
+class _Entity(object):
+    """The server side state of one managed object"""
+    def __init__(self, mo, name='', parent=None, **props):
+        self.mo = mo
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.props = props
+
+
+class FakeVCenter(object):
+    """The simulated vCenter; also acts as the pyVmomi stub for every managed object
+
+    :param latency: How slow the simulated vCenter is
+    :type latency: Latency
+    """
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.round_trips = collections.Counter()
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._entities = {}
+        self._results = {}
+        self._pending_tasks = []
+        self._processes = {}
+        self._instance_uuid = str(uuid.uuid4())
+        self._build_inventory()
+
+    # -- Setting up the inventory ---------------------------------------------
+
+    def _new(self, vimtype, prefix, name='', parent=None, **props):
+        mo = vimtype('{}-{}'.format(prefix, next(self._ids)), self)
+        entity = _Entity(mo, name, parent, **props)
+        self._entities[mo._moId] = entity
+        if parent is not None:
+            parent.children.append(entity)
+        return entity
+
+    def _build_inventory(self):
+        self._root = self._new(vim.Folder, 'group-d', 'Datacenters')
+        self._datacenter = self._new(vim.Datacenter, 'datacenter', 'dc', self._root)
+        vm_folder = self._new(vim.Folder, 'group-v', 'vm')
+        self._network_folder = self._new(vim.Folder, 'group-n', 'network')
+        host_folder = self._new(vim.Folder, 'group-h', 'host')
+        self._datacenter.props.update(vmFolder=vm_folder, networkFolder=self._network_folder,
+                                      hostFolder=host_folder)
+        self._top = self._new(vim.Folder, 'group-v', const.INF_VCENTER_TOP_LVL_DIR, vm_folder)
+        cluster = self._new(vim.ClusterComputeResource, 'domain-c', 'cluster', host_folder)
+        cluster.props['resourcePool'] = self._new(vim.ResourcePool, 'resgroup', const.INF_VCENTER_RESORUCE_POOL)
+        self._switch = self._new(vim.dvs.VmwareDistributedVirtualSwitch, 'dvs', 'dvSwitch',
+                                 self._network_folder, uuid=str(uuid.uuid4()))
+        self.add_network('VM Network')
+        self._content = vim.ServiceInstanceContent(
+            rootFolder=self._root.mo,
+            propertyCollector=self._new(vmodl.query.PropertyCollector, 'propertyCollector').mo,
+            viewManager=self._new(vim.view.ViewManager, 'ViewManager').mo,
+            searchIndex=self._new(vim.SearchIndex, 'SearchIndex').mo,
+            sessionManager=self._new(vim.SessionManager, 'SessionManager').mo,
+            setting=self._new(vim.option.OptionManager, 'VpxSettings').mo,
+            ovfManager=self._new(vim.OvfManager, 'OvfManager').mo,
+            guestOperationsManager=self._new(vim.vm.guest.GuestOperationsManager, 'guestOperationsManager',
+                                             processManager=self._new(vim.vm.guest.ProcessManager,
+                                                                      'processManager')).mo,
+            about=vim.AboutInfo(instanceUuid=self._instance_uuid))
+
+    def add_network(self, name):
+        """Make a port group on the distributed switch
+
+        :Returns: vim.Network
+        """
+        with self._lock:
+            return self._new(vim.dvs.DistributedVirtualPortgroup, 'dvportgroup', name,
+                             self._network_folder).mo
+
+    def add_folder(self, name, networks=('frontend',)):
+        """Make a user's folder, and their networks
+
+        :Returns: vim.Folder
+
+        :param name: The name of the folder, i.e. the username
+        :type name: String
+
+        :param networks: The names of the user's networks; the port groups are named ``<user>_<network>``
+        :type networks: List
+        """
+        with self._lock:
+            folder = self._new(vim.Folder, 'group-v', name, self._top)
+        for network in networks:
+            self.add_network('{}_{}'.format(name, network))
+        return folder.mo
+
+    def add_vm(self, folder, name, annotation=None, network=None, powered_on=True, snapshot=False):
+        """Make a VM that already exists when the benchmark starts
+
+        :Returns: vim.VirtualMachine
+
+        :param folder: The folder to put the VM in
+        :type folder: vim.Folder
+
+        :param name: The name of the VM
+        :type name: String
+
+        :param annotation: The notes (i.e. vLab meta data) of the VM
+        :type annotation: String
+
+        :param network: The name of the network the VM is connected to
+        :type network: String
+
+        :param powered_on: Set to False for a powered off VM
+        :type powered_on: Boolean
+
+        :param snapshot: Set to True to give the VM a snapshot, i.e. for a template
+        :type snapshot: Boolean
+        """
+        with self._lock:
+            networks = [x for x in self._network_folder.children if x.name == network]
+            the_vm = self._new(vim.VirtualMachine, 'vm', name, self._entities[folder._moId],
+                               annotation=annotation,
+                               power_state='poweredOn' if powered_on else 'poweredOff',
+                               powered_on_at=0,
+                               network=networks,
+                               change_version=1,
+                               snapshot=self._new(vim.vm.Snapshot, 'snapshot').mo if snapshot else None)
+        return the_vm.mo
+
+    def connect(self):
+        """Obtain a ``vlab_inf_common`` vCenter object that talks to this fake
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        the_vcenter = vCenter.__new__(vCenter)
+        the_vcenter._conn = vim.ServiceInstance('ServiceInstance', self)
+        the_vcenter._base_dir = const.INF_VCENTER_TOP_LVL_DIR
+        the_vcenter._net_cache = None
+        return the_vcenter
+
+    def reset_counts(self):
+        """Forget how many round trips have been made
+
+        :Returns: None
+        """
+        with self._lock:
+            self.round_trips.clear()
+
+    def round_trip(self, what):
+        """Pay for one round trip to the server
+
+        :Returns: None
+        """
+        with self._lock:
+            self.round_trips[what] += 1
+        if self.latency.rtt:
+            time.sleep(self.latency.rtt)
+
+    # -- The pyVmomi stub interface -------------------------------------------
+
+    def InvokeMethod(self, mo, info, args):
+        self.round_trip(info.wsdlName)
+        handler = getattr(self, '_m_{}'.format(info.wsdlName), None)
+        if handler is None:
+            raise NotImplementedError('The fake vCenter does not implement {}'.format(info.wsdlName))
+        if info.wsdlName == 'WaitForUpdatesEx':
+            # Blocks; must not hold the lock while waiting
+            return handler(mo, *args)
+        with self._lock:
+            self._finish_tasks()
+            return handler(mo, *args)
+
+    def InvokeAccessor(self, mo, info):
+        self.round_trip('get.{}'.format(info.name))
+        with self._lock:
+            self._finish_tasks()
+            return self._property(self._entity(mo), info.name)
+
+    # -- Properties -----------------------------------------------------------
+
+    def _entity(self, mo):
+        try:
+            return self._entities[mo._moId]
+        except KeyError:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+
+    def _property(self, entity, name):
+        mo = entity.mo
+        if name == 'name':
+            return entity.name
+        elif name == 'parent':
+            return entity.parent.mo if entity.parent else None
+        elif name == 'childEntity':
+            return [x.mo for x in entity.children]
+        elif name in ('vmFolder', 'networkFolder', 'hostFolder', 'resourcePool', 'processManager'):
+            return entity.props[name].mo
+        elif name == 'view':
+            return [x.mo for x in self._view(entity)]
+        elif name == 'setting':
+            return []
+        elif name == 'info' and isinstance(mo, vim.Task):
+            return self._task_info(entity)
+        elif isinstance(mo, vim.VirtualMachine):
+            return self._vm_property(entity, name)
+        elif isinstance(mo, vim.Network):
+            if name == 'vm':
+                return [x.mo for x in self._entities.values() if entity in x.props.get('network', [])]
+            elif name == 'key':
+                return mo._moId
+            elif name == 'config':
+                return vim.dvs.DistributedVirtualPortgroup.ConfigInfo(key=mo._moId, name=entity.name,
+                                                                      distributedVirtualSwitch=self._switch.mo)
+        elif name in entity.props:
+            return entity.props[name]
+        raise NotImplementedError('The fake vCenter has no property {} for {}'.format(name, mo))
+
+    def _vm_property(self, entity, name):
+        props = entity.props
+        if name == 'runtime':
+            return vim.vm.RuntimeInfo(powerState=props['power_state'])
+        elif name == 'config':
+            nic = vim.vm.device.VirtualVmxnet3(key=4000,
+                                               deviceInfo=vim.Description(label='Network adapter 1', summary=''))
+            return vim.vm.ConfigInfo(name=entity.name,
+                                     annotation=props['annotation'],
+                                     changeVersion=str(props['change_version']),
+                                     hardware=vim.vm.VirtualHardware(device=[nic]))
+        elif name == 'guest':
+            nics = []
+            if self._booted(entity):
+                nics.append(vim.vm.GuestInfo.NicInfo(ipAddress=['10.1.{}.{}'.format(*divmod(int(entity.mo._moId.split('-')[1]), 250)),
+                                                                'fe80::1']))
+            return vim.vm.GuestInfo(net=nics)
+        elif name == 'network':
+            return [x.mo for x in props['network']]
+        elif name == 'snapshot':
+            if props['snapshot'] is None:
+                return None
+            return vim.vm.SnapshotInfo(currentSnapshot=props['snapshot'])
+        raise NotImplementedError('The fake vCenter has no VM property {}'.format(name))
+
+    def _resolve(self, entity, path):
+        """Read a property path, like ``runtime.powerState``, without another round trip"""
+        parts = path.split('.')
+        value = self._property(entity, parts[0])
+        for part in parts[1:]:
+            if value is None:
+                break
+            value = getattr(value, part, None)
+        if isinstance(value, list):
+            # Values of a DynamicProperty must be typed arrays
+            item_type = type(value[0]) if value else vmodl.DataObject
+            value = item_type.Array(value)
+        return value
+
+    def _booted(self, entity):
+        props = entity.props
+        return props['power_state'] == 'poweredOn' and time.time() >= props['powered_on_at'] + self.latency.boot
+
+    def _view(self, view):
+        found = []
+        def walk(entity):
+            kids = list(entity.children)
+            kids += [entity.props[x] for x in ('vmFolder', 'hostFolder', 'networkFolder', 'resourcePool')
+                     if x in entity.props]
+            for kid in kids:
+                if any(isinstance(kid.mo, x) for x in view.props['types']):
+                    found.append(kid)
+                if view.props['recursive']:
+                    walk(kid)
+        walk(view.props['container'])
+        return found
+
+    # -- Tasks ----------------------------------------------------------------
+
+    def _task(self, effect, seconds=None):
+        """Start a task that completes after a while; ``effect`` returns the result, or raises RuntimeError"""
+        seconds = self.latency.task if seconds is None else seconds
+        task = self._new(vim.Task, 'task', done_at=time.time() + seconds, effect=effect,
+                         state='running', result=None, error=None)
+        self._pending_tasks.append(task)
+        return task.mo
+
+    def _finish_tasks(self):
+        now = time.time()
+        still_running = []
+        for task in self._pending_tasks:
+            if task.props['done_at'] > now:
+                still_running.append(task)
+                continue
+            try:
+                task.props['result'] = task.props['effect']()
+                task.props['state'] = 'success'
+            except RuntimeError as doh:
+                task.props['error'] = vmodl.MethodFault(msg='{}'.format(doh))
+                task.props['state'] = 'error'
+            task.props['completed_at'] = datetime.fromtimestamp(task.props['done_at'], tz=timezone.utc)
+        self._pending_tasks = still_running
+
+    def _task_info(self, task):
+        props = task.props
+        return vim.TaskInfo(key=task.mo._moId, task=task.mo, state=props['state'],
+                            result=props['result'], error=props['error'],
+                            completeTime=props.get('completed_at'))
+
+    # -- Methods --------------------------------------------------------------
+
+    def _m_RetrieveServiceContent(self, mo):
+        return self._content
+
+    def _m_AcquireCloneTicket(self, mo):
+        return 'cst-VCT-{}'.format(uuid.uuid4())
+
+    def _m_CreateContainerView(self, mo, container, types, recursive):
+        return self._new(vim.view.ContainerView, 'session[{}]'.format(uuid.uuid4()),
+                         container=self._entity(container), types=types, recursive=recursive).mo
+
+    def _m_DestroyView(self, mo):
+        self._entities.pop(mo._moId, None)
+
+    def _m_FindChild(self, mo, entity, name):
+        for child in self._entity(entity).children:
+            if child.name == name:
+                return child.mo
+        return None
+
+    def _m_CreateFolder(self, mo, name):
+        return self._new(vim.Folder, 'group-v', name, self._entity(mo)).mo
+
+    def _m_RetrievePropertiesEx(self, mo, specs, options):
+        objects = self._collect(specs)
+        if not objects:
+            return None
+        return self._page(objects, options.maxObjects if options else None)
+
+    def _m_ContinueRetrievePropertiesEx(self, mo, token):
+        objects, page_size = self._results.pop(token)
+        return self._page(objects, page_size)
+
+    def _m_CancelRetrievePropertiesEx(self, mo, token):
+        self._results.pop(token, None)
+
+    def _page(self, objects, page_size):
+        page_size = page_size or len(objects)
+        token = None
+        if len(objects) > page_size:
+            token = str(uuid.uuid4())
+            self._results[token] = (objects[page_size:], page_size)
+        return PC.RetrieveResult(objects=objects[:page_size], token=token)
+
+    def _collect(self, specs):
+        """Evaluate PropertyCollector filters, following traversal specs"""
+        contents = []
+        seen = set()
+        for spec in specs:
+            for obj_spec in spec.objectSet:
+                reached = []
+                self._traverse(self._entity(obj_spec.obj), obj_spec.skip, obj_spec.selectSet, reached)
+                for entity in reached:
+                    if entity.mo._moId in seen:
+                        continue
+                    seen.add(entity.mo._moId)
+                    prop_set = []
+                    for prop_spec in spec.propSet:
+                        if isinstance(entity.mo, prop_spec.type):
+                            prop_set += [vmodl.DynamicProperty(name=x, val=self._resolve(entity, x))
+                                         for x in prop_spec.pathSet]
+                    if prop_set:
+                        contents.append(PC.ObjectContent(obj=entity.mo, propSet=prop_set))
+        return contents
+
+    def _traverse(self, entity, skip, select_set, reached):
+        if not skip:
+            reached.append(entity)
+        for traversal in select_set or []:
+            if not isinstance(entity.mo, traversal.type):
+                continue
+            value = self._property(entity, traversal.path)
+            if value is None:
+                continue
+            if not isinstance(value, list):
+                value = [value]
+            for mo in value:
+                self._traverse(self._entities[mo._moId], traversal.skip, traversal.selectSet, reached)
+
+    def _m_CreatePropertyCollector(self, mo):
+        return self._new(vmodl.query.PropertyCollector, 'session[{}]'.format(uuid.uuid4()),
+                         watched=[], reported={}, version=0).mo
+
+    def _m_DestroyPropertyCollector(self, mo):
+        self._entities.pop(mo._moId, None)
+
+    def _m_CreateFilter(self, mo, spec, partialUpdates):
+        collector = self._entity(mo)
+        collector.props['watched'] += [self._entity(x.obj) for x in spec.objectSet]
+        return self._new(vmodl.query.PropertyCollector.Filter, 'session[{}]'.format(uuid.uuid4())).mo
+
+    def _m_WaitForUpdatesEx(self, mo, version, options):
+        """Only supports watching ``info.state`` and ``info.error`` of tasks, which is all the worker does"""
+        max_wait = options.maxWaitSeconds if options and options.maxWaitSeconds is not None else 60
+        deadline = time.time() + max_wait
+        while True:
+            with self._lock:
+                self._finish_tasks()
+                collector = self._entity(mo)
+                reported = collector.props['reported']
+                changes = []
+                for task in collector.props['watched']:
+                    state = task.props['state']
+                    if reported.get(task.mo._moId) != state:
+                        reported[task.mo._moId] = state
+                        changes.append(PC.ObjectUpdate(kind='modify', obj=task.mo, changeSet=[
+                            PC.Change(name='info.state', op='assign', val=state),
+                            PC.Change(name='info.error', op='assign', val=task.props['error'])]))
+                if changes:
+                    collector.props['version'] += 1
+                    return PC.UpdateSet(version=str(collector.props['version']),
+                                        filterSet=[PC.FilterUpdate(objectSet=changes)])
+                due = [x.props['done_at'] for x in collector.props['watched'] if x.props['state'] == 'running']
+            now = time.time()
+            if now >= deadline:
+                return None
+            wake_at = min(due + [deadline])
+            time.sleep(max(wake_at - now, 0.001))
+
+    # VM power, configuration and life cycle
+
+    def _m_PowerOnVM_Task(self, mo, host=None):
+        entity = self._entity(mo)
+        def effect():
+            if entity.props['power_state'] != 'poweredOn':
+                entity.props['power_state'] = 'poweredOn'
+                entity.props['powered_on_at'] = time.time()
+        return self._task(effect)
+
+    def _m_PowerOffVM_Task(self, mo):
+        entity = self._entity(mo)
+        def effect():
+            entity.props['power_state'] = 'poweredOff'
+        return self._task(effect)
+
+    def _m_Destroy_Task(self, mo):
+        entity = self._entity(mo)
+        def effect():
+            if entity.props.get('power_state') == 'poweredOn':
+                raise RuntimeError('The attempted operation cannot be performed in the current state (Powered on).')
+            entity.parent.children.remove(entity)
+            self._entities.pop(mo._moId, None)
+        return self._task(effect)
+
+    def _m_ReconfigVM_Task(self, mo, spec):
+        entity = self._entity(mo)
+        def effect():
+            props = entity.props
+            if spec.changeVersion and spec.changeVersion != str(props['change_version']):
+                raise RuntimeError('Cannot complete operation due to concurrent modification by another operation.')
+            if spec.annotation is not None:
+                props['annotation'] = spec.annotation
+            for change in spec.deviceChange or []:
+                port = getattr(change.device.backing, 'port', None)
+                if port is not None:
+                    props['network'] = [self._entities[port.portgroupKey]]
+            props['change_version'] += 1
+        return self._task(effect)
+
+    def _m_CloneVM_Task(self, mo, folder, name, spec):
+        source = self._entity(mo)
+        def effect():
+            the_vm = self._new(vim.VirtualMachine, 'vm', name, self._entity(folder),
+                               annotation=source.props['annotation'],
+                               power_state='poweredOff',
+                               powered_on_at=0,
+                               network=list(source.props['network']),
+                               change_version=1,
+                               snapshot=None)
+            if spec.powerOn:
+                the_vm.props['power_state'] = 'poweredOn'
+                the_vm.props['powered_on_at'] = time.time()
+            return the_vm.mo
+        return self._task(effect)
+
+    def _m_CreateSnapshot_Task(self, mo, name, description, memory, quiesce):
+        entity = self._entity(mo)
+        def effect():
+            entity.props['snapshot'] = self._new(vim.vm.Snapshot, 'snapshot').mo
+            return entity.props['snapshot']
+        return self._task(effect)
+
+    def _m_Rename_Task(self, mo, newName):
+        entity = self._entity(mo)
+        def effect():
+            entity.name = newName
+        return self._task(effect)
+
+    def _m_MoveIntoFolder_Task(self, mo, things):
+        folder = self._entity(mo)
+        def effect():
+            for thing in things:
+                entity = self._entity(thing)
+                entity.parent.children.remove(entity)
+                entity.parent = folder
+                folder.children.append(entity)
+        return self._task(effect)
+
+    # Guest operations
+
+    def _m_StartProgramInGuest(self, mo, vm, auth, spec):
+        entity = self._entity(vm)
+        if not self._booted(entity):
+            raise vim.fault.GuestOperationsUnavailable()
+        pid = next(self._ids)
+        self._processes[pid] = time.time() + self.latency.guest_op
+        return pid
+
+    def _m_ListProcessesInGuest(self, mo, vm, auth, pids):
+        answer = []
+        for pid in pids or []:
+            ends_at = self._processes[pid]
+            if ends_at <= time.time():
+                answer.append(vim.vm.guest.ProcessManager.ProcessInfo(
+                    pid=pid, name='sh', owner='administrator', exitCode=0,
+                    endTime=datetime.fromtimestamp(ends_at, tz=timezone.utc)))
+            else:
+                answer.append(vim.vm.guest.ProcessManager.ProcessInfo(pid=pid, name='sh', owner='administrator'))
+        return answer
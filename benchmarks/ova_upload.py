@@ -0,0 +1,200 @@
+# -*- coding: UTF-8 -*-
+"""
+How fast one worker process can upload the disks of an OVA, with the upload
+in ``vlab_inf_common`` versus the parallel, zero-copy one in this repo.
+
+Usage::
+
+    python benchmarks/ova_upload.py [--disks 4] [--disk-mb 256] [--parallel 4] [--tls]
+
+The lease URLs point at a local HTTP server (in another process, so it doesn't
+skew the CPU time of the uploader) that reads and discards every upload. The
+network is nearly free, so what's measured is the cost of the copy loop: MB/s,
+and CPU seconds spent per GB sent. With ``--tls`` the uploads use HTTPS, like
+a real ESXi host.
+
+The server is a single Python process, so it can be what limits how much
+uploading several disks at once helps here.
+"""
+import os
+import ssl
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from vlab_inf_common.vmware import Ova
+
+from vlab_claritynow_api.lib import const
+from vlab_claritynow_api.lib.worker import ova_cache
+
+
+READ_SIZE = 1024 * 1024
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Sink(BaseHTTPRequestHandler):
+    """Reads, and throws away, every upload"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        remaining = int(self.headers['Content-Length'])
+        while remaining:
+            chunk = self.rfile.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(port_queue, cert_file):
+    server = _Server(('127.0.0.1', 0), _Sink)
+    if cert_file:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _write_cert(path):
+    """Save a self-signed cert and its key, for the HTTPS server"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+                                    .public_key(key.public_key()).serial_number(1) \
+                                    .not_valid_before(now).not_valid_after(now + timedelta(hours=1)) \
+                                    .sign(key, hashes.SHA256())
+    with open(path, 'wb') as the_file:
+        the_file.write(key.private_bytes(serialization.Encoding.PEM,
+                                         serialization.PrivateFormat.TraditionalOpenSSL,
+                                         serialization.NoEncryption()))
+        the_file.write(cert.public_bytes(serialization.Encoding.PEM))
+
+
+def _make_ova(path, disks, disk_mb, work_dir):
+    """Write an OVA with a descriptor, and ``disks`` disks of random data"""
+    members = []
+    ovf = os.path.join(work_dir, 'bench.ovf')
+    with open(ovf, 'w') as the_file:
+        the_file.write('<Envelope><NetworkSection><Network ovf:name="VM Network"></Network></NetworkSection></Envelope>')
+    members.append(ovf)
+    for idx in range(disks):
+        disk = os.path.join(work_dir, 'bench-disk{}.vmdk'.format(idx))
+        with open(disk, 'wb') as the_file:
+            block = os.urandom(READ_SIZE)
+            for _ in range(disk_mb):
+                the_file.write(block)
+        members.append(disk)
+    with tarfile.open(path, 'w') as the_tar:
+        for member in members:
+            the_tar.add(member, arcname=os.path.basename(member))
+            os.remove(member)
+
+
+class _Lease(object):
+    """Just enough of a vim.HttpNfcLease for an upload"""
+    def __init__(self, urls):
+        self.state = 'ready'
+        self.info = type('LeaseInfo', (), {'deviceUrl': [type('DeviceUrl', (), {'importKey': x, 'url': y})
+                                                         for x, y in urls.items()]})
+
+    def Progress(self, percent):
+        pass
+
+    def Complete(self):
+        self.state = 'done'
+
+    def Abort(self, fault=None):
+        self.state = 'error'
+
+
+def _spec(disk_names):
+    file_items = [type('FileItem', (), {'path': x, 'deviceId': 'disk-{}'.format(idx)})
+                  for idx, x in enumerate(disk_names)]
+    return type('ImportSpec', (), {'fileItem': file_items})
+
+
+def run(name, make_ova, ova_path, base_url, total_bytes, repeat):
+    """Deploy the OVA ``repeat`` times, and report how quickly it went"""
+    seconds = []
+    cpu = []
+    for _ in range(repeat):
+        ova = make_ova(ova_path)
+        try:
+            urls = {'disk-{}'.format(idx): '{}/nfc/disk-{}.vmdk'.format(base_url, idx) for idx in range(len(ova.vmdks))}
+            lease = _Lease(urls)
+            started = time.time()
+            cpu_started = time.process_time()
+            ova.deploy(_spec(sorted(ova.vmdks)), lease, '127.0.0.1')
+            cpu.append(time.process_time() - cpu_started)
+            seconds.append(time.time() - started)
+        finally:
+            ova.close()
+    took = sum(seconds) / repeat
+    cpu_per_gb = (sum(cpu) / repeat) / (total_bytes / 1024 ** 3)
+    mb_per_second = total_bytes / 1024 ** 2 / took
+    print('{:>24} {:>10.1f} {:>10.2f} {:>16.2f}'.format(name, mb_per_second, took, cpu_per_gb))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--disks', type=int, default=4, help='Disks in the OVA')
+    parser.add_argument('--disk-mb', type=int, default=256, help='Size of each disk')
+    parser.add_argument('--parallel', type=int, default=const.VLAB_CLARITYNOW_UPLOAD_PARALLEL, help='Disks to upload at once')
+    parser.add_argument('--repeat', type=int, default=3, help='Deploys to average over')
+    parser.add_argument('--tls', action='store_true', help='Upload over HTTPS')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    server = None
+    try:
+        cert_file = None
+        if args.tls:
+            cert_file = os.path.join(work_dir, 'server.pem')
+            _write_cert(cert_file)
+        port_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_serve, args=(port_queue, cert_file), daemon=True)
+        server.start()
+        base_url = '{}://127.0.0.1:{}'.format('https' if args.tls else 'http', port_queue.get(timeout=10))
+
+        ova_path = os.path.join(work_dir, 'ClarityNow-bench.ova')
+        _make_ova(ova_path, args.disks, args.disk_mb, work_dir)
+        total_bytes = args.disks * args.disk_mb * 1024 * 1024
+        print('{} disks of {} MB, over {}'.format(args.disks, args.disk_mb, base_url.split(':')[0]))
+        print('{:>24} {:>10} {:>10} {:>16}'.format('uploader', 'MB/s', 'seconds', 'CPU seconds/GB'))
+        run('vlab_inf_common.Ova', Ova, ova_path, base_url, total_bytes, args.repeat)
+        bench_const = const._replace(VLAB_CLARITYNOW_UPLOAD_PARALLEL=1)
+        with patch.object(ova_cache, 'const', bench_const):
+            run('CachedOva, 1 at a time', ova_cache.open_ova, ova_path, base_url, total_bytes, args.repeat)
+        bench_const = const._replace(VLAB_CLARITYNOW_UPLOAD_PARALLEL=args.parallel)
+        with patch.object(ova_cache, 'const', bench_const):
+            run('CachedOva, {} at a time'.format(args.parallel), ova_cache.open_ova, ova_path, base_url, total_bytes, args.repeat)
+    finally:
+        if server is not None:
+            server.terminate()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
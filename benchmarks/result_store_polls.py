@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+"""
+How many ``GET /api/2/inf/claritynow/task/<id>`` polls per second one API
+process can answer, for each result store.
+
+Usage::
+
+    python benchmarks/result_store_polls.py [--seconds 5] [--results 10000]
+
+Only stores that work without any other services (the SQLite store, and
+optionally a running redis via --redis-url) are measured. ``rpc://`` is not,
+because only the process that sent a task can ever read its result.
+"""
+import os
+import time
+import random
+import logging
+import shutil
+import argparse
+import tempfile
+
+import ujson
+from flask import Flask
+from celery import Celery
+from vlab_api_common.http_auth import generate_v2_test_token
+
+from vlab_claritynow_api.lib.result_store import backend_url
+from vlab_claritynow_api.lib.views import ClarityNowView
+
+
+def make_client(url):
+    """Make a test client for an API process that uses the supplied result store"""
+    app = Flask(__name__)
+    app.celery_app = Celery('claritynow', backend=backend_url(url), broker='memory://')
+    app.celery_app.conf.result_expires = 3600
+    ClarityNowView.register(app)
+    return app, app.test_client()
+
+
+def run(url, seconds, results):
+    """Store some results, then poll random ones as quickly as possible"""
+    app, client = make_client(url)
+    task_ids = []
+    for idx in range(results):
+        task_id = 'bench-{}'.format(idx)
+        app.celery_app.backend.store_result(task_id, {'content': {}, 'error': None, 'params': {}}, 'SUCCESS')
+        task_ids.append(task_id)
+    headers = {'X-Auth': generate_v2_test_token(username='bob')}
+    polls = 0
+    started = time.time()
+    while time.time() - started < seconds:
+        resp = client.get('/api/2/inf/claritynow/task/{}'.format(random.choice(task_ids)), headers=headers)
+        assert resp.status_code == 200, resp.data
+        polls += 1
+    polls_per_second = polls / (time.time() - started)
+    # The store by itself, without Flask and token checks
+    lookups = 0
+    started = time.time()
+    while time.time() - started < seconds:
+        app.celery_app.backend.get_task_meta(random.choice(task_ids))
+        lookups += 1
+    return polls_per_second, lookups / (time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--results', type=int, default=10000)
+    parser.add_argument('--redis-url', default=None)
+    args = parser.parse_args()
+    # Otherwise every poll is written to the access log
+    logging.disable(logging.CRITICAL)
+
+    tmp_dir = tempfile.mkdtemp()
+    stores = {'sqlite': 'sqlite://{}'.format(os.path.join(tmp_dir, 'results.db'))}
+    if args.redis_url:
+        stores['redis'] = args.redis_url
+    report = {'results_stored': args.results, 'polls_per_second': {}, 'store_lookups_per_second': {}}
+    try:
+        for name, url in stores.items():
+            polls, lookups = run(url, args.seconds, args.results)
+            report['polls_per_second'][name] = round(polls, 1)
+            report['store_lookups_per_second'][name] = round(lookups, 1)
+    finally:
+        shutil.rmtree(tmp_dir)
+    print(ujson.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+# -*- coding: UTF-8 -*-
+"""
+How long the worker takes to show, create, delete and change the network of
+ClarityNow instances, and how many round trips to vCenter that costs, as the
+number of VMs in the user's folder grows.
+
+Usage::
+
+    python benchmarks/worker_ops.py [--sizes 1,10,100,500] [--rtt 0.005]
+                                    [--baseline benchmarks/results/worker_ops_baseline.json]
+
+Runs against the simulated vCenter in ``fake_vcenter.py``, so no lab is needed.
+Creates use linked clones of a template that already exists; uploading an OVA
+is not simulated.
+
+The results are saved as JSON (``--output``). Supply ``--baseline`` with an
+older results file to compare against it; the script exits non-zero if any
+operation makes more round trips, or is more than ``--tolerance`` slower.
+Round trip counts don't depend on the speed of the machine running the
+benchmark, so they're the most reliable thing to compare.
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import collections.abc
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import ujson
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from fake_vcenter import FakeVCenter, Latency
+from vlab_claritynow_api.lib import const
+from vlab_claritynow_api.lib.worker import vmware, templates
+
+
+USERNAME = 'bob'
+IMAGE = 'bench'
+OTHER_USER_VMS = 5
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+# vlab_inf_common targets Python 3.6, where this alias still existed
+if not hasattr(collections, 'Iterable'):
+    collections.Iterable = collections.abc.Iterable
+
+
+def _self_signed_cert():
+    """The fake vCenter's TLS cert, for building console URLs"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'fake-vcenter')])
+    now = datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+                                    .public_key(key.public_key()).serial_number(1) \
+                                    .not_valid_before(now).not_valid_after(now + timedelta(hours=1)) \
+                                    .sign(key, hashes.SHA256())
+    return cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+def _meta(component, **extra):
+    meta = {'component': component, 'created': time.time(), 'version': IMAGE,
+            'configured': True, 'generation': 1}
+    meta.update(extra)
+    return ujson.dumps(meta)
+
+
+def build_lab(latency, folder_size, users, images_dir):
+    """Make a simulated vCenter with ``folder_size`` ClarityNow VMs in the benchmark user's folder"""
+    server = FakeVCenter(latency)
+    folder = server.add_folder(USERNAME, networks=('frontend', 'backend'))
+    for idx in range(folder_size):
+        server.add_vm(folder, 'cn-{}'.format(idx), _meta('ClarityNow'), '{}_frontend'.format(USERNAME))
+    for user in range(users):
+        username = 'user{}'.format(user)
+        other_folder = server.add_folder(username)
+        for idx in range(OTHER_USER_VMS):
+            server.add_vm(other_folder, 'cn-{}'.format(idx), _meta('ClarityNow'), '{}_frontend'.format(username))
+    ova_path = os.path.join(images_dir, 'ClarityNow-{}.ova'.format(IMAGE))
+    template_folder = server.add_folder(const.VLAB_CLARITYNOW_TEMPLATE_FOLDER, networks=())
+    server.add_vm(template_folder, templates.template_name(IMAGE),
+                  _meta(templates.TEMPLATE_COMPONENT, **templates.ova_signature(ova_path)),
+                  'VM Network', powered_on=False, snapshot=True)
+    return server
+
+
+def measure(server, calls):
+    """Run each call, and record the wall time and round trips it took
+
+    :Returns: Dictionary
+    """
+    seconds = []
+    round_trips = []
+    by_method = {}
+    for call in calls:
+        server.reset_counts()
+        started = time.time()
+        call()
+        seconds.append(time.time() - started)
+        round_trips.append(sum(server.round_trips.values()))
+        for method, count in server.round_trips.items():
+            by_method[method] = by_method.get(method, 0) + count
+    total = sum(seconds)
+    top = sorted(by_method.items(), key=lambda x: x[1], reverse=True)[:5]
+    return {'calls': len(calls),
+            'seconds_per_call': round(total / len(calls), 4),
+            'round_trips_per_call': round(sum(round_trips) / len(calls), 1),
+            'throughput_per_second': round(len(calls) / total, 3) if total else None,
+            'top_round_trips': {x: round(y / len(calls), 1) for x, y in top},
+           }
+
+
+def run_size(latency, folder_size, args, images_dir, logger):
+    """Benchmark every operation for one folder size"""
+    server = build_lab(latency, folder_size, args.users, images_dir)
+    vcenter = server.connect()
+    results = {}
+    results['show'] = measure(server, [lambda: vmware.show_claritynow(vcenter, USERNAME, logger)] * args.repeat)
+
+    networks = ['{}_backend'.format(USERNAME), '{}_frontend'.format(USERNAME)]
+    results['update_network'] = measure(server, [
+        lambda net=networks[x % 2]: vmware.update_network(vcenter, USERNAME, 'cn-0', net, logger)
+        for x in range(args.repeat)])
+
+    new_names = ['bench-new-{}'.format(x) for x in range(args.creates)]
+    results['create'] = measure(server, [
+        lambda name=x: vmware.create_claritynow(vcenter, USERNAME, name, IMAGE,
+                                                '{}_frontend'.format(USERNAME), logger)
+        for x in new_names])
+    results['delete'] = measure(server, [
+        lambda name=x: vmware.delete_claritynow(vcenter, USERNAME, name, logger)
+        for x in new_names])
+    return results
+
+
+def compare(baseline, current, tolerance):
+    """Print how the current results differ from the baseline
+
+    :Returns: List - the regressions found
+    """
+    regressions = []
+    print('{:>6} {:>15} {:>22} {:>22}'.format('size', 'operation', 'round trips', 'seconds'))
+    for size, operations in current['results'].items():
+        for operation, now in operations.items():
+            before = baseline.get('results', {}).get(size, {}).get(operation)
+            if before is None:
+                continue
+            trips = '{} -> {}'.format(before['round_trips_per_call'], now['round_trips_per_call'])
+            secs = '{:.3f} -> {:.3f}'.format(before['seconds_per_call'], now['seconds_per_call'])
+            flag = ''
+            if now['round_trips_per_call'] > before['round_trips_per_call']:
+                flag = 'REGRESSION'
+            elif now['seconds_per_call'] > before['seconds_per_call'] * (1 + tolerance):
+                flag = 'REGRESSION'
+            if flag:
+                regressions.append((size, operation))
+            print('{:>6} {:>15} {:>22} {:>22} {}'.format(size, operation, trips, secs, flag))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1,10,100,500', help='VMs in the user folder; comma separated')
+    parser.add_argument('--users', type=int, default=20, help='Other users, with {} VMs each'.format(OTHER_USER_VMS))
+    parser.add_argument('--repeat', type=int, default=3, help='Times to run show and update_network')
+    parser.add_argument('--creates', type=int, default=2, help='VMs to create (and then delete)')
+    parser.add_argument('--rtt', type=float, default=0.005, help='Seconds per SOAP round trip')
+    parser.add_argument('--task', type=float, default=0.5, help='Seconds per vCenter task')
+    parser.add_argument('--boot', type=float, default=2.0, help='Seconds from power on until a VM has an IP')
+    parser.add_argument('--guest-op', type=float, default=0.5, help='Seconds for a command in a VM to exit')
+    parser.add_argument('--output', default=None, help='Where to save the results')
+    parser.add_argument('--baseline', default=None, help='Older results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown vs. the baseline')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+
+    latency = Latency(rtt=args.rtt, task=args.task, boot=args.boot, guest_op=args.guest_op)
+    cert = _self_signed_cert()
+    def get_server_certificate(addr, *a, **kw):
+        # A TLS handshake with vCenter is at least one round trip
+        time.sleep(latency.rtt)
+        return cert
+
+    images_dir = tempfile.mkdtemp()
+    with open(os.path.join(images_dir, 'ClarityNow-{}.ova'.format(IMAGE)), 'w') as the_file:
+        the_file.write('not really an OVA')
+    bench_const = const._replace(VLAB_CLARITYNOW_IMAGES_DIR=images_dir,
+                                 VLAB_CLARITYNOW_PROVISION_MODE='linked_clone')
+    report = {'created': datetime.utcnow().isoformat(),
+              'commit': _git_commit(),
+              'latency': latency.as_dict(),
+              'users': args.users,
+              'results': {}}
+    try:
+        with patch('ssl.get_server_certificate', get_server_certificate), \
+             patch.object(vmware, 'const', bench_const), \
+             patch.object(templates, 'const', bench_const):
+            for size in [int(x) for x in args.sizes.split(',')]:
+                started = time.time()
+                report['results'][str(size)] = run_size(latency, size, args, images_dir, logger)
+                print('folder size {}: done in {:.1f}s'.format(size, time.time() - started), file=sys.stderr)
+    finally:
+        shutil.rmtree(images_dir)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, 'worker_ops-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as the_file:
+        the_file.write(ujson.dumps(report, indent=2))
+    print('Results saved to {}'.format(output), file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as the_file:
+            baseline = ujson.load(the_file)
+        if compare(baseline, report, args.tolerance):
+            sys.exit(1)
+    else:
+        print(ujson.dumps(report['results'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
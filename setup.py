@@ -3,13 +3,19 @@
 """
 claritynow RESTful API
 """
+import re
+import os.path
+
 from setuptools import setup, find_packages
 
 
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vlab_claritynow_api', '__init__.py')) as the_file:
+    VERSION = re.search(r"__version__ = '(.+)'", the_file.read()).group(1)
+
 setup(name="vlab-claritynow-api",
       author="Nicholas Willhite,",
       author_email='willnx84@gmail.com',
-      version='2019.06.25',
+      version=VERSION,
       packages=find_packages(),
       include_package_data=True,
       package_files={'vlab_claritynow_api' : ['app.ini']},
@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in admission.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_claritynow_api.lib import admission, queues
+
+
+class TestTokenBucket(unittest.TestCase):
+    """A set of test cases for the ``TokenBucket`` object"""
+
+    def test_burst(self):
+        """``TokenBucket`` allows up to ``burst`` tokens at once"""
+        bucket = admission.TokenBucket(rate=1, burst=3, now=0)
+
+        waits = [bucket.take(1, now=0) for _ in range(4)]
+
+        self.assertEqual(waits, [0, 0, 0, 1])
+
+    def test_refills(self):
+        """``TokenBucket`` gets tokens back over time"""
+        bucket = admission.TokenBucket(rate=0.5, burst=1, now=0)
+        bucket.take(1, now=0)
+
+        self.assertEqual(bucket.take(1, now=1), 1)
+        self.assertEqual(bucket.take(1, now=2), 0)
+
+    def test_cost(self):
+        """``TokenBucket`` takes as many tokens as it's asked to"""
+        bucket = admission.TokenBucket(rate=1, burst=3, now=0)
+
+        self.assertEqual(bucket.take(3, now=0), 0)
+        self.assertEqual(bucket.take(2, now=0), 2)
+
+
+class TestRateLimits(unittest.TestCase):
+    """A set of test cases for the ``RateLimits`` object"""
+
+    def test_rejects(self):
+        """``RateLimits`` raises Rejected once a user runs out of tokens"""
+        limits = admission.RateLimits({'create': (6, 1)})
+        limits.admit('bob', 'create')
+
+        with self.assertRaises(admission.Rejected) as the_error:
+            limits.admit('bob', 'create')
+
+        self.assertEqual(the_error.exception.retry_after, 10)
+
+    def test_per_user(self):
+        """``RateLimits`` keeps a bucket for every user"""
+        limits = admission.RateLimits({'create': (6, 1)})
+
+        limits.admit('bob', 'create')
+        limits.admit('alice', 'create')
+
+    def test_per_operation(self):
+        """``RateLimits`` keeps a bucket for every operation"""
+        limits = admission.RateLimits({'create': (6, 1), 'delete': (6, 1)})
+
+        limits.admit('bob', 'create')
+        limits.admit('bob', 'delete')
+
+    def test_too_large(self):
+        """``RateLimits`` raises TooLarge for more machines than a full bucket holds"""
+        limits = admission.RateLimits({'create': (6, 3)})
+
+        with self.assertRaises(admission.TooLarge):
+            limits.admit('bob', 'create', 4)
+
+    def test_too_large_costs_nothing(self):
+        """``RateLimits`` takes no tokens for a request that's too large"""
+        limits = admission.RateLimits({'create': (6, 3)})
+        try:
+            limits.admit('bob', 'create', 4)
+        except admission.TooLarge:
+            pass
+
+        limits.admit('bob', 'create', 3)
+
+    def test_full_bucket(self):
+        """``RateLimits`` takes a full bucket when the cost is None"""
+        limits = admission.RateLimits({'delete': (6, 3)})
+        limits.admit('bob', 'delete', None)
+
+        with self.assertRaises(admission.Rejected):
+            limits.admit('bob', 'delete')
+
+    def test_unlimited(self):
+        """``RateLimits`` does not limit operations with a rate of zero"""
+        limits = admission.RateLimits({'create': (0, 1)})
+
+        for _ in range(10):
+            limits.admit('bob', 'create')
+
+    def test_counts_rejections(self):
+        """``RateLimits`` counts every request it turns away"""
+        limits = admission.RateLimits({'testing': (6, 1)})
+        limits.admit('bob', 'testing')
+        before = admission.REJECTIONS.value(operation='testing', reason='rate_limit')
+
+        with self.assertRaises(admission.Rejected):
+            limits.admit('bob', 'testing')
+
+        after = admission.REJECTIONS.value(operation='testing', reason='rate_limit')
+        self.assertEqual(after - before, 1)
+
+    @patch.object(admission.time, 'monotonic')
+    def test_prunes(self, fake_monotonic):
+        """``RateLimits`` forgets the buckets of users that have been idle"""
+        fake_monotonic.side_effect = [0, 100]
+        limits = admission.RateLimits({'create': (6, 1)})
+
+        limits.admit('bob', 'create')
+        limits.admit('alice', 'create')
+
+        self.assertEqual(list(limits._buckets.keys()), [('alice', 'create')])
+
+
+class TestBackpressure(unittest.TestCase):
+    """A set of test cases for the ``Backpressure`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.backpressure = admission.Backpressure(MagicMock(), max_depth=10, interval=15, logger=MagicMock())
+
+    @patch.object(admission.queues, 'sample_depths')
+    def test_rejects(self, fake_sample_depths):
+        """``Backpressure`` raises Rejected while the slow queue is too deep"""
+        fake_sample_depths.return_value = {queues.SLOW_QUEUE: 10, queues.FAST_QUEUE: 0}
+        self.backpressure.sample()
+
+        with self.assertRaises(admission.Rejected) as the_error:
+            self.backpressure.admit('create')
+
+        self.assertEqual(the_error.exception.retry_after, 15)
+
+    @patch.object(admission.queues, 'sample_depths')
+    def test_admits(self, fake_sample_depths):
+        """``Backpressure`` admits requests while the slow queue is short"""
+        fake_sample_depths.return_value = {queues.SLOW_QUEUE: 9, queues.FAST_QUEUE: 100}
+        self.backpressure.sample()
+
+        self.backpressure.admit('create')
+
+    def test_no_sample(self):
+        """``Backpressure`` admits requests before the queue has been sampled"""
+        self.backpressure.admit('create')
+
+    @patch.object(admission.time, 'time')
+    @patch.object(admission.queues, 'sample_depths')
+    def test_stale(self, fake_sample_depths, fake_time):
+        """``Backpressure`` admits requests when the last sample is too old to trust"""
+        fake_sample_depths.return_value = {queues.SLOW_QUEUE: 100}
+        fake_time.side_effect = [100, 146]
+        self.backpressure.sample()
+
+        self.backpressure.admit('create')
+
+    @patch.object(admission.queues, 'sample_depths')
+    def test_disabled(self, fake_sample_depths):
+        """``Backpressure`` admits every request when the max depth is zero"""
+        fake_sample_depths.return_value = {queues.SLOW_QUEUE: 100}
+        self.backpressure.max_depth = 0
+        self.backpressure.sample()
+
+        self.backpressure.admit('create')
+
+    @patch.object(admission.queues, 'sample_depths')
+    def test_gauge(self, fake_sample_depths):
+        """``Backpressure`` reports if it's turning requests away"""
+        fake_sample_depths.return_value = {queues.SLOW_QUEUE: 100}
+        self.backpressure.sample()
+
+        self.assertEqual(admission.BACKPRESSURE.value(), 1)
+
+    @patch.object(admission.queues, 'sample_depths')
+    def test_start(self, fake_sample_depths):
+        """``Backpressure`` samples the queue from a background thread"""
+        fake_sample_depths.return_value = {queues.SLOW_QUEUE: 100}
+        self.backpressure.interval = 0.01
+        try:
+            sampler = self.backpressure.start()
+            for _ in range(100):
+                if fake_sample_depths.called:
+                    break
+                sampler.join(0.01)
+        finally:
+            self.backpressure.stop()
+        sampler.join(1)
+
+        self.assertTrue(fake_sample_depths.called)
+        self.assertFalse(sampler.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -52,6 +52,36 @@ class TestClarityNowViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_batch_post_schema(self):
+        """The schema defined for POST on /batch is valid"""
+        try:
+            Draft4Validator.check_schema(claritynow.ClarityNowView.BATCH_POST_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_batch_delete_schema(self):
+        """The schema defined for DELETE on /batch is valid"""
+        try:
+            Draft4Validator.check_schema(claritynow.ClarityNowView.BATCH_DELETE_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_inventory_args(self):
+        """The schema defined for GET on /inventory is valid"""
+        try:
+            Draft4Validator.check_schema(claritynow.ClarityNowView.INVENTORY_ARGS)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -11,7 +11,9 @@ from vlab_api_common import flask_common
 from vlab_api_common.http_auth import generate_v2_test_token
 
 
+from vlab_claritynow_api.lib import admission
 from vlab_claritynow_api.lib.views import claritynow
+from vlab_claritynow_api.lib.views import metrics as metrics_view
 
 
 class TestClarityNowView(unittest.TestCase):
@@ -33,6 +35,7 @@ class TestClarityNowView(unittest.TestCase):
         cls.fake_task = MagicMock()
         cls.fake_task.id = 'asdf-asdf-asdf'
         app.celery_app.send_task.return_value = cls.fake_task
+        claritynow.RATE_LIMITS.clear()
 
     def test_v1_deprecated(self):
         """ClarityNowView - GET on /api/1/inf/claritynow returns an HTTP 404"""
@@ -64,6 +67,60 @@ class TestClarityNowView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_get_coalesced(self):
+        """ClarityNowView - GET on /api/2/inf/claritynow only sends one task for a burst of requests"""
+        claritynow.SHOW_REQUESTS.forget('bob')
+        self.fake_task.ready.return_value = False
+        self.addCleanup(self.fake_task.ready.reset_mock, return_value=True)
+        self.app.get('/api/2/inf/claritynow', headers={'X-Auth': self.token})
+        self.app.get('/api/2/inf/claritynow', headers={'X-Auth': self.token})
+
+        call_count = self.app.application.celery_app.send_task.call_count
+
+        self.assertEqual(call_count, 1)
+
+    def test_get_after_post(self):
+        """ClarityNowView - GET on /api/2/inf/claritynow sends a new task after the user creates a ClarityNow"""
+        claritynow.SHOW_REQUESTS.forget('bob')
+        self.app.get('/api/2/inf/claritynow', headers={'X-Auth': self.token})
+        self.app.post('/api/2/inf/claritynow',
+                      headers={'X-Auth': self.token},
+                      json={'network': "someLAN",
+                            'name': "myClarityNowBox",
+                            'image': "someVersion"})
+        self.app.get('/api/2/inf/claritynow', headers={'X-Auth': self.token})
+
+        call_count = self.app.application.celery_app.send_task.call_count
+
+        self.assertEqual(call_count, 3)
+
+    def test_get_after_modify_network(self):
+        """ClarityNowView - GET on /api/2/inf/claritynow sends a new task after the user changes a network"""
+        claritynow.SHOW_REQUESTS.forget('bob')
+        self.app.get('/api/2/inf/claritynow', headers={'X-Auth': self.token})
+        resp = self.app.put('/api/2/inf/claritynow/network',
+                            headers={'X-Auth': self.token},
+                            json={'name': "myClarityNowBox",
+                                  'new_network': "otherLAN"})
+        self.app.get('/api/2/inf/claritynow', headers={'X-Auth': self.token})
+
+        call_count = self.app.application.celery_app.send_task.call_count
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(call_count, 3)
+
+    def test_modify_network_args(self):
+        """ClarityNowView - PUT on the ./network end point sends the user's network to the task"""
+        self.app.put('/api/2/inf/claritynow/network',
+                     headers={'X-Auth': self.token},
+                     json={'name': "myClarityNowBox",
+                           'new_network': "otherLAN"})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('claritynow.modify_network', ['bob', 'myClarityNowBox', 'bob_otherLAN', 'noId'])
+
+        self.assertEqual(the_args, expected)
+
     def test_post_task(self):
         """ClarityNowView - POST on /api/2/inf/claritynow returns a task-id"""
         resp = self.app.post('/api/2/inf/claritynow',
@@ -90,6 +147,203 @@ class TestClarityNowView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_post_retry(self):
+        """ClarityNowView - POST with the same X-REQUEST-ID and body returns the original task-id"""
+        body = {'network': "someLAN", 'name': "myClarityNowBox", 'image': "someVersion"}
+        headers = {'X-Auth': self.token, 'X-REQUEST-ID': 'test_post_retry'}
+        first = self.app.post('/api/2/inf/claritynow', headers=headers, json=body)
+        self.fake_task.id = 'new-task'
+        second = self.app.post('/api/2/inf/claritynow', headers=headers, json=body)
+
+        self.assertEqual(first.json['content']['task-id'], second.json['content']['task-id'])
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+
+    def test_post_retry_other_body(self):
+        """ClarityNowView - POST reusing an X-REQUEST-ID for a different body returns an HTTP 409"""
+        headers = {'X-Auth': self.token, 'X-REQUEST-ID': 'test_post_retry_other_body'}
+        self.app.post('/api/2/inf/claritynow', headers=headers,
+                      json={'network': "someLAN", 'name': "box1", 'image': "someVersion"})
+        resp = self.app.post('/api/2/inf/claritynow', headers=headers,
+                             json={'network': "someLAN", 'name': "box2", 'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
+    def test_post_no_request_id(self):
+        """ClarityNowView - POST without an X-REQUEST-ID always sends a new task"""
+        body = {'network': "someLAN", 'name': "myClarityNowBox", 'image': "someVersion"}
+        self.app.post('/api/2/inf/claritynow', headers={'X-Auth': self.token}, json=body)
+        resp = self.app.post('/api/2/inf/claritynow', headers={'X-Auth': self.token}, json=body)
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 2)
+        self.assertFalse('Idempotent-Replayed' in resp.headers)
+
+    def test_batch_create_retry(self):
+        """ClarityNowView - POST on the ./batch end point with the same X-REQUEST-ID and body sends one task"""
+        body = {'network': "someLAN", 'names': ["box1", "box2"], 'image': "someVersion"}
+        headers = {'X-Auth': self.token, 'X-REQUEST-ID': 'test_batch_create_retry'}
+        self.app.post('/api/2/inf/claritynow/batch', headers=headers, json=body)
+        resp = self.app.post('/api/2/inf/claritynow/batch', headers=headers, json=body)
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
+    @patch.object(claritynow, 'RATE_LIMITS', admission.RateLimits({'create': (1, 1)}))
+    def test_post_rate_limit(self):
+        """ClarityNowView - POST returns an HTTP 429 with Retry-After once a user runs out of tokens"""
+        body = {'network': "someLAN", 'name': "myClarityNowBox", 'image': "someVersion"}
+        self.app.post('/api/2/inf/claritynow', headers={'X-Auth': self.token}, json=body)
+        resp = self.app.post('/api/2/inf/claritynow', headers={'X-Auth': self.token}, json=body)
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '60')
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
+    @patch.object(claritynow, 'RATE_LIMITS', admission.RateLimits({'create': (1, 1)}))
+    def test_post_retry_not_limited(self):
+        """ClarityNowView - POST retried with the same X-REQUEST-ID costs no tokens"""
+        body = {'network': "someLAN", 'name': "myClarityNowBox", 'image': "someVersion"}
+        headers = {'X-Auth': self.token, 'X-REQUEST-ID': 'test_post_retry_not_limited'}
+        self.app.post('/api/2/inf/claritynow', headers=headers, json=body)
+        resp = self.app.post('/api/2/inf/claritynow', headers=headers, json=body)
+
+        self.assertEqual(resp.status_code, 202)
+
+    def test_post_backpressure(self):
+        """ClarityNowView - POST returns an HTTP 429 while the slow queue is too deep"""
+        self.app.application.backpressure = MagicMock()
+        self.app.application.backpressure.admit.side_effect = admission.Rejected('testing', 15)
+        resp = self.app.post('/api/2/inf/claritynow',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'name': "myClarityNowBox",
+                                   'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '15')
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(claritynow, 'RATE_LIMITS', admission.RateLimits({'create': (1, 5)}))
+    def test_batch_create_cost(self):
+        """ClarityNowView - POST on the ./batch end point takes a token for every instance"""
+        self.app.post('/api/2/inf/claritynow/batch',
+                      headers={'X-Auth': self.token},
+                      json={'network': "someLAN",
+                            'names': ["box1", "box2", "box3"],
+                            'image': "someVersion"})
+        resp = self.app.post('/api/2/inf/claritynow/batch',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'names': ["box4", "box5", "box6"],
+                                   'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 429)
+
+    @patch.object(claritynow, 'RATE_LIMITS', admission.RateLimits({'create': (1, 2)}))
+    def test_batch_create_too_large(self):
+        """ClarityNowView - POST on the ./batch end point returns an HTTP 400 for more instances than the burst"""
+        resp = self.app.post('/api/2/inf/claritynow/batch',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'names': ["box1", "box2", "box3"],
+                                   'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(claritynow, 'RATE_LIMITS', admission.RateLimits({'delete': (1, 2)}))
+    def test_batch_delete_too_large(self):
+        """ClarityNowView - DELETE on the ./batch end point returns an HTTP 400 for more instances than the burst"""
+        resp = self.app.delete('/api/2/inf/claritynow/batch',
+                               headers={'X-Auth': self.token},
+                               json={'names': ["box1", "box2", "box3"]})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(claritynow, 'RATE_LIMITS', admission.RateLimits({'delete': (1, 2)}))
+    def test_batch_delete_all_cost(self):
+        """ClarityNowView - DELETE on the ./batch end point takes a full bucket to delete every instance"""
+        self.app.delete('/api/2/inf/claritynow/batch', headers={'X-Auth': self.token}, json={'all': True})
+        resp = self.app.delete('/api/2/inf/claritynow', headers={'X-Auth': self.token}, json={'name': "box1"})
+
+        self.assertEqual(resp.status_code, 429)
+
+    @patch.object(claritynow, 'RATE_LIMITS', admission.RateLimits({'delete': (1, 1)}))
+    def test_delete_rate_limit(self):
+        """ClarityNowView - DELETE returns an HTTP 429 once a user runs out of tokens"""
+        self.app.delete('/api/2/inf/claritynow', headers={'X-Auth': self.token}, json={'name': "box1"})
+        resp = self.app.delete('/api/2/inf/claritynow', headers={'X-Auth': self.token}, json={'name': "box2"})
+
+        self.assertEqual(resp.status_code, 429)
+
+    def test_batch_create(self):
+        """ClarityNowView - POST on the ./batch end point returns one task-id for every instance"""
+        resp = self.app.post('/api/2/inf/claritynow/batch',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'names': ["box1", "box2"],
+                                   'image': "someVersion"})
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+
+    def test_batch_create_args(self):
+        """ClarityNowView - POST on the ./batch end point sends every name to a single task"""
+        self.app.post('/api/2/inf/claritynow/batch',
+                      headers={'X-Auth': self.token},
+                      json={'network': "someLAN",
+                            'names': ["box1", "box2"],
+                            'image': "someVersion"})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('claritynow.create_batch', ['bob', ['box1', 'box2'], 'someVersion', 'bob_someLAN', 'noId'])
+
+        self.assertEqual(the_args, expected)
+
+    def test_batch_create_duplicate_names(self):
+        """ClarityNowView - POST on the ./batch end point returns 400 if a name is supplied twice"""
+        resp = self.app.post('/api/2/inf/claritynow/batch',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'names': ["box1", "box1"],
+                                   'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_batch_delete(self):
+        """ClarityNowView - DELETE on the ./batch end point sends every name to a single task"""
+        self.app.delete('/api/2/inf/claritynow/batch',
+                        headers={'X-Auth': self.token},
+                        json={'names': ["box1", "box2"]})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('claritynow.delete_batch', ['bob', ['box1', 'box2'], 'noId'])
+
+        self.assertEqual(the_args, expected)
+
+    def test_batch_delete_all(self):
+        """ClarityNowView - DELETE on the ./batch end point with all=true deletes every ClarityNow the user owns"""
+        self.app.delete('/api/2/inf/claritynow/batch',
+                        headers={'X-Auth': self.token},
+                        json={'all': True})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('claritynow.delete_batch', ['bob', None, 'noId'])
+
+        self.assertEqual(the_args, expected)
+
+    def test_batch_delete_ambiguous(self):
+        """ClarityNowView - DELETE on the ./batch end point returns 400 when given both names and all"""
+        resp = self.app.delete('/api/2/inf/claritynow/batch',
+                               headers={'X-Auth': self.token},
+                               json={'all': True, 'names': ['box1']})
+
+        self.assertEqual(resp.status_code, 400)
+
     def test_delete_task(self):
         """ClarityNowView - DELETE on /api/2/inf/claritynow returns a task-id"""
         resp = self.app.delete('/api/2/inf/claritynow',
@@ -112,8 +366,10 @@ class TestClarityNowView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
-    def test_image(self):
+    @patch.object(claritynow.IMAGE_CATALOG, 'refresh')
+    def test_image(self, fake_refresh):
         """ClarityNowView - GET on the ./image end point returns the a task-id"""
+        fake_refresh.side_effect = FileNotFoundError('testing')
         resp = self.app.get('/api/2/inf/claritynow/image',
                             headers={'X-Auth': self.token})
 
@@ -122,8 +378,10 @@ class TestClarityNowView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
-    def test_image(self):
+    @patch.object(claritynow.IMAGE_CATALOG, 'refresh')
+    def test_image_link(self, fake_refresh):
         """ClarityNowView - GET on the ./image end point sets the Link header"""
+        fake_refresh.side_effect = FileNotFoundError('testing')
         resp = self.app.get('/api/2/inf/claritynow/image',
                             headers={'X-Auth': self.token})
 
@@ -132,6 +390,223 @@ class TestClarityNowView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    @patch.object(claritynow, 'IMAGE_CATALOG')
+    def test_image_local(self, fake_IMAGE_CATALOG):
+        """ClarityNowView - GET on the ./image end point answers directly when the images are mounted"""
+        fake_IMAGE_CATALOG.images = ['2.11.0']
+        fake_IMAGE_CATALOG.details = {'2.11.0': {'file': 'ClarityNow-2.11.0.ova', 'size': 4, 'mtime': 1}}
+        fake_IMAGE_CATALOG.etag = 'abc'
+        resp = self.app.get('/api/2/inf/claritynow/image',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content']['image'], ['2.11.0'])
+        self.assertEqual(resp.headers['ETag'], '"abc"')
+
+    @patch.object(claritynow, 'IMAGE_CATALOG')
+    def test_image_not_modified(self, fake_IMAGE_CATALOG):
+        """ClarityNowView - GET on the ./image end point honors If-None-Match"""
+        fake_IMAGE_CATALOG.etag = 'abc'
+        resp = self.app.get('/api/2/inf/claritynow/image',
+                            headers={'X-Auth': self.token, 'If-None-Match': '"abc"'})
+
+        self.assertEqual(resp.status_code, 304)
+
+    def _task_result(self, status, result=None):
+        """Make the Celery result the ./task end point looks up"""
+        fake_result = MagicMock()
+        fake_result.status = status
+        fake_result.result = result
+        self.app.application.celery_app.AsyncResult.return_value = fake_result
+
+    def test_task_etag(self):
+        """ClarityNowView - GET on the ./task end point sends the tag of the result as the ETag"""
+        self._task_result('SUCCESS', {'content': {'myBox': {}}, 'error': None, 'params': {}, 'etag': 'abc'})
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'myBox': {}})
+        self.assertEqual(resp.headers['ETag'], 'W/"abc"')
+
+    def test_task_etag_not_in_body(self):
+        """ClarityNowView - GET on the ./task end point does not send the tag in the body"""
+        self._task_result('SUCCESS', {'content': {'myBox': {}}, 'error': None, 'params': {}, 'etag': 'abc'})
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertTrue('etag' not in resp.json)
+
+    def test_task_not_modified(self):
+        """ClarityNowView - GET on the ./task end point honors If-None-Match"""
+        self._task_result('SUCCESS', {'content': {'myBox': {}}, 'error': None, 'params': {}, 'etag': 'abc'})
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token, 'If-None-Match': '"abc"'})
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+    def test_task_not_modified_weak(self):
+        """ClarityNowView - GET on the ./task end point honors If-None-Match with a weak ETag"""
+        self._task_result('SUCCESS', {'content': {'myBox': {}}, 'error': None, 'params': {}, 'etag': 'abc'})
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token, 'If-None-Match': 'W/"abc"'})
+
+        self.assertEqual(resp.status_code, 304)
+
+    @patch.object(claritynow.ujson, 'dumps')
+    def test_task_not_modified_no_dumps(self, fake_dumps):
+        """ClarityNowView - GET on the ./task end point does not serialize a result the client already has"""
+        self._task_result('SUCCESS', {'content': {'myBox': {}}, 'error': None, 'params': {}, 'etag': 'abc'})
+        self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                     headers={'X-Auth': self.token, 'If-None-Match': '"abc"'})
+
+        fake_dumps.assert_not_called()
+
+    def test_task_etag_untagged(self):
+        """ClarityNowView - GET on the ./task end point makes an ETag for results without a tag"""
+        self._task_result('SUCCESS', {'content': {'myBox': {}}, 'error': None, 'params': {}})
+        first = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                             headers={'X-Auth': self.token})
+        second = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                              headers={'X-Auth': self.token, 'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(second.status_code, 304)
+        self.assertFalse(first.headers['ETag'].startswith('W/'))
+
+    def test_task_pending(self):
+        """ClarityNowView - GET on the ./task end point returns HTTP 202 while the task is running"""
+        self._task_result('PENDING')
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue('ETag' not in resp.headers)
+
+    def test_task_error(self):
+        """ClarityNowView - GET on the ./task end point returns HTTP 400 when the task had bad input"""
+        self._task_result('SUCCESS', {'content': {}, 'error': 'testing', 'params': {}})
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json['error'], 'testing')
+
+    def test_task_failure(self):
+        """ClarityNowView - GET on the ./task end point returns HTTP 500 when the task blew up"""
+        self._task_result('FAILURE', RuntimeError('testing'))
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 500)
+
+    def test_task_both_ids(self):
+        """ClarityNowView - GET on the ./task end point returns HTTP 400 if the task id is in the URL and params"""
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf?task-id=asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_inventory(self):
+        """ClarityNowView - GET on the ./inventory end point returns a task-id for admins"""
+        claritynow.const.VLAB_CLARITYNOW_ADMINS.append('bob')
+        try:
+            resp = self.app.get('/api/2/inf/claritynow/inventory',
+                                headers={'X-Auth': self.token})
+        finally:
+            claritynow.const.VLAB_CLARITYNOW_ADMINS.remove('bob')
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+
+    def test_inventory_args(self):
+        """ClarityNowView - GET on the ./inventory end point sends the cursor and page size to the task"""
+        claritynow.const.VLAB_CLARITYNOW_ADMINS.append('bob')
+        try:
+            self.app.get('/api/2/inf/claritynow/inventory?cursor=vm-20&per_page=10',
+                         headers={'X-Auth': self.token})
+        finally:
+            claritynow.const.VLAB_CLARITYNOW_ADMINS.remove('bob')
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        sent = the_args[1][:2]
+        expected = ['vm-20', 10]
+
+        self.assertEqual(sent, expected)
+
+    def test_inventory_bad_args(self):
+        """ClarityNowView - GET on the ./inventory end point returns 400 for an invalid page size"""
+        claritynow.const.VLAB_CLARITYNOW_ADMINS.append('bob')
+        try:
+            resp = self.app.get('/api/2/inf/claritynow/inventory?per_page=0',
+                                headers={'X-Auth': self.token})
+        finally:
+            claritynow.const.VLAB_CLARITYNOW_ADMINS.remove('bob')
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_inventory_not_admin(self):
+        """ClarityNowView - GET on the ./inventory end point returns 403 for non-admins"""
+        resp = self.app.get('/api/2/inf/claritynow/inventory',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 403)
+
+    @patch.object(claritynow, 'STREAMS')
+    @patch.object(claritynow.progress.time, 'sleep')
+    def test_stream_task(self, fake_sleep, fake_streams):
+        """ClarityNowView - GET on /api/2/inf/claritynow/task/<id>/stream sends the progress as Server-Sent Events"""
+        fake_result = self.app.application.celery_app.AsyncResult.return_value
+        fake_result.backend.get_task_meta.side_effect = [{'status': 'PROGRESS', 'result': {'machines': {}}},
+                                                         {'status': 'SUCCESS', 'result': {'content': {}, 'error': None, 'params': {}}}]
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf/stream',
+                            headers={'X-Auth': self.token})
+
+        body = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertTrue('event: progress\n' in body)
+        self.assertTrue(body.endswith('event: result\ndata: {"status":"SUCCESS","content":{},"error":null,"params":{}}\n\n'))
+
+    @patch.object(claritynow, 'STREAMS')
+    @patch.object(claritynow.progress.time, 'sleep')
+    def test_stream_task_release(self, fake_sleep, fake_streams):
+        """ClarityNowView - A stream gives back its slot once the response is closed"""
+        fake_result = self.app.application.celery_app.AsyncResult.return_value
+        fake_result.backend.get_task_meta.return_value = {'status': 'SUCCESS', 'result': {}}
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf/stream',
+                            headers={'X-Auth': self.token})
+        resp.close()
+
+        self.assertTrue(fake_streams.release.called)
+
+    @patch.object(claritynow, 'STREAMS')
+    @patch.object(claritynow.progress.time, 'sleep')
+    def test_stream_task_timed(self, fake_sleep, fake_streams):
+        """ClarityNowView - Streamed responses are observed in claritynow_http_request_seconds"""
+        labels = {'view': 'ClarityNowView', 'endpoint': 'stream_task', 'method': 'GET', 'status': '200'}
+        before = metrics_view.REQUEST_SECONDS.value(**labels)['count']
+        fake_result = self.app.application.celery_app.AsyncResult.return_value
+        fake_result.backend.get_task_meta.return_value = {'status': 'SUCCESS', 'result': {}}
+        resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf/stream',
+                            headers={'X-Auth': self.token})
+        resp.close()
+        after = metrics_view.REQUEST_SECONDS.value(**labels)['count']
+
+        self.assertEqual(after - before, 1)
+
+    def test_stream_task_busy(self):
+        """ClarityNowView - GET on /api/2/inf/claritynow/task/<id>/stream returns HTTP 503 when every stream is in use"""
+        with patch.object(claritynow, 'STREAMS') as fake_streams:
+            fake_streams.acquire.return_value = False
+            resp = self.app.get('/api/2/inf/claritynow/task/asdf-asdf-asdf/stream',
+                                headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertTrue('Retry-After' in resp.headers)
+
 
 if __name__ == '__main__':
     unittest.main()
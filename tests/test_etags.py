@@ -0,0 +1,46 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in etags.py
+"""
+import unittest
+
+from vlab_claritynow_api.lib import etags
+
+
+class TestEtags(unittest.TestCase):
+    """A set of test cases for the etags.py module"""
+
+    def test_content_etag(self):
+        """``content_etag`` is the same for the same content"""
+        first = etags.content_etag({'a': {'state': 'on'}, 'b': {'state': 'off'}})
+        second = etags.content_etag({'b': {'state': 'off'}, 'a': {'state': 'on'}})
+
+        self.assertEqual(first, second)
+
+    def test_content_etag_changes(self):
+        """``content_etag`` changes when the content does"""
+        first = etags.content_etag({'a': {'state': 'on'}})
+        second = etags.content_etag({'a': {'state': 'off'}})
+
+        self.assertNotEqual(first, second)
+
+    def test_content_etag_volatile(self):
+        """``content_etag`` ignores the volatile keys of each item"""
+        first = etags.content_etag({'a': {'state': 'on', 'console': 'x'}}, volatile=['console'])
+        second = etags.content_etag({'a': {'state': 'on', 'console': 'y'}}, volatile=['console'])
+
+        self.assertEqual(first, second)
+
+    def test_content_etag_volatile_not_dict(self):
+        """``content_etag`` handles content whose items are not dictionaries"""
+        output = etags.content_etag({'vms': [], 'cursor': None}, volatile=['console'])
+
+        self.assertTrue(isinstance(output, str))
+
+    def test_body_etag(self):
+        """``body_etag`` is the same for the same body"""
+        self.assertEqual(etags.body_etag('{"a":1}'), etags.body_etag('{"a":1}'))
+
+
+if __name__ == '__main__':
+    unittest.main()
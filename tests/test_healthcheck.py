@@ -3,7 +3,9 @@
 A suite of tests for the healthcheck API end point
 """
 import unittest
+from unittest.mock import MagicMock
 
+import ujson
 from flask import Flask
 
 from vlab_claritynow_api.lib.views import healthcheck
@@ -18,6 +20,9 @@ class TestHealthView(unittest.TestCase):
         app = Flask(__name__)
         healthcheck.HealthView.register(app)
         app.config['TESTING'] = True
+        app.readiness = MagicMock()
+        app.readiness.status.return_value = (True, {'broker': {'ok': True}})
+        cls.flask_app = app
         cls.app = app.test_client()
 
     def test_health_check(self):
@@ -28,6 +33,35 @@ class TestHealthView(unittest.TestCase):
 
         self.assertEqual(expected, resp.status_code)
 
+    def test_health_check_version(self):
+        """The health check reports the version of the API"""
+        resp = self.app.get('/api/1/inf/claritynow/healthcheck')
+
+        self.assertEqual(resp.json['version'], healthcheck.VERSION)
+
+    def test_ready(self):
+        """The readiness end point returns 200 when every check worked"""
+        resp = self.app.get('/api/1/inf/claritynow/healthcheck/ready')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['checks'], {'broker': {'ok': True}})
+
+    def test_ready_failing(self):
+        """The readiness end point returns 503 when a check failed"""
+        self.flask_app.readiness.status.return_value = (False, {'broker': {'ok': False, 'error': 'testing'}})
+
+        resp = self.app.get('/api/1/inf/claritynow/healthcheck/ready')
+
+        self.assertEqual(resp.status_code, 503)
+
+    def test_ready_no_checks(self):
+        """The readiness end point returns 503 when nothing is checking the dependencies"""
+        del self.flask_app.readiness
+
+        resp = self.app.get('/api/1/inf/claritynow/healthcheck/ready')
+
+        self.assertEqual(resp.status_code, 503)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,223 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in idempotency.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+from celery import Celery
+from celery.backends.base import KeyValueStoreBackend
+
+from vlab_claritynow_api.lib import idempotency, result_store
+
+
+class FakeStore(object):
+    """Stands in for a shared key/value result store"""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class TestIdempotentRequests(unittest.TestCase):
+    """A set of test cases for the ``IdempotentRequests`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.send_task = MagicMock()
+        self.send_task.return_value.id = 'task-1'
+        self.body = {'name': 'box1', 'image': '1.0.0', 'network': 'bob_lan'}
+
+    def test_replay(self):
+        """``IdempotentRequests`` hands back the original task for the same request id and body"""
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+
+        first = requests.send('bob', 'req-1', self.body, self.send_task)
+        second = requests.send('bob', 'req-1', dict(self.body), self.send_task)
+
+        self.assertEqual(first, ('task-1', False))
+        self.assertEqual(second, ('task-1', True))
+        self.assertEqual(self.send_task.call_count, 1)
+
+    def test_conflict(self):
+        """``IdempotentRequests`` raises IdempotencyConflict when a request id is reused for another body"""
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+        requests.send('bob', 'req-1', self.body, self.send_task)
+
+        with self.assertRaises(idempotency.IdempotencyConflict):
+            requests.send('bob', 'req-1', {'name': 'box2'}, self.send_task)
+
+    def test_per_user(self):
+        """``IdempotentRequests`` does not share request ids between users"""
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+
+        requests.send('bob', 'req-1', self.body, self.send_task)
+        requests.send('alice', 'req-1', self.body, self.send_task)
+
+        self.assertEqual(self.send_task.call_count, 2)
+
+    def test_no_request_id(self):
+        """``IdempotentRequests`` always sends a task when there's no request id"""
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+
+        requests.send('bob', None, self.body, self.send_task)
+        requests.send('bob', None, self.body, self.send_task)
+
+        self.assertEqual(self.send_task.call_count, 2)
+
+    def test_disabled(self):
+        """``IdempotentRequests`` always sends a task when the TTL is zero"""
+        requests = idempotency.IdempotentRequests('testing', ttl=0)
+
+        requests.send('bob', 'req-1', self.body, self.send_task)
+        requests.send('bob', 'req-1', self.body, self.send_task)
+
+        self.assertEqual(self.send_task.call_count, 2)
+
+    @patch.object(idempotency.time, 'time')
+    def test_ttl(self, fake_time):
+        """``IdempotentRequests`` sends a new task once the request id has expired"""
+        fake_time.side_effect = [100, 161]
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+
+        requests.send('bob', 'req-1', self.body, self.send_task)
+        _, replayed = requests.send('bob', 'req-1', self.body, self.send_task)
+
+        self.assertFalse(replayed)
+        self.assertEqual(self.send_task.call_count, 2)
+
+    def test_shared_store(self):
+        """``IdempotentRequests`` finds request ids saved by another API process"""
+        store = FakeStore()
+        one = idempotency.IdempotentRequests('testing', ttl=60)
+        other = idempotency.IdempotentRequests('testing', ttl=60)
+
+        one.send('bob', 'req-1', self.body, self.send_task, store=store)
+        task_id, replayed = other.send('bob', 'req-1', self.body, self.send_task, store=store)
+
+        self.assertEqual(task_id, 'task-1')
+        self.assertTrue(replayed)
+        self.assertEqual(self.send_task.call_count, 1)
+
+    def test_shared_store_claimed(self):
+        """``IdempotentRequests`` does not send the task while another API process is sending it"""
+        store = FakeStore()
+        claim = {'task_id': None, 'body': idempotency.fingerprint(self.body), 'expires': 2**32}
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+        key = idempotency.hashlib.sha1('testing\0bob\0req-1'.encode()).hexdigest()
+        store.set(idempotency.STORE_PREFIX + key, ujson.dumps(claim))
+
+        with self.assertRaises(idempotency.IdempotencyConflict):
+            requests.send('bob', 'req-1', self.body, self.send_task, store=store)
+
+        self.send_task.assert_not_called()
+
+    def test_shared_store_release(self):
+        """``IdempotentRequests`` releases its claim on the request id when sending the task fails"""
+        store = FakeStore()
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+        self.send_task.side_effect = RuntimeError('broker down')
+
+        with self.assertRaises(RuntimeError):
+            requests.send('bob', 'req-1', self.body, self.send_task, store=store)
+
+        self.assertEqual(store.data, {})
+
+    def test_redis(self):
+        """``IdempotentRequests`` claims the request id with SET NX in Redis"""
+        store = MagicMock(spec=['get', 'set', 'delete', 'client', 'expires'])
+        store.expires = 3600
+        store.get.return_value = None
+
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+        requests.send('bob', 'req-1', self.body, self.send_task, store=store)
+        _, claim_kwargs = store.client.set.call_args_list[0]
+
+        self.assertEqual(claim_kwargs, {'nx': True, 'ex': 60})
+
+    def test_sqlite_race(self):
+        """``IdempotentRequests`` - only one API process sends the task when both get the request at once"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        url = 'sqlite://{}'.format(os.path.join(tmp_dir, 'results.db'))
+        one_store = Celery('claritynow', backend=result_store.backend_url(url), broker='memory://').backend
+        other_store = Celery('claritynow', backend=result_store.backend_url(url), broker='memory://').backend
+        one = idempotency.IdempotentRequests('testing', ttl=60)
+        other = idempotency.IdempotentRequests('testing', ttl=60)
+        other_send_task = MagicMock()
+        # The other process gets the retry while this one is still sending the task
+        def send_task():
+            with self.assertRaises(idempotency.IdempotencyConflict):
+                other.send('bob', 'req-1', self.body, other_send_task, store=other_store)
+            return self.send_task()
+
+        one.send('bob', 'req-1', self.body, send_task, store=one_store)
+        task_id, replayed = other.send('bob', 'req-1', self.body, other_send_task, store=other_store)
+
+        other_send_task.assert_not_called()
+        self.assertEqual((task_id, replayed), ('task-1', True))
+
+    def test_prunes(self):
+        """``IdempotentRequests`` forgets expired request ids"""
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+        with patch.object(idempotency.time, 'time', return_value=100):
+            requests.send('bob', 'req-1', self.body, self.send_task)
+        with patch.object(idempotency.time, 'time', return_value=200):
+            requests.send('bob', 'req-2', self.body, self.send_task)
+
+        self.assertEqual(len(requests._local), 1)
+
+    def test_drops_locks(self):
+        """``IdempotentRequests`` does not keep a lock for every request id it has seen"""
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+
+        requests.send('bob', 'req-1', self.body, self.send_task)
+
+        self.assertEqual(len(requests._locks), 0)
+
+    def test_drops_locks_on_error(self):
+        """``IdempotentRequests`` drops the lock of a request id when sending the task fails"""
+        requests = idempotency.IdempotentRequests('testing', ttl=60)
+        self.send_task.side_effect = RuntimeError('broker down')
+
+        with self.assertRaises(RuntimeError):
+            requests.send('bob', 'req-1', self.body, self.send_task)
+
+        self.assertEqual(len(requests._locks), 0)
+
+
+class TestHelpers(unittest.TestCase):
+    """A set of test cases for the functions in idempotency.py"""
+    def test_fingerprint(self):
+        """``fingerprint`` does not depend on the order of the keys"""
+        first = idempotency.fingerprint({'a': 1, 'b': [1, 2]})
+        second = idempotency.fingerprint({'b': [1, 2], 'a': 1})
+
+        self.assertEqual(first, second)
+
+    def test_shared_store(self):
+        """``shared_store`` returns the result store when it's a key/value store"""
+        celery_app = MagicMock()
+        celery_app.backend = MagicMock(spec=KeyValueStoreBackend)
+
+        self.assertTrue(idempotency.shared_store(celery_app) is celery_app.backend)
+
+    def test_shared_store_rpc(self):
+        """``shared_store`` returns None when the result store is not shared, i.e. rpc://"""
+        celery_app = MagicMock()
+
+        self.assertTrue(idempotency.shared_store(celery_app) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in images.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_claritynow_api.lib import images
+
+
+class TestImageCatalog(unittest.TestCase):
+    """A set of test cases for the ImageCatalog object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.images_dir = tempfile.mkdtemp()
+        for name in ('ClarityNow-2.11.0.ova', 'ClarityNow-2.10.0.ova', 'README'):
+            with open(os.path.join(self.images_dir, name), 'w') as the_file:
+                the_file.write('data')
+        self.catalog = images.ImageCatalog(self.images_dir)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.images_dir)
+
+    def test_images(self):
+        """``ImageCatalog.images`` is the list of versions that can be deployed"""
+        self.catalog.refresh()
+
+        self.assertEqual(self.catalog.images, ['2.10.0', '2.11.0'])
+
+    def test_details(self):
+        """``ImageCatalog.details`` contains the size of every OVA"""
+        self.catalog.refresh()
+
+        self.assertEqual(self.catalog.details['2.11.0']['size'], 4)
+
+    @patch.object(images.os, 'listdir')
+    def test_refresh_cached(self, fake_listdir):
+        """``ImageCatalog.refresh`` only lists the directory when it has changed"""
+        fake_listdir.return_value = []
+        self.catalog.refresh()
+        self.catalog.refresh()
+
+        self.assertEqual(fake_listdir.call_count, 1)
+
+    def test_refresh_changed(self):
+        """``ImageCatalog.refresh`` rebuilds the catalog when an OVA is added"""
+        self.catalog.refresh()
+        etag = self.catalog.etag
+        with open(os.path.join(self.images_dir, 'ClarityNow-2.12.0.ova'), 'w') as the_file:
+            the_file.write('data')
+        # make sure the mtime changes, even on file systems with coarse timestamps
+        stat = os.stat(self.images_dir)
+        os.utime(self.images_dir, (stat.st_atime, stat.st_mtime + 10))
+
+        self.catalog.refresh()
+
+        self.assertTrue('2.12.0' in self.catalog.images)
+        self.assertNotEqual(etag, self.catalog.etag)
+
+    def test_refresh_missing_dir(self):
+        """``ImageCatalog.refresh`` raises FileNotFoundError when the directory is not mounted"""
+        catalog = images.ImageCatalog(os.path.join(self.images_dir, 'nope'))
+
+        with self.assertRaises(FileNotFoundError):
+            catalog.refresh()
+
+
+if __name__ == '__main__':
+    unittest.main()
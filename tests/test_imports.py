@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests that keep the vSphere libraries out of the API processes
+"""
+import os
+import sys
+import unittest
+import subprocess
+
+import ujson
+
+
+# Every module the API loads; nothing in lib/worker
+API_MODULES = ['vlab_claritynow_api.app',
+               'vlab_claritynow_api.lib.views',
+               'vlab_claritynow_api.lib.images',
+               'vlab_claritynow_api.lib.metrics',
+               'vlab_claritynow_api.lib.progress',
+               'vlab_claritynow_api.lib.queues',
+               'vlab_claritynow_api.lib.readiness',
+               'vlab_claritynow_api.lib.result_store',
+               'vlab_claritynow_api.lib.single_flight',
+               'vlab_claritynow_api.lib.tracing']
+FORBIDDEN = ['pyVmomi', 'pyVim', 'vlab_inf_common.vmware', 'pkg_resources']
+
+
+def loaded_modules(modules):
+    """Import some modules in a new Python process, and list everything it loaded
+
+    Other tests import the worker, so the vSphere libraries are already loaded
+    in this process.
+    """
+    code = 'import sys, ujson\nfor name in sys.argv[1:]:\n    __import__(name)\nprint(ujson.dumps(list(sys.modules)))'
+    env = dict(os.environ)
+    env['VLAB_CLARITYNOW_METRICS_DIR'] = ''
+    output = subprocess.check_output([sys.executable, '-c', code] + modules, env=env)
+    return set(ujson.loads(output.decode().strip().split('\n')[-1]))
+
+
+class TestApiImports(unittest.TestCase):
+    """A set of test cases for what the API imports"""
+
+    def test_no_vsphere(self):
+        """The API never loads the vSphere libraries or pkg_resources"""
+        loaded = loaded_modules(API_MODULES)
+
+        found = [x for x in FORBIDDEN if x in loaded]
+
+        self.assertEqual(found, [])
+
+    def test_worker_loads_vsphere(self):
+        """Sanity check that ``loaded_modules`` would notice the vSphere libraries"""
+        loaded = loaded_modules(['vlab_claritynow_api.lib.worker.vmware'])
+
+        self.assertTrue('pyVmomi' in loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
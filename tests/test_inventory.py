@@ -0,0 +1,422 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in inventory.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+from pyVmomi import vim, vmodl
+
+from vlab_claritynow_api.lib.worker import inventory
+
+
+PC = vmodl.query.PropertyCollector
+
+
+def make_content(obj, **props):
+    """Build a PropertyCollector result for a single object"""
+    content = MagicMock()
+    content.obj = obj
+    content.propSet = []
+    for prop_name, value in props.items():
+        prop = MagicMock()
+        prop.name = prop_name.replace('__', '.')
+        prop.val = value
+        content.propSet.append(prop)
+    return content
+
+
+class TestRetrieve(unittest.TestCase):
+    """A set of test cases for the ``retrieve`` function"""
+
+    def test_pages(self):
+        """``retrieve`` follows the continuation token until every page is consumed"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector
+        page1 = PC.RetrieveResult(objects=[PC.ObjectContent(obj=vim.VirtualMachine('vm-1'))], token='more')
+        page2 = PC.RetrieveResult(objects=[PC.ObjectContent(obj=vim.VirtualMachine('vm-2'))])
+        collector.RetrievePropertiesEx.return_value = page1
+        collector.ContinueRetrievePropertiesEx.return_value = page2
+
+        output = [x.obj._moId for x in inventory.retrieve(fake_vcenter, MagicMock())]
+        expected = ['vm-1', 'vm-2']
+
+        self.assertEqual(output, expected)
+
+    def test_no_results(self):
+        """``retrieve`` handles vCenter returning nothing"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.propertyCollector.RetrievePropertiesEx.return_value = None
+
+        output = list(inventory.retrieve(fake_vcenter, MagicMock()))
+
+        self.assertEqual(output, [])
+
+    def test_cancel(self):
+        """``retrieve`` cancels the query if the caller stops iterating early"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector
+        page1 = PC.RetrieveResult(objects=[PC.ObjectContent(obj=vim.VirtualMachine('vm-1'))], token='more')
+        collector.RetrievePropertiesEx.return_value = page1
+
+        results = inventory.retrieve(fake_vcenter, MagicMock())
+        next(results)
+        results.close()
+
+        collector.CancelRetrievePropertiesEx.assert_called_with('more')
+
+
+class TestFolderVms(unittest.TestCase):
+    """A set of test cases for the ``folder_vms`` function"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        cls.meta = {'component': 'ClarityNow', 'created': 1234, 'version': '2.11.0',
+                    'configured': True, 'generation': 1}
+        network = vim.Network('network-1')
+        nic = vim.vm.GuestInfo.NicInfo(ipAddress=['10.0.0.2', 'fe80::1'])
+        cls.results = [make_content(vim.VirtualMachine('vm-1'),
+                                    name='myClarityNow',
+                                    config__annotation=ujson.dumps(cls.meta),
+                                    runtime__powerState='poweredOn',
+                                    guest__net=[nic],
+                                    network=[network]),
+                       make_content(vim.VirtualMachine('vm-2'),
+                                    name='someOtherVM',
+                                    config__annotation='',
+                                    runtime__powerState='poweredOff'),
+                       make_content(network, name='alice_frontend')]
+
+    @patch.object(inventory, 'ConsoleUrlMaker')
+    @patch.object(inventory, 'retrieve')
+    def test_folder_vms(self, fake_retrieve, fake_ConsoleUrlMaker):
+        """``folder_vms`` returns the same info as ``virtual_machine.get_info``"""
+        fake_retrieve.return_value = iter(self.results)
+        fake_ConsoleUrlMaker.return_value.return_value = 'https://some-console'
+
+        output = inventory.folder_vms(MagicMock(), vim.Folder('group-1'), 'alice', component='ClarityNow')
+        expected = {'myClarityNow': {'state': 'poweredOn',
+                                     'console': 'https://some-console',
+                                     'ips': ['10.0.0.2'],
+                                     'networks': ['frontend'],
+                                     'moid': 'vm-1',
+                                     'meta': self.meta}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory, 'ConsoleUrlMaker')
+    @patch.object(inventory, 'retrieve')
+    def test_folder_vms_single_query(self, fake_retrieve, fake_ConsoleUrlMaker):
+        """``folder_vms`` makes one PropertyCollector query for the whole folder"""
+        fake_retrieve.return_value = iter(self.results)
+
+        inventory.folder_vms(MagicMock(), vim.Folder('group-1'), 'alice', component='ClarityNow')
+
+        self.assertEqual(fake_retrieve.call_count, 1)
+
+    @patch.object(inventory, 'ConsoleUrlMaker')
+    @patch.object(inventory, 'retrieve')
+    def test_folder_vms_no_match(self, fake_retrieve, fake_ConsoleUrlMaker):
+        """``folder_vms`` skips the console lookup when no VMs match"""
+        fake_retrieve.return_value = iter(self.results)
+
+        output = inventory.folder_vms(MagicMock(), vim.Folder('group-1'), 'alice', component='InsightIQ')
+
+        self.assertEqual(output, {})
+        fake_ConsoleUrlMaker.assert_not_called()
+
+    def test_parse_meta_unknown(self):
+        """``parse_meta`` returns 'Unknown' meta data for VMs without valid notes"""
+        output = inventory.parse_meta(None)['component']
+        expected = 'Unknown'
+
+        self.assertEqual(output, expected)
+
+
+class TestFindVm(unittest.TestCase):
+    """A set of test cases for the ``find_vm`` function"""
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_vm(self, fake_retrieve):
+        """``find_vm`` returns the VM when the name and component match"""
+        fake_vcenter = MagicMock()
+        the_vm = vim.VirtualMachine('vm-1')
+        fake_vcenter.content.searchIndex.FindChild.return_value = the_vm
+        annotation = ujson.dumps({'component': 'ClarityNow'})
+        fake_retrieve.return_value = iter([make_content(the_vm, config__annotation=annotation)])
+
+        output = inventory.find_vm(fake_vcenter, vim.Folder('group-1'), 'myClarityNow', component='ClarityNow')
+
+        self.assertTrue(output is the_vm)
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_vm_only_notes(self, fake_retrieve):
+        """``find_vm`` only reads the notes of the VM"""
+        fake_vcenter = MagicMock()
+        the_vm = vim.VirtualMachine('vm-1')
+        fake_vcenter.content.searchIndex.FindChild.return_value = the_vm
+        fake_retrieve.return_value = iter([])
+
+        inventory.find_vm(fake_vcenter, vim.Folder('group-1'), 'myClarityNow', component='ClarityNow')
+        the_args, _ = fake_retrieve.call_args
+        paths = the_args[1].propSet[0].pathSet
+
+        self.assertEqual(paths, ['config.annotation'])
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_vm_wrong_component(self, fake_retrieve):
+        """``find_vm`` returns None when the VM is a different component"""
+        fake_vcenter = MagicMock()
+        the_vm = vim.VirtualMachine('vm-1')
+        fake_vcenter.content.searchIndex.FindChild.return_value = the_vm
+        annotation = ujson.dumps({'component': 'OneFS'})
+        fake_retrieve.return_value = iter([make_content(the_vm, config__annotation=annotation)])
+
+        output = inventory.find_vm(fake_vcenter, vim.Folder('group-1'), 'myClarityNow', component='ClarityNow')
+
+        self.assertTrue(output is None)
+
+    def test_find_vm_no_such_vm(self):
+        """``find_vm`` returns None when there's no VM with the supplied name"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+
+        output = inventory.find_vm(fake_vcenter, vim.Folder('group-1'), 'myClarityNow', component='ClarityNow')
+
+        self.assertTrue(output is None)
+
+
+def make_update(version, *changes):
+    """Build the output of ``WaitForUpdatesEx``; each change is (task, property, value)"""
+    update = MagicMock()
+    update.version = version
+    filter_set = MagicMock()
+    filter_set.objectSet = []
+    for the_task, prop_name, value in changes:
+        obj_update = MagicMock()
+        obj_update.obj = the_task
+        change = MagicMock()
+        change.name = prop_name
+        change.val = value
+        obj_update.changeSet = [change]
+        filter_set.objectSet.append(obj_update)
+    update.filterSet = [filter_set]
+    return update
+
+
+class TestWaitForTasks(unittest.TestCase):
+    """A set of test cases for the ``wait_for_tasks`` function"""
+
+    def test_wait_for_tasks(self):
+        """``wait_for_tasks`` waits until every task is done"""
+        task1 = vim.Task('task-1')
+        task2 = vim.Task('task-2')
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        collector.WaitForUpdatesEx.side_effect = [make_update('1', (task1, 'info.state', 'running'),
+                                                                   (task2, 'info.state', 'success')),
+                                                  None,
+                                                  make_update('2', (task1, 'info.state', 'success'))]
+
+        output = inventory.wait_for_tasks(fake_vcenter, [task1, task2])
+        expected = {'task-1': None, 'task-2': None}
+
+        self.assertEqual(output, expected)
+
+    def test_wait_for_tasks_single_collector(self):
+        """``wait_for_tasks`` uses one PropertyCollector for every task, and destroys it"""
+        task1 = vim.Task('task-1')
+        task2 = vim.Task('task-2')
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        collector.WaitForUpdatesEx.return_value = make_update('1', (task1, 'info.state', 'success'),
+                                                                   (task2, 'info.state', 'success'))
+
+        inventory.wait_for_tasks(fake_vcenter, [task1, task2])
+
+        self.assertEqual(collector.CreateFilter.call_count, 1)
+        self.assertTrue(collector.DestroyPropertyCollector.called)
+
+    def test_wait_for_tasks_error(self):
+        """``wait_for_tasks`` returns the error message of a failed task"""
+        task1 = vim.Task('task-1')
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        error = MagicMock()
+        error.msg = 'testing'
+        collector.WaitForUpdatesEx.return_value = make_update('1', (task1, 'info.error', error),
+                                                                   (task1, 'info.state', 'error'))
+
+        output = inventory.wait_for_tasks(fake_vcenter, [task1])
+        expected = {'task-1': 'testing'}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory.time, 'time')
+    def test_wait_for_tasks_timeout(self, fake_time):
+        """``wait_for_tasks`` gives up on tasks that take longer than the timeout"""
+        fake_time.side_effect = [0, 700]
+        task1 = vim.Task('task-1')
+        fake_vcenter = MagicMock()
+
+        output = inventory.wait_for_tasks(fake_vcenter, [task1], timeout=600)
+        expected = {'task-1': 'Timeout of 600 seconds exceeded'}
+
+        self.assertEqual(output, expected)
+
+    def test_wait_for_tasks_none(self):
+        """``wait_for_tasks`` does not talk to vCenter when there are no tasks"""
+        fake_vcenter = MagicMock()
+
+        inventory.wait_for_tasks(fake_vcenter, [])
+
+        self.assertFalse(fake_vcenter.content.propertyCollector.CreatePropertyCollector.called)
+
+
+class TestFolders(unittest.TestCase):
+    """A set of test cases for ``child_vms``"""
+
+    @patch.object(inventory, 'retrieve')
+    def test_child_vms(self, fake_retrieve):
+        """``child_vms`` pairs every VM with its properties"""
+        the_vm = vim.VirtualMachine('vm-1')
+        fake_retrieve.return_value = (x for x in [make_content(the_vm, name='someVM')])
+
+        output = inventory.child_vms(MagicMock(), vim.Folder('group-1'), ['name'])
+        expected = [(the_vm, {'name': 'someVM'})]
+
+        self.assertEqual(output, expected)
+
+
+class TestIterAllVms(unittest.TestCase):
+    """A set of test cases for the ``iter_all_vms`` function"""
+
+    def setUp(self):
+        inventory._listing.clear()
+
+    @patch.object(inventory, '_vm_properties')
+    @patch.object(inventory, '_view_filter')
+    @patch.object(inventory, 'retrieve')
+    def test_iter_all_vms(self, fake_retrieve, fake_view_filter, fake_vm_properties):
+        """``iter_all_vms`` yields every matching VM along with the name of its owner"""
+        folder = vim.Folder('group-1')
+        meta = {'component': 'ClarityNow', 'created': 1234, 'version': '2.11.0',
+                'configured': True, 'generation': 1}
+        folders = [make_content(folder, name='alice')]
+        vms = [make_content(vim.VirtualMachine('vm-1')), make_content(vim.VirtualMachine('vm-2'))]
+        fake_retrieve.side_effect = [(x for x in folders), (x for x in vms)]
+        fake_vm_properties.return_value = {'vm-1': {'name': 'cn1', 'parent': folder,
+                                                    'config.annotation': ujson.dumps(meta),
+                                                    'runtime.powerState': 'poweredOn'},
+                                           'vm-2': {'name': 'other', 'parent': folder,
+                                                    'config.annotation': '',
+                                                    'runtime.powerState': 'poweredOn'}}
+
+        output = list(inventory.iter_all_vms(MagicMock(), component='ClarityNow'))
+        expected = [{'name': 'cn1', 'owner': 'alice', 'state': 'poweredOn', 'moid': 'vm-1', 'meta': meta}]
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory, '_vm_properties')
+    @patch.object(inventory, '_view_filter')
+    @patch.object(inventory, 'retrieve')
+    def test_iter_all_vms_after(self, fake_retrieve, fake_view_filter, fake_vm_properties):
+        """``iter_all_vms`` only reads VMs after the cursor, in order of their moid, a page at a time"""
+        meta = ujson.dumps({'component': 'ClarityNow'})
+        vms = [make_content(vim.VirtualMachine(x)) for x in ('vm-4', 'vm-2', 'vm-3', 'vm-1')]
+        fake_retrieve.side_effect = [(x for x in []), (x for x in vms)]
+        fake_vm_properties.side_effect = lambda vcenter, chunk, props: {x._moId: {'config.annotation': meta} for x in chunk}
+
+        output = [x['moid'] for x in inventory.iter_all_vms(MagicMock(), component='ClarityNow', after='vm-1', page_size=2)]
+        chunks = [[y._moId for y in x[0][1]] for x in fake_vm_properties.call_args_list]
+
+        self.assertEqual(output, ['vm-2', 'vm-3', 'vm-4'])
+        self.assertEqual(chunks, [['vm-2', 'vm-3'], ['vm-4']])
+
+    @patch.object(inventory, '_vm_properties')
+    @patch.object(inventory, '_view_filter')
+    @patch.object(inventory, 'retrieve')
+    def test_iter_all_vms_destroyed(self, fake_retrieve, fake_view_filter, fake_vm_properties):
+        """``iter_all_vms`` skips VMs destroyed after they were listed"""
+        vms = [make_content(vim.VirtualMachine('vm-1'))]
+        fake_retrieve.side_effect = [(x for x in []), (x for x in vms)]
+        fake_vm_properties.return_value = {}
+
+        output = list(inventory.iter_all_vms(MagicMock(), component='ClarityNow'))
+
+        self.assertEqual(output, [])
+
+    @patch.object(inventory, '_vm_properties')
+    @patch.object(inventory, '_view_filter')
+    @patch.object(inventory, 'retrieve')
+    def test_iter_all_vms_reuses_listing(self, fake_retrieve, fake_view_filter, fake_vm_properties):
+        """``iter_all_vms`` only lists every VM when a walk starts, not for the pages after it"""
+        vms = [make_content(vim.VirtualMachine(x)) for x in ('vm-1', 'vm-2', 'vm-3')]
+        fake_retrieve.side_effect = [(x for x in []), (x for x in vms)]
+        fake_vm_properties.side_effect = lambda vcenter, chunk, props: {}
+
+        list(inventory.iter_all_vms(MagicMock(), component='ClarityNow', page_size=1))
+        list(inventory.iter_all_vms(MagicMock(), component='ClarityNow', after='vm-1', page_size=1))
+        chunks = [[y._moId for y in x[0][1]] for x in fake_vm_properties.call_args_list]
+
+        self.assertEqual(fake_retrieve.call_count, 2)
+        self.assertEqual(chunks, [['vm-1'], ['vm-2'], ['vm-3'], ['vm-2'], ['vm-3']])
+
+    @patch.object(inventory.time, 'time')
+    @patch.object(inventory, '_vm_properties')
+    @patch.object(inventory, '_view_filter')
+    @patch.object(inventory, 'retrieve')
+    def test_iter_all_vms_listing_expires(self, fake_retrieve, fake_view_filter, fake_vm_properties, fake_time):
+        """``iter_all_vms`` lists every VM again once the listing is too old"""
+        fake_time.side_effect = [100, 100 + inventory.LISTING_TTL, 100 + inventory.LISTING_TTL]
+        fake_retrieve.side_effect = [(x for x in []), (x for x in []), (x for x in []), (x for x in [])]
+        fake_vm_properties.return_value = {}
+
+        list(inventory.iter_all_vms(MagicMock(), component='ClarityNow'))
+        list(inventory.iter_all_vms(MagicMock(), component='ClarityNow', after='vm-1'))
+
+        self.assertEqual(fake_retrieve.call_count, 4)
+
+    @patch.object(inventory, '_view_filter')
+    @patch.object(inventory, 'retrieve')
+    def test_iter_all_vms_destroys_view(self, fake_retrieve, fake_view_filter):
+        """``iter_all_vms`` cleans up the container view when the caller is done"""
+        fake_vcenter = MagicMock()
+        fake_retrieve.side_effect = [(x for x in []), (x for x in [])]
+
+        list(inventory.iter_all_vms(fake_vcenter, component='ClarityNow'))
+        view = fake_vcenter.content.viewManager.CreateContainerView.return_value
+
+        view.DestroyView.assert_called()
+
+
+class TestVmProperties(unittest.TestCase):
+    """A set of test cases for the ``_vm_properties`` function"""
+
+    @patch.object(inventory, 'retrieve')
+    def test_vm_properties(self, fake_retrieve):
+        """``_vm_properties`` maps the moid of every VM to its properties"""
+        fake_retrieve.return_value = [make_content(vim.VirtualMachine('vm-1'), name='cn1')]
+
+        output = inventory._vm_properties(MagicMock(), [vim.VirtualMachine('vm-1')], ['name'])
+        expected = {'vm-1': {'name': 'cn1'}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory, 'retrieve')
+    def test_vm_properties_destroyed(self, fake_retrieve):
+        """``_vm_properties`` drops a VM that no longer exists, and reads the rest"""
+        gone = vim.VirtualMachine('vm-1')
+        fake_retrieve.side_effect = [vmodl.fault.ManagedObjectNotFound(obj=gone),
+                                     [make_content(vim.VirtualMachine('vm-2'), name='cn2')]]
+
+        output = inventory._vm_properties(MagicMock(), [gone, vim.VirtualMachine('vm-2')], ['name'])
+        expected = {'vm-2': {'name': 'cn2'}}
+
+        self.assertEqual(output, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in metrics.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from vlab_claritynow_api.lib import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """A set of test cases for the metrics.py module"""
+
+    def test_counter(self):
+        """``counter`` can be incremented"""
+        the_counter = metrics.counter('test_counter_total')
+        the_counter.inc()
+        the_counter.inc(2)
+
+        self.assertEqual(the_counter.value(), 3)
+
+    def test_counter_labels(self):
+        """``counter`` tracks values per set of labels"""
+        the_counter = metrics.counter('test_counter_labels_total')
+        the_counter.inc(mode='a')
+        the_counter.inc(mode='b')
+        the_counter.inc(mode='b')
+
+        self.assertEqual(the_counter.value(mode='b'), 2)
+
+    def test_get_existing(self):
+        """``counter`` returns the same object for the same name"""
+        first = metrics.counter('test_same_total')
+        second = metrics.counter('test_same_total')
+
+        self.assertTrue(first is second)
+
+    def test_type_mismatch(self):
+        """``gauge`` raises ValueError if the name is already used by a different type of metric"""
+        metrics.counter('test_mismatch')
+
+        with self.assertRaises(ValueError):
+            metrics.gauge('test_mismatch')
+
+    def test_gauge(self):
+        """``gauge`` can be set, incremented and decremented"""
+        the_gauge = metrics.gauge('test_gauge')
+        the_gauge.set(10)
+        the_gauge.inc()
+        the_gauge.dec(3)
+
+        self.assertEqual(the_gauge.value(), 8)
+
+    def test_histogram(self):
+        """``histogram`` counts observations into cumulative buckets"""
+        the_histogram = metrics.histogram('test_histogram_seconds', buckets=(1, 10))
+        the_histogram.observe(0.5)
+        the_histogram.observe(5)
+        the_histogram.observe(50)
+
+        output = the_histogram.value()
+        expected = {'count': 3, 'sum': 55.5, 'buckets': [1, 2]}
+
+        self.assertEqual(output, expected)
+
+    def test_histogram_labels(self):
+        """``histogram`` tracks observations per set of labels"""
+        the_histogram = metrics.histogram('test_histogram_labels_seconds')
+        the_histogram.observe(1, mode='ova')
+
+        self.assertEqual(the_histogram.value(mode='linked_clone')['count'], 0)
+
+    def test_snapshot(self):
+        """``snapshot`` returns the samples of every metric"""
+        metrics.gauge('test_snapshot').set(4, pool='a')
+
+        output = metrics.snapshot()['test_snapshot']
+        expected = [({'pool': 'a'}, 4)]
+
+        self.assertEqual(output, expected)
+
+    def test_render_counter(self):
+        """``render`` formats counters in the Prometheus text format"""
+        metrics.counter('test_render_total', 'Things rendered').inc(2, mode='a')
+
+        output = metrics.render()
+
+        self.assertTrue('# HELP test_render_total Things rendered\n' in output)
+        self.assertTrue('# TYPE test_render_total counter\n' in output)
+        self.assertTrue('test_render_total{mode="a"} 2\n' in output)
+
+    def test_render_histogram(self):
+        """``render`` includes a bucket per bound, +Inf, the sum and the count of a histogram"""
+        metrics.histogram('test_render_seconds', buckets=(1, 10)).observe(5, mode='a')
+
+        output = metrics.render()
+
+        self.assertTrue('test_render_seconds_bucket{le="1",mode="a"} 0\n' in output)
+        self.assertTrue('test_render_seconds_bucket{le="10",mode="a"} 1\n' in output)
+        self.assertTrue('test_render_seconds_bucket{le="+Inf",mode="a"} 1\n' in output)
+        self.assertTrue('test_render_seconds_sum{mode="a"} 5\n' in output)
+        self.assertTrue('test_render_seconds_count{mode="a"} 1\n' in output)
+
+    def test_render_escapes(self):
+        """``render`` escapes quotes, backslashes and newlines in label values"""
+        metrics.gauge('test_render_escape').set(1, name='a"b\\c\nd')
+
+        output = metrics.render()
+
+        self.assertTrue('test_render_escape{{name="a\\"b\\\\c\\nd",pid="{}"}} 1\n'.format(os.getpid()) in output)
+
+    def test_merge(self):
+        """``merge`` sums the counters and histograms of several processes"""
+        exports = [{'pid': 1, 'metrics': [{'name': 'x_total', 'kind': 'counter', 'description': '',
+                                           'samples': [({'a': '1'}, 2)]},
+                                          {'name': 'x_seconds', 'kind': 'histogram', 'description': '',
+                                           'buckets': [1], 'samples': [({}, {'count': 1, 'sum': 0.5, 'buckets': [1]})]}]},
+                   {'pid': 2, 'metrics': [{'name': 'x_total', 'kind': 'counter', 'description': '',
+                                           'samples': [({'a': '1'}, 3)]},
+                                          {'name': 'x_seconds', 'kind': 'histogram', 'description': '',
+                                           'buckets': [1], 'samples': [({}, {'count': 1, 'sum': 2, 'buckets': [0]})]}]}]
+
+        output = {x['name']: x['samples'] for x in metrics.merge(exports)}
+        expected = {'x_total': [({'a': '1'}, 5)],
+                    'x_seconds': [({}, {'count': 2, 'sum': 2.5, 'buckets': [1]})]}
+
+        self.assertEqual(output, expected)
+
+    def test_merge_gauges(self):
+        """``merge`` keeps the gauges of live processes apart, and drops the ones of exited processes"""
+        alive = os.getpid()
+        exports = [{'pid': alive, 'metrics': [{'name': 'x', 'kind': 'gauge', 'description': '',
+                                               'samples': [({}, 2)]}]},
+                   {'pid': 2 ** 22 + 1, 'metrics': [{'name': 'x', 'kind': 'gauge', 'description': '',
+                                                     'samples': [({}, 3)]}]}]
+
+        output = metrics.merge(exports)[0]['samples']
+        expected = [({'pid': str(alive)}, 2)]
+
+        self.assertEqual(output, expected)
+
+    def test_merge_gauges_one_process(self):
+        """``merge`` labels gauges with the pid even when only one process saved metrics"""
+        exports = [{'pid': os.getpid(), 'metrics': [{'name': 'x', 'kind': 'gauge', 'description': '',
+                                                     'samples': [({'a': '1'}, 2)]}]}]
+
+        output = metrics.merge(exports)[0]['samples']
+        expected = [({'a': '1', 'pid': str(os.getpid())}, 2)]
+
+        self.assertEqual(output, expected)
+
+    def test_remove_stale(self):
+        """``remove_stale`` deletes the metrics of exited processes, and keeps the ones of live processes"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name in ('{}.json'.format(os.getpid()), '{}.json'.format(2 ** 22 + 1), '{}.json.tmp'.format(2 ** 22 + 1)):
+            with open(os.path.join(directory, name), 'w') as the_file:
+                the_file.write('{}')
+
+        metrics.remove_stale(directory)
+
+        self.assertEqual(os.listdir(directory), ['{}.json'.format(os.getpid())])
+
+    def test_dump(self):
+        """``render`` includes the metrics another process saved with ``dump``"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        the_counter = metrics.counter('test_dump_total')
+        the_counter.inc(4)
+        metrics.dump(directory)
+        # Pretend it was saved by a different process
+        path = os.path.join(directory, '{}.json'.format(os.getpid()))
+        with open(path) as the_file:
+            exported = the_file.read().replace('"pid":{}'.format(os.getpid()), '"pid":1')
+        os.remove(path)
+        with open(os.path.join(directory, '1.json'), 'w') as the_file:
+            the_file.write(exported)
+
+        output = metrics.render(directory)
+
+        self.assertTrue('test_dump_total 8\n' in output)
+
+    def test_reset(self):
+        """``reset`` forgets the value of every metric"""
+        the_counter = metrics.counter('test_reset_total')
+        the_counter.inc()
+        metrics.reset()
+
+        self.assertEqual(the_counter.value(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the metrics API end point
+"""
+import unittest
+
+from flask import Flask
+
+from vlab_claritynow_api.lib import metrics
+from vlab_claritynow_api.lib.views import healthcheck
+from vlab_claritynow_api.lib.views import metrics as metrics_view
+
+
+class TestMetricsView(unittest.TestCase):
+    """A set of test cases for the MetricsView object"""
+
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        app = Flask(__name__)
+        metrics_view.MetricsView.register(app)
+        healthcheck.HealthView.register(app)
+        app.config['TESTING'] = True
+        cls.app = app.test_client()
+
+    def test_get(self):
+        """GET on /api/1/inf/claritynow/metrics returns the metrics in the Prometheus text format"""
+        resp = self.app.get('/api/1/inf/claritynow/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], metrics.CONTENT_TYPE)
+
+    def test_request_timed(self):
+        """Requests to a TimedView are observed in claritynow_http_request_seconds"""
+        labels = {'view': 'HealthView', 'endpoint': 'get', 'method': 'GET', 'status': '200'}
+        before = metrics_view.REQUEST_SECONDS.value(**labels)['count']
+        self.app.get('/api/1/inf/claritynow/healthcheck')
+        after = metrics_view.REQUEST_SECONDS.value(**labels)['count']
+
+        self.assertEqual(after - before, 1)
+
+    def test_rendered(self):
+        """The request latency histogram is included in the metrics"""
+        self.app.get('/api/1/inf/claritynow/healthcheck')
+        resp = self.app.get('/api/1/inf/claritynow/metrics')
+
+        self.assertTrue(b'claritynow_http_request_seconds_bucket{' in resp.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in morefs.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from pyVmomi import vim, vmodl
+
+from vlab_claritynow_api.lib.worker import morefs
+
+
+def make_content(obj, name):
+    """Build a PropertyCollector result with just the name of an object"""
+    content = MagicMock()
+    content.obj = obj
+    prop = MagicMock()
+    prop.name = 'name'
+    prop.val = name
+    content.propSet = [prop]
+    return content
+
+
+class TestMorefCache(unittest.TestCase):
+    """A set of test cases for the ``MorefCache`` object"""
+
+    def test_get(self):
+        """``MorefCache.get`` returns the type and moid of a loaded object"""
+        cache = morefs.MorefCache(ttl=300)
+        cache.replace(morefs.FOLDER, {'alice': (vim.Folder, 'group-1')})
+
+        output = cache.get(morefs.FOLDER, 'alice')
+        expected = (vim.Folder, 'group-1')
+
+        self.assertEqual(output, expected)
+
+    def test_get_missing(self):
+        """``MorefCache.get`` returns None for an unknown name"""
+        cache = morefs.MorefCache(ttl=300)
+
+        self.assertTrue(cache.get(morefs.FOLDER, 'alice') is None)
+
+    def test_get_by_kind(self):
+        """``MorefCache.get`` does not mix up a folder and network with the same name"""
+        cache = morefs.MorefCache(ttl=300)
+        cache.replace(morefs.NETWORK, {'alice': (vim.Network, 'network-1')})
+
+        self.assertTrue(cache.get(morefs.FOLDER, 'alice') is None)
+
+    @patch.object(morefs.time, 'time')
+    def test_get_expired(self, fake_time):
+        """``MorefCache.get`` forgets entries older than the TTL"""
+        fake_time.return_value = 100
+        cache = morefs.MorefCache(ttl=300)
+        cache.replace(morefs.FOLDER, {'alice': (vim.Folder, 'group-1')})
+        fake_time.return_value = 401
+
+        self.assertTrue(cache.get(morefs.FOLDER, 'alice') is None)
+
+    def test_replace(self):
+        """``MorefCache.replace`` drops objects that no longer exist"""
+        cache = morefs.MorefCache(ttl=300)
+        cache.replace(morefs.FOLDER, {'alice': (vim.Folder, 'group-1')})
+        cache.replace(morefs.FOLDER, {'bob': (vim.Folder, 'group-2')})
+
+        self.assertTrue(cache.get(morefs.FOLDER, 'alice') is None)
+
+    def test_replace_ttl_zero(self):
+        """``MorefCache`` remembers nothing when the TTL is zero"""
+        cache = morefs.MorefCache(ttl=0)
+        cache.replace(morefs.FOLDER, {'alice': (vim.Folder, 'group-1')})
+
+        self.assertTrue(cache.get(morefs.FOLDER, 'alice') is None)
+
+    def test_forget(self):
+        """``MorefCache.forget`` drops a single entry"""
+        cache = morefs.MorefCache(ttl=300)
+        cache.replace(morefs.FOLDER, {'alice': (vim.Folder, 'group-1'), 'bob': (vim.Folder, 'group-2')})
+        cache.forget(morefs.FOLDER, 'alice')
+
+        self.assertTrue(cache.get(morefs.FOLDER, 'alice') is None)
+        self.assertEqual(cache.get(morefs.FOLDER, 'bob'), (vim.Folder, 'group-2'))
+
+    def test_clear(self):
+        """``MorefCache.clear`` drops every entry"""
+        cache = morefs.MorefCache(ttl=300)
+        cache.replace(morefs.FOLDER, {'alice': (vim.Folder, 'group-1')})
+        cache.clear()
+
+        self.assertTrue(cache.get(morefs.FOLDER, 'alice') is None)
+
+
+class TestLookups(unittest.TestCase):
+    """A set of test cases for looking up folders and networks by name"""
+
+    def setUp(self):
+        """Every test gets an empty cache"""
+        patch.object(morefs, '_CACHE', morefs.MorefCache(ttl=300)).start()
+        self.addCleanup(patch.stopall)
+
+    @patch.object(morefs, '_load')
+    def test_get_folder(self, fake_load):
+        """``get_folder`` returns the folder with the supplied name"""
+        fake_load.return_value = {'alice': (vim.Folder, 'group-1')}
+
+        output = morefs.get_folder(MagicMock(), 'alice')
+
+        self.assertTrue(isinstance(output, vim.Folder))
+        self.assertEqual(output._moId, 'group-1')
+
+    @patch.object(morefs, '_is_named')
+    @patch.object(morefs, '_load')
+    def test_get_folder_cached(self, fake_load, fake_is_named):
+        """``get_folder`` only loads the folder names once"""
+        fake_load.return_value = {'alice': (vim.Folder, 'group-1')}
+        fake_is_named.return_value = True
+
+        morefs.get_folder(MagicMock(), 'alice')
+        morefs.get_folder(MagicMock(), 'alice')
+
+        self.assertEqual(fake_load.call_count, 1)
+
+    @patch.object(morefs, '_is_named')
+    @patch.object(morefs, '_load')
+    def test_get_folder_stale(self, fake_load, fake_is_named):
+        """``get_folder`` loads the folder names again if a cached folder was renamed or deleted"""
+        fake_load.side_effect = [{'alice': (vim.Folder, 'group-1')}, {'alice': (vim.Folder, 'group-2')}]
+        fake_is_named.return_value = False
+
+        morefs.get_folder(MagicMock(), 'alice')
+        output = morefs.get_folder(MagicMock(), 'alice')
+
+        self.assertEqual(fake_load.call_count, 2)
+        self.assertEqual(output._moId, 'group-2')
+
+    @patch.object(morefs, '_load')
+    def test_get_folder_missing(self, fake_load):
+        """``get_folder`` raises ValueError if there's no folder with the supplied name"""
+        fake_load.return_value = {}
+
+        with self.assertRaises(ValueError):
+            morefs.get_folder(MagicMock(), 'alice')
+
+    @patch.object(morefs, '_load')
+    def test_get_network(self, fake_load):
+        """``get_network`` keeps the type of a distributed port group"""
+        fake_load.return_value = {'someLAN': (vim.dvs.DistributedVirtualPortgroup, 'dvportgroup-1')}
+
+        output = morefs.get_network(MagicMock(), 'someLAN')
+
+        self.assertTrue(isinstance(output, vim.dvs.DistributedVirtualPortgroup))
+
+    @patch.object(morefs, '_load')
+    def test_get_network_missing(self, fake_load):
+        """``get_network`` raises ValueError if there's no network with the supplied name"""
+        fake_load.return_value = {}
+
+        with self.assertRaises(ValueError):
+            morefs.get_network(MagicMock(), 'someLAN')
+
+    @patch.object(morefs, '_load')
+    def test_get_or_create_folder(self, fake_load):
+        """``get_or_create_folder`` makes the folder if it does not exist"""
+        fake_load.side_effect = [{}, {'Stuff': (vim.Folder, 'group-1')}]
+        fake_vcenter = MagicMock()
+
+        output = morefs.get_or_create_folder(fake_vcenter, 'Stuff')
+
+        self.assertEqual(output._moId, 'group-1')
+        fake_vcenter.create_vm_folder.assert_called_with('{}/Stuff'.format(morefs.const.INF_VCENTER_TOP_LVL_DIR))
+
+    @patch.object(morefs, '_load')
+    def test_get_or_create_folder_exists(self, fake_load):
+        """``get_or_create_folder`` does not make a folder that already exists"""
+        fake_load.return_value = {'Stuff': (vim.Folder, 'group-1')}
+        fake_vcenter = MagicMock()
+
+        morefs.get_or_create_folder(fake_vcenter, 'Stuff')
+
+        fake_vcenter.create_vm_folder.assert_not_called()
+
+    @patch.object(morefs, '_load')
+    def test_warm(self, fake_load):
+        """``warm`` loads every folder and network, so the first lookups are hits"""
+        fake_load.side_effect = [{'alice': (vim.Folder, 'group-1')}, {'someLAN': (vim.Network, 'network-1')}]
+
+        morefs.warm(MagicMock())
+
+        self.assertEqual(morefs._CACHE.get(morefs.FOLDER, 'alice'), (vim.Folder, 'group-1'))
+        self.assertEqual(morefs._CACHE.get(morefs.NETWORK, 'someLAN'), (vim.Network, 'network-1'))
+
+
+class TestLoad(unittest.TestCase):
+    """A set of test cases for the calls ``morefs`` makes to vCenter"""
+
+    @patch.object(morefs.inventory, '_view_filter')
+    @patch.object(morefs.inventory, 'retrieve')
+    def test_load(self, fake_retrieve, fake_view_filter):
+        """``_load`` maps the name of every object to its type and moid"""
+        fake_retrieve.return_value = [make_content(vim.Folder('group-1'), 'alice'),
+                                      make_content(vim.Folder('group-2'), 'bob')]
+
+        output = morefs._load(MagicMock(), morefs.FOLDER)
+        expected = {'alice': (vim.Folder, 'group-1'), 'bob': (vim.Folder, 'group-2')}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(morefs.inventory, '_view_filter')
+    @patch.object(morefs.inventory, 'retrieve')
+    def test_load_destroys_view(self, fake_retrieve, fake_view_filter):
+        """``_load`` cleans up the container view, even when the lookup fails"""
+        fake_retrieve.side_effect = RuntimeError('testing')
+        fake_vcenter = MagicMock()
+
+        with self.assertRaises(RuntimeError):
+            morefs._load(fake_vcenter, morefs.NETWORK)
+
+        fake_vcenter.content.viewManager.CreateContainerView.return_value.DestroyView.assert_called()
+
+    @patch.object(morefs.inventory, 'get_properties')
+    def test_is_named(self, fake_get_properties):
+        """``_is_named`` is True when the object still has the same name"""
+        fake_get_properties.return_value = {'name': 'alice'}
+
+        self.assertTrue(morefs._is_named(MagicMock(), vim.Folder('group-1'), 'alice'))
+
+    @patch.object(morefs.inventory, 'get_properties')
+    def test_is_named_renamed(self, fake_get_properties):
+        """``_is_named`` is False when the object has a different name"""
+        fake_get_properties.return_value = {'name': 'bob'}
+
+        self.assertFalse(morefs._is_named(MagicMock(), vim.Folder('group-1'), 'alice'))
+
+    @patch.object(morefs.inventory, 'get_properties')
+    def test_is_named_deleted(self, fake_get_properties):
+        """``_is_named`` is False when the object no longer exists"""
+        fake_get_properties.side_effect = vmodl.fault.ManagedObjectNotFound()
+
+        self.assertFalse(morefs._is_named(MagicMock(), vim.Folder('group-1'), 'alice'))
+
+
+if __name__ == '__main__':
+    unittest.main()
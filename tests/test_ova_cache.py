@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in ova_cache.py
+"""
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_claritynow_api.lib.worker import ova_cache
+
+
+OVF = '<Envelope><NetworkSection><Network ovf:name="VM Network"></Network></NetworkSection></Envelope>'
+
+
+def _make_ova(path, disk=b'0123456789' * 100, compress=False):
+    """Write a small OVA file, with one descriptor and one disk"""
+    mode = 'w:gz' if compress else 'w'
+    with tarfile.open(path, mode) as the_tar:
+        for name, data in (('ClarityNow.ovf', OVF.encode()), ('ClarityNow-disk1.vmdk', disk)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            the_tar.addfile(info, io.BytesIO(data))
+
+
+class TestOvaCache(unittest.TestCase):
+    """A set of test cases for the OvaCache object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.images_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.images_dir)
+        self.ova_path = os.path.join(self.images_dir, 'ClarityNow-1.0.0.ova')
+        _make_ova(self.ova_path)
+
+    def test_get(self):
+        """``OvaCache.get`` returns the descriptor, networks and disks of the OVA"""
+        cache = ova_cache.OvaCache(max_entries=2)
+
+        output = cache.get(self.ova_path)
+
+        self.assertEqual(output.ovf, OVF)
+        self.assertEqual(output.networks, ['VM Network'])
+        self.assertEqual(list(output.disks.keys()), ['ClarityNow-disk1.vmdk'])
+
+    def test_get_cached(self):
+        """``OvaCache.get`` only parses an OVA once"""
+        cache = ova_cache.OvaCache(max_entries=2)
+        with patch.object(ova_cache, '_parse', wraps=ova_cache._parse) as fake_parse:
+            cache.get(self.ova_path)
+            cache.get(self.ova_path)
+
+        self.assertEqual(fake_parse.call_count, 1)
+
+    def test_get_changed(self):
+        """``OvaCache.get`` parses an OVA again once the file changes"""
+        cache = ova_cache.OvaCache(max_entries=2)
+        cache.get(self.ova_path)
+        _make_ova(self.ova_path, disk=b'different')
+
+        output = cache.get(self.ova_path)
+
+        self.assertEqual(output.disks['ClarityNow-disk1.vmdk'][1], len(b'different'))
+        self.assertEqual(len(cache._entries), 1)
+
+    def test_get_evicts(self):
+        """``OvaCache.get`` forgets the least recently used OVA when full"""
+        other_path = os.path.join(self.images_dir, 'ClarityNow-2.0.0.ova')
+        _make_ova(other_path)
+        cache = ova_cache.OvaCache(max_entries=1)
+        cache.get(self.ova_path)
+        cache.get(other_path)
+
+        output = [x[0] for x in cache._entries.keys()]
+
+        self.assertEqual(output, [other_path])
+
+    def test_get_missing(self):
+        """``OvaCache.get`` raises FileNotFoundError if the OVA does not exist"""
+        cache = ova_cache.OvaCache(max_entries=1)
+
+        with self.assertRaises(FileNotFoundError):
+            cache.get(os.path.join(self.images_dir, 'nope.ova'))
+
+    def test_get_compressed(self):
+        """``OvaCache.get`` returns None for a compressed OVA, since its disks can't be seeked to"""
+        _make_ova(self.ova_path, compress=True)
+        cache = ova_cache.OvaCache(max_entries=1)
+
+        self.assertTrue(cache.get(self.ova_path) is None)
+
+
+class TestCachedOva(unittest.TestCase):
+    """A set of test cases for opening OVA files via the cache"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.images_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.images_dir)
+        self.ova_path = os.path.join(self.images_dir, 'ClarityNow-1.0.0.ova')
+        _make_ova(self.ova_path)
+
+    def test_open_ova(self):
+        """``open_ova`` returns an Ova with the networks and descriptor of the file"""
+        ova = ova_cache.open_ova(self.ova_path)
+
+        self.assertTrue(isinstance(ova, ova_cache.CachedOva))
+        self.assertEqual(ova.networks, ['VM Network'])
+        self.assertEqual(ova.ovf, OVF)
+        self.assertEqual(ova.vmdks, ['ClarityNow-disk1.vmdk'])
+
+    @patch.object(ova_cache.upload, 'upload_disks')
+    def test_deploy(self, fake_upload_disks):
+        """``CachedOva.deploy`` uploads each disk from where it is in the OVA, then completes the lease"""
+        ova = ova_cache.open_ova(self.ova_path)
+        offset, size = ova._disks['ClarityNow-disk1.vmdk']
+        fake_lease = MagicMock()
+        fake_lease.info.deviceUrl = [MagicMock(importKey='disk-0', url='https://host/nfc/disk-0.vmdk')]
+        fake_spec = MagicMock()
+        fake_spec.fileItem = [MagicMock(path='ClarityNow-disk1.vmdk', deviceId='disk-0')]
+
+        ova.deploy(fake_spec, fake_lease, 'host')
+        disks = fake_upload_disks.call_args[0][1]
+        expected = [(offset, size, 'https://host/nfc/disk-0.vmdk')]
+
+        self.assertEqual(disks, expected)
+        self.assertTrue(fake_lease.Complete.called)
+
+    @patch.object(ova_cache.upload, 'upload_disks')
+    def test_deploy_fails(self, fake_upload_disks):
+        """``CachedOva.deploy`` aborts the lease if an upload fails"""
+        fake_upload_disks.side_effect = RuntimeError('testing')
+        ova = ova_cache.open_ova(self.ova_path)
+        fake_lease = MagicMock()
+        fake_lease.info.deviceUrl = [MagicMock(importKey='disk-0', url='https://host/nfc/disk-0.vmdk')]
+        fake_spec = MagicMock()
+        fake_spec.fileItem = [MagicMock(path='ClarityNow-disk1.vmdk', deviceId='disk-0')]
+
+        with self.assertRaises(RuntimeError):
+            ova.deploy(fake_spec, fake_lease, 'host')
+
+        self.assertTrue(fake_lease.Abort.called)
+        self.assertFalse(fake_lease.Complete.called)
+
+    @patch.object(ova_cache, 'Ova')
+    def test_open_ova_compressed(self, fake_Ova):
+        """``open_ova`` falls back to a regular Ova for a compressed file"""
+        _make_ova(self.ova_path, compress=True)
+
+        output = ova_cache.open_ova(self.ova_path)
+
+        self.assertTrue(output is fake_Ova.return_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in progress.py
+"""
+import unittest
+import threading
+from unittest.mock import patch, MagicMock
+
+import ujson
+from celery import Celery
+
+from vlab_claritynow_api.lib import progress
+
+
+def _events(stream):
+    """Parse the Server-Sent Events in a stream into (name, data) pairs"""
+    answer = []
+    for chunk in stream:
+        fields = dict(x.split(': ', 1) for x in chunk.strip().split('\n') if not x.startswith(':'))
+        if 'event' in fields:
+            answer.append((fields['event'], ujson.loads(fields['data'])))
+    return answer
+
+
+class TestReporter(unittest.TestCase):
+    """A set of test cases for the Reporter object"""
+
+    def test_update(self):
+        """``Reporter.update`` publishes the phase of every VM"""
+        fake_publish = MagicMock()
+        reporter = progress.Reporter(fake_publish)
+        reporter.update('box1', progress.DEPLOYING, 50)
+        reporter.update('box2', progress.IMAGE_OPENED)
+
+        published = fake_publish.call_args[0][0]
+        expected = {'machines': {'box1': {'phase': 'deploying', 'percent': 50},
+                                 'box2': {'phase': 'image_opened'}}}
+
+        self.assertEqual(published, expected)
+
+    def test_update_unchanged(self):
+        """``Reporter.update`` only publishes when something changed"""
+        fake_publish = MagicMock()
+        reporter = progress.Reporter(fake_publish)
+        reporter.update('box1', progress.DEPLOYING, 50)
+        reporter.update('box1', progress.DEPLOYING, 50)
+
+        self.assertEqual(fake_publish.call_count, 1)
+
+    def test_update_no_publish(self):
+        """``Reporter.update`` does nothing without a publish callable"""
+        reporter = progress.Reporter()
+        reporter.update('box1', progress.DEPLOYING)
+
+    def test_update_publish_fails(self):
+        """``Reporter.update`` logs, and doesn't raise, errors from publishing"""
+        fake_logger = MagicMock()
+        reporter = progress.Reporter(MagicMock(side_effect=RuntimeError('testing')), fake_logger)
+        reporter.update('box1', progress.DEPLOYING)
+
+        self.assertTrue(fake_logger.warning.called)
+
+    def test_task_reporter(self):
+        """``task_reporter`` saves progress as the custom state of the task"""
+        fake_task = MagicMock()
+        fake_task.request.id = 'some-task-id'
+        reporter = progress.task_reporter(fake_task, MagicMock())
+        reporter.update('box1', progress.CONFIGURING)
+
+        the_args, the_kwargs = fake_task.backend.store_result.call_args
+        expected = ('some-task-id', {'machines': {'box1': {'phase': 'configuring'}}}, 'PROGRESS')
+
+        self.assertEqual(the_args, expected)
+        self.assertTrue(the_kwargs['request'] is fake_task.request)
+
+    def test_task_reporter_other_thread(self):
+        """``task_reporter`` publishes with the request of the task, even from another thread"""
+        app = Celery('testing')
+        @app.task(bind=True)
+        def the_task(self):
+            pass
+        the_task.push_request(id='some-task-id', reply_to='some-queue')
+        self.addCleanup(the_task.pop_request)
+        # Celery gives every thread its own backend
+        fake_store_result = patch.object(type(the_task.backend), 'store_result').start()
+        self.addCleanup(patch.stopall)
+        reporter = progress.task_reporter(the_task, MagicMock())
+        publisher = threading.Thread(target=reporter.update, args=('box1', progress.DEPLOYING))
+        publisher.start()
+        publisher.join()
+
+        the_args, the_kwargs = fake_store_result.call_args
+
+        self.assertEqual(the_args[0], 'some-task-id')
+        self.assertEqual(the_kwargs['request'].reply_to, 'some-queue')
+
+
+@patch.object(progress.time, 'sleep')
+class TestFollow(unittest.TestCase):
+    """A set of test cases for the ``follow`` function"""
+
+    def _result(self, *metas):
+        fake_result = MagicMock()
+        fake_result.backend.get_task_meta.side_effect = list(metas)
+        return fake_result
+
+    def test_follow(self, fake_sleep):
+        """``follow`` sends an event for every change, then the result of the task"""
+        moving = {'status': 'PROGRESS', 'result': {'machines': {'box1': {'phase': 'deploying'}}}}
+        fake_result = self._result({'status': 'PENDING', 'result': None},
+                                   moving,
+                                   moving,
+                                   {'status': 'SUCCESS', 'result': {'content': {'box1': {}}, 'error': None, 'params': {}}})
+
+        output = _events(progress.follow(fake_result, poll_interval=1, heartbeat=100, timeout=100))
+        expected = [('progress', {'status': 'PENDING', 'content': {}}),
+                    ('progress', {'status': 'PROGRESS', 'content': {'machines': {'box1': {'phase': 'deploying'}}}}),
+                    ('result', {'status': 'SUCCESS', 'content': {'box1': {}}, 'error': None, 'params': {}})]
+
+        self.assertEqual(output, expected)
+
+    def test_follow_no_etag(self, fake_sleep):
+        """``follow`` does not send the tag of the result"""
+        fake_result = self._result({'status': 'SUCCESS', 'result': {'content': {}, 'error': None, 'params': {}, 'etag': 'abc'}})
+
+        output = _events(progress.follow(fake_result, poll_interval=1, heartbeat=100, timeout=100))
+
+        self.assertTrue('etag' not in output[-1][1])
+
+    def test_follow_failure(self, fake_sleep):
+        """``follow`` sends the error of a task that failed"""
+        fake_result = self._result({'status': 'FAILURE', 'result': RuntimeError('testing')})
+
+        output = _events(progress.follow(fake_result, poll_interval=1, heartbeat=100, timeout=100))
+        expected = [('result', {'status': 'FAILURE', 'error': 'testing'})]
+
+        self.assertEqual(output, expected)
+
+    @patch.object(progress.time, 'time')
+    def test_follow_heartbeat(self, fake_time, fake_sleep):
+        """``follow`` sends a comment when there's been no event for a while"""
+        fake_time.side_effect = [0, 0, 20, 40]
+        pending = {'status': 'PENDING', 'result': None}
+        fake_result = self._result(pending, pending, {'status': 'SUCCESS', 'result': {}})
+
+        output = list(progress.follow(fake_result, poll_interval=1, heartbeat=15, timeout=100))
+
+        self.assertTrue(': keep-alive\n\n' in output)
+
+    @patch.object(progress.time, 'time')
+    def test_follow_timeout(self, fake_time, fake_sleep):
+        """``follow`` gives up on a task that runs for too long"""
+        fake_time.side_effect = [0, 200]
+        fake_result = self._result({'status': 'STARTED', 'result': None})
+
+        output = _events(progress.follow(fake_result, poll_interval=1, heartbeat=15, timeout=100))
+        expected = [('progress', {'status': 'STARTED', 'content': {}}),
+                    ('timeout', {'status': 'STARTED'})]
+
+        self.assertEqual(output, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
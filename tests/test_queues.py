@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in queues.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from celery import Celery
+
+from vlab_claritynow_api.lib import queues
+
+
+class TestConfigure(unittest.TestCase):
+    """A set of test cases for the ``configure`` function"""
+    @classmethod
+    def setUpClass(cls):
+        cls.app = Celery('testing', broker='memory://')
+        queues.configure(cls.app)
+
+    def test_fast_route(self):
+        """``configure`` sends fast work to the fast queue, with a high priority"""
+        route = self.app.amqp.router.route({}, 'claritynow.show', (), {})
+
+        self.assertEqual(route['routing_key'], queues.FAST_QUEUE)
+        self.assertEqual(route['priority'], queues.FAST_PRIORITY)
+
+    def test_slow_route(self):
+        """``configure`` sends slow work to the slow queue, with a lower priority"""
+        route = self.app.amqp.router.route({}, 'claritynow.create', (), {})
+
+        self.assertEqual(route['routing_key'], queues.SLOW_QUEUE)
+        self.assertTrue(route['priority'] < queues.FAST_PRIORITY)
+
+    def test_refill_priority(self):
+        """``configure`` gives refilling the warm pool a lower priority than creates"""
+        refill = self.app.amqp.router.route({}, 'claritynow.refill_warm_pool', (), {})
+        create = self.app.amqp.router.route({}, 'claritynow.create', (), {})
+
+        self.assertTrue(refill['priority'] < create['priority'])
+
+    def test_default_queue(self):
+        """``configure`` sends unknown tasks to the slow queue"""
+        route = self.app.amqp.router.route({}, 'claritynow.someNewThing', (), {})
+
+        self.assertEqual(route['queue'].name, queues.SLOW_QUEUE)
+
+    def test_priority_queues(self):
+        """``configure`` declares every queue with support for priorities"""
+        for queue in self.app.conf.task_queues:
+            self.assertEqual(queue.queue_arguments, {'x-max-priority': queues.MAX_PRIORITY})
+
+    def test_time_limits(self):
+        """``configure`` gives fast tasks a shorter time limit than slow tasks"""
+        annotations = self.app.conf.task_annotations
+
+        self.assertTrue(annotations['claritynow.show']['time_limit'] < annotations['claritynow.create']['time_limit'])
+
+    def test_every_task_routed(self):
+        """Every task the worker defines has a route"""
+        from vlab_claritynow_api.lib.worker import tasks
+        defined = {x for x in tasks.app.tasks.keys() if x.startswith('claritynow.')}
+
+        self.assertEqual(defined, set(queues.ROUTES.keys()))
+
+
+class TestQueueMetrics(unittest.TestCase):
+    """A set of test cases for recording how long tasks wait, and how many are waiting"""
+
+    def test_stamp_sent(self):
+        """``_stamp_sent`` records when the task was sent"""
+        headers = {}
+        queues._stamp_sent(headers=headers)
+
+        self.assertTrue(isinstance(headers['sent_at'], float))
+
+    @patch.object(queues.time, 'time')
+    def test_record_wait(self, fake_time):
+        """``_record_wait`` observes how long the task was in its queue"""
+        fake_time.return_value = 110
+        fake_task = MagicMock()
+        fake_task.request.get.return_value = 100
+        fake_task.request.delivery_info = {'routing_key': 'test_record_wait'}
+
+        queues._record_wait(task=fake_task)
+        output = queues.QUEUE_WAIT.value(queue='test_record_wait')
+
+        self.assertEqual(output['sum'], 10)
+
+    def test_record_wait_no_stamp(self):
+        """``_record_wait`` ignores tasks sent without a timestamp"""
+        fake_task = MagicMock()
+        fake_task.request.get.return_value = None
+        fake_task.request.delivery_info = {'routing_key': 'test_record_wait_no_stamp'}
+
+        queues._record_wait(task=fake_task)
+        output = queues.QUEUE_WAIT.value(queue='test_record_wait_no_stamp')
+
+        self.assertEqual(output['count'], 0)
+
+    def test_sample_depths(self):
+        """``sample_depths`` sets the depth gauge of every queue"""
+        fake_app = MagicMock()
+        fake_conn = fake_app.connection_for_read.return_value.__enter__.return_value
+        fake_conn.channel.return_value.queue_declare.return_value = ('someQueue', 7, 1)
+
+        output = queues.sample_depths(fake_app, MagicMock())
+        expected = {queues.SLOW_QUEUE: 7, queues.FAST_QUEUE: 7}
+
+        self.assertEqual(output, expected)
+        self.assertEqual(queues.QUEUE_DEPTH.value(queue=queues.FAST_QUEUE), 7)
+
+    def test_sample_depths_missing(self):
+        """``sample_depths`` skips a queue the broker doesn't have yet"""
+        fake_app = MagicMock()
+        fake_conn = fake_app.connection_for_read.return_value.__enter__.return_value
+        fake_conn.channel.return_value.queue_declare.side_effect = [RuntimeError('NOT_FOUND'), ('someQueue', 2, 1)]
+
+        output = queues.sample_depths(fake_app, MagicMock())
+        expected = {queues.FAST_QUEUE: 2}
+
+        self.assertEqual(output, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
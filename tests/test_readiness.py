@@ -0,0 +1,145 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in readiness.py
+"""
+import socket
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_claritynow_api.lib import readiness
+
+
+class TestReadiness(unittest.TestCase):
+    """A set of test cases for the ``Readiness`` object"""
+
+    def test_status_not_checked(self):
+        """``Readiness`` is not ready before the checks have run"""
+        ready = readiness.Readiness({'broker': lambda: None}, interval=15)
+
+        output, _ = ready.status()
+
+        self.assertFalse(output)
+
+    def test_status(self):
+        """``Readiness`` is ready when every check worked"""
+        ready = readiness.Readiness({'broker': lambda: None, 'images': lambda: None}, interval=15)
+        ready.run_checks()
+
+        output, checks = ready.status()
+
+        self.assertTrue(output)
+        self.assertEqual(sorted(checks.keys()), ['broker', 'images'])
+
+    def test_status_failed(self):
+        """``Readiness`` is not ready when any check failed, and reports why"""
+        broken = MagicMock(side_effect=RuntimeError('testing'))
+        ready = readiness.Readiness({'broker': lambda: None, 'images': broken}, interval=15)
+        ready.run_checks()
+
+        output, checks = ready.status()
+
+        self.assertFalse(output)
+        self.assertEqual(checks['images']['error'], 'testing')
+
+    def test_status_informational(self):
+        """``Readiness`` is ready when only an informational check failed, and still reports it"""
+        broken = MagicMock(side_effect=RuntimeError('testing'))
+        ready = readiness.Readiness({'broker': lambda: None, 'images': broken}, interval=15, informational={'images'})
+        ready.run_checks()
+
+        output, checks = ready.status()
+
+        self.assertTrue(output)
+        self.assertFalse(checks['images']['ok'])
+        self.assertFalse(checks['images']['required'])
+
+    @patch.object(readiness.time, 'time')
+    def test_status_stale(self, fake_time):
+        """``Readiness`` is not ready when the checks stopped running"""
+        fake_time.return_value = 100
+        ready = readiness.Readiness({'broker': lambda: None}, interval=15)
+        ready.run_checks()
+        fake_time.return_value = 200
+
+        output, _ = ready.status()
+
+        self.assertFalse(output)
+
+    def test_status_does_not_check(self):
+        """``Readiness.status`` only reports results; it never runs a check"""
+        check = MagicMock()
+        ready = readiness.Readiness({'broker': check}, interval=15)
+        ready.run_checks()
+
+        for _ in range(3):
+            ready.status()
+
+        self.assertEqual(check.call_count, 1)
+
+    def test_start(self):
+        """``Readiness.start`` runs the checks in the background"""
+        check = MagicMock()
+        ready = readiness.Readiness({'broker': check}, interval=15)
+
+        ready.start()
+        try:
+            for _ in range(100):
+                if ready.status()[1]:
+                    break
+                readiness.time.sleep(0.01)
+        finally:
+            ready.stop()
+
+        check.assert_called()
+
+    def test_dependency_up(self):
+        """``Readiness`` records the outcome of every check as a gauge"""
+        broken = MagicMock(side_effect=RuntimeError('testing'))
+        ready = readiness.Readiness({'test_dependency_up': broken}, interval=15)
+        ready.run_checks()
+
+        self.assertEqual(readiness.DEPENDENCY_UP.value(check='test_dependency_up'), 0)
+
+
+class TestChecks(unittest.TestCase):
+    """A set of test cases for the checks of each dependency"""
+
+    def test_check_broker(self):
+        """``check_broker`` connects to the broker, and gives up after the timeout"""
+        fake_celery_app = MagicMock()
+
+        readiness.check_broker(fake_celery_app, timeout=5)()
+        _, the_kwargs = fake_celery_app.connection_for_write.call_args
+
+        self.assertEqual(the_kwargs['connect_timeout'], 5)
+        fake_celery_app.connection_for_write.return_value.__enter__.return_value.connect.assert_called()
+
+    @patch.object(readiness.os, 'listdir')
+    def test_check_images(self, fake_listdir):
+        """``check_images`` raises if the images directory cannot be read"""
+        fake_listdir.side_effect = FileNotFoundError('testing')
+
+        with self.assertRaises(FileNotFoundError):
+            readiness.check_images('/images')()
+
+    def test_check_vcenter(self):
+        """``check_vcenter`` opens a TCP connection to vCenter"""
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            readiness.check_vcenter('127.0.0.1', server.getsockname()[1], timeout=1)()
+        finally:
+            server.close()
+
+    @patch.object(readiness.socket, 'create_connection')
+    def test_check_vcenter_down(self, fake_create_connection):
+        """``check_vcenter`` raises if vCenter cannot be reached"""
+        fake_create_connection.side_effect = ConnectionRefusedError('testing')
+
+        with self.assertRaises(ConnectionRefusedError):
+            readiness.check_vcenter('localhost', 443, timeout=1)()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in result_store.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from celery import Celery
+
+from vlab_claritynow_api.lib import result_store
+
+
+class TestBackendUrl(unittest.TestCase):
+    """A set of test cases for the ``backend_url`` function"""
+
+    def test_sqlite(self):
+        """``backend_url`` points Celery at the SQLite backend for sqlite:// URLs"""
+        output = result_store.backend_url('sqlite:///results/claritynow.db')
+        expected = 'vlab_claritynow_api.lib.result_store:SQLiteBackend+sqlite:///results/claritynow.db'
+
+        self.assertEqual(output, expected)
+
+    def test_other(self):
+        """``backend_url`` leaves other URLs alone"""
+        output = result_store.backend_url('rpc://')
+        expected = 'rpc://'
+
+        self.assertEqual(output, expected)
+
+
+class TestSQLiteBackend(unittest.TestCase):
+    """A set of test cases for the ``SQLiteBackend`` object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.url = 'sqlite://{}'.format(os.path.join(self.tmp_dir, 'results.db'))
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.tmp_dir)
+
+    def make_app(self, expires=3600):
+        """Make a Celery app that uses the SQLite result store"""
+        app = Celery('claritynow', backend=result_store.backend_url(self.url), broker='memory://')
+        app.conf.result_expires = expires
+        return app
+
+    def test_shared(self):
+        """``SQLiteBackend`` - a result stored by one process can be read by another"""
+        self.make_app().backend.store_result('some-task-id', {'content': {}, 'error': None}, 'SUCCESS')
+
+        result = self.make_app().AsyncResult('some-task-id')
+
+        self.assertEqual(result.status, 'SUCCESS')
+        self.assertEqual(result.result, {'content': {}, 'error': None})
+
+    def test_unknown(self):
+        """``SQLiteBackend`` - an unknown task is PENDING"""
+        result = self.make_app().AsyncResult('some-task-id')
+
+        self.assertEqual(result.status, 'PENDING')
+
+    def test_expires(self):
+        """``SQLiteBackend`` - results are not returned once they expire"""
+        app = self.make_app(expires=10)
+        app.backend.store_result('some-task-id', {'content': {}, 'error': None}, 'SUCCESS')
+
+        with patch.object(result_store.time, 'time', return_value=result_store.time.time() + 11):
+            result = app.AsyncResult('some-task-id')
+            status = result.status
+
+        self.assertEqual(status, 'PENDING')
+
+    def test_cleanup(self):
+        """``SQLiteBackend`` - ``cleanup`` deletes expired results"""
+        app = self.make_app(expires=10)
+        app.backend.store_result('some-task-id', {'content': {}, 'error': None}, 'SUCCESS')
+
+        with patch.object(result_store.time, 'time', return_value=result_store.time.time() + 11):
+            app.backend.cleanup()
+        rows = app.backend._conn().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+        self.assertEqual(rows, 0)
+
+    def test_add(self):
+        """``SQLiteBackend`` - ``add`` only saves a key that isn't saved already"""
+        backend = self.make_app().backend
+
+        first = backend.add('some-key', 'one')
+        second = self.make_app().backend.add('some-key', 'two')
+
+        self.assertTrue(first)
+        self.assertFalse(second)
+        self.assertEqual(backend.get('some-key'), 'one')
+
+    def test_add_expired(self):
+        """``SQLiteBackend`` - ``add`` replaces a key that has expired"""
+        backend = self.make_app().backend
+        backend.add('some-key', 'one', ttl=10)
+
+        with patch.object(result_store.time, 'time', return_value=result_store.time.time() + 11):
+            added = backend.add('some-key', 'two')
+            value = backend.get('some-key')
+
+        self.assertTrue(added)
+        self.assertEqual(value, 'two')
+
+    def test_bad_url(self):
+        """``SQLiteBackend`` - raises ValueError without a sqlite:// URL"""
+        with self.assertRaises(ValueError):
+            result_store.SQLiteBackend(url=None, app=self.make_app())
+
+
+if __name__ == '__main__':
+    unittest.main()
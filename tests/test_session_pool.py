@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in session_pool.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_claritynow_api.lib.worker import session_pool
+
+
+class TestSessionPool(unittest.TestCase):
+    """A set of test cases for the SessionPool object"""
+
+    def test_reuses_session(self):
+        """``SessionPool`` only logs into vCenter once for back-to-back borrows"""
+        fake_connect = MagicMock()
+        pool = session_pool.SessionPool(size=2, idle_timeout=60, connect=fake_connect)
+
+        with pool.borrow():
+            pass
+        with pool.borrow():
+            pass
+
+        self.assertEqual(fake_connect.call_count, 1)
+
+    def test_yields_session(self):
+        """``SessionPool.borrow`` yields the object returned by the connect function"""
+        fake_connect = MagicMock()
+        pool = session_pool.SessionPool(size=1, idle_timeout=60, connect=fake_connect)
+
+        with pool.borrow() as vcenter:
+            output = vcenter
+        expected = fake_connect.return_value
+
+        self.assertTrue(output is expected)
+
+    @patch.object(session_pool, '_is_alive')
+    def test_fresh_networks(self, fake_is_alive):
+        """``SessionPool`` sees networks made since the session was last borrowed"""
+        networks = {'lan1': 'net-1'}
+
+        class FakeVCenter(object):
+            _net_cache = None
+
+            @property
+            def networks(self):
+                if not self._net_cache:
+                    self._net_cache = dict(networks)
+                return self._net_cache
+
+        fake_is_alive.return_value = True
+        fake_connect = MagicMock(side_effect=FakeVCenter)
+        pool = session_pool.SessionPool(size=1, idle_timeout=60, connect=fake_connect)
+        with pool.borrow() as vcenter:
+            vcenter.networks
+        networks['lan2'] = 'net-2'
+        with pool.borrow() as vcenter:
+            output = vcenter.networks
+        expected = {'lan1': 'net-1', 'lan2': 'net-2'}
+
+        self.assertEqual(output, expected)
+        self.assertEqual(fake_connect.call_count, 1)
+
+    def test_concurrent_borrows(self):
+        """``SessionPool`` opens a new session when all the existing ones are borrowed"""
+        fake_connect = MagicMock()
+        fake_connect.side_effect = [MagicMock(), MagicMock()]
+        pool = session_pool.SessionPool(size=2, idle_timeout=60, connect=fake_connect)
+
+        with pool.borrow() as first:
+            with pool.borrow() as second:
+                pass
+
+        self.assertFalse(first is second)
+
+    @patch.object(session_pool, '_is_alive')
+    def test_reconnects_dead_session(self, fake_is_alive):
+        """``SessionPool`` replaces sessions that are no longer authenticated"""
+        fake_is_alive.return_value = False
+        fake_connect = MagicMock()
+        pool = session_pool.SessionPool(size=1, idle_timeout=60, connect=fake_connect)
+        reconnects = session_pool.POOL_RECONNECTS.value()
+
+        with pool.borrow():
+            pass
+        with pool.borrow():
+            pass
+
+        self.assertEqual(fake_connect.call_count, 2)
+        self.assertEqual(session_pool.POOL_RECONNECTS.value(), reconnects + 1)
+
+    @patch.object(session_pool.time, 'time')
+    def test_idle_timeout(self, fake_time):
+        """``SessionPool`` replaces sessions that have been idle for too long"""
+        fake_time.side_effect = [100, 500, 501]
+        fake_connect = MagicMock()
+        pool = session_pool.SessionPool(size=1, idle_timeout=60, connect=fake_connect)
+
+        with pool.borrow():
+            pass
+        with pool.borrow():
+            pass
+
+        self.assertEqual(fake_connect.call_count, 2)
+        fake_connect.return_value.close.assert_called()
+
+    def test_connect_failure(self):
+        """``SessionPool`` does not leak a slot when unable to connect to vCenter"""
+        fake_connect = MagicMock()
+        fake_connect.side_effect = [RuntimeError('testing'), MagicMock()]
+        pool = session_pool.SessionPool(size=1, idle_timeout=60, connect=fake_connect)
+
+        with self.assertRaises(RuntimeError):
+            with pool.borrow():
+                pass
+        with pool.borrow():
+            pass
+
+        self.assertEqual(fake_connect.call_count, 2)
+
+    def test_bad_size(self):
+        """``SessionPool`` raises ValueError if the pool size is less than 1"""
+        with self.assertRaises(ValueError):
+            session_pool.SessionPool(size=0, idle_timeout=60)
+
+    def test_close(self):
+        """``SessionPool.close`` logs out of idle sessions"""
+        fake_connect = MagicMock()
+        pool = session_pool.SessionPool(size=1, idle_timeout=60, connect=fake_connect)
+        with pool.borrow():
+            pass
+
+        pool.close()
+
+        fake_connect.return_value.close.assert_called()
+
+    @patch.object(session_pool.os, 'getpid')
+    def test_get_pool_per_process(self, fake_getpid):
+        """``get_pool`` makes a new pool after the process forks"""
+        fake_getpid.return_value = 1
+        first = session_pool.get_pool()
+        fake_getpid.return_value = 2
+        second = session_pool.get_pool()
+
+        self.assertFalse(first is second)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in single_flight.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_claritynow_api.lib import single_flight
+
+
+class TestSingleFlight(unittest.TestCase):
+    """A set of test cases for the ``SingleFlight`` object"""
+
+    def test_coalesces(self):
+        """``SingleFlight`` hands back the same task while it's not done"""
+        flight = single_flight.SingleFlight('testing', window=5)
+        send_task = MagicMock()
+        send_task.return_value.id = 'task-1'
+        send_task.return_value.ready.return_value = False
+
+        first = flight.send('alice', send_task)
+        second = flight.send('alice', send_task)
+
+        self.assertEqual(first, second)
+        self.assertEqual(send_task.call_count, 1)
+
+    def test_per_key(self):
+        """``SingleFlight`` does not share tasks between different keys"""
+        flight = single_flight.SingleFlight('testing', window=5)
+        send_task = MagicMock()
+
+        flight.send('alice', send_task)
+        flight.send('bob', send_task)
+
+        self.assertEqual(send_task.call_count, 2)
+
+    def test_done(self):
+        """``SingleFlight`` sends a new task once the last one is done"""
+        flight = single_flight.SingleFlight('testing', window=5)
+        send_task = MagicMock()
+        send_task.return_value.ready.return_value = True
+
+        flight.send('alice', send_task)
+        flight.send('alice', send_task)
+
+        self.assertEqual(send_task.call_count, 2)
+
+    @patch.object(single_flight.time, 'time')
+    def test_window(self, fake_time):
+        """``SingleFlight`` sends a new task once the window has passed, even if the last one isn't done"""
+        fake_time.side_effect = [100, 106]
+        flight = single_flight.SingleFlight('testing', window=5)
+        send_task = MagicMock()
+        send_task.return_value.ready.return_value = False
+
+        flight.send('alice', send_task)
+        flight.send('alice', send_task)
+
+        self.assertEqual(send_task.call_count, 2)
+
+    def test_disabled(self):
+        """``SingleFlight`` always sends a new task when the window is zero"""
+        flight = single_flight.SingleFlight('testing', window=0)
+        send_task = MagicMock()
+
+        flight.send('alice', send_task)
+        flight.send('alice', send_task)
+
+        self.assertEqual(send_task.call_count, 2)
+
+    def test_forget(self):
+        """``SingleFlight`` sends a new task after the key is forgotten"""
+        flight = single_flight.SingleFlight('testing', window=5)
+        send_task = MagicMock()
+
+        flight.send('alice', send_task)
+        flight.forget('alice')
+        flight.send('alice', send_task)
+
+        self.assertEqual(send_task.call_count, 2)
+
+    def test_drops_locks(self):
+        """``SingleFlight`` does not keep a lock for a key once nobody is using it"""
+        flight = single_flight.SingleFlight('testing', window=5)
+
+        flight.send('alice', MagicMock())
+
+        self.assertEqual(len(flight._locks), 0)
+
+    def test_drops_locks_on_error(self):
+        """``SingleFlight`` drops the lock for a key when sending the task fails"""
+        flight = single_flight.SingleFlight('testing', window=5)
+        send_task = MagicMock(side_effect=RuntimeError('testing'))
+
+        with self.assertRaises(RuntimeError):
+            flight.send('alice', send_task)
+
+        self.assertEqual(len(flight._locks), 0)
+
+    def test_hits(self):
+        """``SingleFlight`` counts how many requests were coalesced"""
+        flight = single_flight.SingleFlight('test_hits', window=5)
+        send_task = MagicMock()
+        send_task.return_value.ready.return_value = False
+
+        flight.send('alice', send_task)
+        flight.send('alice', send_task)
+        flight.send('alice', send_task)
+
+        self.assertEqual(single_flight.metrics.counter('claritynow_coalesced_total').value(request='test_hits'), 2)
+
+
+class TestKeyedLocks(unittest.TestCase):
+    """A set of test cases for the ``KeyedLocks`` object"""
+
+    def test_hold(self):
+        """``KeyedLocks.hold`` locks the key until the block is done"""
+        locks = single_flight.KeyedLocks()
+
+        with locks.hold('alice'):
+            held = len(locks)
+
+        self.assertEqual(held, 1)
+        self.assertEqual(len(locks), 0)
+
+    def test_waiters(self):
+        """``KeyedLocks`` keeps the lock while another thread waits on it"""
+        locks = single_flight.KeyedLocks()
+        started = single_flight.threading.Event()
+        done = []
+
+        def wait_on_alice():
+            started.set()
+            with locks.hold('alice'):
+                done.append(len(locks))
+
+        with locks.hold('alice'):
+            waiter = single_flight.threading.Thread(target=wait_on_alice)
+            waiter.start()
+            started.wait(1)
+            # Give the waiter time to block on the lock
+            waiter.join(0.05)
+            self.assertEqual(done, [])
+        waiter.join(1)
+
+        self.assertEqual(done, [1])
+        self.assertEqual(len(locks), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
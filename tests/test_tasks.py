@@ -10,18 +10,33 @@ from vlab_claritynow_api.lib.worker import tasks
 
 class TestTasks(unittest.TestCase):
     """A set of test cases for tasks.py"""
+    @patch.object(tasks, 'session_pool')
     @patch.object(tasks, 'vmware')
-    def test_show_ok(self, fake_vmware):
+    def test_show_ok(self, fake_vmware, fake_session_pool):
         """``show`` returns a dictionary when everything works as expected"""
         fake_vmware.show_claritynow.return_value = {'worked': True}
 
         output = tasks.show(username='bob', txn_id='myId')
-        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {},
+                    'etag': tasks.etags.content_etag({'worked': True})}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_show_etag(self, fake_vmware, fake_session_pool):
+        """``show`` tags the result the same way, even though the console URLs are new every time"""
+        fake_vmware.show_claritynow.side_effect = [{'myBox': {'state': 'poweredOn', 'console': 'https://ticket-1'}},
+                                                   {'myBox': {'state': 'poweredOn', 'console': 'https://ticket-2'}}]
+
+        first = tasks.show(username='bob', txn_id='myId')
+        second = tasks.show(username='bob', txn_id='myId')
+
+        self.assertEqual(first['etag'], second['etag'])
+
+    @patch.object(tasks, 'session_pool')
     @patch.object(tasks, 'vmware')
-    def test_show_value_error(self, fake_vmware):
+    def test_show_value_error(self, fake_vmware, fake_session_pool):
         """``show`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.show_claritynow.side_effect = [ValueError("testing")]
 
@@ -30,8 +45,31 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'session_pool')
     @patch.object(tasks, 'vmware')
-    def test_create_ok(self, fake_vmware):
+    def test_inventory_ok(self, fake_vmware, fake_session_pool):
+        """``inventory`` returns a dictionary when everything works as expected"""
+        fake_vmware.inventory_claritynow.return_value = {'vms': [], 'cursor': None}
+
+        output = tasks.inventory(cursor='', per_page=10, txn_id='myId')
+        expected = {'content' : {'vms': [], 'cursor': None}, 'error': None, 'params': {'cursor': '', 'per_page': 10},
+                    'etag': tasks.etags.content_etag({'vms': [], 'cursor': None})}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_inventory_value_error(self, fake_vmware, fake_session_pool):
+        """``inventory`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.inventory_claritynow.side_effect = [ValueError("testing")]
+
+        output = tasks.inventory(cursor='', per_page=10, txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_create_ok(self, fake_vmware, fake_session_pool):
         """``create`` returns a dictionary when everything works as expected"""
         fake_vmware.create_claritynow.return_value = {'worked': True}
 
@@ -44,8 +82,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'session_pool')
     @patch.object(tasks, 'vmware')
-    def test_create_value_error(self, fake_vmware):
+    def test_create_value_error(self, fake_vmware, fake_session_pool):
         """``create`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.create_claritynow.side_effect = [ValueError("testing")]
 
@@ -58,8 +97,132 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'refill_warm_pool')
+    @patch.object(tasks, 'warm_pool')
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_create_refills_warm_pool(self, fake_vmware, fake_session_pool, fake_warm_pool, fake_refill_warm_pool):
+        """``create`` refills the warm pool after creating a pooled image"""
+        fake_warm_pool.pool_sizes.return_value = {'0.0.1': 2}
+
+        tasks.create(username='bob',
+                     machine_name='claritynowBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     txn_id='myId')
+
+        fake_refill_warm_pool.delay.assert_called_with(txn_id='myId')
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_delete_batch_ok(self, fake_vmware, fake_session_pool):
+        """``delete_batch`` returns a dictionary when everything works as expected"""
+        fake_vmware.delete_claritynow_batch.return_value = {'deleted': ['box1'], 'failed': {}}
+
+        output = tasks.delete_batch(username='bob', machine_names=['box1'], txn_id='myId')
+        expected = {'content' : {'deleted': ['box1'], 'failed': {}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'reap_templates')
+    @patch.object(tasks, 'const')
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_delete_batch_reaps_templates(self, fake_vmware, fake_session_pool, fake_const, fake_reap_templates):
+        """``delete_batch`` looks for retired templates to destroy when making linked clones"""
+        fake_const.VLAB_CLARITYNOW_PROVISION_MODE = 'linked_clone'
+        fake_const.VLAB_CLARITYNOW_LOG_LEVEL = 'INFO'
+
+        tasks.delete_batch(username='bob', machine_names=['box1'], txn_id='myId')
+
+        fake_reap_templates.delay.assert_called_with(txn_id='myId')
+
+    @patch.object(tasks, 'templates')
+    @patch.object(tasks, 'session_pool')
+    def test_reap_templates(self, fake_session_pool, fake_templates):
+        """``reap_templates`` returns the names of the templates it destroyed"""
+        fake_templates.reap_retired.return_value = ['ClarityNow-template-1.0.0-retired-1']
+
+        output = tasks.reap_templates(txn_id='myId')
+        expected = {'content' : {'destroyed': ['ClarityNow-template-1.0.0-retired-1']}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_delete_batch_value_error(self, fake_vmware, fake_session_pool):
+        """``delete_batch`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.delete_claritynow_batch.side_effect = [ValueError("testing")]
+
+        output = tasks.delete_batch(username='bob', machine_names=None, txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_create_batch_ok(self, fake_vmware, fake_session_pool):
+        """``create_batch`` returns a dictionary when everything works as expected"""
+        fake_vmware.create_claritynow_batch.return_value = {'created': {'box1': {}}, 'failed': {}}
+
+        output = tasks.create_batch(username='bob',
+                                    machine_names=['box1'],
+                                    image='0.0.1',
+                                    network='someLAN',
+                                    txn_id='myId')
+        expected = {'content' : {'created': {'box1': {}}, 'failed': {}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_create_batch_value_error(self, fake_vmware, fake_session_pool):
+        """``create_batch`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.create_claritynow_batch.side_effect = [ValueError("testing")]
+
+        output = tasks.create_batch(username='bob',
+                                    machine_names=['box1'],
+                                    image='0.0.1',
+                                    network='someLAN',
+                                    txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_refill_warm_pool(self, fake_vmware, fake_session_pool):
+        """``refill_warm_pool`` returns the number of ready VMs per image"""
+        fake_vmware.refill_warm_pool.return_value = ({'0.0.1': 2}, False)
+
+        output = tasks.refill_warm_pool(txn_id='myId')
+        expected = {'content' : {'0.0.1': 2}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_refill_warm_pool_unfinished(self, fake_vmware, fake_session_pool):
+        """``refill_warm_pool`` sends another refill when it parked as many VMs as one run may"""
+        fake_vmware.refill_warm_pool.return_value = ({'0.0.1': 2}, True)
+        refill_warm_pool = tasks.refill_warm_pool
+
+        with patch.object(tasks, 'refill_warm_pool') as fake_refill_warm_pool:
+            refill_warm_pool(txn_id='myId')
+
+        fake_refill_warm_pool.delay.assert_called_with(txn_id='myId')
+
+    @patch.object(tasks, 'session_pool')
+    @patch.object(tasks, 'vmware')
+    def test_refill_warm_pool_value_error(self, fake_vmware, fake_session_pool):
+        """``refill_warm_pool`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.refill_warm_pool.side_effect = [ValueError("testing")]
+
+        output = tasks.refill_warm_pool(txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'session_pool')
     @patch.object(tasks, 'vmware')
-    def test_delete_ok(self, fake_vmware):
+    def test_delete_ok(self, fake_vmware, fake_session_pool):
         """``delete`` returns a dictionary when everything works as expected"""
         fake_vmware.delete_claritynow.return_value = {'worked': True}
 
@@ -68,8 +231,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'session_pool')
     @patch.object(tasks, 'vmware')
-    def test_delete_value_error(self, fake_vmware):
+    def test_delete_value_error(self, fake_vmware, fake_session_pool):
         """``delete`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.delete_claritynow.side_effect = [ValueError("testing")]
 
@@ -89,8 +253,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'session_pool')
     @patch.object(tasks, 'vmware')
-    def test_modify_network(self, fake_vmware):
+    def test_modify_network(self, fake_vmware, fake_session_pool):
         """``modify_network`` returns an empty content dictionary upon success"""
         output = tasks.modify_network(username='pat',
                                       machine_name='myClarityNow',
@@ -100,8 +265,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'session_pool')
     @patch.object(tasks, 'vmware')
-    def test_modify_network_error(self, fake_vmware):
+    def test_modify_network_error(self, fake_vmware, fake_session_pool):
         """``modify_network`` Catches ValueError, and sets the response accordingly"""
         fake_vmware.update_network.side_effect = ValueError('some bad input')
 
@@ -0,0 +1,259 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in templates.py
+"""
+import time
+import unittest
+from unittest.mock import patch, MagicMock, ANY
+
+import ujson
+from pyVmomi import vim
+
+from vlab_claritynow_api.lib.worker import templates
+
+
+class TestTemplates(unittest.TestCase):
+    """A set of test cases for the templates.py module"""
+
+    def setUp(self):
+        """Keep the folder lookups from talking to the fake vCenter"""
+        patch.object(templates.morefs, 'get_folder').start()
+        patch.object(templates.morefs, 'get_or_create_folder').start()
+        self.addCleanup(patch.stopall)
+
+    def test_template_name(self):
+        """``template_name`` includes the version of ClarityNow"""
+        output = templates.template_name('2.11.0')
+        expected = 'ClarityNow-template-2.11.0'
+
+        self.assertEqual(output, expected)
+
+    @patch.object(templates.os, 'stat')
+    def test_ova_signature(self, fake_stat):
+        """``ova_signature`` is the size and modification time of the OVA"""
+        fake_stat.return_value.st_size = 100
+        fake_stat.return_value.st_mtime = 1234
+
+        output = templates.ova_signature('/images/ClarityNow-2.11.0.ova')
+        expected = {'ova_size': 100, 'ova_mtime': 1234}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(templates, '_build_template')
+    @patch.object(templates.inventory, 'get_properties')
+    @patch.object(templates, 'ova_signature')
+    def test_get_template_reuse(self, fake_ova_signature, fake_get_properties, fake_build_template):
+        """``get_template`` returns the existing template when the OVA has not changed"""
+        fake_vcenter = MagicMock()
+        the_template = vim.VirtualMachine('vm-1')
+        fake_vcenter.content.searchIndex.FindChild.return_value = the_template
+        fake_ova_signature.return_value = {'ova_size': 100, 'ova_mtime': 1234}
+        meta = {'component': templates.TEMPLATE_COMPONENT, 'ova_size': 100, 'ova_mtime': 1234}
+        fake_get_properties.return_value = {'config.annotation': ujson.dumps(meta)}
+
+        output = templates.get_template(fake_vcenter, '2.11.0', '/images/foo.ova', MagicMock(), MagicMock())
+
+        self.assertTrue(output is the_template)
+        fake_build_template.assert_not_called()
+
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, '_build_template')
+    @patch.object(templates.inventory, 'child_vms')
+    @patch.object(templates.inventory, 'get_properties')
+    @patch.object(templates, 'ova_signature')
+    def test_get_template_stale(self, fake_ova_signature, fake_get_properties, fake_child_vms, fake_build_template, fake_consume_task):
+        """``get_template`` retires the template and builds a new one when the OVA changes"""
+        fake_vcenter = MagicMock()
+        the_template = MagicMock(spec=vim.VirtualMachine)
+        fake_vcenter.content.searchIndex.FindChild.return_value = the_template
+        fake_ova_signature.return_value = {'ova_size': 100, 'ova_mtime': 5678}
+        meta = {'component': templates.TEMPLATE_COMPONENT, 'ova_size': 100, 'ova_mtime': 1234}
+        fake_get_properties.return_value = {'config.annotation': ujson.dumps(meta)}
+        fake_child_vms.return_value = []
+
+        output = templates.get_template(fake_vcenter, '2.11.0', '/images/foo.ova', MagicMock(), MagicMock())
+
+        self.assertTrue(output is fake_build_template.return_value)
+        the_template.Rename_Task.assert_called()
+
+    @patch.object(templates, '_destroy')
+    @patch.object(templates, '_build_template')
+    @patch.object(templates.inventory, 'child_vms')
+    @patch.object(templates.inventory, 'get_properties')
+    @patch.object(templates, 'ova_signature')
+    def test_get_template_unfinished(self, fake_ova_signature, fake_get_properties, fake_child_vms, fake_build_template, fake_destroy):
+        """``get_template`` destroys a template without meta data, and builds a new one"""
+        fake_vcenter = MagicMock()
+        the_template = vim.VirtualMachine('vm-1')
+        fake_vcenter.content.searchIndex.FindChild.return_value = the_template
+        fake_get_properties.return_value = {}
+        fake_child_vms.return_value = []
+
+        output = templates.get_template(fake_vcenter, '2.11.0', '/images/foo.ova', MagicMock(), MagicMock())
+
+        self.assertTrue(output is fake_build_template.return_value)
+        fake_destroy.assert_called_once_with(the_template, ANY)
+
+    @patch.object(templates, '_build_template')
+    @patch.object(templates.inventory, 'child_vms')
+    @patch.object(templates, 'ova_signature')
+    def test_get_template_building(self, fake_ova_signature, fake_child_vms, fake_build_template):
+        """``get_template`` returns None while another worker is building the template"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+        building = 'ClarityNow-template-2.11.0-building-{}'.format(int(time.time()))
+        fake_child_vms.return_value = [(MagicMock(), {'name': building})]
+
+        output = templates.get_template(fake_vcenter, '2.11.0', '/images/foo.ova', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        fake_build_template.assert_not_called()
+
+    @patch.object(templates, '_destroy')
+    @patch.object(templates, '_build_template')
+    @patch.object(templates.inventory, 'child_vms')
+    @patch.object(templates, 'ova_signature')
+    def test_get_template_build_crashed(self, fake_ova_signature, fake_child_vms, fake_build_template, fake_destroy):
+        """``get_template`` destroys a build that never finished, and builds the template again"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+        started = int(time.time()) - templates.BUILD_TIMEOUT - 1
+        crashed = MagicMock()
+        fake_child_vms.return_value = [(crashed, {'name': 'ClarityNow-template-2.11.0-building-{}'.format(started)}),
+                                       (MagicMock(), {'name': 'ClarityNow-template-2.11.1-building-{}'.format(int(time.time()))})]
+
+        output = templates.get_template(fake_vcenter, '2.11.0', '/images/foo.ova', MagicMock(), MagicMock())
+
+        self.assertTrue(output is fake_build_template.return_value)
+        fake_destroy.assert_called_once_with(crashed, ANY)
+
+    @patch.object(templates, '_build_template')
+    @patch.object(templates.inventory, 'child_vms')
+    @patch.object(templates, 'ova_signature')
+    def test_get_template_new(self, fake_ova_signature, fake_child_vms, fake_build_template):
+        """``get_template`` builds the template when it does not exist"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+        fake_child_vms.return_value = []
+
+        output = templates.get_template(fake_vcenter, '2.11.0', '/images/foo.ova', MagicMock(), MagicMock())
+
+        self.assertTrue(output is fake_build_template.return_value)
+
+    @patch.object(templates.virtual_machine, 'set_meta')
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates.virtual_machine, 'deploy_from_ova')
+    @patch.object(templates.ova_cache, 'open_ova')
+    def test_build_template(self, fake_open_ova, fake_deploy_from_ova, fake_consume_task, fake_set_meta):
+        """``_build_template`` builds under a marker name, and renames the template once it's ready"""
+        fake_open_ova.return_value.networks = ['VM Network']
+        the_template = fake_deploy_from_ova.return_value
+
+        output = templates._build_template(MagicMock(), '2.11.0', '/images/foo.ova', vim.Network('network-1'), {}, MagicMock())
+        building = fake_deploy_from_ova.call_args[0][5]
+
+        self.assertTrue(output is the_template)
+        self.assertTrue(building.startswith('ClarityNow-template-2.11.0-building-'))
+        the_template.Rename_Task.assert_called_with('ClarityNow-template-2.11.0')
+
+    @patch.object(templates.virtual_machine, 'deploy_from_ova')
+    @patch.object(templates.ova_cache, 'open_ova')
+    def test_build_template_duplicate(self, fake_open_ova, fake_deploy_from_ova):
+        """``_build_template`` returns None when another worker started the same build"""
+        fake_open_ova.return_value.networks = ['VM Network']
+        fake_deploy_from_ova.side_effect = vim.fault.DuplicateName()
+
+        output = templates._build_template(MagicMock(), '2.11.0', '/images/foo.ova', vim.Network('network-1'), {}, MagicMock())
+
+        self.assertTrue(output is None)
+
+    @patch.object(templates, '_destroy')
+    @patch.object(templates.virtual_machine, 'set_meta')
+    @patch.object(templates.virtual_machine, 'deploy_from_ova')
+    @patch.object(templates.ova_cache, 'open_ova')
+    def test_build_template_lost_race(self, fake_open_ova, fake_deploy_from_ova, fake_set_meta, fake_destroy):
+        """``_build_template`` destroys its build and returns None when another worker finished first"""
+        fake_open_ova.return_value.networks = ['VM Network']
+        the_template = fake_deploy_from_ova.return_value
+        rename = MagicMock()
+        rename.info.completeTime = 1
+        rename.info.error = vim.fault.DuplicateName(msg='taken')
+        the_template.Rename_Task.return_value = rename
+        the_template.CreateSnapshot_Task.return_value.info.error = None
+
+        output = templates._build_template(MagicMock(), '2.11.0', '/images/foo.ova', vim.Network('network-1'), {}, MagicMock())
+
+        self.assertTrue(output is None)
+        fake_destroy.assert_called_once_with(the_template, ANY)
+
+    @patch.object(templates, '_destroy')
+    @patch.object(templates, '_parent_disks')
+    @patch.object(templates.inventory, 'child_vms')
+    def test_reap_retired(self, fake_child_vms, fake_parent_disks, fake_destroy):
+        """``reap_retired`` only destroys retired templates no VM is a linked clone of"""
+        used, unused = MagicMock(_moId='vm-1'), MagicMock(_moId='vm-2')
+        used_disk = vim.vm.FileLayoutEx.FileInfo(type='diskDescriptor', name='[ds] used/used.vmdk')
+        unused_disk = vim.vm.FileLayoutEx.FileInfo(type='diskDescriptor', name='[ds] unused/unused.vmdk')
+        fake_child_vms.return_value = [(used, {'name': 'ClarityNow-template-1.0.0-retired-1', 'layoutEx.file': [used_disk]}),
+                                       (unused, {'name': 'ClarityNow-template-1.0.1-retired-1', 'layoutEx.file': [unused_disk]}),
+                                       (MagicMock(), {'name': 'ClarityNow-template-1.0.2', 'layoutEx.file': []})]
+        fake_parent_disks.return_value = {'[ds] used/used.vmdk'}
+
+        output = templates.reap_retired(MagicMock(), MagicMock())
+
+        self.assertEqual(output, ['ClarityNow-template-1.0.1-retired-1'])
+        fake_destroy.assert_called_once_with(unused, ANY)
+
+    @patch.object(templates, '_parent_disks')
+    @patch.object(templates.inventory, 'child_vms')
+    def test_reap_retired_none(self, fake_child_vms, fake_parent_disks):
+        """``reap_retired`` doesn't read the disks of every VM when no template is retired"""
+        fake_child_vms.return_value = [(MagicMock(), {'name': 'ClarityNow-template-1.0.2'})]
+
+        templates.reap_retired(MagicMock(), MagicMock())
+
+        fake_parent_disks.assert_not_called()
+
+    @patch.object(templates, 'ova_signature')
+    def test_get_template_no_ova(self, fake_ova_signature):
+        """``get_template`` raises FileNotFoundError if the OVA does not exist"""
+        fake_ova_signature.side_effect = FileNotFoundError('testing')
+
+        with self.assertRaises(FileNotFoundError):
+            templates.get_template(MagicMock(), '2.11.0', '/images/foo.ova', MagicMock(), MagicMock())
+
+    @patch.object(templates.virtual_machine, 'power')
+    @patch.object(templates.virtual_machine, 'change_network')
+    @patch.object(templates.inventory, 'get_properties')
+    @patch.object(templates, 'consume_task')
+    def test_linked_clone(self, fake_consume_task, fake_get_properties, fake_change_network, fake_power):
+        """``linked_clone`` makes a child disk off of the base snapshot"""
+        the_template = MagicMock()
+        fake_vcenter = MagicMock()
+        fake_vcenter.resource_pools = {templates.const.INF_VCENTER_RESORUCE_POOL: vim.ResourcePool('resgroup-1')}
+        fake_get_properties.return_value = {'snapshot.currentSnapshot': vim.vm.Snapshot('snapshot-1')}
+
+        templates.linked_clone(fake_vcenter, the_template, 'alice', 'myClarityNow', MagicMock())
+        _, the_kwargs = the_template.CloneVM_Task.call_args
+        disk_move_type = the_kwargs['spec'].location.diskMoveType
+
+        self.assertEqual(disk_move_type, 'createNewChildDiskBacking')
+
+    @patch.object(templates.virtual_machine, 'power')
+    @patch.object(templates.virtual_machine, 'change_network')
+    @patch.object(templates.inventory, 'get_properties')
+    @patch.object(templates, 'consume_task')
+    def test_linked_clone_network(self, fake_consume_task, fake_get_properties, fake_change_network, fake_power):
+        """``linked_clone`` connects the new VM to the requested network"""
+        fake_network = MagicMock()
+        fake_vcenter = MagicMock()
+        fake_vcenter.resource_pools = {templates.const.INF_VCENTER_RESORUCE_POOL: vim.ResourcePool('resgroup-1')}
+        fake_get_properties.return_value = {'snapshot.currentSnapshot': vim.vm.Snapshot('snapshot-1')}
+
+        templates.linked_clone(fake_vcenter, MagicMock(), 'alice', 'myClarityNow', fake_network)
+
+        fake_change_network.assert_called_with(fake_consume_task.return_value, fake_network)
+
+
+if __name__ == '__main__':
+    unittest.main()
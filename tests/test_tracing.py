@@ -0,0 +1,46 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in tracing.py
+"""
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_claritynow_api.lib import tracing
+
+
+class TestTracing(unittest.TestCase):
+    """A set of test cases for the tracing.py module"""
+
+    def test_span(self):
+        """``span`` observes how long the block took"""
+        before = tracing.SPAN_SECONDS.value(span='test.ok', outcome='ok')['count']
+        with tracing.span('test.ok'):
+            pass
+        after = tracing.SPAN_SECONDS.value(span='test.ok', outcome='ok')['count']
+
+        self.assertEqual(after - before, 1)
+
+    def test_span_error(self):
+        """``span`` records an outcome of 'error' when the block raises, and re-raises"""
+        before = tracing.SPAN_SECONDS.value(span='test.error', outcome='error')['count']
+        with self.assertRaises(RuntimeError):
+            with tracing.span('test.error'):
+                raise RuntimeError('testing')
+        after = tracing.SPAN_SECONDS.value(span='test.error', outcome='error')['count']
+
+        self.assertEqual(after - before, 1)
+
+    def test_span_logs(self):
+        """``span`` logs the span through the supplied logger"""
+        fake_logger = MagicMock()
+        with tracing.span('test.logged', fake_logger):
+            pass
+
+        message = fake_logger.info.call_args[0][0]
+
+        self.assertTrue(message.startswith('span=test.logged seconds='))
+        self.assertTrue(message.endswith('outcome=ok'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in upload.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest.mock import MagicMock
+
+from vlab_claritynow_api.lib.worker import upload
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Keeps the body of every POST, by path"""
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received[self.path] = body
+        self.send_response(500 if self.path.startswith('/fail') else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestUpload(unittest.TestCase):
+    """A set of test cases for uploading the disks of an OVA"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        cls.server = _Server(('127.0.0.1', 0), _Handler)
+        cls.server.received = {}
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:{}'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        """Runs once all the tests are done"""
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.server.received.clear()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.ova_path = os.path.join(self.tmp_dir, 'ClarityNow-1.0.0.ova')
+        self.data = os.urandom(100000)
+        with open(self.ova_path, 'wb') as the_file:
+            the_file.write(self.data)
+
+    def test_send_disk(self):
+        """``send_disk`` uploads only the part of the file the disk is in"""
+        progress = upload.Progress(5000)
+        upload.send_disk(self.ova_path, 512, 5000, self.url + '/disk-0', progress)
+
+        self.assertEqual(self.server.received['/disk-0'], self.data[512:5512])
+        self.assertEqual(progress.percent, 100)
+
+    def test_send_disk_rejected(self):
+        """``send_disk`` raises RuntimeError if the server rejects the upload"""
+        with self.assertRaises(RuntimeError):
+            upload.send_disk(self.ova_path, 0, 10, self.url + '/fail', upload.Progress(10))
+
+    def test_upload_disks(self):
+        """``upload_disks`` uploads every disk"""
+        disks = [(0, 30000, self.url + '/disk-0'),
+                 (30000, 50000, self.url + '/disk-1'),
+                 (80000, 20000, self.url + '/disk-2')]
+        progress = upload.Progress(100000)
+        upload.upload_disks(self.ova_path, disks, progress, parallel=2)
+
+        self.assertEqual(self.server.received['/disk-1'], self.data[30000:80000])
+        self.assertEqual(len(self.server.received), 3)
+        self.assertEqual(progress.sent, 100000)
+
+    def test_upload_disks_fails(self):
+        """``upload_disks`` raises the error of a failed upload"""
+        disks = [(0, 10, self.url + '/disk-0'), (10, 10, self.url + '/fail')]
+
+        with self.assertRaises(RuntimeError):
+            upload.upload_disks(self.ova_path, disks, upload.Progress(20), parallel=2)
+
+    def test_send_mapped(self):
+        """``_send_mapped`` sends the part of the file the disk is in, even if it doesn't start on a page"""
+        fake_sock = MagicMock()
+        sent = []
+        fake_sock.sendall.side_effect = lambda chunk: sent.append(bytes(chunk))
+        progress = upload.Progress(70000)
+        with open(self.ova_path, 'rb') as the_file:
+            upload._send_mapped(fake_sock, the_file, 12345, 70000, progress)
+
+        self.assertEqual(b''.join(sent), self.data[12345:82345])
+        self.assertEqual(progress.sent, 70000)
+
+    def test_keep_alive(self):
+        """``keep_alive`` tells the lease how far along the upload is"""
+        fake_lease = MagicMock()
+        progress = upload.Progress(10)
+        progress.add(5)
+        reported = threading.Event()
+        done = upload.keep_alive(fake_lease, progress, 0.01, on_progress=lambda _: reported.set())
+        reported.wait(2)
+        done.set()
+
+        fake_lease.Progress.assert_called_with(50)
+
+
+if __name__ == '__main__':
+    unittest.main()
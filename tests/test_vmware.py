@@ -3,31 +3,42 @@
 A suite of tests for the functions in vmware.py
 """
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 
+import ujson
+
+from vlab_claritynow_api.lib import tracing, progress
 from vlab_claritynow_api.lib.worker import vmware
 
 
+def fake_get_network(vcenter, name):
+    """Stands in for ``morefs.get_network``, so tests can set ``vcenter.networks``"""
+    try:
+        return vcenter.networks[name]
+    except KeyError:
+        raise ValueError('No such network named {}'.format(name))
+
+
 class TestVMware(unittest.TestCase):
     """A set of test cases for the vmware.py module"""
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_show_claritynow(self, fake_vCenter, fake_consume_task, fake_get_info):
+    def setUp(self):
+        """Keep the moref lookups from talking to the fake vCenter"""
+        self.fake_get_folder = patch.object(vmware.morefs, 'get_folder').start()
+        patch.object(vmware.morefs, 'get_network', side_effect=fake_get_network).start()
+        self.addCleanup(patch.stopall)
+
+    @patch.object(vmware.inventory, 'folder_vms')
+    def test_show_claritynow(self, fake_folder_vms):
         """``claritynow`` returns a dictionary when everything works as expected"""
-        fake_vm = MagicMock()
-        fake_vm.name = 'ClarityNow'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta' : {'component': 'ClarityNow',
-                                                'created': 1234,
-                                                'version': '3.28',
-                                                'configured': True,
-                                                'generation': 1}}
-
-        output = vmware.show_claritynow(username='alice')
+        fake_vcenter = MagicMock()
+        fake_folder_vms.return_value = {'ClarityNow': {'meta' : {'component': 'ClarityNow',
+                                                                 'created': 1234,
+                                                                 'version': '3.28',
+                                                                 'configured': True,
+                                                                 'generation': 1}}}
+
+        output = vmware.show_claritynow(fake_vcenter, username='alice', logger=MagicMock())
         expected = {'ClarityNow': {'meta' : {'component': 'ClarityNow',
                                              'created': 1234,
                                              'version': '3.28',
@@ -36,62 +47,149 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.inventory, 'folder_vms')
+    def test_show_claritynow_component(self, fake_folder_vms):
+        """``claritynow`` only asks for ClarityNow VMs in the user's folder"""
+        fake_vcenter = MagicMock()
+
+        vmware.show_claritynow(fake_vcenter, username='alice', logger=MagicMock())
+        _, the_kwargs = fake_folder_vms.call_args
+
+        self.assertEqual(the_kwargs['component'], 'ClarityNow')
+
+    @patch.object(vmware.inventory, 'iter_all_vms')
+    def test_inventory_claritynow(self, fake_iter_all_vms):
+        """``inventory_claritynow`` returns the moid of the last VM as the cursor when there are more VMs"""
+        fake_iter_all_vms.return_value = ({'moid': 'vm-{}'.format(x)} for x in range(2, 5))
+
+        output = vmware.inventory_claritynow(MagicMock(), cursor='vm-1', per_page=2)
+        expected = {'vms': [{'moid': 'vm-2'}, {'moid': 'vm-3'}], 'cursor': 'vm-3'}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.inventory, 'iter_all_vms')
+    def test_inventory_claritynow_resumes(self, fake_iter_all_vms):
+        """``inventory_claritynow`` resumes after the cursor, and only reads one page"""
+        fake_iter_all_vms.return_value = ({'moid': 'vm-{}'.format(x)} for x in range(2, 5))
+
+        vmware.inventory_claritynow(MagicMock(), cursor='vm-1', per_page=2)
+        _, the_kwargs = fake_iter_all_vms.call_args
+
+        self.assertEqual(the_kwargs['after'], 'vm-1')
+        self.assertEqual(the_kwargs['page_size'], 3)
+
+    @patch.object(vmware.inventory, 'iter_all_vms')
+    def test_inventory_claritynow_last_page(self, fake_iter_all_vms):
+        """``inventory_claritynow`` returns a cursor of None on the last page"""
+        fake_iter_all_vms.return_value = ({'moid': 'vm-{}'.format(x)} for x in range(4, 5))
+
+        output = vmware.inventory_claritynow(MagicMock(), cursor='vm-3', per_page=2)
+        expected = {'vms': [{'moid': 'vm-4'}], 'cursor': None}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.inventory, 'find_vm')
     @patch.object(vmware.virtual_machine, 'power')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_claritynow(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    def test_delete_claritynow(self, fake_consume_task, fake_power, fake_find_vm):
         """``delete_claritynow`` returns None when everything works as expected"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'ClarityNowBox'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta' : {'component': 'ClarityNow',
-                                                'created': 1234,
-                                                'version': '3.28',
-                                                'configured': True,
-                                                'generation': 1}}
-
-        output = vmware.delete_claritynow(username='bob', machine_name='ClarityNowBox', logger=fake_logger)
+        fake_vcenter = MagicMock()
+
+        output = vmware.delete_claritynow(fake_vcenter, username='bob', machine_name='ClarityNowBox', logger=fake_logger)
         expected = None
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.inventory, 'find_vm')
     @patch.object(vmware.virtual_machine, 'power')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_claritynow_value_error(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    def test_delete_claritynow_destroys(self, fake_consume_task, fake_power, fake_find_vm):
+        """``delete_claritynow`` destroys the VM found by name"""
+        fake_logger = MagicMock()
+        fake_vcenter = MagicMock()
+
+        vmware.delete_claritynow(fake_vcenter, username='bob', machine_name='ClarityNowBox', logger=fake_logger)
+
+        fake_find_vm.return_value.Destroy_Task.assert_called()
+
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware, 'consume_task')
+    def test_delete_claritynow_value_error(self, fake_consume_task, fake_power, fake_find_vm):
         """``delete_claritynow`` raises ValueError when unable to find requested vm for deletion"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'win10'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'note' : 'ClarityNow=1.0.0'}
+        fake_vcenter = MagicMock()
+        fake_find_vm.return_value = None
 
         with self.assertRaises(ValueError):
-            vmware.delete_claritynow(username='bob', machine_name='myOtherClarityNowBox', logger=fake_logger)
+            vmware.delete_claritynow(fake_vcenter, username='bob', machine_name='myOtherClarityNowBox', logger=fake_logger)
+
+    @patch.object(vmware.inventory, 'wait_for_tasks')
+    @patch.object(vmware.inventory, 'child_vms')
+    def test_delete_claritynow_batch(self, fake_child_vms, fake_wait_for_tasks):
+        """``delete_claritynow_batch`` destroys every VM named"""
+        vm1 = MagicMock()
+        vm2 = MagicMock()
+        meta = ujson.dumps({'component': 'ClarityNow'})
+        fake_child_vms.return_value = [(vm1, {'name': 'box1', 'config.annotation': meta, 'runtime.powerState': 'poweredOn'}),
+                                       (vm2, {'name': 'box2', 'config.annotation': meta, 'runtime.powerState': 'poweredOff'})]
+        fake_wait_for_tasks.return_value = {}
+
+        output = vmware.delete_claritynow_batch(MagicMock(), 'alice', ['box1', 'box2', 'box3'], MagicMock())
+        expected = {'deleted': ['box1', 'box2'], 'failed': {'box3': 'No claritynow named box3 found'}}
+
+        self.assertEqual(output, expected)
+        self.assertTrue(vm1.PowerOffVM_Task.called)
+        self.assertFalse(vm2.PowerOffVM_Task.called)
+
+    @patch.object(vmware.inventory, 'wait_for_tasks')
+    @patch.object(vmware.inventory, 'child_vms')
+    def test_delete_claritynow_batch_all(self, fake_child_vms, fake_wait_for_tasks):
+        """``delete_claritynow_batch`` destroys every ClarityNow the user owns when no names are supplied"""
+        meta = ujson.dumps({'component': 'ClarityNow'})
+        other_meta = ujson.dumps({'component': 'OneFS'})
+        fake_child_vms.return_value = [(MagicMock(), {'name': 'box1', 'config.annotation': meta, 'runtime.powerState': 'poweredOn'}),
+                                       (MagicMock(), {'name': 'isi01', 'config.annotation': other_meta, 'runtime.powerState': 'poweredOn'})]
+        fake_wait_for_tasks.return_value = {}
+
+        output = vmware.delete_claritynow_batch(MagicMock(), 'alice', None, MagicMock())
+        expected = {'deleted': ['box1'], 'failed': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.inventory, 'wait_for_tasks')
+    @patch.object(vmware.inventory, 'child_vms')
+    def test_delete_claritynow_batch_power_failure(self, fake_child_vms, fake_wait_for_tasks):
+        """``delete_claritynow_batch`` does not destroy a VM that failed to power off"""
+        the_vm = MagicMock()
+        the_vm.PowerOffVM_Task.return_value._moId = 'task-1'
+        meta = ujson.dumps({'component': 'ClarityNow'})
+        fake_child_vms.return_value = [(the_vm, {'name': 'box1', 'config.annotation': meta, 'runtime.powerState': 'poweredOn'})]
+        fake_wait_for_tasks.return_value = {'task-1': 'testing'}
+
+        output = vmware.delete_claritynow_batch(MagicMock(), 'alice', ['box1'], MagicMock())
+        expected = {'deleted': [], 'failed': {'box1': 'testing'}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(the_vm.Destroy_Task.called)
 
     @patch.object(vmware.virtual_machine, 'set_meta')
     @patch.object(vmware, '_setup_vm')
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.ova_cache, 'open_ova')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_claritynow(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_setup_vm, fake_set_meta):
+    def test_create_claritynow(self, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_setup_vm, fake_set_meta):
         """``create_claritynow`` returns a dictionary upon success"""
         fake_logger = MagicMock()
+        fake_vcenter = MagicMock()
         fake_deploy_from_ova.return_value.name = 'ClarityNowBox'
         fake_get_info.return_value = {'worked': True}
         fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
 
-        output = vmware.create_claritynow(username='alice',
+        output = vmware.create_claritynow(fake_vcenter, username='alice',
                                           machine_name='ClarityNowBox',
                                           image='1.0.0',
                                           network='someLAN',
@@ -100,39 +198,365 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware.ova_cache, 'open_ova')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_claritynow_invalid_network(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
+    def test_create_claritynow_progress(self, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_setup_vm, fake_set_meta):
+        """``create_claritynow`` reports each phase of the create"""
+        fake_publish = MagicMock()
+        fake_vcenter = MagicMock()
+        fake_deploy_from_ova.return_value.name = 'ClarityNowBox'
+        fake_Ova.return_value.networks = ['someLAN']
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        vmware.create_claritynow(fake_vcenter, username='alice',
+                                 machine_name='ClarityNowBox',
+                                 image='1.0.0',
+                                 network='someLAN',
+                                 logger=MagicMock(),
+                                 reporter=progress.Reporter(fake_publish))
+        phases = [x[0][0]['machines']['ClarityNowBox']['phase'] for x in fake_publish.call_args_list]
+        expected = ['image_opened', 'deploying', 'configuring']
+
+        self.assertEqual(phases[:3], expected)
+
+    @patch.object(vmware.threading, 'Thread')
+    def test_report_upload_joins(self, fake_Thread):
+        """``_report_upload`` stops and joins the watcher thread when the upload finishes"""
+        with vmware._report_upload(MagicMock(), 'ClarityNowBox', MagicMock()):
+            pass
+
+        self.assertTrue(fake_Thread.return_value.join.called)
+
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'const')
+    def test_create_claritynow_linked_clone(self, fake_const, fake_deploy_from_ova, fake_get_info, fake_templates, fake_setup_vm, fake_set_meta):
+        """``create_claritynow`` makes a linked clone when VLAB_CLARITYNOW_PROVISION_MODE is 'linked_clone'"""
+        fake_const.VLAB_CLARITYNOW_PROVISION_MODE = 'linked_clone'
+        fake_const.VLAB_CLARITYNOW_IMAGES_DIR = '/images'
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_get_info.return_value = {'worked': True}
+        fake_templates.linked_clone.return_value.name = 'ClarityNowBox'
+
+        output = vmware.create_claritynow(fake_vcenter, username='alice',
+                                          machine_name='ClarityNowBox',
+                                          image='1.0.0',
+                                          network='someLAN',
+                                          logger=MagicMock())
+        expected = {'ClarityNowBox' : {'worked': True}}
+
+        self.assertEqual(output, expected)
+        fake_deploy_from_ova.assert_not_called()
+
+    @patch.object(vmware, 'warm_pool')
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'const')
+    def test_create_claritynow_bad_name(self, fake_const, fake_deploy_from_ova, fake_templates, fake_warm_pool):
+        """``create_claritynow`` raises ValueError for an invalid hostname before any clone or claim"""
+        fake_const.VLAB_CLARITYNOW_PROVISION_MODE = 'linked_clone'
+        fake_const.VLAB_CLARITYNOW_IMAGES_DIR = '/images'
+        fake_warm_pool.pool_sizes.return_value = {'1.0.0': 2}
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        with self.assertRaises(ValueError):
+            vmware.create_claritynow(fake_vcenter, username='alice',
+                                     machine_name='not_a_hostname!',
+                                     image='1.0.0',
+                                     network='someLAN',
+                                     logger=MagicMock())
+
+        fake_templates.linked_clone.assert_not_called()
+        fake_warm_pool.claim.assert_not_called()
+        fake_deploy_from_ova.assert_not_called()
+
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware.ova_cache, 'open_ova')
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'const')
+    def test_create_claritynow_template_not_ready(self, fake_const, fake_deploy_from_ova, fake_get_info, fake_templates, fake_Ova, fake_setup_vm, fake_set_meta):
+        """``create_claritynow`` does a full OVA deploy while the template is being built"""
+        fake_const.VLAB_CLARITYNOW_PROVISION_MODE = 'linked_clone'
+        fake_const.VLAB_CLARITYNOW_IMAGES_DIR = '/images'
+        fake_const.VLAB_CLARITYNOW_PROGRESS_SECONDS = 5
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_Ova.return_value.networks = ['someLAN']
+        fake_templates.get_template.return_value = None
+
+        vmware.create_claritynow(fake_vcenter, username='alice',
+                                 machine_name='ClarityNowBox',
+                                 image='1.0.0',
+                                 network='someLAN',
+                                 logger=MagicMock())
+
+        fake_deploy_from_ova.assert_called()
+
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware, 'const')
+    def test_create_claritynow_linked_clone_bad_image(self, fake_const, fake_templates):
+        """``create_claritynow`` raises ValueError in linked_clone mode if the image does not exist"""
+        fake_const.VLAB_CLARITYNOW_PROVISION_MODE = 'linked_clone'
+        fake_const.VLAB_CLARITYNOW_IMAGES_DIR = '/images'
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_templates.get_template.side_effect = FileNotFoundError('testing')
+
+        with self.assertRaises(ValueError):
+            vmware.create_claritynow(fake_vcenter, username='alice',
+                                     machine_name='ClarityNowBox',
+                                     image='1.0.0',
+                                     network='someLAN',
+                                     logger=MagicMock())
+
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware, 'warm_pool')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    def test_create_claritynow_warm_pool(self, fake_deploy_from_ova, fake_get_info, fake_warm_pool, fake_setup_vm, fake_set_meta):
+        """``create_claritynow`` skips deploying and configuring when a parked VM is claimed"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_warm_pool.pool_sizes.return_value = {'1.0.0': 2}
+        fake_warm_pool.claim.return_value.name = 'ClarityNowBox'
+        fake_get_info.return_value = {'worked': True}
+
+        output = vmware.create_claritynow(fake_vcenter, username='alice',
+                                          machine_name='ClarityNowBox',
+                                          image='1.0.0',
+                                          network='someLAN',
+                                          logger=MagicMock())
+        expected = {'ClarityNowBox' : {'worked': True}}
+
+        self.assertEqual(output, expected)
+        fake_deploy_from_ova.assert_not_called()
+        fake_setup_vm.assert_not_called()
+
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware.ova_cache, 'open_ova')
+    @patch.object(vmware, 'warm_pool')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    def test_create_claritynow_warm_pool_miss(self, fake_deploy_from_ova, fake_get_info, fake_warm_pool, fake_Ova, fake_setup_vm, fake_set_meta):
+        """``create_claritynow`` deploys a new VM when the warm pool is empty"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_Ova.return_value.networks = ['someLAN']
+        fake_warm_pool.pool_sizes.return_value = {'1.0.0': 2}
+        fake_warm_pool.claim.return_value = None
+
+        vmware.create_claritynow(fake_vcenter, username='alice',
+                                 machine_name='ClarityNowBox',
+                                 image='1.0.0',
+                                 network='someLAN',
+                                 logger=MagicMock())
+
+        fake_deploy_from_ova.assert_called()
+        fake_setup_vm.assert_called()
+
+    @patch.object(vmware.os.path, 'isfile')
+    @patch.object(vmware, '_provision')
+    def test_create_claritynow_batch(self, fake_provision, fake_isfile):
+        """``create_claritynow_batch`` returns the info of every instance created"""
+        fake_provision.side_effect = lambda vcenter, source, username, machine_name, logger, reporter: {machine_name: {}}
+        fake_vcenter = MagicMock()
+
+        output = vmware.create_claritynow_batch(fake_vcenter, 'alice', ['box1', 'box2'], '1.0.0', 'someLAN', MagicMock())
+        expected = {'created': {'box1': {}, 'box2': {}}, 'failed': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.os.path, 'isfile')
+    @patch.object(vmware, '_provision')
+    def test_create_claritynow_batch_isolated(self, fake_provision, fake_isfile):
+        """``create_claritynow_batch`` keeps creating instances when one fails"""
+        def provision(vcenter, source, username, machine_name, logger, reporter):
+            if machine_name == 'box1':
+                raise RuntimeError('testing')
+            return {machine_name: {}}
+        fake_provision.side_effect = provision
+
+        output = vmware.create_claritynow_batch(MagicMock(), 'alice', ['box1', 'box2'], '1.0.0', 'someLAN', MagicMock())
+        expected = {'created': {'box2': {}}, 'failed': {'box1': 'testing'}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.os.path, 'isfile')
+    @patch.object(vmware, '_provision')
+    def test_create_claritynow_batch_bad_image(self, fake_provision, fake_isfile):
+        """``create_claritynow_batch`` raises ValueError if the image does not exist"""
+        fake_isfile.return_value = False
+
+        with self.assertRaises(ValueError):
+            vmware.create_claritynow_batch(MagicMock(), 'alice', ['box1'], '1.0.0', 'someLAN', MagicMock())
+
+    def test_create_claritynow_batch_bad_network(self):
+        """``create_claritynow_batch`` raises ValueError if the network does not exist"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {}
+
+        with self.assertRaises(ValueError):
+            vmware.create_claritynow_batch(fake_vcenter, 'alice', ['box1'], '1.0.0', 'someLAN', MagicMock())
+
+    @patch.object(vmware.ova_cache, 'open_ova')
+    def test_image_source_reuses_ova(self, fake_Ova):
+        """``ImageSource`` opens the OVA file once, and lends it out for every deploy"""
+        source = vmware.ImageSource(MagicMock(), '1.0.0', 'someLAN', max_open=2)
+        with source.ova():
+            pass
+        with source.ova():
+            pass
+        source.close()
+
+        self.assertEqual(fake_Ova.call_count, 1)
+
+    @patch.object(vmware.ova_cache, 'open_ova')
+    def test_image_source_max_open(self, fake_Ova):
+        """``ImageSource`` opens the OVA file again for concurrent deploys, up to ``max_open``"""
+        source = vmware.ImageSource(MagicMock(), '1.0.0', 'someLAN', max_open=2)
+        with source.ova():
+            with source.ova():
+                pass
+        source.close()
+
+        self.assertEqual(fake_Ova.call_count, 2)
+
+    @patch.object(vmware, 'templates')
+    def test_image_source_template(self, fake_templates):
+        """``ImageSource`` only looks up the linked clone template once"""
+        source = vmware.ImageSource(MagicMock(), '1.0.0', 'someLAN')
+        source.template(MagicMock(), MagicMock())
+        source.template(MagicMock(), MagicMock())
+
+        self.assertEqual(fake_templates.get_template.call_count, 1)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'warm_pool')
+    def test_refill_warm_pool(self, fake_warm_pool, fake_deploy, fake_setup_vm, fake_get_info):
+        """``refill_warm_pool`` only parks enough VMs to fill the pool"""
+        fake_warm_pool.pool_sizes.return_value = {'1.0.0': 3}
+        fake_warm_pool.count.return_value = (1, 0)
+        fake_deploy.return_value = (MagicMock(), 'ova')
+
+        output = vmware.refill_warm_pool(MagicMock(), MagicMock(), max_parks=5)
+        expected = ({'1.0.0': 2}, False)
+
+        self.assertEqual(output, expected)
+        self.assertEqual(fake_warm_pool.park.call_count, 2)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'warm_pool')
+    def test_refill_warm_pool_max_parks(self, fake_warm_pool, fake_deploy, fake_setup_vm, fake_get_info):
+        """``refill_warm_pool`` parks at most ``max_parks`` VMs, and says when it stopped early"""
+        fake_warm_pool.pool_sizes.return_value = {'1.0.0': 3, '2.0.0': 3}
+        fake_warm_pool.count.return_value = (0, 0)
+        fake_deploy.return_value = (MagicMock(), 'ova')
+
+        output = vmware.refill_warm_pool(MagicMock(), MagicMock(), max_parks=2)
+        expected = ({'1.0.0': 2, '2.0.0': 0}, True)
+
+        self.assertEqual(output, expected)
+        self.assertEqual(fake_deploy.call_count, 2)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'warm_pool')
+    def test_refill_warm_pool_error(self, fake_warm_pool, fake_deploy, fake_setup_vm, fake_get_info):
+        """``refill_warm_pool`` stops refilling an image if parking a VM fails"""
+        fake_warm_pool.pool_sizes.return_value = {'1.0.0': 3}
+        fake_warm_pool.count.return_value = (0, 0)
+        fake_deploy.side_effect = RuntimeError('testing')
+
+        output = vmware.refill_warm_pool(MagicMock(), MagicMock(), max_parks=5)
+        expected = ({'1.0.0': 0}, False)
+
+        self.assertEqual(output, expected)
+        self.assertEqual(fake_deploy.call_count, 1)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'warm_pool')
+    def test_refill_warm_pool_setup_error(self, fake_warm_pool, fake_deploy, fake_setup_vm, fake_get_info):
+        """``refill_warm_pool`` destroys a VM it deployed but couldn't configure"""
+        fake_warm_pool.pool_sizes.return_value = {'1.0.0': 3}
+        fake_warm_pool.count.return_value = (0, 0)
+        the_vm = MagicMock()
+        fake_deploy.return_value = (the_vm, 'ova')
+        fake_get_info.side_effect = vmware.vmodl.fault.ManagedObjectNotFound()
+
+        output = vmware.refill_warm_pool(MagicMock(), MagicMock(), max_parks=5)
+        expected = ({'1.0.0': 0}, False)
+
+        self.assertEqual(output, expected)
+        fake_warm_pool._destroy.assert_called_once_with(the_vm, ANY)
+        fake_warm_pool.park.assert_not_called()
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_setup_vm')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'warm_pool')
+    def test_refill_warm_pool_reaps(self, fake_warm_pool, fake_deploy, fake_setup_vm, fake_get_info):
+        """``refill_warm_pool`` destroys VMs that were never parked before counting the pool"""
+        fake_warm_pool.pool_sizes.return_value = {'1.0.0': 3}
+        fake_warm_pool.count.return_value = (3, 3)
+
+        vmware.refill_warm_pool(MagicMock(), MagicMock(), max_parks=5)
+
+        self.assertEqual(fake_warm_pool.reap.call_count, 1)
+
+    @patch.object(vmware.ova_cache, 'open_ova')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'consume_task')
+    def test_create_claritynow_invalid_network(self, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
         """``create_claritynow`` raises ValueError if supplied with a non-existing network"""
         fake_logger = MagicMock()
+        fake_vcenter = MagicMock()
         fake_get_info.return_value = {'worked': True}
         fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
 
         with self.assertRaises(ValueError):
-            vmware.create_claritynow(username='alice',
+            vmware.create_claritynow(fake_vcenter, username='alice',
                                   machine_name='ClarityNowBox',
                                   image='1.0.0',
                                   network='someOtherLAN',
                                   logger=fake_logger)
 
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.ova_cache, 'open_ova')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_claritynow_bad_image(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
+    def test_create_claritynow_bad_image(self, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
         """``create_claritynow`` raises ValueError if supplied with a non-existing image/version for deployment"""
         fake_logger = MagicMock()
+        fake_vcenter = MagicMock()
         fake_get_info.return_value = {'worked': True}
         fake_Ova.side_effect = FileNotFoundError('testing')
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_vcenter.networks = {'someLAN' : vmware.vim.Network(moId='1')}
 
         with self.assertRaises(ValueError):
-            vmware.create_claritynow(username='alice',
+            vmware.create_claritynow(fake_vcenter, username='alice',
                                   machine_name='ClarityNowBox',
                                   image='1.0.0',
                                   network='someOtherLAN',
@@ -163,104 +587,173 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'run_command')
-    def test_setup_vm(self, fake_run_command):
-        """``_setup_vm`` returns None when everything works as expected"""
-        fake_logger = MagicMock()
+    def _guest(self, exit_code=0):
+        """Make a vCenter whose guest commands exit right away"""
         fake_vcenter = MagicMock()
-        fake_vm = MagicMock()
-        fake_run_command.return_value.exitCode = None
+        process_mgr = fake_vcenter.content.guestOperationsManager.processManager
+        process_mgr.StartProgramInGuest.side_effect = [101, 102]
+        process_mgr.ListProcessesInGuest.return_value = [MagicMock(exitCode=exit_code)]
+        return fake_vcenter, process_mgr
 
-        output = vmware._setup_vm(fake_vcenter, fake_vm, fake_logger)
+    def test_setup_vm(self):
+        """``_setup_vm`` returns None when everything works as expected"""
+        fake_vcenter, _ = self._guest()
+
+        output = vmware._setup_vm(fake_vcenter, MagicMock(), MagicMock())
         expected = None
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'run_command')
-    def test_setup_vm_cmd1_failure(self, fake_run_command):
-        """``_setup_vm`` Raises RuntimeError if the 1st command fails"""
-        fake_logger = MagicMock()
-        fake_vcenter = MagicMock()
-        fake_vm = MagicMock()
-        fake_run_command.side_effect = [RuntimeError("testing"), RuntimeError("testing")]
+    def test_setup_vm_commands(self):
+        """``_setup_vm`` only runs timedatectl through sudo, never a shell"""
+        fake_vcenter, process_mgr = self._guest()
+
+        vmware._setup_vm(fake_vcenter, MagicMock(), MagicMock())
+        commands = [(x[0][2].programPath, x[0][2].arguments) for x in process_mgr.StartProgramInGuest.call_args_list]
+        expected = [('/usr/bin/sudo', '/usr/bin/timedatectl set-ntp 0'),
+                    ('/usr/bin/sudo', '/usr/bin/timedatectl set-time 2018-09-28')]
+
+        self.assertEqual(commands, expected)
+
+    def test_setup_vm_one_session(self):
+        """``_setup_vm`` uses the same credentials for every command"""
+        fake_vcenter, process_mgr = self._guest()
+
+        vmware._setup_vm(fake_vcenter, MagicMock(), MagicMock())
+        creds = [x[0][1] for x in process_mgr.StartProgramInGuest.call_args_list]
+
+        self.assertTrue(creds[0] is creds[1])
+
+    def test_setup_vm_in_order(self):
+        """``_setup_vm`` waits for NTP to be disabled before setting the time"""
+        fake_vcenter, process_mgr = self._guest()
+        calls = []
+        process_mgr.StartProgramInGuest.side_effect = lambda *args: calls.append('start') or len(calls)
+        process_mgr.ListProcessesInGuest.side_effect = lambda *args: calls.append('list') or [MagicMock(exitCode=0)]
+
+        vmware._setup_vm(fake_vcenter, MagicMock(), MagicMock())
+
+        self.assertEqual(calls, ['start', 'list', 'start', 'list'])
+
+    @patch.object(vmware, 'span')
+    def test_setup_vm_spans(self, fake_span):
+        """``_setup_vm`` times every step on its own"""
+        fake_vcenter, _ = self._guest()
+
+        vmware._setup_vm(fake_vcenter, MagicMock(), MagicMock())
+        spans = [x[0][0] for x in fake_span.call_args_list]
+
+        self.assertEqual(spans, ['create.setup.ntp', 'create.setup.time'])
+
+    @patch.object(vmware.time, 'sleep')
+    def test_setup_vm_waits_for_tools(self, fake_sleep):
+        """``_setup_vm`` retries the first command until VMware Tools is up"""
+        fake_vcenter, process_mgr = self._guest()
+        process_mgr.StartProgramInGuest.side_effect = [vmware.vim.fault.GuestOperationsUnavailable(), 101, 102]
+
+        vmware._setup_vm(fake_vcenter, MagicMock(), MagicMock())
+
+        self.assertEqual(process_mgr.StartProgramInGuest.call_count, 3)
+
+    @patch.object(vmware.time, 'sleep')
+    @patch.object(vmware.time, 'time')
+    def test_setup_vm_failure(self, fake_time, fake_sleep):
+        """``_setup_vm`` Raises RuntimeError if the command cannot be run"""
+        fake_time.side_effect = [0, vmware.SETUP_TIMEOUT + 1]
+        fake_vcenter, process_mgr = self._guest()
+        process_mgr.StartProgramInGuest.side_effect = vmware.vim.fault.GuestOperationsUnavailable()
 
         with self.assertRaises(RuntimeError):
-            vmware._setup_vm(fake_vcenter, fake_vm, fake_logger)
+            vmware._setup_vm(fake_vcenter, MagicMock(), MagicMock())
 
-    @patch.object(vmware.virtual_machine, 'run_command')
-    def test_setup_vm_cmd2_failure(self, fake_run_command):
-        """``_setup_vm`` Raises RuntimeError if the 2nd command fails"""
+    def test_setup_vm_exit_code(self):
+        """``_setup_vm`` logs, and does not raise, when a command fails"""
+        fake_vcenter, _ = self._guest(exit_code=1)
         fake_logger = MagicMock()
-        fake_vcenter = MagicMock()
-        fake_vm = MagicMock()
-        fake_result1 = MagicMock()
-        fake_result1.exitCode = None
-        fake_result2 = RuntimeError('testing')
-        fake_run_command.side_effect = [fake_result1, fake_result2]
+
+        vmware._setup_vm(fake_vcenter, MagicMock(), fake_logger)
+
+        self.assertEqual(fake_logger.error.call_count, 2)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_setup_vm')
+    def test_setup_and_wait_for_ip(self, fake_setup_vm, fake_get_info):
+        """``_setup_and_wait_for_ip`` returns the info of the VM"""
+        fake_get_info.return_value = {'worked': True}
+
+        output = vmware._setup_and_wait_for_ip(MagicMock(), MagicMock(), 'alice', MagicMock(), MagicMock())
+        expected = {'worked': True}
+
+        self.assertEqual(output, expected)
+        self.assertTrue(fake_setup_vm.called)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_setup_vm')
+    def test_setup_and_wait_for_ip_setup_fails(self, fake_setup_vm, fake_get_info):
+        """``_setup_and_wait_for_ip`` raises the error from the setup"""
+        fake_setup_vm.side_effect = RuntimeError('testing')
 
         with self.assertRaises(RuntimeError):
-            vmware._setup_vm(fake_vcenter, fake_vm, fake_logger)
+            vmware._setup_and_wait_for_ip(MagicMock(), MagicMock(), 'alice', MagicMock(), MagicMock())
+
+    @patch.object(vmware, '_setup_and_wait_for_ip')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    def test_provision_spans(self, fake_deploy, fake_set_meta, fake_setup_and_wait_for_ip):
+        """``_provision`` records a span for each phase of the create"""
+        fake_deploy.return_value = (MagicMock(), 'ova')
+        fake_source = MagicMock()
+        fake_source.image = 'test_provision_spans'
+        before = tracing.SPAN_SECONDS.value(span='create.set_meta', outcome='ok')['count']
+
+        vmware._provision(MagicMock(), fake_source, 'alice', 'myClarityNow', MagicMock(), MagicMock())
+        after = tracing.SPAN_SECONDS.value(span='create.set_meta', outcome='ok')['count']
+
+        self.assertEqual(after, before + 1)
 
     @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.inventory, 'find_vm')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    def test_update_network(self, fake_consume_task, fake_find_vm, fake_change_network):
         """``update_network`` Returns None upon success"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myClarityNow'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'ClarityNow'}}
-
-        result = vmware.update_network(username='pat',
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'wootTown' : 'someNetworkObject'}
+
+        result = vmware.update_network(fake_vcenter, username='pat',
                                        machine_name='myClarityNow',
-                                       new_network='wootTown')
+                                       new_network='wootTown',
+                                       logger=MagicMock())
 
         self.assertTrue(result is None)
 
     @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.inventory, 'find_vm')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network_no_vm(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    def test_update_network_no_vm(self, fake_consume_task, fake_find_vm, fake_change_network):
         """``update_network`` Raises ValueError if the supplied VM doesn't exist"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myClarityNow'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'ClarityNow'}}
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'wootTown' : 'someNetworkObject'}
+        fake_find_vm.return_value = None
 
         with self.assertRaises(ValueError):
-            vmware.update_network(username='pat',
+            vmware.update_network(fake_vcenter, username='pat',
                                   machine_name='SomeOtherMachine',
-                                  new_network='wootTown')
+                                  new_network='wootTown',
+                                  logger=MagicMock())
 
     @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.inventory, 'find_vm')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network_no_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    def test_update_network_no_network(self, fake_consume_task, fake_find_vm, fake_change_network):
         """``update_network`` Raises ValueError if the supplied new network doesn't exist"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myClarityNow'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'ClarityNow'}}
+        fake_vcenter = MagicMock()
+        fake_vcenter.networks = {'wootTown' : 'someNetworkObject'}
 
         with self.assertRaises(ValueError):
-            vmware.update_network(username='pat',
+            vmware.update_network(fake_vcenter, username='pat',
                                   machine_name='myClarityNow',
-                                  new_network='dohNet')
+                                  new_network='dohNet',
+                                  logger=MagicMock())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,241 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in warm_pool.py
+"""
+import time
+import unittest
+from unittest.mock import patch, MagicMock, ANY
+
+import ujson
+
+from vlab_claritynow_api.lib.worker import warm_pool
+
+
+def parked(name, component, version='2.11.0', change_version='1'):
+    """Make the output of ``inventory.child_vms`` for a single VM"""
+    meta = {'component': component, 'version': version}
+    props = {'name': name, 'config.annotation': ujson.dumps(meta), 'config.changeVersion': change_version}
+    return (MagicMock(), props)
+
+
+class TestWarmPool(unittest.TestCase):
+    """A set of test cases for the warm_pool.py module"""
+
+    def setUp(self):
+        """Keep the folder lookups from talking to the fake vCenter"""
+        self.fake_get_folder = patch.object(warm_pool.morefs, 'get_folder').start()
+        patch.object(warm_pool.morefs, 'get_or_create_folder').start()
+        self.fake_guest_ips = patch.object(warm_pool, '_guest_ips').start()
+        self.fake_wait_for_new_ip = patch.object(warm_pool, '_wait_for_new_ip').start()
+        self.addCleanup(patch.stopall)
+
+    @patch.object(warm_pool, 'const')
+    def test_pool_sizes(self, fake_const):
+        """``pool_sizes`` parses the image and count of every entry"""
+        fake_const.VLAB_CLARITYNOW_WARM_POOL = '2.11.0:3, 2.10.0:1'
+
+        output = warm_pool.pool_sizes()
+        expected = {'2.11.0': 3, '2.10.0': 1}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(warm_pool, 'const')
+    def test_pool_sizes_empty(self, fake_const):
+        """``pool_sizes`` returns an empty dictionary when no pool is configured"""
+        fake_const.VLAB_CLARITYNOW_WARM_POOL = ''
+
+        self.assertEqual(warm_pool.pool_sizes(), {})
+
+    @patch.object(warm_pool, 'const')
+    def test_pool_sizes_invalid(self, fake_const):
+        """``pool_sizes`` raises ValueError for a malformed entry"""
+        fake_const.VLAB_CLARITYNOW_WARM_POOL = '2.11.0'
+
+        with self.assertRaises(ValueError):
+            warm_pool.pool_sizes()
+
+    def test_parked_name(self):
+        """``parked_name`` is unique"""
+        self.assertNotEqual(warm_pool.parked_name('2.11.0'), warm_pool.parked_name('2.11.0'))
+
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_count(self, fake_child_vms, fake_pool_folder):
+        """``count`` includes VMs being deployed, but not claimed VMs or other images"""
+        fake_child_vms.return_value = [parked('ClarityNow-warm-2.11.0-aaa', warm_pool.WARM_COMPONENT),
+                                       parked(warm_pool.parked_name('2.11.0'), 'Unknown'),
+                                       parked('ClarityNow-warm-2.11.0-ccc', warm_pool.CLAIMED_COMPONENT),
+                                       parked('ClarityNow-warm-2.10.0-ddd', warm_pool.WARM_COMPONENT, version='2.10.0')]
+
+        output = warm_pool.count(MagicMock(), '2.11.0')
+        expected = (2, 1)
+
+        self.assertEqual(output, expected)
+
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_count_abandoned(self, fake_child_vms, fake_pool_folder):
+        """``count`` leaves out VMs that weren't parked within PARK_TIMEOUT"""
+        started = int(time.time()) - warm_pool.PARK_TIMEOUT - 1
+        fake_child_vms.return_value = [parked('ClarityNow-warm-2.11.0-{}-aaa'.format(started), 'Unknown'),
+                                       parked('ClarityNow-warm-2.11.0-bbb', 'Unknown')]
+
+        output = warm_pool.count(MagicMock(), '2.11.0')
+        expected = (0, 0)
+
+        self.assertEqual(output, expected)
+
+    @patch.object(warm_pool, '_destroy')
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_reap(self, fake_child_vms, fake_pool_folder, fake_destroy):
+        """``reap`` destroys VMs that weren't parked within PARK_TIMEOUT, and nothing else"""
+        started = int(time.time()) - warm_pool.PARK_TIMEOUT - 1
+        abandoned, _ = parked('ClarityNow-warm-2.11.0-{}-aaa'.format(started), 'Unknown')
+        fake_child_vms.return_value = [(abandoned, _),
+                                       parked(warm_pool.parked_name('2.11.0'), 'Unknown'),
+                                       parked('ClarityNow-warm-2.11.0-{}-ccc'.format(started), warm_pool.WARM_COMPONENT)]
+
+        output = warm_pool.reap(MagicMock(), '2.11.0', MagicMock())
+
+        self.assertEqual(output, 1)
+        fake_destroy.assert_called_once_with(abandoned, ANY)
+
+    @patch.object(warm_pool.virtual_machine, 'change_network')
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_claim(self, fake_child_vms, fake_pool_folder, fake_consume_task, fake_change_network):
+        """``claim`` moves, renames and re-networks a parked VM"""
+        the_vm, props = parked('ClarityNow-warm-2.11.0-aaa', warm_pool.WARM_COMPONENT)
+        fake_child_vms.return_value = [(the_vm, props)]
+        fake_vcenter = MagicMock()
+
+        output = warm_pool.claim(fake_vcenter, '2.11.0', 'alice', 'myClarityNow', MagicMock(), MagicMock())
+
+        self.assertTrue(output is the_vm)
+        the_vm.Rename_Task.assert_called_with('myClarityNow')
+        self.fake_get_folder.return_value.MoveIntoFolder_Task.assert_called_with([the_vm])
+
+    @patch.object(warm_pool.virtual_machine, 'change_network')
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_claim_is_atomic(self, fake_child_vms, fake_pool_folder, fake_consume_task, fake_change_network):
+        """``claim`` only succeeds if the VM has not changed since it was listed"""
+        the_vm, props = parked('ClarityNow-warm-2.11.0-aaa', warm_pool.WARM_COMPONENT, change_version='42')
+        fake_child_vms.return_value = [(the_vm, props)]
+
+        warm_pool.claim(MagicMock(), '2.11.0', 'alice', 'myClarityNow', MagicMock(), MagicMock())
+        spec = the_vm.ReconfigVM_Task.call_args[0][0]
+
+        self.assertEqual(spec.changeVersion, '42')
+
+    @patch.object(warm_pool.virtual_machine, 'change_network')
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_claim_lost_race(self, fake_child_vms, fake_pool_folder, fake_consume_task, fake_change_network):
+        """``claim`` returns None if another worker claimed every parked VM first"""
+        fake_child_vms.return_value = [parked('ClarityNow-warm-2.11.0-aaa', warm_pool.WARM_COMPONENT)]
+        fake_consume_task.side_effect = RuntimeError('The operation is not allowed in the current state')
+        misses = warm_pool.POOL_MISSES.value(image='2.11.0')
+
+        output = warm_pool.claim(MagicMock(), '2.11.0', 'alice', 'myClarityNow', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertEqual(warm_pool.POOL_MISSES.value(image='2.11.0'), misses + 1)
+
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_claim_hit(self, fake_child_vms, fake_pool_folder):
+        """``claim`` counts the hits per image"""
+        fake_child_vms.return_value = [parked('ClarityNow-warm-2.9.0-aaa', warm_pool.WARM_COMPONENT, version='2.9.0')]
+        hits = warm_pool.POOL_HITS.value(image='2.9.0')
+
+        with patch.object(warm_pool, 'consume_task'), patch.object(warm_pool.virtual_machine, 'change_network'):
+            warm_pool.claim(MagicMock(), '2.9.0', 'alice', 'myClarityNow', MagicMock(), MagicMock())
+
+        self.assertEqual(warm_pool.POOL_HITS.value(image='2.9.0'), hits + 1)
+
+    @patch.object(warm_pool.virtual_machine, 'change_network')
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_claim_duplicate_name(self, fake_child_vms, fake_pool_folder, fake_consume_task, fake_change_network):
+        """``claim`` raises ValueError, without claiming a parked VM, if the user already has a VM with the name"""
+        the_vm, props = parked('ClarityNow-warm-2.11.0-aaa', warm_pool.WARM_COMPONENT)
+        fake_child_vms.return_value = [(the_vm, props), parked('myClarityNow', 'ClarityNow')]
+
+        with self.assertRaises(ValueError):
+            warm_pool.claim(MagicMock(), '2.11.0', 'alice', 'myClarityNow', MagicMock(), MagicMock())
+
+        the_vm.ReconfigVM_Task.assert_not_called()
+
+    @patch.object(warm_pool.virtual_machine, 'power')
+    @patch.object(warm_pool.virtual_machine, 'change_network')
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_claim_handover_fails(self, fake_child_vms, fake_pool_folder, fake_consume_task, fake_change_network, fake_power):
+        """``claim`` destroys the claimed VM and returns None if it can't be handed over"""
+        the_vm, props = parked('ClarityNow-warm-2.11.0-aaa', warm_pool.WARM_COMPONENT)
+        fake_child_vms.return_value = [(the_vm, props)]
+        fake_change_network.side_effect = RuntimeError('testing')
+
+        output = warm_pool.claim(MagicMock(), '2.11.0', 'alice', 'myClarityNow', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        the_vm.Destroy_Task.assert_called()
+
+    @patch.object(warm_pool.virtual_machine, 'change_network')
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'pool_folder')
+    @patch.object(warm_pool.inventory, 'child_vms')
+    def test_claim_waits_for_new_ip(self, fake_child_vms, fake_pool_folder, fake_consume_task, fake_change_network):
+        """``claim`` waits for the VM to drop the IP it had on the pool network"""
+        fake_child_vms.return_value = [parked('ClarityNow-warm-2.11.0-aaa', warm_pool.WARM_COMPONENT)]
+        self.fake_guest_ips.return_value = ['10.0.0.5']
+
+        warm_pool.claim(MagicMock(), '2.11.0', 'alice', 'myClarityNow', MagicMock(), MagicMock())
+        the_args, _ = self.fake_wait_for_new_ip.call_args
+
+        self.assertEqual(the_args[2], ['10.0.0.5'])
+
+    @patch.object(warm_pool.virtual_machine, 'set_meta')
+    def test_park(self, fake_set_meta):
+        """``park`` marks the VM as ready to be claimed"""
+        warm_pool.park(MagicMock(), '2.11.0')
+        meta = fake_set_meta.call_args[0][1]
+
+        self.assertEqual(meta['component'], warm_pool.WARM_COMPONENT)
+
+
+
+class TestWaitForNewIp(unittest.TestCase):
+    """A set of test cases for the ``_wait_for_new_ip`` function"""
+
+    @patch.object(warm_pool.time, 'sleep')
+    @patch.object(warm_pool, '_guest_ips')
+    def test_wait_for_new_ip(self, fake_guest_ips, fake_sleep):
+        """``_wait_for_new_ip`` returns once none of the old IPs are left"""
+        fake_guest_ips.side_effect = [['10.0.0.5'], [], ['192.168.1.7']]
+
+        output = warm_pool._wait_for_new_ip(MagicMock(), MagicMock(), ['10.0.0.5'])
+
+        self.assertEqual(output, ['192.168.1.7'])
+
+    @patch.object(warm_pool.time, 'time')
+    @patch.object(warm_pool.time, 'sleep')
+    @patch.object(warm_pool, '_guest_ips')
+    def test_wait_for_new_ip_timeout(self, fake_guest_ips, fake_sleep, fake_time):
+        """``_wait_for_new_ip`` raises RuntimeError if the VM keeps its old IP"""
+        fake_time.side_effect = [100, 101, 500]
+        fake_guest_ips.return_value = ['10.0.0.5']
+
+        with self.assertRaises(RuntimeError):
+            warm_pool._wait_for_new_ip(MagicMock(), MagicMock(), ['10.0.0.5'], timeout=300)
+
+
+if __name__ == '__main__':
+    unittest.main()
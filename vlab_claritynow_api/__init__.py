@@ -1 +1,3 @@
 # -*- coding: UTF-8 -*-
+# setup.py reads this, so the API can report its version without pkg_resources
+__version__ = '2019.06.25'
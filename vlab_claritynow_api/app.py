@@ -1,16 +1,54 @@
 # -*- coding: UTF-8 -*-
 from flask import Flask
 from celery import Celery
+from vlab_api_common import get_logger
 
-from vlab_claritynow_api.lib import const
-from vlab_claritynow_api.lib.views import HealthView, ClarityNowView
+from vlab_claritynow_api.lib import const, queues, metrics, readiness, admission
+from vlab_claritynow_api.lib.result_store import backend_url
+from vlab_claritynow_api.lib.views import HealthView, ClarityNowView, MetricsView
+from vlab_claritynow_api.lib.views.metrics import METRICS_DIR
 
 app = Flask(__name__)
-app.celery_app = Celery('claritynow', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+app.celery_app = Celery('claritynow', backend=backend_url(const.VLAB_CLARITYNOW_RESULT_BACKEND), broker=const.VLAB_MESSAGE_BROKER)
+app.celery_app.conf.result_expires = const.VLAB_CLARITYNOW_RESULT_TTL
+queues.configure(app.celery_app)
 app.celery_app.conf.broker_heartbeat = 0 #https://github.com/celery/celery/issues/4895
+# send_task borrows a producer (and its broker connection) from this pool, so
+# every uWSGI thread can publish at once. Keep it >= the number of threads.
+app.celery_app.conf.broker_pool_limit = const.VLAB_CLARITYNOW_API_BROKER_POOL
+# Fail a request that can't reach the broker, instead of stalling its thread
+app.celery_app.conf.broker_connection_timeout = const.VLAB_CLARITYNOW_API_PUBLISH_TIMEOUT
+app.celery_app.conf.task_publish_retry_policy = {'max_retries': 2,
+                                                 'interval_start': 0,
+                                                 'interval_step': 0.2,
+                                                 'interval_max': 0.5}
+
+# Load balancer probes read what these last found, instead of checking for themselves
+app.readiness = readiness.Readiness({'broker': readiness.check_broker(app.celery_app, const.VLAB_CLARITYNOW_READY_TIMEOUT),
+                                     'images': readiness.check_images(const.VLAB_CLARITYNOW_IMAGES_DIR),
+                                     'vcenter': readiness.check_vcenter(const.INF_VCENTER_SERVER,
+                                                                        const.INF_VCENTER_PORT,
+                                                                        const.VLAB_CLARITYNOW_READY_TIMEOUT)},
+                                    interval=const.VLAB_CLARITYNOW_READY_SECONDS,
+                                    # Creates still work without the images mounted in the API
+                                    informational={'images'})
+app.readiness.start()
+
+# Creates and deletes get a 429 while the slow queue is too deep
+if const.VLAB_CLARITYNOW_MAX_QUEUE_DEPTH:
+    app.backpressure = admission.Backpressure(app.celery_app,
+                                              const.VLAB_CLARITYNOW_MAX_QUEUE_DEPTH,
+                                              const.VLAB_CLARITYNOW_QUEUE_SAMPLE_SECONDS,
+                                              get_logger(__name__, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL))
+    app.backpressure.start()
 
 HealthView.register(app)
 ClarityNowView.register(app)
+MetricsView.register(app)
+
+if METRICS_DIR:
+    # Every uWSGI process saves its metrics, so any of them can answer a scrape
+    metrics.start_flushing(METRICS_DIR, const.VLAB_CLARITYNOW_METRICS_FLUSH_SECONDS)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+# -*- coding: UTF-8 -*-
+"""
+Turns away expensive requests, before they're queued as hours of vCenter work.
+
+Creating or destroying ClarityNow ties up vCenter for minutes, so two things
+limit how much of that work the API will queue:
+
+* Every user has a token bucket for each operation (``create`` and ``delete``).
+  A bucket holds ``burst`` tokens, and gets back ``rate`` tokens a minute. Each
+  machine in a request takes a token. When a user's bucket runs dry, the
+  request is answered with 429, and a ``Retry-After`` of when enough tokens
+  will be back. A batch for more machines than a full bucket holds could never
+  be admitted, so it's answered with 400 instead; deleting every machine a user
+  owns takes a full bucket.
+* A thread in every API process samples the depth of the slow queue. While
+  ``VLAB_CLARITYNOW_MAX_QUEUE_DEPTH`` or more tasks are waiting, every create
+  and delete is answered with 429, no matter who sent it.
+
+The buckets are kept by each API process, so a user that spreads requests over
+every process can get a multiple of the limit; that's still a far cry from
+unlimited. The queue depth is read from the broker, so it's the same for every
+process.
+
+The API imports this module, so it must never import the vSphere libraries.
+"""
+import math
+import time
+import threading
+
+from vlab_claritynow_api.lib import metrics, queues
+
+
+REJECTIONS = metrics.counter('claritynow_admission_rejections_total', 'Requests answered with 429, by operation and reason')
+BACKPRESSURE = metrics.gauge('claritynow_backpressure', 'If creates and deletes are turned away because the slow queue is too deep')
+
+
+class Rejected(Exception):
+    """The request was not admitted; try again in ``retry_after`` seconds
+
+    :param message: Why the request was not admitted
+    :type message: String
+
+    :param retry_after: How many seconds the client should wait
+    :type retry_after: Integer
+    """
+    def __init__(self, message, retry_after):
+        super(Rejected, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class TooLarge(ValueError):
+    """The request is for more machines than a full bucket holds"""
+    pass
+
+
+def _whole_seconds(seconds):
+    """Retry-After must be a whole number of seconds; never tell a client zero"""
+    return max(int(math.ceil(seconds)), 1)
+
+
+class TokenBucket(object):
+    """Allows a burst of work, then a steady rate of it
+
+    :param rate: How many tokens come back every second
+    :type rate: Float
+
+    :param burst: The most tokens the bucket holds
+    :type burst: Integer
+
+    :param now: A reading of ``time.monotonic``
+    :type now: Float
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def level(self, now):
+        """How many tokens the bucket holds at a given time
+
+        :Returns: Float
+        """
+        return min(self.burst, self.tokens + (now - self.updated) * self.rate)
+
+    def take(self, cost, now):
+        """Take tokens, if the bucket holds enough of them
+
+        :Returns: Float - zero when the tokens were taken, otherwise how many
+                  seconds until the bucket will hold enough of them
+
+        :param cost: How many tokens to take; never more than ``burst``
+        :type cost: Integer
+
+        :param now: A reading of ``time.monotonic``
+        :type now: Float
+        """
+        self.tokens = self.level(now)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimits(object):
+    """A token bucket for every user and operation
+
+    :param limits: Maps an operation to a tuple of (tokens per minute, burst);
+                   operations with a rate or burst of zero aren't limited.
+    :type limits: Dictionary
+    """
+    def __init__(self, limits):
+        self.limits = {op: (rate / 60.0, burst) for op, (rate, burst) in limits.items() if rate > 0 and burst > 0}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def admit(self, username, operation, cost=1):
+        """Take tokens from the bucket of a user, or refuse the request
+
+        :Returns: None
+
+        :Raises: Rejected when the bucket doesn't hold enough tokens, and
+                 TooLarge when a full bucket wouldn't be enough
+
+        :param username: Who sent the request
+        :type username: String
+
+        :param operation: What the request does, i.e. ``create``
+        :type operation: String
+
+        :param cost: How many machines the request is for; None for a full bucket
+        :type cost: Integer
+        """
+        limit = self.limits.get(operation)
+        if limit is None:
+            return
+        if cost is None:
+            cost = limit[1]
+        elif cost > limit[1]:
+            error = 'Unable to {} more than {} machines at once; split the request into smaller batches'.format(operation, limit[1])
+            raise TooLarge(error)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get((username, operation))
+            if bucket is None:
+                bucket = TokenBucket(limit[0], limit[1], now)
+                self._buckets[(username, operation)] = bucket
+            wait = bucket.take(cost, now)
+            self._prune(now)
+        if wait:
+            REJECTIONS.inc(operation=operation, reason='rate_limit')
+            error = 'Too many {} requests; try again in {} seconds'.format(operation, _whole_seconds(wait))
+            raise Rejected(error, _whole_seconds(wait))
+
+    def _prune(self, now):
+        """Drop buckets that have refilled; caller must hold ``_lock``"""
+        full = [x for x, y in self._buckets.items() if y.level(now) >= y.burst]
+        for key in full:
+            self._buckets.pop(key)
+
+    def clear(self):
+        """Refill every bucket
+
+        :Returns: None
+        """
+        with self._lock:
+            self._buckets.clear()
+
+
+class Backpressure(object):
+    """Samples the depth of the slow queue, and turns away work while it's too deep
+
+    :param celery_app: Used to connect to the broker
+    :type celery_app: celery.Celery
+
+    :param max_depth: How many waiting tasks is too many. Zero disables it.
+    :type max_depth: Integer
+
+    :param interval: How many seconds between samples
+    :type interval: Integer/Float
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    def __init__(self, celery_app, max_depth, interval, logger):
+        self.celery_app = celery_app
+        self.max_depth = max_depth
+        self.interval = interval
+        self.logger = logger
+        self._depth = None
+        self._sampled = 0
+        self._stop = threading.Event()
+
+    def sample(self):
+        """Ask the broker how many tasks are waiting in the slow queue
+
+        :Returns: None
+        """
+        depth = queues.sample_depths(self.celery_app, self.logger).get(queues.SLOW_QUEUE)
+        if depth is None:
+            return
+        self._depth, self._sampled = depth, time.time()
+        BACKPRESSURE.set(1 if depth >= self.max_depth else 0)
+
+    def start(self):
+        """Keep sampling the depth of the slow queue from a background thread
+
+        :Returns: threading.Thread
+        """
+        def _sample():
+            while not self._stop.is_set():
+                try:
+                    self.sample()
+                except Exception as doh:
+                    self.logger.warning('Unable to reach broker to sample queue depths: {}'.format(doh))
+                self._stop.wait(self.interval)
+        sampler = threading.Thread(target=_sample, name='backpressure', daemon=True)
+        sampler.start()
+        return sampler
+
+    def stop(self):
+        """Stop sampling the depth of the slow queue
+
+        :Returns: None
+        """
+        self._stop.set()
+
+    def admit(self, operation):
+        """Refuse the request while the slow queue is too deep
+
+        An old sample can't be trusted, so without a recent one the request is
+        admitted; the broker being down is for the readiness checks to report.
+
+        :Returns: None
+
+        :Raises: Rejected when the slow queue is too deep
+
+        :param operation: What the request does, i.e. ``create``
+        :type operation: String
+        """
+        if self.max_depth <= 0 or self._depth is None:
+            return
+        if time.time() - self._sampled > self.interval * 3:
+            return
+        if self._depth >= self.max_depth:
+            REJECTIONS.inc(operation=operation, reason='backpressure')
+            error = '{} tasks are already waiting; try again in {} seconds'.format(self._depth, _whole_seconds(self.interval))
+            raise Rejected(error, _whole_seconds(self.interval))
@@ -24,6 +24,46 @@ DEFINED = OrderedDict([
             ('VLAB_URL', environ.get('VLAB_URL', 'https://localhost')),
             ('VLAB_CLARITYNOW_IMAGES_DIR', environ.get('VLAB_CLARITYNOW_IMAGES_DIR', '/images')),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
+            ('VLAB_CLARITYNOW_API_BROKER_POOL', int(environ.get('VLAB_CLARITYNOW_API_BROKER_POOL', 16))),
+            ('VLAB_CLARITYNOW_API_PUBLISH_TIMEOUT', int(environ.get('VLAB_CLARITYNOW_API_PUBLISH_TIMEOUT', 5))),
+            ('VLAB_CLARITYNOW_SHOW_COALESCE_SECONDS', float(environ.get('VLAB_CLARITYNOW_SHOW_COALESCE_SECONDS', 30))),
+            ('VLAB_CLARITYNOW_IDEMPOTENCY_TTL', int(environ.get('VLAB_CLARITYNOW_IDEMPOTENCY_TTL', 3600))),
+            ('VLAB_CLARITYNOW_CREATES_PER_MINUTE', float(environ.get('VLAB_CLARITYNOW_CREATES_PER_MINUTE', 2))),
+            ('VLAB_CLARITYNOW_CREATE_BURST', int(environ.get('VLAB_CLARITYNOW_CREATE_BURST', 10))),
+            ('VLAB_CLARITYNOW_DELETES_PER_MINUTE', float(environ.get('VLAB_CLARITYNOW_DELETES_PER_MINUTE', 10))),
+            ('VLAB_CLARITYNOW_DELETE_BURST', int(environ.get('VLAB_CLARITYNOW_DELETE_BURST', 20))),
+            ('VLAB_CLARITYNOW_MAX_QUEUE_DEPTH', int(environ.get('VLAB_CLARITYNOW_MAX_QUEUE_DEPTH', 100))),
+            ('VLAB_CLARITYNOW_SLOW_TIME_LIMIT', int(environ.get('VLAB_CLARITYNOW_SLOW_TIME_LIMIT', 1800))),
+            ('VLAB_CLARITYNOW_FAST_TIME_LIMIT', int(environ.get('VLAB_CLARITYNOW_FAST_TIME_LIMIT', 120))),
+            ('VLAB_CLARITYNOW_QUEUE_SAMPLE_SECONDS', int(environ.get('VLAB_CLARITYNOW_QUEUE_SAMPLE_SECONDS', 15))),
+            ('VLAB_CLARITYNOW_METRICS_DIR', environ.get('VLAB_CLARITYNOW_METRICS_DIR', '/tmp/claritynow-metrics')),
+            ('VLAB_CLARITYNOW_METRICS_FLUSH_SECONDS', float(environ.get('VLAB_CLARITYNOW_METRICS_FLUSH_SECONDS', 5))),
+            ('VLAB_CLARITYNOW_WORKER_METRICS_PORT', int(environ.get('VLAB_CLARITYNOW_WORKER_METRICS_PORT', 9108))),
+            ('VLAB_CLARITYNOW_PROGRESS_SECONDS', float(environ.get('VLAB_CLARITYNOW_PROGRESS_SECONDS', 5))),
+            ('VLAB_CLARITYNOW_STREAM_POLL_SECONDS', float(environ.get('VLAB_CLARITYNOW_STREAM_POLL_SECONDS', 1))),
+            ('VLAB_CLARITYNOW_STREAM_HEARTBEAT_SECONDS', float(environ.get('VLAB_CLARITYNOW_STREAM_HEARTBEAT_SECONDS', 15))),
+            ('VLAB_CLARITYNOW_STREAM_MAX_SECONDS', int(environ.get('VLAB_CLARITYNOW_STREAM_MAX_SECONDS', 1800))),
+            ('VLAB_CLARITYNOW_MAX_STREAMS', int(environ.get('VLAB_CLARITYNOW_MAX_STREAMS', 4))),
+            ('VLAB_CLARITYNOW_RESULT_BACKEND', environ.get('VLAB_CLARITYNOW_RESULT_BACKEND', 'rpc://')),
+            ('VLAB_CLARITYNOW_RESULT_TTL', int(environ.get('VLAB_CLARITYNOW_RESULT_TTL', 3600))),
+            ('VLAB_CLARITYNOW_OVA_CACHE_SIZE', int(environ.get('VLAB_CLARITYNOW_OVA_CACHE_SIZE', 16))),
+            ('VLAB_CLARITYNOW_UPLOAD_PARALLEL', int(environ.get('VLAB_CLARITYNOW_UPLOAD_PARALLEL', 4))),
+            ('VLAB_CLARITYNOW_LEASE_PROGRESS_SECONDS', float(environ.get('VLAB_CLARITYNOW_LEASE_PROGRESS_SECONDS', 5))),
+            ('VLAB_CLARITYNOW_MOREF_TTL', int(environ.get('VLAB_CLARITYNOW_MOREF_TTL', 300))),
+            ('VLAB_CLARITYNOW_READY_SECONDS', float(environ.get('VLAB_CLARITYNOW_READY_SECONDS', 15))),
+            ('VLAB_CLARITYNOW_READY_TIMEOUT', float(environ.get('VLAB_CLARITYNOW_READY_TIMEOUT', 5))),
+            ('VLAB_CLARITYNOW_PROVISION_MODE', environ.get('VLAB_CLARITYNOW_PROVISION_MODE', 'ova')),
+            ('VLAB_CLARITYNOW_TEMPLATE_FOLDER', environ.get('VLAB_CLARITYNOW_TEMPLATE_FOLDER', 'ClarityNowTemplates')),
+            ('VLAB_CLARITYNOW_WARM_POOL', environ.get('VLAB_CLARITYNOW_WARM_POOL', '')),
+            ('VLAB_CLARITYNOW_WARM_POOL_FOLDER', environ.get('VLAB_CLARITYNOW_WARM_POOL_FOLDER', 'ClarityNowWarmPool')),
+            ('VLAB_CLARITYNOW_WARM_POOL_NETWORK', environ.get('VLAB_CLARITYNOW_WARM_POOL_NETWORK', 'VM Network')),
+            ('VLAB_CLARITYNOW_WARM_POOL_REFILL_MAX', int(environ.get('VLAB_CLARITYNOW_WARM_POOL_REFILL_MAX', 2))),
+            ('VLAB_CLARITYNOW_BATCH_MAX', int(environ.get('VLAB_CLARITYNOW_BATCH_MAX', 50))),
+            ('VLAB_CLARITYNOW_BATCH_PARALLEL', int(environ.get('VLAB_CLARITYNOW_BATCH_PARALLEL', 4))),
+            ('VLAB_CLARITYNOW_VCENTER_POOL_SIZE', int(environ.get('VLAB_CLARITYNOW_VCENTER_POOL_SIZE', 4))),
+            ('VLAB_CLARITYNOW_ADMINS', [x for x in environ.get('VLAB_CLARITYNOW_ADMINS', '').split(',') if x]),
+            ('VLAB_CLARITYNOW_INVENTORY_MAX_PAGE', int(environ.get('VLAB_CLARITYNOW_INVENTORY_MAX_PAGE', 500))),
+            ('VLAB_CLARITYNOW_VCENTER_IDLE_TIMEOUT', int(environ.get('VLAB_CLARITYNOW_VCENTER_IDLE_TIMEOUT', 900))),
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+"""
+Entity tags for the results of tasks, so a client can skip what it already has.
+
+The workers tag the results of ``claritynow.show`` and ``claritynow.inventory``
+with a hash of the content, computed once per task. The API sends the tag as
+the ``ETag`` of ``/task/<id>``. When a poll has ``If-None-Match`` with that
+tag, the API answers 304 without serializing or sending the result again.
+
+The tag only depends on the content, not the task, so a client that sends a new
+``GET`` (i.e. a new task) still gets a 304 if nothing changed.
+
+The tag of ``claritynow.show`` leaves out the ``console`` of each machine,
+because the console ticket is new every time. So the API sends the tags of the
+workers as weak ETags: a 304 means the machines are the same, not that the body
+is byte for byte the same. A client that keeps a cached body must send a new
+``GET`` for a ``console`` ticket it can use. The tag itself is never part of
+the body sent to the client.
+
+Both the API and the worker use this module, so it must never import the
+vSphere libraries.
+"""
+import hashlib
+
+import ujson
+
+
+def content_etag(content, volatile=()):
+    """Hash the content of a task result
+
+    :Returns: String
+
+    :param content: The ``content`` of the result of a task
+    :type content: Dictionary
+
+    :param volatile: Keys of each item in ``content`` that differ every time,
+                     even when nothing changed; they're left out of the hash.
+    :type volatile: Iterable
+    """
+    if volatile:
+        content = {name: _without(item, volatile) for name, item in content.items()}
+    return hashlib.sha1(ujson.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _without(item, keys):
+    if not isinstance(item, dict):
+        return item
+    return {x: y for x, y in item.items() if x not in keys}
+
+
+def body_etag(body):
+    """Hash an already serialized result, for tasks that don't tag their results
+
+    :Returns: String
+
+    :param body: The JSON that would be sent to the client
+    :type body: String
+    """
+    return hashlib.sha1(body.encode()).hexdigest()
@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+"""
+Makes retried creates safe, by keying them on the ``X-REQUEST-ID`` header.
+
+A client that times out waiting on ``POST /api/2/inf/claritynow`` will often
+send the same request again. Without this, that's a second deploy of the OVA.
+Instead, the first create with a request id remembers the task it sent, and for
+``VLAB_CLARITYNOW_IDEMPOTENCY_TTL`` seconds a create with the same request id
+and the same body gets that task id back. Reusing a request id with a different
+body is an error.
+
+The keys are saved in the result store when it's a shared key/value store (i.e.
+SQLite or Redis), so a retry answered by another API process is caught too.
+A process claims the key in the store, in one atomic step, before it sends the
+task; a retry that arrives while the claim is being sent gets a conflict, so two
+processes never both send the create. With ``rpc://`` the keys are only kept by
+the process that sent the task. A shared store also expires the keys after
+``VLAB_CLARITYNOW_RESULT_TTL``, if that's sooner.
+"""
+import time
+import hashlib
+import threading
+
+import ujson
+from celery.backends.base import KeyValueStoreBackend
+
+from vlab_claritynow_api.lib import metrics
+from vlab_claritynow_api.lib.single_flight import KeyedLocks
+
+
+STORE_PREFIX = 'claritynow-idempotency-'
+
+
+class IdempotencyConflict(ValueError):
+    """The request id was already used for a different request"""
+    pass
+
+
+def shared_store(celery_app):
+    """Obtain the result store of a Celery app, if every API process can read it
+
+    :Returns: celery.backends.base.KeyValueStoreBackend, or None
+
+    :param celery_app: The Celery app the API sends tasks with
+    :type celery_app: celery.Celery
+    """
+    backend = celery_app.backend
+    if isinstance(backend, KeyValueStoreBackend):
+        return backend
+    return None
+
+
+def _save(store, key, value, ttl, only_new=False):
+    """Save a key in a shared store, for ``ttl`` seconds
+
+    :Returns: Boolean - False if ``only_new`` is set and the key is already saved
+
+    :param store: The output from ``shared_store``
+    :type store: celery.backends.base.KeyValueStoreBackend
+
+    :param only_new: Set to only save the key if no process has, in one atomic step
+    :type only_new: Boolean
+    """
+    client = getattr(store, 'client', None)
+    if hasattr(store, 'add'):
+        # result_store.SQLiteBackend
+        if only_new:
+            return store.add(key, value, ttl)
+        store.set(key, value, ttl)
+        return True
+    elif hasattr(client, 'setnx'):
+        # Redis
+        return bool(client.set(key, value, nx=only_new, ex=ttl))
+    # Other stores have no atomic add; this still narrows the race to one round trip
+    if only_new and store.get(key) is not None:
+        return False
+    store.set(key, value)
+    return True
+
+
+def fingerprint(body):
+    """Hash a request body; the same body always has the same hash
+
+    :Returns: String
+
+    :param body: The parsed JSON body of the request
+    :type body: Dictionary
+    """
+    return hashlib.sha1(ujson.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+class IdempotentRequests(object):
+    """Hands out the task of an earlier, identical request with the same request id
+
+    :param name: Labels the metrics, i.e. ``create``
+    :type name: String
+
+    :param ttl: How many seconds to remember a request id. Zero disables it.
+    :type ttl: Integer/Float
+    """
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self._local = {}
+        self._locks = KeyedLocks()
+        self._lock = threading.Lock()
+        self._replays = metrics.counter('claritynow_idempotent_replays_total',
+                                        'Retried requests handed the task of the original request')
+
+    def _lookup(self, key, now, store):
+        """Find what's remembered about a key, locally and then in the shared store"""
+        entry = self._local.get(key)
+        if entry is None and store is not None:
+            value = store.get(STORE_PREFIX + key)
+            if value is not None:
+                entry = ujson.loads(value)
+        if entry is None or entry['expires'] < now:
+            return None
+        return entry
+
+    def send(self, username, request_id, body, send_task, store=None):
+        """Obtain the task of an earlier request with the same id, or send a new task
+
+        :Returns: Tuple of (String, Boolean) - the task id, and if it's from an earlier request
+
+        :Raises: IdempotencyConflict if the request id was used with a different body
+
+        :param username: Who sent the request; request ids are only unique per user
+        :type username: String
+
+        :param request_id: The ``X-REQUEST-ID`` of the request; None to always send a new task
+        :type request_id: String
+
+        :param body: The parsed JSON body of the request
+        :type body: Dictionary
+
+        :param send_task: Sends the task for a new request; must return the task
+        :type send_task: Function
+
+        :param store: Where every API process can find the key, i.e. a SQLite result store
+        :type store: celery.backends.base.KeyValueStoreBackend
+        """
+        if self.ttl <= 0 or not request_id:
+            return send_task().id, False
+        key = hashlib.sha1('{}\0{}\0{}'.format(self.name, username, request_id).encode()).hexdigest()
+        body_hash = fingerprint(body)
+        # Only requests with the same id wait on each other
+        with self._locks.hold(key):
+            now = time.time()
+            entry = self._lookup(key, now, store)
+            if entry is None and store is not None:
+                ttl = int(min(self.ttl, getattr(store, 'expires', None) or self.ttl))
+                claim = {'task_id': None, 'body': body_hash, 'expires': now + self.ttl}
+                if not _save(store, STORE_PREFIX + key, ujson.dumps(claim), ttl, only_new=True):
+                    # Another API process claimed it since the lookup
+                    entry = self._lookup(key, now, store) or claim
+            if entry is not None:
+                if entry['body'] != body_hash:
+                    error = 'Request id {} was already used for a different request'.format(request_id)
+                    raise IdempotencyConflict(error)
+                if entry['task_id'] is None:
+                    error = 'Request id {} is still being sent; retry it'.format(request_id)
+                    raise IdempotencyConflict(error)
+                self._replays.inc(request=self.name)
+                return entry['task_id'], True
+            try:
+                task = send_task()
+            except Exception:
+                if store is not None:
+                    # Let a retry send it
+                    store.delete(STORE_PREFIX + key)
+                raise
+            entry = {'task_id': task.id, 'body': body_hash, 'expires': now + self.ttl}
+            with self._lock:
+                self._local[key] = entry
+                self._prune(now)
+            if store is not None:
+                _save(store, STORE_PREFIX + key, ujson.dumps(entry), ttl)
+            return task.id, False
+
+    def _prune(self, now):
+        """Drop expired keys; caller must hold ``_lock``"""
+        stale = [x for x, y in self._local.items() if y['expires'] < now]
+        for key in stale:
+            self._local.pop(key)
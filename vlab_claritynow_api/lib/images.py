@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+"""
+Keeps track of the ClarityNow images (OVA files) that can be deployed.
+
+Both the API and the worker use this module, so it must never import the
+vSphere libraries.
+"""
+import os
+import hashlib
+import threading
+
+import ujson
+
+
+def convert_name(name, to_version=False):
+    """This function centralizes converting between the name of the OVA, and the
+    version of software it contains.
+
+    The OVA files are named ``ClarityNow-<version>.ova``.
+
+    :param name: The thing to covert
+    :type name: String
+
+    :param to_version: Set to True to covert the name of an OVA to the version
+    :type to_version: Boolean
+    """
+    if to_version:
+        return name.split('-')[-1].replace('.ova', '')
+    else:
+        return 'ClarityNow-{}.ova'.format(name)
+
+
+class ImageCatalog(object):
+    """An index of the OVA files in the images directory.
+
+    Listing and stat'ing every OVA is only done when the modification time of
+    the directory changes (i.e. an OVA is added, removed, or renamed), so looking
+    up the catalog is normally just one ``stat`` call.
+
+    :param images_dir: The directory that contains the ClarityNow OVA files
+    :type images_dir: String
+    """
+    def __init__(self, images_dir):
+        self.images_dir = images_dir
+        self._dir_mtime = None
+        self._details = {}
+        self._etag = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Rebuild the catalog if the images directory has changed
+
+        :Returns: Boolean - True if the catalog was rebuilt
+
+        :Raises: FileNotFoundError if the images directory does not exist
+        """
+        dir_mtime = os.stat(self.images_dir).st_mtime
+        with self._lock:
+            if dir_mtime == self._dir_mtime:
+                return False
+            details = {}
+            for file_name in os.listdir(self.images_dir):
+                if not file_name.endswith('.ova'):
+                    continue
+                try:
+                    info = os.stat(os.path.join(self.images_dir, file_name))
+                except FileNotFoundError:
+                    # removed while we were looking
+                    continue
+                details[convert_name(file_name, to_version=True)] = {'file': file_name,
+                                                                     'size': info.st_size,
+                                                                     'mtime': info.st_mtime}
+            self._details = details
+            self._etag = hashlib.sha1(ujson.dumps(details, sort_keys=True).encode()).hexdigest()
+            self._dir_mtime = dir_mtime
+            return True
+
+    @property
+    def images(self):
+        """The versions of ClarityNow that can be deployed
+
+        :Returns: List
+        """
+        return sorted(self._details.keys())
+
+    @property
+    def details(self):
+        """A mapping of version to the file name, size and modification time of the OVA
+
+        :Returns: Dictionary
+        """
+        return self._details
+
+    @property
+    def etag(self):
+        """Changes whenever the contents of the catalog change
+
+        :Returns: String
+        """
+        return self._etag
@@ -0,0 +1,501 @@
+# -*- coding: UTF-8 -*-
+"""
+A tiny, dependency-free registry of process-wide metrics.
+
+Both the API and the worker record counters, gauges and histograms here; every
+metric is identified by its name, and every sample by the labels supplied when
+it was recorded.
+
+The API (uWSGI) and the worker (Celery prefork) both run several processes,
+and each has its own registry. When a metrics directory is configured, every
+process periodically writes its metrics there (``start_flushing``), and the
+process answering a scrape merges them all (``render``): counters and
+histograms are summed, and gauges are always reported per process with a
+``pid`` label. The files of exited processes are deleted when the worker starts
+(``remove_stale``).
+"""
+import os
+import glob
+import time
+import atexit
+import threading
+from socketserver import ThreadingMixIn
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import ujson
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+_LOCK = threading.Lock()
+_REGISTRY = OrderedDict()
+
+
+class _Metric(object):
+    """Common logic for all metric types
+
+    :param name: The unique name of the metric
+    :type name: String
+
+    :param description: A short, human friendly explanation of the metric
+    :type description: String
+    """
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def value(self, **labels):
+        """Obtain the current value of the metric for the supplied labels
+
+        :Returns: Float
+        """
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        """Obtain every recorded value of the metric
+
+        :Returns: List of (Dictionary, Float) tuples
+        """
+        with self._lock:
+            return [(dict(k), v) for k, v in self._values.items()]
+
+    def clear(self):
+        """Forget every recorded value
+
+        :Returns: None
+        """
+        with self._lock:
+            self._values = OrderedDict()
+
+
+class Counter(_Metric):
+    """A value that only ever goes up"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter
+
+        :Returns: None
+
+        :param amount: How much to increase the counter by
+        :type amount: Integer/Float
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that can go up and down"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Replace the current value of the gauge
+
+        :Returns: None
+
+        :param value: The new value
+        :type value: Integer/Float
+        """
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        """Increase the gauge
+
+        :Returns: None
+
+        :param amount: How much to increase the gauge by
+        :type amount: Integer/Float
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Decrease the gauge
+
+        :Returns: None
+
+        :param amount: How much to decrease the gauge by
+        :type amount: Integer/Float
+        """
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Counts observations (like how long something took) into buckets
+
+    :param buckets: The upper bounds of the buckets, smallest first
+    :type buckets: Tuple
+    """
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                       30, 60, 120, 300, 600, 1200, 1800)
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Record a single observation
+
+        :Returns: None
+
+        :param value: The thing to record, i.e. the number of seconds something took
+        :type value: Integer/Float
+        """
+        key = self._key(labels)
+        with self._lock:
+            current = self._values.get(key)
+            if current is None:
+                current = {'count': 0, 'sum': 0, 'buckets': [0] * len(self.buckets)}
+                self._values[key] = current
+            current['count'] += 1
+            current['sum'] += value
+            for idx, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    current['buckets'][idx] += 1
+
+    def value(self, **labels):
+        """Obtain the count, sum and cumulative bucket counts for the supplied labels
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            current = self._values.get(self._key(labels))
+            if current is None:
+                return {'count': 0, 'sum': 0, 'buckets': [0] * len(self.buckets)}
+            return {'count': current['count'], 'sum': current['sum'],
+                    'buckets': list(current['buckets'])}
+
+    def samples(self):
+        """Obtain every recorded value of the metric
+
+        :Returns: List of (Dictionary, Dictionary) tuples
+        """
+        with self._lock:
+            return [(dict(k), {'count': v['count'], 'sum': v['sum'], 'buckets': list(v['buckets'])})
+                    for k, v in self._values.items()]
+
+
+def _get_or_create(cls, name, description, **kwargs):
+    with _LOCK:
+        metric = _REGISTRY.get(name)
+        if metric is None:
+            metric = cls(name, description, **kwargs)
+            _REGISTRY[name] = metric
+        elif not isinstance(metric, cls):
+            error = 'Metric {} already registered as a {}'.format(name, metric.kind)
+            raise ValueError(error)
+    return metric
+
+
+def counter(name, description=''):
+    """Obtain the counter with the given name, creating it if needed
+
+    :Returns: Counter
+
+    :param name: The unique name of the metric
+    :type name: String
+
+    :param description: A short, human friendly explanation of the metric
+    :type description: String
+    """
+    return _get_or_create(Counter, name, description)
+
+
+def gauge(name, description=''):
+    """Obtain the gauge with the given name, creating it if needed
+
+    :Returns: Gauge
+
+    :param name: The unique name of the metric
+    :type name: String
+
+    :param description: A short, human friendly explanation of the metric
+    :type description: String
+    """
+    return _get_or_create(Gauge, name, description)
+
+
+def histogram(name, description='', buckets=Histogram.DEFAULT_BUCKETS):
+    """Obtain the histogram with the given name, creating it if needed
+
+    :Returns: Histogram
+
+    :param name: The unique name of the metric
+    :type name: String
+
+    :param description: A short, human friendly explanation of the metric
+    :type description: String
+
+    :param buckets: The upper bounds of the buckets; only used when creating the histogram
+    :type buckets: Tuple
+    """
+    return _get_or_create(Histogram, name, description, buckets=buckets)
+
+
+def collect():
+    """Obtain every registered metric
+
+    :Returns: List
+    """
+    with _LOCK:
+        return list(_REGISTRY.values())
+
+
+def snapshot():
+    """Obtain the current value of every metric, keyed by metric name
+
+    :Returns: Dictionary
+    """
+    answer = {}
+    for metric in collect():
+        answer[metric.name] = metric.samples()
+    return answer
+
+
+def reset():
+    """Forget the value of every metric, i.e. in a freshly forked process
+
+    :Returns: None
+    """
+    for metric in collect():
+        metric.clear()
+
+
+def export():
+    """Obtain every metric of this process, in a form that can be saved as JSON
+
+    :Returns: Dictionary
+    """
+    families = []
+    for metric in collect():
+        family = {'name': metric.name,
+                  'kind': metric.kind,
+                  'description': metric.description,
+                  'samples': metric.samples()}
+        if isinstance(metric, Histogram):
+            family['buckets'] = list(metric.buckets)
+        families.append(family)
+    return {'pid': os.getpid(), 'metrics': families}
+
+
+def dump(directory):
+    """Save the metrics of this process, for another process to merge
+
+    :Returns: None
+
+    :param directory: Where every process of the service saves its metrics
+    :type directory: String
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}.json'.format(os.getpid()))
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as the_file:
+        the_file.write(ujson.dumps(export()))
+    # Readers never see a half written file
+    os.replace(tmp_path, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_stale(directory):
+    """Delete the metrics saved by processes that have exited
+
+    Only call this when the service starts; the counters of an exited process
+    are part of the totals until then.
+
+    :Returns: None
+
+    :param directory: Where every process of the service saves its metrics
+    :type directory: String
+    """
+    for path in glob.glob(os.path.join(directory, '*.json*')):
+        try:
+            pid = int(os.path.basename(path).split('.')[0])
+        except ValueError:
+            continue
+        if pid == os.getpid() or _alive(pid):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _load(directory):
+    """Read the metrics every other process saved to the directory"""
+    exports = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as the_file:
+                exported = ujson.load(the_file)
+        except (OSError, ValueError):
+            continue
+        if exported.get('pid') != os.getpid():
+            exports.append(exported)
+    return exports
+
+
+def merge(exports):
+    """Combine the metrics of several processes
+
+    Counters and histograms are summed. Gauges of live processes are always
+    kept apart with a ``pid`` label; gauges of exited processes are dropped.
+
+    :Returns: List of Dictionaries, like the ``metrics`` of ``export``
+
+    :param exports: The output of ``export`` for every process
+    :type exports: List
+    """
+    families = OrderedDict()
+    for exported in exports:
+        pid = exported['pid']
+        for family in exported['metrics']:
+            merged = families.setdefault(family['name'], dict(family, samples=OrderedDict()))
+            if family['kind'] == 'gauge':
+                if pid != os.getpid() and not _alive(pid):
+                    continue
+                # Always labeled, so a series is the same no matter how many processes saved metrics
+                for labels, value in family['samples']:
+                    merged['samples'][tuple(sorted(dict(labels, pid=str(pid)).items()))] = value
+                continue
+            for labels, value in family['samples']:
+                key = tuple(sorted(labels.items()))
+                current = merged['samples'].get(key)
+                if current is None:
+                    merged['samples'][key] = value
+                elif family['kind'] == 'histogram':
+                    merged['samples'][key] = {'count': current['count'] + value['count'],
+                                              'sum': current['sum'] + value['sum'],
+                                              'buckets': [x + y for x, y in zip(current['buckets'], value['buckets'])]}
+                else:
+                    merged['samples'][key] = current + value
+    answer = []
+    for family in families.values():
+        family['samples'] = [(dict(x), y) for x, y in family['samples'].items()]
+        answer.append(family)
+    return answer
+
+
+def _escape(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(x, _escape(y)) for x, y in sorted(labels.items())) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return '{}'.format(int(value))
+    return '{}'.format(value)
+
+
+def render(directory=None):
+    """Format the metrics in the Prometheus text exposition format
+
+    :Returns: String
+
+    :param directory: Also include the metrics saved here by other processes
+    :type directory: String
+    """
+    exports = [export()]
+    if directory:
+        exports += _load(directory)
+    lines = []
+    for family in merge(exports):
+        name = family['name']
+        if family['description']:
+            lines.append('# HELP {} {}'.format(name, family['description']))
+        lines.append('# TYPE {} {}'.format(name, family['kind']))
+        for labels, value in family['samples']:
+            if family['kind'] == 'histogram':
+                for upper_bound, count in zip(family['buckets'], value['buckets']):
+                    bucket_labels = dict(labels, le=_number(float(upper_bound)))
+                    lines.append('{}_bucket{} {}'.format(name, _labels(bucket_labels), count))
+                lines.append('{}_bucket{} {}'.format(name, _labels(dict(labels, le='+Inf')), value['count']))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(value['sum'])))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), value['count']))
+            else:
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def start_flushing(directory, interval):
+    """Keep saving the metrics of this process in the background, and when it exits
+
+    :Returns: threading.Thread
+
+    :param directory: Where every process of the service saves its metrics
+    :type directory: String
+
+    :param interval: How many seconds between saves
+    :type interval: Integer/Float
+    """
+    def _flush():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(directory)
+            except OSError:
+                pass
+    atexit.register(dump, directory)
+    flusher = threading.Thread(target=_flush, name='metrics-flush', daemon=True)
+    flusher.start()
+    return flusher
+
+
+def serve(port, directory=None):
+    """Answer ``GET /metrics`` on a port, from a background thread
+
+    :Returns: http.server.HTTPServer
+
+    :param port: The TCP port to listen on
+    :type port: Integer
+
+    :param directory: Also include the metrics saved here by other processes
+    :type directory: String
+    """
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render(directory).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', '{}'.format(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            # Scrapes every few seconds would drown out the task logs
+            pass
+
+    class _Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = _Server(('0.0.0.0', port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
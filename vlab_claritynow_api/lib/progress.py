@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+"""
+Reports the progress of long running tasks, and streams it to clients.
+
+Workers publish a custom ``PROGRESS`` state into the result store as a task
+moves through its phases. The API reads that state and pushes every change
+to the client as a Server-Sent Event, so a client can wait on one request for
+a create to finish instead of polling ``/task/<id>`` over and over.
+
+This module is imported by both the API and the worker, so it must never
+import the vSphere libraries.
+"""
+import time
+import threading
+
+import ujson
+
+
+STATE = 'PROGRESS'
+# The phases of creating a ClarityNow instance, in the order they happen
+IMAGE_OPENED = 'image_opened'
+DEPLOYING = 'deploying'
+CONFIGURING = 'configuring'
+WAITING_FOR_IP = 'waiting_for_ip'
+READY_STATES = frozenset(['SUCCESS', 'FAILURE', 'REVOKED'])
+
+
+class Reporter(object):
+    """Tracks the phase of every VM a task is working on, and publishes changes
+
+    Safe to use from several threads, i.e. the deploys of a batch create.
+    With no ``publish`` callable, every update is ignored.
+
+    :param publish: Called with the progress of every VM when any of them changes
+    :type publish: Callable
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    def __init__(self, publish=None, logger=None):
+        self._publish = publish
+        self._logger = logger
+        self._machines = {}
+        self._lock = threading.Lock()
+
+    def update(self, machine_name, phase, percent=None):
+        """Record the phase a VM is in
+
+        :Returns: None
+
+        :param machine_name: The name of the VM being created
+        :type machine_name: String
+
+        :param phase: What's being done to the VM, i.e. ``deploying``
+        :type phase: String
+
+        :param percent: How far through the phase the VM is, if known
+        :type percent: Integer
+        """
+        if self._publish is None:
+            return
+        status = {'phase': phase}
+        if percent is not None:
+            status['percent'] = int(percent)
+        # Publishing under the lock keeps the updates from different threads in order
+        with self._lock:
+            if self._machines.get(machine_name) == status:
+                return
+            self._machines[machine_name] = status
+            try:
+                self._publish({'machines': dict(self._machines)})
+            except Exception as doh:
+                # Never fail a create because the progress couldn't be saved
+                if self._logger is not None:
+                    self._logger.warning('Unable to publish progress: {}'.format(doh))
+
+
+def task_reporter(task, logger):
+    """Make a Reporter that saves progress as the state of a Celery task
+
+    :Returns: Reporter
+
+    :param task: The bound task that's running
+    :type task: celery.Task
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    # Task.request is thread local, so capture it now, not in a deploy thread.
+    # The backend needs all of it; i.e. rpc:// publishes to its reply_to.
+    request = task.request
+    def publish(meta):
+        task.backend.store_result(request.id, meta, STATE, request=request)
+    return Reporter(publish, logger)
+
+
+def event(name, data):
+    """Format one Server-Sent Event
+
+    :Returns: String
+
+    :param name: The type of event, i.e. ``progress``
+    :type name: String
+
+    :param data: The payload; it's sent as JSON
+    :type data: Dictionary
+    """
+    return 'event: {}\ndata: {}\n\n'.format(name, ujson.dumps(data))
+
+
+def _result(meta):
+    """The final answer of a task, like ``/task/<id>`` would report it"""
+    answer = {'status': meta['status']}
+    if meta['status'] == 'SUCCESS' and isinstance(meta.get('result'), dict):
+        answer.update(meta['result'])
+        answer.pop('etag', None)
+    elif meta.get('result') is not None:
+        answer['error'] = '{}'.format(meta['result'])
+    return answer
+
+
+def follow(async_result, poll_interval, heartbeat, timeout):
+    """Yield a Server-Sent Event every time a task makes progress, until it's done
+
+    Emits a ``progress`` event whenever the state of the task changes, a
+    ``result`` event once the task is done, and a ``timeout`` event if it's
+    still running after ``timeout`` seconds. A comment line is sent after
+    ``heartbeat`` idle seconds so proxies don't close the connection.
+
+    :Returns: Generator
+
+    :param async_result: The task to follow
+    :type async_result: celery.result.AsyncResult
+
+    :param poll_interval: How many seconds between reads of the result store
+    :type poll_interval: Integer/Float
+
+    :param heartbeat: Send a keep alive after this many seconds without an event
+    :type heartbeat: Integer/Float
+
+    :param timeout: Give up after this many seconds
+    :type timeout: Integer/Float
+    """
+    started = time.time()
+    last_sent = started
+    last = None
+    # Tell EventSource clients how long to wait before reconnecting
+    yield 'retry: {}\n\n'.format(int(poll_interval * 1000))
+    while True:
+        meta = async_result.backend.get_task_meta(async_result.id)
+        if meta['status'] in READY_STATES:
+            yield event('result', _result(meta))
+            return
+        current = (meta['status'], ujson.dumps(meta.get('result')))
+        now = time.time()
+        if current != last:
+            last = current
+            last_sent = now
+            content = meta['result'] if meta['status'] == STATE else {}
+            yield event('progress', {'status': meta['status'], 'content': content})
+        elif now - last_sent >= heartbeat:
+            last_sent = now
+            yield ': keep-alive\n\n'
+        if now - started >= timeout:
+            yield event('timeout', {'status': meta['status']})
+            return
+        time.sleep(poll_interval)
@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+"""
+Routes tasks onto separate Celery queues for slow and fast work.
+
+Deploying (or destroying) ClarityNow takes minutes, while looking up a user's
+instances or the available images takes seconds. Each kind of work has its own
+queue, so a handful of long creates can't fill every worker slot and make a
+``show`` wait behind them. Run a worker per queue (``celery worker -Q <queue>``)
+to give each queue its own concurrency; the time limits are set per task here.
+
+Both the API (which sends the tasks) and the worker (which runs them) must call
+``configure`` on their Celery app, so this module must never import the vSphere
+libraries.
+"""
+import time
+import threading
+
+from kombu import Queue
+from celery.signals import before_task_publish, task_prerun
+
+from vlab_claritynow_api.lib import const, metrics
+
+
+SLOW_QUEUE = 'claritynow_slow'
+FAST_QUEUE = 'claritynow_fast'
+MAX_PRIORITY = 9
+
+# Fast work jumps ahead of slow work on a shared broker, and refilling the warm
+# pool never delays a create a user is waiting on.
+SLOW_PRIORITY = 5
+FAST_PRIORITY = MAX_PRIORITY
+BACKGROUND_PRIORITY = 1
+
+ROUTES = {
+    'claritynow.create': (SLOW_QUEUE, SLOW_PRIORITY),
+    'claritynow.create_batch': (SLOW_QUEUE, SLOW_PRIORITY),
+    'claritynow.delete': (SLOW_QUEUE, SLOW_PRIORITY),
+    'claritynow.delete_batch': (SLOW_QUEUE, SLOW_PRIORITY),
+    'claritynow.refill_warm_pool': (SLOW_QUEUE, BACKGROUND_PRIORITY),
+    'claritynow.reap_templates': (SLOW_QUEUE, BACKGROUND_PRIORITY),
+    'claritynow.show': (FAST_QUEUE, FAST_PRIORITY),
+    'claritynow.inventory': (FAST_QUEUE, FAST_PRIORITY),
+    'claritynow.image': (FAST_QUEUE, FAST_PRIORITY),
+    'claritynow.modify_network': (FAST_QUEUE, FAST_PRIORITY),
+}
+
+QUEUE_DEPTH = metrics.gauge('claritynow_queue_depth', 'Tasks waiting in each queue, as of the last sample')
+QUEUE_WAIT = metrics.histogram('claritynow_queue_wait_seconds', 'Time a task spent in its queue before a worker started it')
+
+
+def time_limit(queue):
+    """The most seconds a task from the queue may run before it's killed
+
+    :Returns: Integer
+
+    :param queue: The name of the queue
+    :type queue: String
+    """
+    if queue == FAST_QUEUE:
+        return const.VLAB_CLARITYNOW_FAST_TIME_LIMIT
+    return const.VLAB_CLARITYNOW_SLOW_TIME_LIMIT
+
+
+def configure(celery_app):
+    """Set up the queues, routes, priorities and time limits of a Celery app
+
+    Must be called before any tasks are registered with the app.
+
+    :Returns: None
+
+    :param celery_app: The app to configure
+    :type celery_app: celery.Celery
+    """
+    conf = celery_app.conf
+    conf.task_queues = [Queue(x, routing_key=x, queue_arguments={'x-max-priority': MAX_PRIORITY})
+                        for x in (SLOW_QUEUE, FAST_QUEUE)]
+    # Anything not routed is assumed to be slow
+    conf.task_default_queue = SLOW_QUEUE
+    conf.task_default_priority = SLOW_PRIORITY
+    conf.task_routes = {name: {'queue': queue, 'routing_key': queue, 'priority': priority}
+                        for name, (queue, priority) in ROUTES.items()}
+    conf.task_annotations = {name: {'time_limit': time_limit(queue)}
+                             for name, (queue, _) in ROUTES.items()}
+    # Reserving tasks ahead of time would hide them from the priority ordering,
+    # and park them behind a 20 minute create.
+    conf.worker_prefetch_multiplier = 1
+
+
+@before_task_publish.connect
+def _stamp_sent(headers=None, **kwargs):
+    """Record when a task was sent, so the worker can tell how long it waited"""
+    if headers is not None:
+        headers.setdefault('sent_at', time.time())
+
+
+@task_prerun.connect
+def _record_wait(task=None, **kwargs):
+    """Observe how long a task sat in its queue"""
+    sent_at = task.request.get('sent_at')
+    if sent_at is None:
+        return
+    delivery_info = task.request.delivery_info or {}
+    queue = delivery_info.get('routing_key') or SLOW_QUEUE
+    QUEUE_WAIT.observe(max(time.time() - sent_at, 0), queue=queue)
+
+
+def sample_depths(celery_app, logger):
+    """Ask the broker how many tasks are waiting in each queue
+
+    :Returns: Dictionary
+
+    :param celery_app: Used to connect to the broker
+    :type celery_app: celery.Celery
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    depths = {}
+    with celery_app.connection_for_read() as conn:
+        for queue in (SLOW_QUEUE, FAST_QUEUE):
+            # A failed passive declare closes the channel, so use one per queue
+            channel = conn.channel()
+            try:
+                _, depth, _ = channel.queue_declare(queue=queue, passive=True)
+            except Exception as doh:
+                logger.warning('Unable to sample depth of queue {}: {}'.format(queue, doh))
+                continue
+            finally:
+                try:
+                    channel.close()
+                except Exception:
+                    pass
+            QUEUE_DEPTH.set(depth, queue=queue)
+            depths[queue] = depth
+    return depths
+
+
+def watch_depths(celery_app, interval, logger):
+    """Keep sampling the depth of the queues in the background
+
+    :Returns: threading.Thread
+
+    :param celery_app: Used to connect to the broker
+    :type celery_app: celery.Celery
+
+    :param interval: How many seconds between samples
+    :type interval: Integer
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    def _watch():
+        while True:
+            try:
+                sample_depths(celery_app, logger)
+            except Exception as doh:
+                logger.warning('Unable to reach broker to sample queue depths: {}'.format(doh))
+            time.sleep(interval)
+    watcher = threading.Thread(target=_watch, name='queue-depths', daemon=True)
+    watcher.start()
+    return watcher
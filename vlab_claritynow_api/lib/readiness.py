@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 -*-
+"""
+Checks, in the background, that the API can reach everything it depends on.
+
+Load balancers ask every API process if it's ready every few seconds. Instead of
+talking to the broker and vCenter for each of those requests, one thread per
+process runs the checks every ``VLAB_CLARITYNOW_READY_SECONDS``, and the
+readiness end point only reports what the last run found.
+
+The API imports this module, so it must never import the vSphere libraries.
+"""
+import os
+import time
+import socket
+import threading
+
+from vlab_claritynow_api.lib import metrics
+
+
+DEPENDENCY_UP = metrics.gauge('claritynow_dependency_up', 'If the last check of a dependency of the API worked')
+
+
+class Readiness(object):
+    """Runs a set of checks on an interval, and remembers how they went
+
+    :param checks: Maps the name of each check to a callable; a check fails by raising
+    :type checks: Dictionary
+
+    :param interval: How many seconds between runs of the checks
+    :type interval: Integer/Float
+
+    :param informational: The names of checks that are reported, but don't stop the API from being ready
+    :type informational: Set
+    """
+    def __init__(self, checks, interval, informational=()):
+        self.checks = checks
+        self.interval = interval
+        self.informational = frozenset(informational)
+        self._results = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run_checks(self):
+        """Run every check once, and save the results
+
+        :Returns: None
+        """
+        results = {}
+        for name, check in self.checks.items():
+            started = time.time()
+            try:
+                check()
+            except Exception as doh:
+                result = {'ok': False, 'error': '{}'.format(doh)}
+            else:
+                result = {'ok': True}
+            result['required'] = name not in self.informational
+            result['seconds'] = round(time.time() - started, 3)
+            result['checked'] = int(started)
+            DEPENDENCY_UP.set(1 if result['ok'] else 0, check=name)
+            results[name] = result
+        with self._lock:
+            self._results = results
+
+    def start(self):
+        """Keep running the checks from a background thread
+
+        :Returns: threading.Thread
+        """
+        def _check():
+            while not self._stop.is_set():
+                self.run_checks()
+                self._stop.wait(self.interval)
+        checker = threading.Thread(target=_check, name='readiness-checks', daemon=True)
+        checker.start()
+        return checker
+
+    def stop(self):
+        """Stop running the checks
+
+        :Returns: None
+        """
+        self._stop.set()
+
+    def status(self):
+        """Report the results of the last run of the checks
+
+        Not ready until the checks have run once. If the checks haven't run in
+        a while (i.e. a check is hung), the old results can't be trusted, so
+        the API isn't ready either. Failed informational checks are reported,
+        but don't count.
+
+        :Returns: Tuple of (Boolean, Dictionary)
+        """
+        with self._lock:
+            results = dict(self._results)
+        if not results:
+            return False, {}
+        oldest = min(x['checked'] for x in results.values())
+        fresh = time.time() - oldest < self.interval * 3
+        return fresh and all(x['ok'] for x in results.values() if x['required']), results
+
+
+def check_broker(celery_app, timeout):
+    """Make a check that connects to the message broker
+
+    :Returns: Callable
+
+    :param celery_app: The Celery app the API sends tasks with
+    :type celery_app: celery.Celery
+
+    :param timeout: How many seconds to wait for the broker
+    :type timeout: Integer/Float
+    """
+    def check():
+        with celery_app.connection_for_write(connect_timeout=timeout) as conn:
+            conn.connect()
+    return check
+
+
+def check_images(images_dir):
+    """Make a check that the directory of ClarityNow images can be read
+
+    Creates fall back to a task that reads the image when the directory isn't
+    mounted, so the API registers this check as informational.
+
+    :Returns: Callable
+
+    :param images_dir: The directory that contains the ClarityNow OVA files
+    :type images_dir: String
+    """
+    def check():
+        os.listdir(images_dir)
+    return check
+
+
+def check_vcenter(host, port, timeout):
+    """Make a check that opens a TCP connection to vCenter
+
+    Logging in would cost vCenter a session every few seconds, from every API
+    process; only the workers log in.
+
+    :Returns: Callable
+
+    :param host: The IP/FQDN of vCenter
+    :type host: String
+
+    :param port: The HTTPS port of vCenter
+    :type port: Integer
+
+    :param timeout: How many seconds to wait for vCenter
+    :type timeout: Integer/Float
+    """
+    def check():
+        socket.create_connection((host, port), timeout=timeout).close()
+    return check
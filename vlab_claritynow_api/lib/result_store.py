@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+"""
+Where the results of tasks are kept, so that any API process can report them.
+
+With ``rpc://`` a result is sent back to the one process that sent the task, so
+no other uWSGI worker or API replica can answer ``/task/<id>`` for it. Set
+``VLAB_CLARITYNOW_RESULT_BACKEND`` to pick the store:
+
+- ``rpc://`` - the default; results go back through the broker to the sender
+- ``sqlite:///<path>`` - a SQLite file shared by every API and worker process
+  on the host (i.e. via a docker volume)
+- any other Celery result backend URL, like ``redis://``, for a store shared
+  between hosts
+
+Results expire after ``VLAB_CLARITYNOW_RESULT_TTL`` seconds.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from celery.backends.base import KeyValueStoreBackend
+
+
+SQLITE_BACKEND = 'vlab_claritynow_api.lib.result_store:SQLiteBackend'
+
+
+def backend_url(url):
+    """Translate ``VLAB_CLARITYNOW_RESULT_BACKEND`` into a URL Celery can load
+
+    :Returns: String
+
+    :param url: The URL of the result store
+    :type url: String
+    """
+    if url.startswith('sqlite://'):
+        # Celery loads "<module>:<class>+<url>" as a custom backend
+        return '{}+{}'.format(SQLITE_BACKEND, url)
+    return url
+
+
+class SQLiteBackend(KeyValueStoreBackend):
+    """A Celery result backend that stores results in a SQLite file.
+
+    Looking up a result is a primary key read, so it costs the same no matter
+    how many results are stored. Expired results are never returned, and are
+    deleted at most once every ``PRUNE_INTERVAL`` seconds.
+
+    :param url: Where the database file is, i.e. ``sqlite:///results/claritynow.db``
+    :type url: String
+    """
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, url=None, *args, **kwargs):
+        super(SQLiteBackend, self).__init__(*args, **kwargs)
+        if not url or not url.startswith('sqlite://'):
+            raise ValueError('SQLite result backend needs a sqlite:// URL, supplied {}'.format(url))
+        self.url = url
+        self.path = url[len('sqlite://'):]
+        self._local = threading.local()
+        self._last_prune = 0
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value BLOB, expires REAL)')
+
+    def __reduce__(self, args=(), kwargs=None):
+        kwargs = {} if not kwargs else kwargs
+        return super(SQLiteBackend, self).__reduce__(args, dict(kwargs, url=self.url))
+
+    def _conn(self):
+        """Obtain the connection for this thread; SQLite connections cannot be shared
+
+        :Returns: sqlite3.Connection
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            # New thread, or a forked worker; never reuse the parent's connection
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value, expires FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            return None
+        return value
+
+    def mget(self, keys):
+        return [self.get(x) for x in keys]
+
+    def set(self, key, value, ttl=None):
+        self._conn().execute('INSERT OR REPLACE INTO results (key, value, expires) VALUES (?, ?, ?)',
+                             (key, value, self._expires(ttl)))
+        if time.time() - self._last_prune > self.PRUNE_INTERVAL:
+            self.cleanup()
+
+    def add(self, key, value, ttl=None):
+        """Save a key only if it isn't saved already (or has expired)
+
+        The check and the save are one transaction, so when several processes
+        add the same key at once, only one of them does.
+
+        :Returns: Boolean - True if the key was saved
+
+        :param ttl: How many seconds to keep the key; defaults to when results expire
+        :type ttl: Integer
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT expires FROM results WHERE key = ?', (key,)).fetchone()
+            added = row is None or (row[0] is not None and row[0] < time.time())
+            if added:
+                conn.execute('INSERT OR REPLACE INTO results (key, value, expires) VALUES (?, ?, ?)',
+                             (key, value, self._expires(ttl)))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return added
+
+    def _expires(self, ttl):
+        """When a key saved now expires, or None if it never does"""
+        ttl = ttl or self.expires
+        return time.time() + ttl if ttl else None
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM results WHERE key = ?', (key,))
+
+    def cleanup(self):
+        """Delete expired results"""
+        self._last_prune = time.time()
+        self._conn().execute('DELETE FROM results WHERE expires < ?', (self._last_prune,))
@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+"""
+Coalesces identical requests, so a burst of them only sends one task.
+
+Dashboards and the CLI ask for the same user's ClarityNow instances many times
+within a few seconds. Instead of sending a new ``claritynow.show`` task (and
+walking the vCenter inventory) for each one, every request made while that
+task is still queued or running is handed its id. Once the task is done, the
+next request sends a new one, so nobody is handed a result from before they
+asked. The window is only an upper bound, so a task that was lost (i.e. its
+worker died) doesn't get handed out forever.
+
+Coalescing is per API process.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+from vlab_claritynow_api.lib import metrics
+
+
+class KeyedLocks(object):
+    """A lock per key, only kept while a thread holds or waits on it"""
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        """Hold the lock for a key for the duration of a ``with`` block
+
+        :Returns: None
+
+        :param key: Only threads holding the same key wait on each other
+        :type key: String
+        """
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._locks.pop(key)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._locks)
+
+
+class SingleFlight(object):
+    """Shares one task between identical requests, while the task is not done
+
+    :param name: Labels the hit/miss counters, i.e. ``show``
+    :type name: String
+
+    :param window: The most seconds to keep handing out the same task. Zero disables coalescing.
+    :type window: Integer/Float
+    """
+    def __init__(self, name, window):
+        self.name = name
+        self.window = window
+        self._inflight = {}
+        self._locks = KeyedLocks()
+        self._lock = threading.Lock()
+        self._hits = metrics.counter('claritynow_coalesced_total', 'Requests handed the task of an identical, recent request')
+        self._misses = metrics.counter('claritynow_coalesce_misses_total', 'Requests that had to send a new task')
+
+    def send(self, key, send_task):
+        """Obtain the id of an unfinished task for the key, or send a new one
+
+        :Returns: String - the task id
+
+        :param key: What makes two requests identical, i.e. the username
+        :type key: String
+
+        :param send_task: Sends the task when there isn't an unfinished one; must return the AsyncResult
+        :type send_task: Function
+        """
+        if self.window <= 0:
+            return send_task().id
+        # Only requests for the same key wait on each other
+        with self._locks.hold(key):
+            now = time.time()
+            entry = self._inflight.get(key)
+            if entry is not None and now - entry[1] < self.window and not entry[0].ready():
+                self._hits.inc(request=self.name)
+                return entry[0].id
+            task = send_task()
+            self._misses.inc(request=self.name)
+            with self._lock:
+                self._inflight[key] = (task, now)
+                self._prune(now)
+            return task.id
+
+    def forget(self, key):
+        """Stop handing out the task for a key, i.e. because the user changed something
+
+        :Returns: None
+
+        :param key: The key supplied to ``send``
+        :type key: String
+        """
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def _prune(self, now):
+        """Drop entries that are past the window; caller must hold ``_lock``"""
+        stale = [x for x, y in self._inflight.items() if now - y[1] >= self.window]
+        for key in stale:
+            self._inflight.pop(key)
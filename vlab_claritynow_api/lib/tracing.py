@@ -0,0 +1,61 @@
+# -*- coding: UTF-8 -*-
+"""
+Timing spans for the phases of a task.
+
+Every span is observed in the ``claritynow_span_seconds`` histogram, and
+logged through the supplied logger. The loggers made by ``get_task_logger``
+stamp every message with the ``txn_id`` of the request, so the spans of one
+API call can be found in the worker logs.
+"""
+import time
+from contextlib import contextmanager
+
+from vlab_claritynow_api.lib import metrics
+
+
+SPAN_SECONDS = metrics.histogram('claritynow_span_seconds', 'Time spent in each phase of a task')
+
+
+def record(name, seconds, outcome, logger=None):
+    """Observe a span that has already finished
+
+    :Returns: None
+
+    :param name: What was timed, i.e. ``create.set_meta``
+    :type name: String
+
+    :param seconds: How long it took
+    :type seconds: Float
+
+    :param outcome: ``ok``, or ``error`` if it raised an exception
+    :type outcome: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    SPAN_SECONDS.observe(seconds, span=name, outcome=outcome)
+    if logger is not None:
+        logger.info('span={} seconds={:.3f} outcome={}'.format(name, seconds, outcome))
+
+
+@contextmanager
+def span(name, logger=None):
+    """Time the body of a ``with`` block
+
+    :Returns: None
+
+    :param name: What is being timed, i.e. ``create.set_meta``
+    :type name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    started = time.time()
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        record(name, time.time() - started, outcome, logger)
@@ -1,3 +1,4 @@
 # -*- coding: UTF-8 -*-
 from .healthcheck import HealthView
 from .claritynow import ClarityNowView
+from .metrics import MetricsView
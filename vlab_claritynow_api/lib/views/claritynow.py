@@ -2,21 +2,52 @@
 """
 Defines the RESTful API for the ClarityNow service
 """
+import threading
+
 import ujson
 from flask import current_app
 from flask_classy import request, route, Response
 from vlab_inf_common.views import MachineView
-from vlab_inf_common.vmware import vCenter, vim
 from vlab_api_common import describe, get_logger, requires, validate_input
 
 
-from vlab_claritynow_api.lib import const
+from vlab_claritynow_api.lib import const, progress, etags, idempotency, admission
+from vlab_claritynow_api.lib.images import ImageCatalog
+from vlab_claritynow_api.lib.single_flight import SingleFlight
+from vlab_claritynow_api.lib.views.metrics import TimedView
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL)
+IMAGE_CATALOG = ImageCatalog(const.VLAB_CLARITYNOW_IMAGES_DIR)
+SHOW_REQUESTS = SingleFlight('show', const.VLAB_CLARITYNOW_SHOW_COALESCE_SECONDS)
+CREATE_REQUESTS = idempotency.IdempotentRequests('create', const.VLAB_CLARITYNOW_IDEMPOTENCY_TTL)
+BATCH_CREATE_REQUESTS = idempotency.IdempotentRequests('create_batch', const.VLAB_CLARITYNOW_IDEMPOTENCY_TTL)
+RATE_LIMITS = admission.RateLimits({'create': (const.VLAB_CLARITYNOW_CREATES_PER_MINUTE, const.VLAB_CLARITYNOW_CREATE_BURST),
+                                    'delete': (const.VLAB_CLARITYNOW_DELETES_PER_MINUTE, const.VLAB_CLARITYNOW_DELETE_BURST)})
+# A stream holds a uWSGI thread until the task is done; leave threads for everything else
+STREAMS = threading.BoundedSemaphore(const.VLAB_CLARITYNOW_MAX_STREAMS)
+
+
+def _admit(username, operation, cost=1):
+    """Raise admission.Rejected if the work should not be queued right now, or
+    admission.TooLarge if it never could be"""
+    # Check the queue first, so a request turned away anyway costs no tokens
+    backpressure = getattr(current_app, 'backpressure', None)
+    if backpressure is not None:
+        backpressure.admit(operation)
+    RATE_LIMITS.admit(username, operation, cost)
+
 
+def _rejected(resp_data, rejection):
+    """Answer a request that was not admitted with an HTTP 429"""
+    resp_data['error'] = '{}'.format(rejection)
+    resp = Response(ujson.dumps(resp_data))
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(rejection.retry_after)
+    return resp
 
-class ClarityNowView(MachineView):
+
+class ClarityNowView(TimedView, MachineView):
     """API end point to manage ClarityNow instances"""
     route_base = '/api/2/inf/claritynow'
     RESOURCE = 'claritynow'
@@ -56,7 +87,74 @@ class ClarityNowView(MachineView):
     IMAGES_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                      "description": "View available versions of ClarityNow that can be created"
                     }
+    BATCH_POST_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                         "type": "object",
+                         "description": "Create several ClarityNow instances of the same image, on the same network",
+                         "properties": {
+                            "names": {
+                                "description": "The names to give your ClarityNow instances",
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "minItems": 1,
+                                "maxItems": const.VLAB_CLARITYNOW_BATCH_MAX,
+                                "uniqueItems": True
+                            },
+                            "image": {
+                                "description": "The image/version of ClarityNow to create",
+                                "type": "string"
+                            },
+                            "network": {
+                                "description": "The network to hook the ClarityNow instances up to",
+                                "type": "string"
+                            }
+                         },
+                         "required": ["names", "image", "network"]
+                        }
+    BATCH_DELETE_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                           "type": "object",
+                           "description": "Destroy several ClarityNow instances; supply the names, or all=true for every one you own",
+                           "properties": {
+                              "names": {
+                                  "description": "The names of the ClarityNow instances to destroy",
+                                  "type": "array",
+                                  "items": {"type": "string"},
+                                  "minItems": 1,
+                                  "uniqueItems": True
+                              },
+                              "all": {
+                                  "description": "Destroy every ClarityNow instance you own",
+                                  "type": "boolean",
+                                  "enum": [True]
+                              }
+                           },
+                           "oneOf": [{"required": ["names"]}, {"required": ["all"]}]
+                          }
+    INVENTORY_ARGS = {"$schema": "http://json-schema.org/draft-04/schema#",
+                      "description": "Admin only - Display every ClarityNow instance, for all users",
+                      "type": "object",
+                      "properties": {
+                        "cursor": {
+                            "description": "Where to start the page; use the cursor returned by the previous page",
+                            "type": "string",
+                            "default": ""
+                        },
+                        "per_page": {
+                            "description": "The most ClarityNow instances to return",
+                            "type": "integer",
+                            "minimum": 1,
+                            "maximum": const.VLAB_CLARITYNOW_INVENTORY_MAX_PAGE,
+                            "default": const.VLAB_CLARITYNOW_INVENTORY_MAX_PAGE
+                        }
+                      }
+                     }
 
+    def after_request(self, name, response):
+        # BaseView reads the entire body to wrap it as JSON, which would block
+        # until a stream of events is finished; only skip that, not the timing
+        if response.is_streamed:
+            self.record_time(name, response)
+            return response
+        return super(ClarityNowView, self).after_request(name, response)
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA)
@@ -65,11 +163,11 @@ class ClarityNowView(MachineView):
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
-        task = current_app.celery_app.send_task('claritynow.show', [username, txn_id])
-        resp_data['content'] = {'task-id': task.id}
+        task_id = SHOW_REQUESTS.send(username, lambda: current_app.celery_app.send_task('claritynow.show', [username, txn_id]))
+        resp_data['content'] = {'task-id': task_id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
-        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
         return resp
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
@@ -83,11 +181,24 @@ class ClarityNowView(MachineView):
         machine_name = body['name']
         image = body['image']
         network = '{}_{}'.format(username, body['network'])
-        task = current_app.celery_app.send_task('claritynow.create', [username, machine_name, image, network, txn_id])
-        resp_data['content'] = {'task-id': task.id}
+        def send_task():
+            _admit(username, 'create')
+            return current_app.celery_app.send_task('claritynow.create', [username, machine_name, image, network, txn_id])
+        try:
+            task_id, replayed = CREATE_REQUESTS.send(username, request.headers.get('X-REQUEST-ID'), body, send_task,
+                                        store=idempotency.shared_store(current_app.celery_app))
+        except idempotency.IdempotencyConflict as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 409
+        except admission.Rejected as doh:
+            return _rejected(resp_data, doh)
+        SHOW_REQUESTS.forget(username)
+        resp_data['content'] = {'task-id': task_id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
-        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
+        if replayed:
+            resp.headers['Idempotent-Replayed'] = 'true'
         return resp
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
@@ -98,7 +209,92 @@ class ClarityNowView(MachineView):
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
         machine_name = kwargs['body']['name']
+        try:
+            _admit(username, 'delete')
+        except admission.Rejected as doh:
+            return _rejected(resp_data, doh)
         task = current_app.celery_app.send_task('claritynow.delete', [username, machine_name, txn_id])
+        SHOW_REQUESTS.forget(username)
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/batch', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BATCH_POST_SCHEMA)
+    def batch_create(self, *args, **kwargs):
+        """Create several ClarityNow instances with one request"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        body = kwargs['body']
+        machine_names = body['names']
+        image = body['image']
+        network = '{}_{}'.format(username, body['network'])
+        def send_task():
+            _admit(username, 'create', len(machine_names))
+            return current_app.celery_app.send_task('claritynow.create_batch', [username, machine_names, image, network, txn_id])
+        try:
+            task_id, replayed = BATCH_CREATE_REQUESTS.send(username, request.headers.get('X-REQUEST-ID'), body, send_task,
+                                        store=idempotency.shared_store(current_app.celery_app))
+        except idempotency.IdempotencyConflict as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 409
+        except admission.TooLarge as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        except admission.Rejected as doh:
+            return _rejected(resp_data, doh)
+        SHOW_REQUESTS.forget(username)
+        resp_data['content'] = {'task-id': task_id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
+        if replayed:
+            resp.headers['Idempotent-Replayed'] = 'true'
+        return resp
+
+    @route('/network', methods=["PUT"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=MachineView.NETWORK_SCHEMA)
+    @describe(put=MachineView.NETWORK_SCHEMA)
+    def modify_network(self, *args, **kwargs):
+        """Change the network a virtual machine is connected to"""
+        username = kwargs['token']['username']
+        machine_name = kwargs['body']['name']
+        new_network = '{}_{}'.format(username, kwargs['body']['new_network'])
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        task = current_app.celery_app.send_task('claritynow.modify_network', [username, machine_name, new_network, txn_id])
+        SHOW_REQUESTS.forget(username)
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/batch', methods=["DELETE"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BATCH_DELETE_SCHEMA)
+    def batch_delete(self, *args, **kwargs):
+        """Destroy several ClarityNow instances with one request"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        # None means "every ClarityNow I own"
+        machine_names = kwargs['body'].get('names')
+        try:
+            # How many that is isn't known yet, so deleting everything takes a full bucket
+            _admit(username, 'delete', len(machine_names) if machine_names else None)
+        except admission.TooLarge as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        except admission.Rejected as doh:
+            return _rejected(resp_data, doh)
+        task = current_app.celery_app.send_task('claritynow.delete_batch', [username, machine_names, txn_id])
+        SHOW_REQUESTS.forget(username)
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -113,9 +309,129 @@ class ClarityNowView(MachineView):
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
+        try:
+            IMAGE_CATALOG.refresh()
+        except FileNotFoundError:
+            # The images are not mounted on this API host; ask a worker
+            pass
+        else:
+            if IMAGE_CATALOG.etag in request.if_none_match:
+                resp = Response(status=304)
+            else:
+                resp_data['content'] = {'image': IMAGE_CATALOG.images,
+                                        'details': IMAGE_CATALOG.details}
+                resp = Response(ujson.dumps(resp_data))
+                resp.status_code = 200
+            resp.set_etag(IMAGE_CATALOG.etag)
+            return resp
         task = current_app.celery_app.send_task('claritynow.image', [txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
+
+    @route('/inventory', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @requires(username=const.VLAB_CLARITYNOW_ADMINS, version=None, verify=const.VLAB_VERIFY_TOKEN)
+    @describe(get_args=INVENTORY_ARGS)
+    def inventory(self, *args, **kwargs):
+        """Admin only - Page through every ClarityNow instance, for all users"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        cursor = request.args.get('cursor', '')
+        try:
+            per_page = int(request.args.get('per_page', const.VLAB_CLARITYNOW_INVENTORY_MAX_PAGE))
+        except ValueError:
+            resp_data['error'] = 'Param per_page must be an integer'
+            return ujson.dumps(resp_data), 400
+        if not (0 < per_page <= const.VLAB_CLARITYNOW_INVENTORY_MAX_PAGE):
+            error = 'Param per_page must be between 1 and {}'
+            resp_data['error'] = error.format(const.VLAB_CLARITYNOW_INVENTORY_MAX_PAGE)
+            return ujson.dumps(resp_data), 400
+        task = current_app.celery_app.send_task('claritynow.inventory', [cursor, per_page, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/task', methods=["GET"])
+    @route('/task/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=MachineView.TASK_ARGS)
+    def handle_task(self, *args, **kwargs):
+        """End point for checking the status of Celery tasks
+
+        Same as ``TaskView.handle_task``, but the result of a finished task has
+        an ETag. A poll with a matching ``If-None-Match`` gets a 304, and the
+        result is neither serialized nor sent again. The tags of the workers
+        are weak; see ``etags``.
+        """
+        resp = {'user': kwargs['token']['username'], 'content' : {}}
+        if request.args.get('task-id', None) and kwargs.get('tid', None):
+            resp['error'] = 'task-id supplied in URL and as param'
+            return ujson.dumps(resp), 400
+
+        task_id = request.args.get('task-id', kwargs.get('tid', None))
+        if task_id is None:
+            resp['error'] = "no task id provided"
+            return ujson.dumps(resp), 400
+
+        result = current_app.celery_app.AsyncResult(task_id)
+        resp['content']['status'] = result.status
+        if result.status == 'FAILURE':
+            return ujson.dumps(resp), 500
+        elif result.status != 'SUCCESS':
+            return ujson.dumps(resp), 202
+        answer = dict(result.result)
+        # The tag goes in the header, not the body
+        etag = answer.pop('etag', None)
+        if answer['error']:
+            resp.update(answer)
+            resp['error'] = answer['error']
+            return ujson.dumps(resp), 400
+        body = None
+        weak = etag is not None
+        if etag is None:
+            # Not tagged by the worker, so the result has to be serialized to hash it
+            body = ujson.dumps(answer)
+            etag = etags.body_etag(body)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body or ujson.dumps(answer))
+            response.status_code = 200
+        response.set_etag(etag, weak=weak)
+        return response
+
+    @route('/task/<tid>/stream', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def stream_task(self, *args, **kwargs):
+        """Push the progress of a task to the client as Server-Sent Events
+
+        Sends a ``progress`` event every time the task changes state, then a
+        ``result`` event (with the same body as ``/task/<id>``) once it's done,
+        and closes the stream.
+        """
+        resp_data = {'user' : kwargs['token']['username']}
+        if not STREAMS.acquire(blocking=False):
+            resp_data['error'] = 'Too many clients following tasks; poll the task instead'
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 503
+            resp.headers['Retry-After'] = '{}'.format(max(1, int(const.VLAB_CLARITYNOW_STREAM_POLL_SECONDS)))
+            resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, kwargs['tid']))
+            return resp
+        result = current_app.celery_app.AsyncResult(kwargs['tid'])
+        events = progress.follow(result,
+                                 poll_interval=const.VLAB_CLARITYNOW_STREAM_POLL_SECONDS,
+                                 heartbeat=const.VLAB_CLARITYNOW_STREAM_HEARTBEAT_SECONDS,
+                                 timeout=const.VLAB_CLARITYNOW_STREAM_MAX_SECONDS)
+        resp = Response(events, mimetype='text/event-stream')
+        # Runs once the client has the whole stream, or has gone away
+        resp.call_on_close(STREAMS.release)
+        resp.headers['Cache-Control'] = 'no-cache'
+        # Don't let nginx hold the events back in a buffer
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
@@ -2,17 +2,22 @@
 """
 Enables Health checks for the power API
 """
-from time import time
-import pkg_resources
-
 import ujson
-from flask_classy import FlaskView, Response
-from vlab_inf_common.vmware import vCenter
+from flask import current_app
+from flask_classy import FlaskView, Response, route
+
+from vlab_claritynow_api import __version__ as VERSION
+from vlab_claritynow_api.lib.views.metrics import TimedView
+
 
-from vlab_claritynow_api.lib import const
+def _json_response(body, status):
+    response = Response(ujson.dumps(body))
+    response.status_code = status
+    response.headers['Content-Type'] = 'application/json'
+    return response
 
 
-class HealthView(FlaskView):
+class HealthView(TimedView, FlaskView):
     """
     Simple end point to test if the service is alive
     """
@@ -20,11 +25,20 @@ class HealthView(FlaskView):
     trailing_slash = False
 
     def get(self):
-        """End point for health checks"""
-        resp = {}
-        status = 200
-        resp['version'] = pkg_resources.get_distribution('vlab-claritynow-api').version
-        response = Response(ujson.dumps(resp))
-        response.status_code = status
-        response.headers['Content-Type'] = 'application/json'
-        return response
+        """End point for health checks; only tests that the process can answer"""
+        return _json_response({'version': VERSION}, 200)
+
+    @route('/ready', methods=['GET'])
+    def ready(self):
+        """End point for readiness checks
+
+        Reports the last results of the background checks of the broker, the
+        images directory and vCenter; it never talks to any of them itself.
+        """
+        readiness = getattr(current_app, 'readiness', None)
+        if readiness is None:
+            is_ready, checks = False, {}
+        else:
+            is_ready, checks = readiness.status()
+        status = 200 if is_ready else 503
+        return _json_response({'version': VERSION, 'ready': is_ready, 'checks': checks}, status)
@@ -0,0 +1,66 @@
+# -*- coding: UTF-8 -*-
+"""
+Exposes the metrics of the API in the Prometheus text format, and times requests
+"""
+import os
+import time
+
+from flask import g, request
+from flask_classy import FlaskView, Response
+
+from vlab_claritynow_api.lib import const, metrics
+
+
+REQUEST_SECONDS = metrics.histogram('claritynow_http_request_seconds', 'Time to answer an API request')
+METRICS_DIR = os.path.join(const.VLAB_CLARITYNOW_METRICS_DIR, 'api') if const.VLAB_CLARITYNOW_METRICS_DIR else None
+
+
+class TimedView(object):
+    """Mix into a FlaskView to record how long every request to it takes
+
+    flask_classy uses one instance of a view for every request, so the start
+    time is kept on ``flask.g`` instead of the instance.
+    """
+    def before_request(self, name, *args, **kwargs):
+        g.request_started = time.time()
+        parent = getattr(super(TimedView, self), 'before_request', None)
+        if parent is not None:
+            return parent(name, *args, **kwargs)
+
+    def after_request(self, name, response):
+        parent = getattr(super(TimedView, self), 'after_request', None)
+        if parent is not None:
+            response = parent(name, response)
+        self.record_time(name, response)
+        return response
+
+    def record_time(self, name, response):
+        """Observe how long the request took; for a streamed response, until its headers
+
+        :Returns: None
+
+        :param name: The name of the view method that handled the request
+        :type name: String
+
+        :param response: What's being sent back to the client
+        :type response: flask.Response
+        """
+        started = g.pop('request_started', None)
+        if started is not None:
+            REQUEST_SECONDS.observe(time.time() - started,
+                                    view=type(self).__name__,
+                                    endpoint=name,
+                                    method=request.method,
+                                    status='{}'.format(response.status_code))
+
+
+class MetricsView(FlaskView):
+    """Every metric of the API, for Prometheus to scrape"""
+    route_base = '/api/1/inf/claritynow/metrics'
+    trailing_slash = False
+
+    def get(self):
+        """End point for scraping metrics"""
+        response = Response(metrics.render(METRICS_DIR))
+        response.headers['Content-Type'] = metrics.CONTENT_TYPE
+        return response
@@ -0,0 +1,517 @@
+# -*- coding: UTF-8 -*-
+"""
+Bulk lookups of virtual machine details via the vSphere PropertyCollector.
+
+Reading properties off of a pyVmomi object (i.e. ``the_vm.runtime.powerState``)
+is a SOAP round trip per attribute. The functions in this module instead ask
+the PropertyCollector for everything we need about every VM in one call.
+"""
+import ssl
+import time
+import bisect
+import textwrap
+import threading
+
+import ujson
+import OpenSSL
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_claritynow_api.lib import const
+
+
+VM_PROPERTIES = ['name', 'config.annotation', 'runtime.powerState', 'guest.net', 'network']
+ADMIN_VM_PROPERTIES = ['name', 'config.annotation', 'runtime.powerState', 'parent']
+UNKNOWN_META = {'component': 'Unknown',
+                'created': 0,
+                'version': "Unknown",
+                'generation': 0,
+                'configured': False
+               }
+# How long the listing of every VM is reused for the pages of one walk of the inventory
+LISTING_TTL = 300
+_listing = {}
+_listing_lock = threading.Lock()
+
+
+def retrieve(vcenter, filter_spec, page_size=None):
+    """Iterate over the results of a PropertyCollector query, one page at a time
+
+    Only one page of results is held in memory. If the caller stops iterating
+    early, the rest of the query is canceled on the vCenter server.
+
+    :Returns: Generator of vmodl.query.PropertyCollector.ObjectContent
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param filter_spec: Defines the objects and properties to collect
+    :type filter_spec: vmodl.query.PropertyCollector.FilterSpec
+
+    :param page_size: The most objects vCenter should return per round trip.
+                      Defaults to letting vCenter decide.
+    :type page_size: Integer
+    """
+    collector = vcenter.content.propertyCollector
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    result = collector.RetrievePropertiesEx([filter_spec], options)
+    try:
+        while result is not None:
+            for obj in result.objects:
+                yield obj
+            if result.token:
+                result = collector.ContinueRetrievePropertiesEx(result.token)
+            else:
+                result = None
+    finally:
+        if result is not None and result.token:
+            collector.CancelRetrievePropertiesEx(result.token)
+
+
+def to_dict(object_content):
+    """Convert the propSet of a PropertyCollector result into a dictionary
+
+    :Returns: Dictionary
+
+    :param object_content: A single object returned by the PropertyCollector
+    :type object_content: vmodl.query.PropertyCollector.ObjectContent
+    """
+    return {x.name: x.val for x in object_content.propSet}
+
+
+def parse_meta(annotation):
+    """Convert the notes of a VM into the vLab meta data
+
+    :Returns: Dictionary
+
+    :param annotation: The value of ``config.annotation``; None if the VM has no config
+    :type annotation: String
+    """
+    try:
+        return ujson.loads(annotation)
+    except (ValueError, TypeError):
+        # ValueError -> VM created, but notes not updated
+        # TypeError  -> VM failed to be created, or is being deployed
+        return dict(UNKNOWN_META)
+
+
+def get_properties(vcenter, the_object, properties):
+    """Read several properties of a single object in one round trip
+
+    :Returns: Dictionary
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_object: The managed object to read properties from
+    :type the_object: pyVmomi.VmomiSupport.ManagedObject
+
+    :param properties: The property paths to read, i.e. ``config.annotation``
+    :type properties: List
+    """
+    PC = vmodl.query.PropertyCollector
+    obj_spec = PC.ObjectSpec(obj=the_object, skip=False)
+    prop_spec = PC.PropertySpec(type=type(the_object), pathSet=properties)
+    filter_spec = PC.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+    answer = {}
+    for obj in retrieve(vcenter, filter_spec):
+        answer.update(to_dict(obj))
+    return answer
+
+
+def wait_for_tasks(vcenter, the_tasks, timeout=600):
+    """Block until every task is done, with one PropertyCollector wait for all of them
+
+    Unlike calling ``consume_task`` on each task, which polls every task once a
+    second, vCenter pushes the state changes for all the tasks to us.
+
+    :Returns: Dictionary - maps the task moId to None if it worked, or the error message
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_tasks: The tasks to wait on
+    :type the_tasks: List of vim.Task
+
+    :param timeout: How many seconds to wait for every task to complete
+    :type timeout: Integer
+    """
+    if not the_tasks:
+        return {}
+    PC = vmodl.query.PropertyCollector
+    # A collector of our own, so we never see (or eat) updates meant for someone else
+    collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+    try:
+        obj_specs = [PC.ObjectSpec(obj=x, skip=False) for x in the_tasks]
+        prop_spec = PC.PropertySpec(type=vim.Task, pathSet=['info.state', 'info.error'])
+        collector.CreateFilter(PC.FilterSpec(objectSet=obj_specs, propSet=[prop_spec]), partialUpdates=True)
+        pending = {x._moId for x in the_tasks}
+        states = {}
+        errors = {}
+        results = {}
+        version = ''
+        deadline = time.time() + timeout
+        while pending:
+            remaining = int(deadline - time.time())
+            if remaining <= 0:
+                for moid in pending:
+                    results[moid] = 'Timeout of {} seconds exceeded'.format(timeout)
+                break
+            update = collector.WaitForUpdatesEx(version, PC.WaitOptions(maxWaitSeconds=min(remaining, 60)))
+            if update is None:
+                continue
+            version = update.version
+            for filter_set in update.filterSet:
+                for obj_update in filter_set.objectSet:
+                    moid = obj_update.obj._moId
+                    for change in obj_update.changeSet:
+                        if change.name == 'info.state':
+                            states[moid] = change.val
+                        elif change.name == 'info.error':
+                            errors[moid] = change.val
+            for moid in list(pending):
+                if states.get(moid) == vim.TaskInfo.State.success:
+                    results[moid] = None
+                    pending.remove(moid)
+                elif states.get(moid) == vim.TaskInfo.State.error:
+                    error = errors.get(moid)
+                    results[moid] = getattr(error, 'msg', None) or '{}'.format(error)
+                    pending.remove(moid)
+        return results
+    finally:
+        collector.DestroyPropertyCollector()
+
+
+def find_vm(vcenter, folder, machine_name, component):
+    """Lookup a VM by name, without scanning every VM in the folder
+
+    :Returns: vim.VirtualMachine, or None if no such VM exists
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The folder that contains the VM
+    :type folder: vim.Folder
+
+    :param machine_name: The name of the VM
+    :type machine_name: String
+
+    :param component: The VM is only returned if its meta data is for this component
+    :type component: String
+    """
+    the_vm = vcenter.content.searchIndex.FindChild(entity=folder, name=machine_name)
+    if not isinstance(the_vm, vim.VirtualMachine):
+        return None
+    props = get_properties(vcenter, the_vm, ['config.annotation'])
+    meta = parse_meta(props.get('config.annotation'))
+    if meta.get('component') != component:
+        return None
+    return the_vm
+
+
+def child_vms(vcenter, folder, properties):
+    """Read the same properties of every VM directly within a folder, in one call
+
+    :Returns: List of (vim.VirtualMachine, Dictionary) tuples
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The folder that contains the VMs
+    :type folder: vim.Folder
+
+    :param properties: The property paths to read, i.e. ``config.annotation``
+    :type properties: List
+    """
+    PC = vmodl.query.PropertyCollector
+    to_children = PC.TraversalSpec(name='folderToChild', type=vim.Folder,
+                                   path='childEntity', skip=False)
+    obj_spec = PC.ObjectSpec(obj=folder, skip=True, selectSet=[to_children])
+    prop_spec = PC.PropertySpec(type=vim.VirtualMachine, pathSet=properties)
+    filter_spec = PC.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+    return [(x.obj, to_dict(x)) for x in retrieve(vcenter, filter_spec)]
+
+
+def _folder_filter(folder):
+    """Make a filter for every VM within a folder, and the networks they use
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param folder: The folder that contains the VMs
+    :type folder: vim.Folder
+    """
+    PC = vmodl.query.PropertyCollector
+    to_networks = PC.TraversalSpec(name='vmToNetwork', type=vim.VirtualMachine,
+                                   path='network', skip=False)
+    to_children = PC.TraversalSpec(name='folderToChild', type=vim.Folder,
+                                   path='childEntity', skip=False,
+                                   selectSet=[to_networks])
+    obj_spec = PC.ObjectSpec(obj=folder, skip=True, selectSet=[to_children])
+    prop_specs = [PC.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES),
+                  PC.PropertySpec(type=vim.Network, pathSet=['name'])]
+    return PC.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+
+
+def _view_filter(view, vimtype, properties):
+    """Make a filter for every object of a given type within a container view
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param view: The container view to traverse
+    :type view: vim.view.ContainerView
+
+    :param vimtype: The type of object to collect properties from
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+    :param properties: The property paths to collect
+    :type properties: List
+    """
+    PC = vmodl.query.PropertyCollector
+    traverse = PC.TraversalSpec(name='traverseView', type=vim.view.ContainerView,
+                                path='view', skip=False)
+    obj_spec = PC.ObjectSpec(obj=view, skip=True, selectSet=[traverse])
+    prop_spec = PC.PropertySpec(type=vimtype, pathSet=properties)
+    return PC.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+
+
+def _get_ips(guest_nics):
+    """Mirrors ``virtual_machine.get_info``; drops link-local IPv6 addresses
+
+    :Returns: List
+
+    :param guest_nics: The value of ``guest.net`` for a VM
+    :type guest_nics: List of vim.vm.GuestInfo.NicInfo
+    """
+    ips = []
+    for nic in guest_nics or []:
+        ips += nic.ipAddress
+    return [x for x in ips if not x.startswith('fe80::')]
+
+
+def _get_networks(vm_networks, network_names, username):
+    """Mirrors ``virtual_machine.get_networks``; only reports the user's networks
+
+    :Returns: List
+
+    :param vm_networks: The value of ``network`` for a VM
+    :type vm_networks: List of vim.Network
+
+    :param network_names: A mapping of network moId to network name
+    :type network_names: Dictionary
+
+    :param username: The name of the user who owns the VM
+    :type username: String
+    """
+    networks = []
+    for network in vm_networks or []:
+        name = network_names.get(network._moId, '')
+        if name.startswith(username):
+            networks.append(name.replace('{}_'.format(username), ''))
+    return networks
+
+
+class ConsoleUrlMaker(object):
+    """Builds the HTML5 console URL for VMs
+
+    The thumbprint of the vCenter cert and the server GUID are the same for
+    every VM, so they're looked up once instead of once per VM.
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    def __init__(self, vcenter):
+        content = vcenter.content
+        vcenter_cert = ssl.get_server_certificate((const.INF_VCENTER_SERVER, const.INF_VCENTER_PORT))
+        self._thumbprint = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, vcenter_cert).digest('sha1').decode()
+        self._server_guid = content.about.instanceUuid
+        self._session_manager = content.sessionManager
+
+    def __call__(self, vm_moid, vm_name):
+        """Obtain the console URL for a single VM
+
+        :Returns: String
+
+        :param vm_moid: The managed object id of the VM
+        :type vm_moid: String
+
+        :param vm_name: The name of the VM
+        :type vm_name: String
+        """
+        # Clone tickets are single use, so every VM needs its own
+        ticket = self._session_manager.AcquireCloneTicket()
+        url = """\
+        https://{0}/ui/webconsole.html?vmId={1}&vmName={2}&serverGuid={3}&
+        locale=en_US&host={0}&sessionTicket={4}&thumbprint={5}
+        """.format(const.INF_VCENTER_SERVER,
+                   vm_moid,
+                   vm_name,
+                   self._server_guid,
+                   ticket,
+                   self._thumbprint)
+        return textwrap.dedent(url).replace('\n', '')
+
+
+def folder_vms(vcenter, folder, username, component):
+    """Obtain details about every VM of a given component type within a folder.
+
+    The output for each VM is the same as ``virtual_machine.get_info``, but every
+    VM is fetched with a single ``RetrievePropertiesEx`` call.
+
+    :Returns: Dictionary
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The folder that contains the VMs
+    :type folder: vim.Folder
+
+    :param username: The name of the user who owns the VMs
+    :type username: String
+
+    :param component: Only return VMs whose meta data is for this component
+    :type component: String
+    """
+    vms = []
+    network_names = {}
+    for obj in retrieve(vcenter, _folder_filter(folder)):
+        props = to_dict(obj)
+        if isinstance(obj.obj, vim.VirtualMachine):
+            vms.append((obj.obj, props))
+        else:
+            network_names[obj.obj._moId] = props.get('name', '')
+
+    found = {}
+    console_url = None
+    for the_vm, props in vms:
+        meta = parse_meta(props.get('config.annotation'))
+        if meta.get('component') != component:
+            continue
+        if console_url is None:
+            console_url = ConsoleUrlMaker(vcenter)
+        details = {}
+        details['state'] = props.get('runtime.powerState')
+        details['console'] = console_url(the_vm._moId, props['name'])
+        details['ips'] = _get_ips(props.get('guest.net'))
+        details['networks'] = _get_networks(props.get('network'), network_names, username)
+        details['moid'] = the_vm._moId
+        details['meta'] = meta
+        found[props['name']] = details
+    return found
+
+
+def iter_all_vms(vcenter, component, after=None, page_size=None):
+    """Iterate over every VM of a given component type, for every user.
+
+    VMs are yielded in order of their moid, so a caller can page through them
+    by resuming after the last moid it saw; VMs made or destroyed between pages
+    don't shift the rest. The moid of every VM, and the names of the folders
+    (i.e. the owners of the VMs), are listed when a walk starts (no ``after``),
+    and that listing is reused for the pages after it, for up to
+    ``LISTING_TTL`` seconds. A page only costs a lookup of the cursor and one
+    read of ``page_size`` VMs, so VMs before the cursor or past where the
+    caller stops are never read. VMs made during a walk show up in the next one.
+
+    :Returns: Generator of Dictionaries
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param component: Only return VMs whose meta data is for this component
+    :type component: String
+
+    :param after: Only yield VMs whose moid sorts after this one
+    :type after: String
+
+    :param page_size: How many VMs to read the properties of per round trip.
+    :type page_size: Integer
+    """
+    moids, owners = _vm_listing(vcenter, fresh=not after)
+    start = bisect.bisect_right(moids, after) if after else 0
+    page_size = page_size or len(moids) or 1
+    for index in range(start, len(moids), page_size):
+        chunk = [vim.VirtualMachine(x) for x in moids[index:index + page_size]]
+        found = _vm_properties(vcenter, chunk, ADMIN_VM_PROPERTIES)
+        for the_vm in chunk:
+            props = found.get(the_vm._moId)
+            if props is None:
+                # Destroyed after the VMs were listed
+                continue
+            meta = parse_meta(props.get('config.annotation'))
+            if meta.get('component') != component:
+                continue
+            parent = props.get('parent')
+            yield {'name': props.get('name'),
+                   'owner': owners.get(parent._moId) if parent else None,
+                   'state': props.get('runtime.powerState'),
+                   'moid': the_vm._moId,
+                   'meta': meta,
+                  }
+
+
+def _vm_listing(vcenter, fresh):
+    """Obtain the sorted moid of every VM, and the names of the folders
+
+    A single container view rooted at ``INF_VCENTER_TOP_LVL_DIR`` finds them.
+    The listing is kept by the worker process, and only made again when
+    ``fresh`` is set, or it's older than ``LISTING_TTL``.
+
+    :Returns: Tuple of (List, Dictionary)
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param fresh: Set to list the VMs again, instead of reusing the last listing
+    :type fresh: Boolean
+    """
+    with _listing_lock:
+        if not fresh and time.time() - _listing.get('listed', 0) < LISTING_TTL:
+            return _listing['moids'], _listing['owners']
+    listed = time.time()
+    root = vcenter.get_vm_folder(const.INF_VCENTER_TOP_LVL_DIR)
+    view = vcenter.content.viewManager.CreateContainerView(container=root,
+                                                           type=[vim.Folder, vim.VirtualMachine],
+                                                           recursive=True)
+    try:
+        owners = {}
+        for obj in retrieve(vcenter, _view_filter(view, vim.Folder, ['name'])):
+            owners[obj.obj._moId] = to_dict(obj).get('name')
+        moids = sorted(obj.obj._moId for obj in retrieve(vcenter, _view_filter(view, vim.VirtualMachine, [])))
+    finally:
+        view.DestroyView()
+    with _listing_lock:
+        _listing.update(listed=listed, moids=moids, owners=owners)
+    return moids, owners
+
+
+def _vm_properties(vcenter, vms, properties):
+    """Read the same properties of several VMs in one round trip
+
+    A VM that no longer exists fails the whole read, so it's dropped and the
+    rest are read again.
+
+    :Returns: Dictionary - maps the moid of each VM to its properties
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param vms: The VMs to read
+    :type vms: List of vim.VirtualMachine
+
+    :param properties: The property paths to read
+    :type properties: List
+    """
+    PC = vmodl.query.PropertyCollector
+    vms = list(vms)
+    while vms:
+        obj_specs = [PC.ObjectSpec(obj=x, skip=False) for x in vms]
+        prop_spec = PC.PropertySpec(type=vim.VirtualMachine, pathSet=properties)
+        filter_spec = PC.FilterSpec(objectSet=obj_specs, propSet=[prop_spec])
+        try:
+            return {obj.obj._moId: to_dict(obj) for obj in retrieve(vcenter, filter_spec)}
+        except vmodl.fault.ManagedObjectNotFound as doh:
+            missing = getattr(doh.obj, '_moId', None)
+            remaining = [x for x in vms if x._moId != missing]
+            if len(remaining) == len(vms):
+                raise
+            vms = remaining
+    return {}
@@ -0,0 +1,242 @@
+# -*- coding: UTF-8 -*-
+"""
+Remembers the managed object ids (morefs) of folders and networks, by name.
+
+``vCenter.get_by_name`` makes a container view of every folder under
+``INF_VCENTER_TOP_LVL_DIR``, then reads the name of each one; that's a SOAP
+round trip per folder, on every show, delete and create. ``vCenter.networks``
+does the same for every network, once per session.
+
+Instead, the names of every folder (or every network) are read with one
+PropertyCollector call, and the morefs are kept for ``VLAB_CLARITYNOW_MOREF_TTL``
+seconds for every session of the worker process. A cached moref is checked with
+a single read of its name before it's used; if the object was deleted or
+renamed, the entry is dropped and the names are loaded again.
+"""
+import time
+import threading
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_claritynow_api.lib import const, metrics
+from vlab_claritynow_api.lib.worker import inventory
+
+
+FOLDER = 'folder'
+NETWORK = 'network'
+LOOKUPS = metrics.counter('claritynow_moref_cache_lookups_total', 'Lookups of folders and networks by name, by hit, miss or stale')
+
+
+class MorefCache(object):
+    """A thread safe mapping of (kind, name) to a moref, where every entry expires
+
+    :param ttl: How many seconds to trust an entry. Zero disables the cache.
+    :type ttl: Integer/Float
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # (kind, name) -> (vimtype, moid, expires)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load_locks = {FOLDER: threading.Lock(), NETWORK: threading.Lock()}
+
+    def get(self, kind, name):
+        """Obtain the type and moid of an object, if it's cached and not expired
+
+        :Returns: Tuple of (vimtype, moid), or None
+
+        :param kind: What sort of object, i.e. ``folder``
+        :type kind: String
+
+        :param name: The name of the object
+        :type name: String
+        """
+        with self._lock:
+            entry = self._entries.get((kind, name))
+            if entry is None:
+                return None
+            if entry[2] < time.time():
+                self._entries.pop((kind, name))
+                return None
+            return entry[0], entry[1]
+
+    def replace(self, kind, found):
+        """Swap every entry of one kind for freshly loaded ones
+
+        :Returns: None
+
+        :param kind: What sort of object, i.e. ``folder``
+        :type kind: String
+
+        :param found: Maps the name of every object to a tuple of (vimtype, moid)
+        :type found: Dictionary
+        """
+        if not self.ttl:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key in [x for x in self._entries if x[0] == kind]:
+                self._entries.pop(key)
+            for name, (vimtype, moid) in found.items():
+                self._entries[(kind, name)] = (vimtype, moid, expires)
+
+    def forget(self, kind, name):
+        """Drop one entry, i.e. because the object is gone
+
+        :Returns: None
+        """
+        with self._lock:
+            self._entries.pop((kind, name), None)
+
+    def clear(self):
+        """Forget every moref
+
+        :Returns: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def load_lock(self, kind):
+        """Held while loading one kind, so a burst of misses only loads it once
+
+        :Returns: threading.Lock
+        """
+        return self._load_locks[kind]
+
+
+_CACHE = MorefCache(const.VLAB_CLARITYNOW_MOREF_TTL)
+
+
+def _container(vcenter, kind):
+    """The folder to look for objects of a kind in, and their type"""
+    if kind == FOLDER:
+        return vcenter.get_vm_folder(path=const.INF_VCENTER_TOP_LVL_DIR), vim.Folder
+    return vcenter.content.rootFolder, vim.Network
+
+
+def _load(vcenter, kind):
+    """Read the name of every object of a kind with one PropertyCollector call
+
+    :Returns: Dictionary - maps the name to a tuple of (vimtype, moid)
+    """
+    container, vimtype = _container(vcenter, kind)
+    view = vcenter.content.viewManager.CreateContainerView(container=container,
+                                                           type=[vimtype],
+                                                           recursive=True)
+    found = {}
+    try:
+        for obj in inventory.retrieve(vcenter, inventory._view_filter(view, vimtype, ['name'])):
+            # Like vCenter.networks, a duplicate name maps to the last one found;
+            # a network may be a DistributedVirtualPortgroup, so keep its real type
+            found[inventory.to_dict(obj).get('name')] = (type(obj.obj), obj.obj._moId)
+    finally:
+        view.DestroyView()
+    return found
+
+
+def _is_named(vcenter, the_object, name):
+    """Check that a cached moref still exists, and still has the same name"""
+    try:
+        props = inventory.get_properties(vcenter, the_object, ['name'])
+    except vmodl.fault.ManagedObjectNotFound:
+        return False
+    return props.get('name') == name
+
+
+def _lookup(vcenter, kind, name):
+    """Find an object by name, from the cache if possible
+
+    :Returns: pyVmomi.VmomiSupport.ManagedObject, or None if no such object exists
+    """
+    cached = _CACHE.get(kind, name)
+    if cached is not None:
+        vimtype, moid = cached
+        the_object = vimtype(moid, vcenter._conn._stub)
+        if _is_named(vcenter, the_object, name):
+            LOOKUPS.inc(kind=kind, result='hit')
+            return the_object
+        LOOKUPS.inc(kind=kind, result='stale')
+        _CACHE.forget(kind, name)
+    else:
+        LOOKUPS.inc(kind=kind, result='miss')
+    with _CACHE.load_lock(kind):
+        # Another thread may have loaded everything while this one waited
+        cached = _CACHE.get(kind, name)
+        if cached is not None:
+            return cached[0](cached[1], vcenter._conn._stub)
+        found = _load(vcenter, kind)
+        _CACHE.replace(kind, found)
+    if name not in found:
+        return None
+    vimtype, moid = found[name]
+    return vimtype(moid, vcenter._conn._stub)
+
+
+def get_folder(vcenter, name):
+    """Lookup a folder under ``INF_VCENTER_TOP_LVL_DIR`` by name
+
+    :Returns: vim.Folder
+
+    :Raises: ValueError if no such folder exists
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the folder, i.e. the username
+    :type name: String
+    """
+    folder = _lookup(vcenter, FOLDER, name)
+    if folder is None:
+        raise ValueError('Unable to locate object named {}'.format(name))
+    return folder
+
+
+def get_or_create_folder(vcenter, name):
+    """Obtain a folder directly under ``INF_VCENTER_TOP_LVL_DIR``, creating it if needed
+
+    :Returns: vim.Folder
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the folder
+    :type name: String
+    """
+    try:
+        return get_folder(vcenter, name)
+    except ValueError:
+        vcenter.create_vm_folder('{}/{}'.format(const.INF_VCENTER_TOP_LVL_DIR, name))
+        return get_folder(vcenter, name)
+
+
+def get_network(vcenter, name):
+    """Lookup a network by name
+
+    :Returns: vim.Network
+
+    :Raises: ValueError if no such network exists
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the network
+    :type name: String
+    """
+    network = _lookup(vcenter, NETWORK, name)
+    if network is None:
+        raise ValueError('No such network named {}'.format(name))
+    return network
+
+
+def warm(vcenter):
+    """Load every folder and network into the cache, i.e. when a worker starts
+
+    :Returns: None
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    for kind in (FOLDER, NETWORK):
+        with _CACHE.load_lock(kind):
+            _CACHE.replace(kind, _load(vcenter, kind))
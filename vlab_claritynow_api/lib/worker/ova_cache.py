@@ -0,0 +1,208 @@
+# -*- coding: UTF-8 -*-
+"""
+Parses each OVA file once, instead of for every deploy.
+
+Opening an ``Ova`` walks every header of the tar file, and reads and parses the
+OVF descriptor. The few ClarityNow images are deployed over and over, so what's
+learned from an OVA (the descriptor, its networks, and where each disk is in
+the file) is kept in an LRU cache. A deploy only has to open the file and
+send the disks from their known offsets.
+
+Entries are keyed on the path, modification time and size of the OVA, so a
+replaced image is parsed again on its next deploy.
+"""
+import os
+import re
+import tarfile
+import threading
+from collections import OrderedDict, namedtuple
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import Ova
+from vlab_inf_common.ssl_context import get_context
+
+from vlab_claritynow_api.lib import const, metrics
+from vlab_claritynow_api.lib.worker import upload
+
+
+LOOKUPS = metrics.counter('claritynow_ova_cache_lookups_total', 'Lookups of parsed OVA files, by hit or miss')
+
+# ``disks`` maps the name of each VMDK to a tuple of (offset, size) within the OVA
+OvaInfo = namedtuple('OvaInfo', 'ovf networks disks')
+
+
+def _parse(ova_path):
+    """Read the descriptor and the location of every disk from an OVA file
+
+    :Returns: OvaInfo, or None if the OVA is compressed
+
+    :Raises: FileNotFoundError if the OVA does not exist
+    """
+    ovf = None
+    disks = {}
+    try:
+        # 'r:' refuses compressed files; their offsets are useless for seeking
+        with tarfile.open(ova_path, mode='r:') as the_tar:
+            for member in the_tar.getmembers():
+                if member.name.endswith('.vmdk'):
+                    disks[member.name] = (member.offset_data, member.size)
+                elif member.name.endswith('.ovf'):
+                    ovf = the_tar.extractfile(member).read().decode()
+    except tarfile.ReadError:
+        return None
+    # Same as Ova.networks, only done once
+    found = re.findall(r'Network ovf:name=[\w\ \"]{1,50}', ovf or '')
+    networks = [x.split('=')[1].replace('"', '') for x in found]
+    return OvaInfo(ovf=ovf, networks=networks, disks=disks)
+
+
+class OvaCache(object):
+    """A thread safe, LRU cache of parsed OVA files
+
+    :param max_entries: The most OVA files to remember
+    :type max_entries: Integer
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ova_path):
+        """Obtain the parsed OVA, reading the file only if it's new or has changed
+
+        :Returns: OvaInfo, or None if the OVA cannot be cached
+
+        :Raises: FileNotFoundError if the OVA does not exist
+
+        :param ova_path: The absolute path to the OVA file
+        :type ova_path: String
+        """
+        info = os.stat(ova_path)
+        key = (ova_path, info.st_mtime, info.st_size)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                LOOKUPS.inc(result='hit')
+                return self._entries[key]
+        LOOKUPS.inc(result='miss')
+        # Parsing reads the whole tar index; don't block lookups of other OVAs
+        parsed = _parse(ova_path)
+        with self._lock:
+            # Drop what we knew about an older copy of the file
+            for stale in [x for x in self._entries if x[0] == ova_path]:
+                self._entries.pop(stale)
+            self._entries[key] = parsed
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return parsed
+
+    def clear(self):
+        """Forget every parsed OVA
+
+        :Returns: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedOva(Ova):
+    """An ``Ova`` built from an already parsed OVA file
+
+    Deploying uploads every disk at once, straight from the file; see
+    ``vlab_claritynow_api.lib.worker.upload``.
+
+    :param ova_path: The absolute path to the OVA file
+    :type ova_path: String
+
+    :param parsed: What was learned from the file
+    :type parsed: OvaInfo
+    """
+    def __init__(self, ova_path, parsed):
+        # Ova.__init__ would read the tar index and descriptor all over again
+        self._path = ova_path
+        self._spec = None
+        self._lease = None
+        self._host = None
+        self._prog = None
+        self._tar = None
+        self._handle = None
+        self._ovf = parsed.ovf
+        self._networks = parsed.networks
+        # The (offset, size) of every disk, by name
+        self._disks = dict(parsed.disks)
+
+    @property
+    def networks(self):
+        """Return a list of network names that a VM has configured"""
+        return list(self._networks)
+
+    def close(self):
+        """Nothing to close; every upload opens the file for itself"""
+        pass
+
+    def _set_progress(self, percent):
+        self._prog = percent
+
+    def deploy(self, deploy_spec, lease, host):
+        """Create a new VM based off the OVA, uploading all of its disks at the same time
+
+        :param deploy_spec: **Required** The OVA deployment spec
+        :type deploy_spec: vim.OvfManager.CreateImportSpecResult
+
+        :param lease: **Required** The vSphere lease that enables VM/vApp creation
+        :type lease: vim.HttpNfcLease
+
+        :param host: **Required** The FQDN for vSphere
+        :type host: String
+        """
+        self._spec = deploy_spec
+        self._lease = lease
+        self._host = host
+        self._prog = 0
+        done = None
+        try:
+            disks = []
+            for file_item in deploy_spec.fileItem:
+                if file_item.path not in self._disks:
+                    continue
+                offset, size = self._disks[file_item.path]
+                disks.append((offset, size, self._get_device_url(file_item)))
+            progress = upload.Progress(sum(x[1] for x in disks))
+            done = upload.keep_alive(lease, progress, const.VLAB_CLARITYNOW_LEASE_PROGRESS_SECONDS,
+                                     on_progress=self._set_progress)
+            upload.upload_disks(self._path, disks, progress, const.VLAB_CLARITYNOW_UPLOAD_PARALLEL,
+                                context=get_context())
+            lease.Progress(100)
+            lease.Complete()
+        except vmodl.MethodFault as doh:
+            lease.Abort(doh)
+            raise
+        except Exception as doh:
+            lease.Abort(vmodl.fault.SystemError(reason=str(doh)))
+            raise
+        finally:
+            if done is not None:
+                done.set()
+            self._spec = None
+            self._lease = None
+            self._host = None
+            self._prog = None
+
+
+_CACHE = OvaCache(const.VLAB_CLARITYNOW_OVA_CACHE_SIZE)
+
+
+def open_ova(ova_path):
+    """Open an OVA file for deploying, parsing it only if it hasn't been seen before
+
+    :Returns: vlab_inf_common.vmware.Ova
+
+    :Raises: FileNotFoundError if the OVA does not exist
+
+    :param ova_path: The absolute path to the OVA file
+    :type ova_path: String
+    """
+    parsed = _CACHE.get(ova_path)
+    if parsed is None:
+        return Ova(ova_path)
+    return CachedOva(ova_path, parsed)
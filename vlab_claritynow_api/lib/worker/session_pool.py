@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+"""
+Keeps authenticated sessions to vCenter alive between tasks.
+
+Logging into vCenter is a full SOAP round trip (plus the logout), and for quick
+tasks like ``claritynow.show`` it costs more than the actual work. Each worker
+process owns one ``SessionPool``; tasks borrow a session, and give it back when
+they're done.
+"""
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from vlab_inf_common.vmware import vCenter
+
+from vlab_claritynow_api.lib import const, metrics
+
+
+POOL_SIZE = metrics.gauge('claritynow_vcenter_pool_size', 'Open vCenter sessions in the pool')
+POOL_IN_USE = metrics.gauge('claritynow_vcenter_pool_in_use', 'vCenter sessions currently borrowed')
+POOL_IDLE_TIMEOUT = metrics.gauge('claritynow_vcenter_pool_idle_timeout_seconds', 'Seconds before an idle vCenter session is replaced')
+POOL_LOGINS = metrics.counter('claritynow_vcenter_pool_logins_total', 'New sessions established with vCenter')
+POOL_RECONNECTS = metrics.counter('claritynow_vcenter_pool_reconnects_total', 'Sessions replaced because they were dead or idle for too long')
+
+
+def _connect():
+    """Establish a new session with vCenter
+
+    :Returns: vlab_inf_common.vmware.vCenter
+    """
+    return vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                   password=const.INF_VCENTER_PASSWORD)
+
+
+def _is_alive(vcenter):
+    """Determine if a session with vCenter is still authenticated
+
+    :Returns: Boolean
+
+    :param vcenter: The session to check
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        return vcenter.content.sessionManager.currentSession is not None
+    except Exception:
+        return False
+
+
+def _forget_caches(vcenter):
+    """Drop what a session remembers about the inventory, which may have changed
+
+    ``vCenter.networks`` maps every network the first time it's read, and never
+    again, so without this a borrowed session can't see networks made since.
+
+    :Returns: None
+
+    :param vcenter: The session being borrowed
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    vcenter._net_cache = None
+
+
+def _close(vcenter):
+    """Logout of vCenter, ignoring any errors from an already dead session
+
+    :Returns: None
+
+    :param vcenter: The session to terminate
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        vcenter.close()
+    except Exception:
+        pass
+
+
+class SessionPool(object):
+    """A bounded set of reusable vCenter sessions
+
+    :param size: The most sessions the pool will have open at one time
+    :type size: Integer
+
+    :param idle_timeout: How many seconds a session can sit unused before it's
+                         replaced with a new one.
+    :type idle_timeout: Integer
+
+    :param connect: Optionally supply the function that establishes a new session.
+    :type connect: Function
+    """
+    def __init__(self, size, idle_timeout, connect=_connect):
+        if size < 1:
+            raise ValueError('Pool size must be at least 1, supplied {}'.format(size))
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._connect = connect
+        self._idle = deque()
+        self._open = 0
+        self._cond = threading.Condition()
+        POOL_IDLE_TIMEOUT.set(idle_timeout)
+
+    @contextmanager
+    def borrow(self):
+        """Obtain a working session with vCenter for the duration of a ``with`` block
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        vcenter = self._checkout()
+        try:
+            yield vcenter
+        finally:
+            self._checkin(vcenter)
+
+    def _checkout(self):
+        """Pop an idle session, or open a new one if the pool has room"""
+        with self._cond:
+            while not self._idle and self._open >= self.size:
+                self._cond.wait()
+            if self._idle:
+                vcenter, last_used = self._idle.pop()
+            else:
+                vcenter, last_used = None, None
+                self._open += 1
+            POOL_IN_USE.inc()
+        try:
+            if vcenter is None:
+                vcenter = self._login()
+            elif (time.time() - last_used) > self.idle_timeout or not _is_alive(vcenter):
+                _close(vcenter)
+                POOL_RECONNECTS.inc()
+                vcenter = self._login()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                POOL_IN_USE.dec()
+                self._cond.notify()
+            self._update_size()
+            raise
+        _forget_caches(vcenter)
+        self._update_size()
+        return vcenter
+
+    def _checkin(self, vcenter):
+        """Return a session to the pool"""
+        with self._cond:
+            self._idle.append((vcenter, time.time()))
+            POOL_IN_USE.dec()
+            self._cond.notify()
+
+    def _login(self):
+        vcenter = self._connect()
+        POOL_LOGINS.inc()
+        return vcenter
+
+    def _update_size(self):
+        POOL_SIZE.set(self._open)
+
+    def close(self):
+        """Logout every idle session
+
+        :Returns: None
+        """
+        with self._cond:
+            while self._idle:
+                vcenter, _ = self._idle.pop()
+                _close(vcenter)
+                self._open -= 1
+        self._update_size()
+
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """Obtain the session pool for the current process
+
+    Celery forks its worker processes, and a session must never be shared between
+    processes, so a new pool is made whenever the PID changes.
+
+    :Returns: SessionPool
+    """
+    global _POOL, _POOL_PID
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_PID != os.getpid():
+            _POOL = SessionPool(size=const.VLAB_CLARITYNOW_VCENTER_POOL_SIZE,
+                                idle_timeout=const.VLAB_CLARITYNOW_VCENTER_IDLE_TIMEOUT)
+            _POOL_PID = os.getpid()
+        return _POOL
+
+
+def borrow():
+    """Borrow a session from this process' pool; use as a context manager
+
+    :Returns: contextmanager
+    """
+    return get_pool().borrow()
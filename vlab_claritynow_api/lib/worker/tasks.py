@@ -2,13 +2,109 @@
 """
 Entry point logic for available backend worker tasks
 """
+import os
+import time
+import threading
+
 from celery import Celery
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, worker_ready, task_prerun, task_postrun
 from vlab_api_common import get_task_logger
 
-from vlab_claritynow_api.lib import const
-from vlab_claritynow_api.lib.worker import vmware
+from vlab_claritynow_api.lib import const, queues, metrics, tracing, progress, etags
+from vlab_claritynow_api.lib.result_store import backend_url
+from vlab_claritynow_api.lib.worker import vmware, session_pool, warm_pool, morefs, templates
+
+app = Celery('claritynow', backend=backend_url(const.VLAB_CLARITYNOW_RESULT_BACKEND), broker=const.VLAB_MESSAGE_BROKER)
+app.conf.result_expires = const.VLAB_CLARITYNOW_RESULT_TTL
+queues.configure(app)
+TASK_SECONDS = metrics.histogram('claritynow_task_seconds', 'Time to run each task, from start to finish')
+METRICS_DIR = os.path.join(const.VLAB_CLARITYNOW_METRICS_DIR, 'worker') if const.VLAB_CLARITYNOW_METRICS_DIR else None
+_STARTED = {}
+
+
+@worker_process_shutdown.connect
+def _logout_of_vcenter(**kwargs):
+    """Do not leave orphaned sessions in vCenter when a worker process exits"""
+    session_pool.get_pool().close()
+
+
+@worker_init.connect
+def _remove_stale_metrics(**kwargs):
+    """The processes of an earlier run of the worker are gone; so are their metrics"""
+    if METRICS_DIR:
+        metrics.remove_stale(METRICS_DIR)
+
+
+@worker_process_init.connect
+def _flush_metrics(**kwargs):
+    """Tasks run in child processes, so their metrics must be saved for the main process to serve"""
+    # Don't also report what the main process recorded before forking
+    metrics.reset()
+    if METRICS_DIR:
+        metrics.start_flushing(METRICS_DIR, const.VLAB_CLARITYNOW_METRICS_FLUSH_SECONDS)
+
+
+@worker_process_init.connect
+def _warm_morefs(**kwargs):
+    """Look up every folder and network before the first task needs one"""
+    if not const.VLAB_CLARITYNOW_MOREF_TTL:
+        return
+    logger = get_task_logger(txn_id='worker-startup', task_id='warm-morefs', loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
+    def _warm():
+        try:
+            with session_pool.borrow() as vcenter:
+                morefs.warm(vcenter)
+        except Exception as doh:
+            # Not fatal; the first lookups will just be slower
+            logger.error('Unable to load folders and networks: {}'.format(doh))
+    threading.Thread(target=_warm, name='warm-morefs', daemon=True).start()
+
+
+@worker_ready.connect
+def _serve_metrics(**kwargs):
+    """Expose the metrics of every worker process on ``VLAB_CLARITYNOW_WORKER_METRICS_PORT``"""
+    if const.VLAB_CLARITYNOW_WORKER_METRICS_PORT:
+        metrics.serve(const.VLAB_CLARITYNOW_WORKER_METRICS_PORT, METRICS_DIR)
+
+
+@task_prerun.connect
+def _start_task_span(task_id=None, **kwargs):
+    _STARTED[task_id] = time.time()
+
+
+@task_postrun.connect
+def _end_task_span(task_id=None, task=None, args=None, kwargs=None, state=None, **extra):
+    """Time every task; the span is logged with the txn_id the task was sent with"""
+    started = _STARTED.pop(task_id, None)
+    if started is None:
+        return
+    took = time.time() - started
+    outcome = 'ok' if state == 'SUCCESS' else 'error'
+    TASK_SECONDS.observe(took, task=task.name, outcome=outcome)
+    txn_id = (kwargs or {}).get('txn_id') or (args[-1] if args else None)
+    logger = get_task_logger(txn_id=txn_id, task_id=task_id, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
+    tracing.record('task.{}'.format(task.name), took, outcome, logger)
 
-app = Celery('claritynow', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+
+@worker_ready.connect
+def _fill_warm_pool(**kwargs):
+    """Park VMs for the warm pool as soon as the worker comes online"""
+    if const.VLAB_CLARITYNOW_WARM_POOL:
+        refill_warm_pool.delay(txn_id='worker-startup')
+
+
+@worker_ready.connect
+def _reap_old_templates(**kwargs):
+    """Destroy the retired templates nothing was cloned from since the worker last ran"""
+    if const.VLAB_CLARITYNOW_PROVISION_MODE == 'linked_clone':
+        reap_templates.delay(txn_id='worker-startup')
+
+
+@worker_ready.connect
+def _watch_queues(**kwargs):
+    """Report how many tasks are waiting in each queue"""
+    logger = get_task_logger(txn_id='worker-startup', task_id='queue-depths', loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
+    queues.watch_depths(app, const.VLAB_CLARITYNOW_QUEUE_SAMPLE_SECONDS, logger)
 
 
 @app.task(name='claritynow.show', bind=True)
@@ -27,13 +123,46 @@ def show(self, username, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        info = vmware.show_claritynow(username)
+        with session_pool.borrow() as vcenter:
+            info = vmware.show_claritynow(vcenter, username, logger)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
         logger.info('Task complete')
         resp['content'] = info
+        # Every show makes new, single use console URLs; they aren't a change
+        resp['etag'] = etags.content_etag(info, volatile=['console'])
+    return resp
+
+
+@app.task(name='claritynow.inventory', bind=True)
+def inventory(self, cursor, per_page, txn_id):
+    """Obtain one page of every ClarityNow instance, for every user
+
+    :Returns: Dictionary
+
+    :param cursor: Where to start the page; an empty string for the first page
+    :type cursor: String
+
+    :param per_page: The most ClarityNow instances to return
+    :type per_page: Integer
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {'cursor': cursor, 'per_page': per_page}}
+    logger.info('Task starting')
+    try:
+        with session_pool.borrow() as vcenter:
+            resp['content'] = vmware.inventory_claritynow(vcenter, cursor, per_page)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+        resp['etag'] = etags.content_etag(resp['content'])
     return resp
 
 
@@ -60,12 +189,103 @@ def create(self, username, machine_name, image, network, txn_id):
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
+    reporter = progress.task_reporter(self, logger)
     logger.info('Task starting')
     try:
-        resp['content'] = vmware.create_claritynow(username, machine_name, image, network, logger)
+        with session_pool.borrow() as vcenter:
+            resp['content'] = vmware.create_claritynow(vcenter, username, machine_name, image, network, logger, reporter)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+    else:
+        if image in warm_pool.pool_sizes():
+            # Replace the parked VM we might have just used, without making the user wait
+            refill_warm_pool.delay(txn_id=txn_id)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='claritynow.create_batch', bind=True)
+def create_batch(self, username, machine_names, image, network, txn_id):
+    """Deploy several instances of ClarityNow, all of the same image and on the same network
+
+    The content of the response has the info of every instance that was
+    ``created``, and the error for every instance that ``failed``.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to create the ClarityNow instances
+    :type username: String
+
+    :param machine_names: The names of the new instances of ClarityNow
+    :type machine_names: List
+
+    :param image: The image/version of ClarityNow to create
+    :type image: String
+
+    :param network: The name of the network to connect the new ClarityNow instances up to
+    :type network: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    reporter = progress.task_reporter(self, logger)
+    logger.info('Task starting')
+    try:
+        with session_pool.borrow() as vcenter:
+            resp['content'] = vmware.create_claritynow_batch(vcenter, username, machine_names, image, network, logger, reporter)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        if image in warm_pool.pool_sizes():
+            refill_warm_pool.delay(txn_id=txn_id)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='claritynow.refill_warm_pool', bind=True)
+def refill_warm_pool(self, txn_id):
+    """Park new VMs until the warm pool for every image is full
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        with session_pool.borrow() as vcenter:
+            resp['content'], unfinished = vmware.refill_warm_pool(vcenter, logger, const.VLAB_CLARITYNOW_WARM_POOL_REFILL_MAX)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        if unfinished:
+            # Keep going in a new task, with a time limit of its own
+            refill_warm_pool.delay(txn_id=txn_id)
+        logger.info('Task complete')
+    return resp
+
+
+@app.task(name='claritynow.reap_templates', bind=True)
+def reap_templates(self, txn_id):
+    """Destroy the retired linked clone templates that no VM reads from anymore
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    with session_pool.borrow() as vcenter:
+        resp['content'] = {'destroyed': templates.reap_retired(vcenter, logger)}
     logger.info('Task complete')
     return resp
 
@@ -89,11 +309,49 @@ def delete(self, username, machine_name, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        vmware.delete_claritynow(username, machine_name, logger)
+        with session_pool.borrow() as vcenter:
+            vmware.delete_claritynow(vcenter, username, machine_name, logger)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        if const.VLAB_CLARITYNOW_PROVISION_MODE == 'linked_clone':
+            # It may have been the last clone of a retired template
+            reap_templates.delay(txn_id=txn_id)
+        logger.info('Task complete')
+    return resp
+
+
+@app.task(name='claritynow.delete_batch', bind=True)
+def delete_batch(self, username, machine_names, txn_id):
+    """Destroy several instances of ClarityNow at once
+
+    The content of the response lists the instances that were ``deleted``, and
+    the error for every instance that ``failed``.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to delete their ClarityNow instances
+    :type username: String
+
+    :param machine_names: The names of the instances to delete, or None for all of them
+    :type machine_names: List
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_CLARITYNOW_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        with session_pool.borrow() as vcenter:
+            resp['content'] = vmware.delete_claritynow_batch(vcenter, username, machine_names, logger)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
+        if const.VLAB_CLARITYNOW_PROVISION_MODE == 'linked_clone':
+            reap_templates.delay(txn_id=txn_id)
         logger.info('Task complete')
     return resp
 
@@ -122,7 +380,8 @@ def modify_network(self, username, machine_name, new_network, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        vmware.update_network(username, machine_name, new_network)
+        with session_pool.borrow() as vcenter:
+            vmware.update_network(vcenter, username, machine_name, new_network, logger)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
@@ -0,0 +1,308 @@
+# -*- coding: UTF-8 -*-
+"""
+Fast provisioning of ClarityNow via linked clones.
+
+The first time an image is deployed in this mode, the OVA is imported once as a
+template VM (in the ``VLAB_CLARITYNOW_TEMPLATE_FOLDER`` folder) and a base
+snapshot is taken. Every create after that is a linked clone of the snapshot,
+which only has to write a small delta disk instead of re-uploading the whole
+OVA.
+
+The size and modification time of the OVA are stored in the template's meta
+data; if the OVA file changes, the old template is retired and a new one made.
+Retired templates are renamed, not destroyed, because existing linked clones
+still read from their disks; ``reap_retired`` destroys them once no VM does.
+
+A template is built under a name that says when the build started (the build
+marker), and only renamed to ``template_name`` once it's ready. While a
+marker is younger than ``BUILD_TIMEOUT``, other workers do a full OVA deploy
+instead of building the same template again. An older marker is from a build
+that crashed, and is destroyed by the next worker that needs the template.
+"""
+import os
+import time
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim, virtual_machine, consume_task
+
+from vlab_claritynow_api.lib import const
+from vlab_claritynow_api.lib.worker import inventory, ova_cache, morefs
+
+
+TEMPLATE_COMPONENT = 'ClarityNowTemplate'
+BASE_SNAPSHOT = 'base'
+# How long building a template can take; a build that isn't done by then crashed
+BUILD_TIMEOUT = 3600
+
+
+def template_name(image):
+    """The name of the template VM for a given version of ClarityNow
+
+    :Returns: String
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+    """
+    return 'ClarityNow-template-{}'.format(image)
+
+
+def _building_name(image):
+    return '{}-building-{}'.format(template_name(image), int(time.time()))
+
+
+def _build_started(name, image):
+    """When the build of a template started, or None if the VM isn't a build marker"""
+    prefix = '{}-building-'.format(template_name(image))
+    if not name.startswith(prefix):
+        return None
+    try:
+        return int(name[len(prefix):])
+    except ValueError:
+        return None
+
+
+def ova_signature(ova_path):
+    """Used to detect when an OVA file has changed
+
+    :Returns: Dictionary
+
+    :Raises: FileNotFoundError if the OVA does not exist
+
+    :param ova_path: The absolute path to the OVA file
+    :type ova_path: String
+    """
+    info = os.stat(ova_path)
+    return {'ova_size': info.st_size, 'ova_mtime': info.st_mtime}
+
+
+def _build_template(vcenter, image, ova_path, network, signature, logger):
+    """Import the OVA as a template VM, and take the base snapshot
+
+    :Returns: vim.VirtualMachine, or None if another worker built it first
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+
+    :param ova_path: The absolute path to the OVA file
+    :type ova_path: String
+
+    :param network: The network to connect the template to
+    :type network: vim.Network
+
+    :param signature: The output from ``ova_signature``
+    :type signature: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    logger.info('Building linked clone template for ClarityNow {}'.format(image))
+    ova = ova_cache.open_ova(ova_path)
+    try:
+        network_map = vim.OvfManager.NetworkMapping()
+        network_map.name = ova.networks[0]
+        network_map.network = network
+        the_template = virtual_machine.deploy_from_ova(vcenter, ova, [network_map],
+                                                       const.VLAB_CLARITYNOW_TEMPLATE_FOLDER,
+                                                       _building_name(image), logger,
+                                                       power_on=False)
+    except vim.fault.DuplicateName:
+        # Another worker started building it the same second
+        return None
+    finally:
+        ova.close()
+    try:
+        consume_task(the_template.CreateSnapshot_Task(name=BASE_SNAPSHOT,
+                                                      description='Linked clones of ClarityNow {}'.format(image),
+                                                      memory=False,
+                                                      quiesce=False))
+        meta_data = {'component' : TEMPLATE_COMPONENT,
+                     'created': time.time(),
+                     'version': image,
+                     'configured': True,
+                     'generation': 1,
+                    }
+        meta_data.update(signature)
+        virtual_machine.set_meta(the_template, meta_data)
+        if _rename(the_template, template_name(image)):
+            return the_template
+        logger.info('Another worker built the template for ClarityNow {} first'.format(image))
+    except (RuntimeError, vmodl.MethodFault):
+        _destroy(the_template, logger)
+        raise
+    _destroy(the_template, logger)
+    return None
+
+
+def _rename(the_vm, name):
+    """Rename a VM
+
+    :Returns: Boolean - False if another VM in the folder already has the name
+    """
+    task = the_vm.Rename_Task(name)
+    try:
+        consume_task(task)
+    except RuntimeError:
+        if isinstance(task.info.error, vim.fault.DuplicateName):
+            return False
+        raise
+    return True
+
+
+def _destroy(the_vm, logger):
+    """Destroy a template VM, logging any failure instead of raising it"""
+    try:
+        consume_task(the_vm.Destroy_Task())
+    except (RuntimeError, vmodl.MethodFault) as doh:
+        logger.error('Unable to destroy template {}: {}'.format(the_vm, doh))
+
+
+def get_template(vcenter, image, ova_path, network, logger):
+    """Obtain the template for an image, building it if needed
+
+    :Returns: vim.VirtualMachine, or None if another worker is building the template
+
+    :Raises: FileNotFoundError if the OVA does not exist
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+
+    :param ova_path: The absolute path to the OVA file
+    :type ova_path: String
+
+    :param network: The network to connect the template to, if one has to be built
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    signature = ova_signature(ova_path)
+    folder = morefs.get_or_create_folder(vcenter, const.VLAB_CLARITYNOW_TEMPLATE_FOLDER)
+    the_template = vcenter.content.searchIndex.FindChild(entity=folder, name=template_name(image))
+    if isinstance(the_template, vim.VirtualMachine):
+        props = inventory.get_properties(vcenter, the_template, ['config.annotation'])
+        meta = inventory.parse_meta(props.get('config.annotation'))
+        if meta.get('component') != TEMPLATE_COMPONENT:
+            # Only a finished template gets this name, so nothing was cloned from it
+            logger.info('Template for ClarityNow {} was never finished; destroying it'.format(image))
+            _destroy(the_template, logger)
+        elif all(meta.get(x) == y for x, y in signature.items()):
+            return the_template
+        else:
+            logger.info('OVA for ClarityNow {} changed; retiring template'.format(image))
+            retired_name = '{}-retired-{}'.format(template_name(image), int(time.time()))
+            consume_task(the_template.Rename_Task(retired_name))
+    now = time.time()
+    for the_vm, props in inventory.child_vms(vcenter, folder, ['name']):
+        started = _build_started(props.get('name', ''), image)
+        if started is None:
+            continue
+        if now - started <= BUILD_TIMEOUT:
+            return None
+        logger.info('Build of template {} never finished; destroying it'.format(props['name']))
+        _destroy(the_vm, logger)
+    return _build_template(vcenter, image, ova_path, network, signature, logger)
+
+
+def reap_retired(vcenter, logger):
+    """Destroy the retired templates that no linked clone reads from anymore
+
+    Only reads the disks of every VM when there are retired templates.
+
+    :Returns: List - the names of the templates destroyed
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    folder = morefs.get_or_create_folder(vcenter, const.VLAB_CLARITYNOW_TEMPLATE_FOLDER)
+    retired = [x for x in inventory.child_vms(vcenter, folder, ['name', 'layoutEx.file'])
+               if '-retired-' in x[1].get('name', '')]
+    if not retired:
+        return []
+    # A template's own disk is a delta of its base disk too
+    in_use = _parent_disks(vcenter, ignore={x[0]._moId for x in retired})
+    destroyed = []
+    for the_template, props in retired:
+        disks = {x.name for x in props.get('layoutEx.file') or [] if x.type == 'diskDescriptor'}
+        if disks & in_use:
+            continue
+        logger.info('No linked clones of {} remain; destroying it'.format(props['name']))
+        _destroy(the_template, logger)
+        destroyed.append(props['name'])
+    return destroyed
+
+
+def _parent_disks(vcenter, ignore):
+    """Obtain every disk that a VM's disks are a delta of, i.e. the disks of templates
+
+    :Returns: Set - the datastore paths of the disks
+
+    :param ignore: The moids of VMs to leave out
+    :type ignore: Set
+    """
+    view = vcenter.content.viewManager.CreateContainerView(container=vcenter.content.rootFolder,
+                                                           type=[vim.VirtualMachine],
+                                                           recursive=True)
+    try:
+        found = inventory.retrieve(vcenter, inventory._view_filter(view, vim.VirtualMachine, ['config.hardware.device']))
+        parents = set()
+        for obj in found:
+            if obj.obj._moId in ignore:
+                continue
+            devices = inventory.to_dict(obj).get('config.hardware.device') or []
+            for device in devices:
+                if not isinstance(device, vim.vm.device.VirtualDisk):
+                    continue
+                backing = getattr(device.backing, 'parent', None)
+                while backing is not None:
+                    parents.add(backing.fileName)
+                    backing = getattr(backing, 'parent', None)
+    finally:
+        view.DestroyView()
+    return parents
+
+
+def linked_clone(vcenter, the_template, username, machine_name, network):
+    """Make a new VM that's a linked clone of a template's base snapshot
+
+    The new VM is connected to the supplied network, and powered on.
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_template: The template VM to clone
+    :type the_template: vim.VirtualMachine
+
+    :param username: The name of the user who will own the new VM
+    :type username: String
+
+    :param machine_name: The name to give the new VM
+    :type machine_name: String
+
+    :param network: The network to connect the new VM to
+    :type network: vim.Network
+    """
+    props = inventory.get_properties(vcenter, the_template, ['snapshot.currentSnapshot'])
+    folder = morefs.get_folder(vcenter, username)
+    relocate_spec = vim.vm.RelocateSpec()
+    relocate_spec.diskMoveType = 'createNewChildDiskBacking'
+    relocate_spec.pool = vcenter.resource_pools[const.INF_VCENTER_RESORUCE_POOL]
+    clone_spec = vim.vm.CloneSpec()
+    clone_spec.location = relocate_spec
+    clone_spec.snapshot = props['snapshot.currentSnapshot']
+    clone_spec.powerOn = False
+    clone_spec.template = False
+    the_vm = consume_task(the_template.CloneVM_Task(folder=folder, name=machine_name, spec=clone_spec))
+    virtual_machine.change_network(the_vm, network)
+    virtual_machine.power(the_vm, state='on')
+    return the_vm
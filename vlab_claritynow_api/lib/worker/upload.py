@@ -0,0 +1,239 @@
+# -*- coding: UTF-8 -*-
+"""
+Uploads the disks of an OVA to the URLs of an import lease.
+
+Every disk is sent on its own connection, several at a time, straight from the
+OVA file at the offset the disk starts at. Nothing is copied through Python
+buffers:
+
+- over plain HTTP, the kernel sends the file with ``sendfile``
+- over HTTPS the bytes must pass through OpenSSL, so the file is memory mapped
+  and slices of the map are handed to the TLS socket
+
+How many bytes have been sent is tracked across all the disks, so the lease can
+be told how far along the import is.
+"""
+import ssl
+import mmap
+import time
+import threading
+import http.client
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from vlab_claritynow_api.lib import metrics
+
+
+CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_BYTES = metrics.counter('claritynow_upload_bytes_total', 'Bytes of OVA disks uploaded to vSphere')
+UPLOAD_SECONDS = metrics.histogram('claritynow_upload_seconds', 'Time to upload every disk of an OVA',
+                                   buckets=(5, 15, 30, 60, 120, 300, 600, 1200))
+
+
+class Progress(object):
+    """Counts the bytes sent by every upload of a deploy
+
+    :param total: How many bytes will be sent, all together
+    :type total: Integer
+    """
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        """Record that more bytes were sent
+
+        :Returns: None
+
+        :param amount: How many bytes were just sent
+        :type amount: Integer
+        """
+        with self._lock:
+            self.sent += amount
+        UPLOAD_BYTES.inc(amount)
+
+    @property
+    def percent(self):
+        """How much of the upload is done, from 0 to 100
+
+        :Returns: Integer
+        """
+        if not self.total:
+            return 100
+        return min(100, int(100 * self.sent / self.total))
+
+
+def _connect(url, context, timeout):
+    """Open a connection to the host in a URL
+
+    :Returns: http.client.HTTPConnection
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'https':
+        return http.client.HTTPSConnection(parsed.hostname, parsed.port, timeout=timeout, context=context)
+    return http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+
+
+def _send_file(sock, the_file, offset, size, progress):
+    """Have the kernel copy part of a file to a socket"""
+    sent = 0
+    while sent < size:
+        # socket.sendfile copes with sockets that have a timeout set
+        amount = sock.sendfile(the_file, offset + sent, min(CHUNK_SIZE, size - sent))
+        if not amount:
+            raise RuntimeError('Connection closed after sending {} of {} bytes'.format(sent, size))
+        sent += amount
+        progress.add(amount)
+
+
+def _send_mapped(sock, the_file, offset, size, progress):
+    """Send part of a file through a socket that can't use sendfile, i.e. TLS"""
+    # A map has to start on a multiple of the allocation granularity
+    start = offset - (offset % mmap.ALLOCATIONGRANULARITY)
+    skip = offset - start
+    if not size:
+        return
+    mapped = mmap.mmap(the_file.fileno(), skip + size, offset=start, access=mmap.ACCESS_READ)
+    try:
+        with memoryview(mapped) as view:
+            end = skip + size
+            position = skip
+            while position < end:
+                amount = min(CHUNK_SIZE, end - position)
+                # The map can't be closed while any slice of it is still around
+                with view[position:position + amount] as chunk:
+                    sock.sendall(chunk)
+                progress.add(amount)
+                position += amount
+    finally:
+        mapped.close()
+
+
+def send_disk(ova_path, offset, size, url, progress, context=None, timeout=300):
+    """Upload one disk from an OVA file to a lease URL
+
+    :Returns: None
+
+    :Raises: RuntimeError if the server rejects the upload
+
+    :param ova_path: The absolute path to the OVA file
+    :type ova_path: String
+
+    :param offset: Where in the OVA the disk starts
+    :type offset: Integer
+
+    :param size: How many bytes the disk is
+    :type size: Integer
+
+    :param url: Where to upload the disk to
+    :type url: String
+
+    :param progress: Where to count the bytes sent
+    :type progress: Progress
+
+    :param context: The TLS settings, for HTTPS URLs
+    :type context: ssl.SSLContext
+
+    :param timeout: How many seconds a send may block before giving up
+    :type timeout: Integer
+    """
+    parsed = urlparse(url)
+    path = parsed.path
+    if parsed.query:
+        path = '{}?{}'.format(path, parsed.query)
+    conn = _connect(url, context, timeout)
+    try:
+        conn.putrequest('POST', path, skip_accept_encoding=True)
+        conn.putheader('Content-Type', 'application/x-vnd.vmware-streamVmdk')
+        conn.putheader('Content-Length', '{}'.format(size))
+        conn.endheaders()
+        with open(ova_path, 'rb') as the_file:
+            if isinstance(conn.sock, ssl.SSLSocket):
+                _send_mapped(conn.sock, the_file, offset, size, progress)
+            else:
+                _send_file(conn.sock, the_file, offset, size, progress)
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status >= 300:
+            raise RuntimeError('Upload to {} failed: HTTP {} {}'.format(url, resp.status, resp.reason))
+    finally:
+        conn.close()
+
+
+def upload_disks(ova_path, disks, progress, parallel, context=None):
+    """Upload several disks from an OVA file at the same time
+
+    :Returns: None
+
+    :Raises: RuntimeError if any upload fails
+
+    :param ova_path: The absolute path to the OVA file
+    :type ova_path: String
+
+    :param disks: A tuple of (offset, size, url) for every disk to upload
+    :type disks: List
+
+    :param progress: Where to count the bytes sent
+    :type progress: Progress
+
+    :param parallel: The most disks to upload at once
+    :type parallel: Integer
+
+    :param context: The TLS settings, for HTTPS URLs
+    :type context: ssl.SSLContext
+    """
+    started = time.time()
+    workers = max(1, min(parallel, len(disks)))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = []
+    try:
+        for offset, size, url in disks:
+            futures.append(executor.submit(send_disk, ova_path, offset, size, url, progress, context))
+        for future in as_completed(futures):
+            # re-raises the error of a failed upload
+            future.result()
+    except BaseException:
+        # Don't wait for the other disks; aborting the lease disconnects them
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+    UPLOAD_SECONDS.observe(time.time() - started)
+
+
+def keep_alive(lease, progress, interval, on_progress=None):
+    """Tell the lease how far along the upload is, until the returned event is set
+
+    vSphere aborts an import lease that hasn't heard about progress for a few
+    minutes, no matter how busy the uploads are.
+
+    :Returns: threading.Event
+
+    :param lease: The lease of the import
+    :type lease: vim.HttpNfcLease
+
+    :param progress: What's been sent so far
+    :type progress: Progress
+
+    :param interval: How many seconds between updates to the lease
+    :type interval: Integer/Float
+
+    :param on_progress: Also called with the percent done, every update
+    :type on_progress: Callable
+    """
+    done = threading.Event()
+    def _chime():
+        while not done.wait(interval):
+            percent = progress.percent
+            try:
+                lease.Progress(percent)
+            except Exception:
+                # The lease is done, or aborted; the upload will find out
+                return
+            if on_progress is not None:
+                on_progress(percent)
+    chimer = threading.Thread(target=_chime, name='lease-keepalive', daemon=True)
+    chimer.start()
+    return done
@@ -1,37 +1,93 @@
 # -*- coding: UTF-8 -*-
 """Business logic for backend worker tasks"""
 import time
+import re
+import queue
 import random
 import os.path
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
-
-from vlab_claritynow_api.lib import const
-
-
-def show_claritynow(username):
+import itertools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim, virtual_machine, consume_task
+
+from vlab_claritynow_api.lib import const, metrics, progress
+from vlab_claritynow_api.lib.tracing import span
+from vlab_claritynow_api.lib.images import convert_name
+from vlab_claritynow_api.lib.worker import inventory, templates, warm_pool, ova_cache, morefs
+
+
+CREATE_SECONDS = metrics.histogram('claritynow_create_seconds', 'Time to create a ClarityNow instance, by provisioning mode')
+# Same rule as ``virtual_machine.deploy_from_ova``; checked up front, because
+# linked clones and the warm pool would otherwise accept any name
+HOSTNAME_REGEX = re.compile(r'^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$')
+# Each is its own sudo command, so sudoers only has to allow timedatectl. They
+# share one guest operations session, and run in order; timedatectl won't set
+# the time while NTP is on.
+SETUP_STEPS = [('ntp', '/usr/bin/timedatectl set-ntp 0'), ('time', '/usr/bin/timedatectl set-time 2018-09-28')]
+# How long VMware Tools has to come up, and each setup command has to exit
+SETUP_TIMEOUT = 600
+GUEST_POLL_SECONDS = 0.25
+
+
+def show_claritynow(vcenter, username, logger):
     """Obtain basic information about ClarityNow
 
     :Returns: Dictionary
 
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
     :param username: The user requesting info about their ClarityNow
     :type username: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with span('show.folder_lookup', logger):
+        folder = morefs.get_folder(vcenter, username)
+    with span('show.folder_vms', logger):
+        return inventory.folder_vms(vcenter, folder, username, component='ClarityNow')
+
+
+def inventory_claritynow(vcenter, cursor, per_page):
+    """Obtain one page of every ClarityNow instance, across all users
+
+    :Returns: Dictionary
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param cursor: Where in the inventory to start the page. Use the ``cursor``
+                   from the previous page, or an empty string to start at the beginning.
+    :type cursor: String
+
+    :param per_page: The most VMs to return
+    :type per_page: Integer
     """
-    claritynow_vms = {}
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for vm in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, vm, username)
-            if info['meta']['component'] == 'ClarityNow':
-                claritynow_vms[vm.name] = info
-    return claritynow_vms
+    vms = inventory.iter_all_vms(vcenter, component='ClarityNow', after=cursor, page_size=per_page + 1)
+    try:
+        # Grab one extra to know if there's another page
+        page = list(itertools.islice(vms, per_page + 1))
+    finally:
+        vms.close()
+    if len(page) > per_page:
+        next_cursor = page[per_page - 1]['moid']
+    else:
+        next_cursor = None
+    return {'vms': page[:per_page], 'cursor': next_cursor}
 
 
-def delete_claritynow(username, machine_name, logger):
+def delete_claritynow(vcenter, username, machine_name, logger):
     """Unregister and destroy a user's ClarityNow
 
     :Returns: None
 
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
     :param username: The user who wants to delete their jumpbox
     :type username: String
 
@@ -41,28 +97,90 @@ def delete_claritynow(username, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'ClarityNow':
-                    logger.debug('powering off VM')
-                    virtual_machine.power(entity, state='off')
-                    delete_task = entity.Destroy_Task()
-                    logger.debug('blocking while VM is being destroyed')
-                    consume_task(delete_task)
-                    break
+    with span('delete.lookup', logger):
+        folder = morefs.get_folder(vcenter, username)
+        the_vm = inventory.find_vm(vcenter, folder, machine_name, component='ClarityNow')
+    if the_vm is None:
+        raise ValueError('No {} named {} found'.format('claritynow', machine_name))
+    logger.debug('powering off VM')
+    with span('delete.power_off', logger):
+        virtual_machine.power(the_vm, state='off')
+    with span('delete.destroy', logger):
+        delete_task = the_vm.Destroy_Task()
+        logger.debug('blocking while VM is being destroyed')
+        consume_task(delete_task)
+
+
+def delete_claritynow_batch(vcenter, username, machine_names, logger):
+    """Power off and destroy several of a user's ClarityNow instances at the same time
+
+    Every power off is started at once, and then every destroy, instead of one
+    VM after another.
+
+    :Returns: Dictionary
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The user who wants to delete their ClarityNow instances
+    :type username: String
+
+    :param machine_names: The names of the VMs to delete. Supply None to delete
+                          every ClarityNow the user owns.
+    :type machine_names: List
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    owned = {}
+    with span('delete_batch.lookup', logger):
+        folder = morefs.get_folder(vcenter, username)
+        for the_vm, props in inventory.child_vms(vcenter, folder, ['name', 'config.annotation', 'runtime.powerState']):
+            if inventory.parse_meta(props.get('config.annotation')).get('component') == 'ClarityNow':
+                owned[props['name']] = (the_vm, props.get('runtime.powerState'))
+    if machine_names is None:
+        machine_names = sorted(owned.keys())
+    failed = {}
+    targets = {}
+    for machine_name in machine_names:
+        if machine_name in owned:
+            targets[machine_name] = owned[machine_name]
         else:
-            raise ValueError('No {} named {} found'.format('claritynow', machine_name))
+            failed[machine_name] = 'No {} named {} found'.format('claritynow', machine_name)
+
+    logger.debug('powering off {} VMs'.format(len(targets)))
+    with span('delete_batch.power_off', logger):
+        power_tasks = {x: y[0].PowerOffVM_Task() for x, y in targets.items() if y[1] != vim.VirtualMachinePowerState.poweredOff}
+        _wait_for_all(vcenter, power_tasks, targets, failed)
+
+    logger.debug('destroying {} VMs'.format(len(targets)))
+    with span('delete_batch.destroy', logger):
+        destroy_tasks = {x: y[0].Destroy_Task() for x, y in targets.items()}
+        _wait_for_all(vcenter, destroy_tasks, targets, failed)
+    return {'deleted': sorted(targets.keys()), 'failed': failed}
+
+
+def _wait_for_all(vcenter, the_tasks, targets, failed):
+    """Wait on tasks for several VMs; VMs whose task failed are moved from ``targets`` to ``failed``
+
+    :Returns: None
+    """
+    results = inventory.wait_for_tasks(vcenter, list(the_tasks.values()))
+    for machine_name, the_task in the_tasks.items():
+        error = results.get(the_task._moId)
+        if error is not None:
+            failed[machine_name] = error
+            targets.pop(machine_name)
 
 
-def create_claritynow(username, machine_name, image, network, logger):
+def create_claritynow(vcenter, username, machine_name, image, network, logger, reporter=None):
     """Deploy a new instance of ClarityNow
 
     :Returns: Dictionary
 
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
     :param username: The name of the user who wants to create a new ClarityNow
     :type username: String
 
@@ -77,37 +195,370 @@ def create_claritynow(username, machine_name, image, network, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param reporter: Told about each phase of the create, for clients following the task
+    :type reporter: vlab_claritynow_api.lib.progress.Reporter
+    """
+    logger.info(convert_name(image))
+    reporter = reporter or progress.Reporter()
+    source = ImageSource(vcenter, image, network)
+    try:
+        return _provision(vcenter, source, username, machine_name, logger, reporter)
+    finally:
+        source.close()
+
+
+def create_claritynow_batch(vcenter, username, machine_names, image, network, logger, reporter=None):
+    """Deploy several instances of ClarityNow, all of the same image and on the same network
+
+    The OVA and network are looked up once for the whole batch, and at most
+    ``VLAB_CLARITYNOW_BATCH_PARALLEL`` instances are deployed at the same time.
+    A failure to create one instance does not stop the others from being created.
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if the image or network does not exist
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The name of the user who wants to create the ClarityNow instances
+    :type username: String
+
+    :param machine_names: The names of the new instances of ClarityNow
+    :type machine_names: List
+
+    :param image: The image/version of ClarityNow to create
+    :type image: String
+
+    :param network: The name of the network to connect the new ClarityNow instances up to
+    :type network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param reporter: Told about each phase of every create, for clients following the task
+    :type reporter: vlab_claritynow_api.lib.progress.Reporter
+    """
+    reporter = reporter or progress.Reporter()
+    workers = max(1, min(const.VLAB_CLARITYNOW_BATCH_PARALLEL, len(machine_names)))
+    source = ImageSource(vcenter, image, network, max_open=workers)
+    if not os.path.isfile(source.ova_path):
+        source.close()
+        raise ValueError("Invalid version of ClarityNow supplied: {}".format(image))
+    created = {}
+    failed = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_provision, vcenter, source, username, x, logger, reporter) : x for x in machine_names}
+            for future in as_completed(futures):
+                machine_name = futures[future]
+                try:
+                    created.update(future.result())
+                except Exception as doh:
+                    # Any error, even from deep in pyVmomi, only fails this one instance
+                    logger.error('Unable to create {}: {}'.format(machine_name, doh))
+                    failed[machine_name] = '{}'.format(doh)
+    finally:
+        source.close()
+    return {'created': created, 'failed': failed}
+
+
+def refill_warm_pool(vcenter, logger, max_parks):
+    """Deploy and configure VMs until every pooled image has enough parked
+
+    Parking a VM takes minutes, so at most ``max_parks`` VMs are parked per
+    call, to finish well within the time limit of the slow queue. Call it again
+    if it stopped early.
+
+    :Returns: Tuple - (Dictionary of the parked VMs ready per image, Boolean -
+              True if it stopped before every pool was full)
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param max_parks: The most VMs to park
+    :type max_parks: Integer
+    """
+    folder_name = const.VLAB_CLARITYNOW_WARM_POOL_FOLDER
+    # Nobody follows the progress of parking VMs
+    reporter = progress.Reporter()
+    ready = {}
+    parked = 0
+    unfinished = False
+    for image, size in warm_pool.pool_sizes().items():
+        warm_pool.reap(vcenter, image, logger)
+        total, ready[image] = warm_pool.count(vcenter, image)
+        if total >= size:
+            continue
+        if parked >= max_parks:
+            unfinished = True
+            continue
+        source = ImageSource(vcenter, image, const.VLAB_CLARITYNOW_WARM_POOL_NETWORK)
+        try:
+            for _ in range(size - total):
+                if parked >= max_parks:
+                    unfinished = True
+                    break
+                machine_name = warm_pool.parked_name(image)
+                logger.info('Parking {}'.format(machine_name))
+                parked += 1
+                the_vm = None
+                try:
+                    the_vm, _ = _deploy(vcenter, source, folder_name, machine_name, logger, reporter)
+                    # Block until the VM has an IP, so a claimed VM is usable right away
+                    _setup_and_wait_for_ip(vcenter, the_vm, folder_name, logger, reporter)
+                except (ValueError, RuntimeError, vmodl.MethodFault) as doh:
+                    logger.error('Unable to park {}: {}'.format(machine_name, doh))
+                    if the_vm is not None:
+                        # Never parked, so it'd never be claimed
+                        warm_pool._destroy(the_vm, logger)
+                    break
+                warm_pool.park(the_vm, image)
+                ready[image] += 1
+        finally:
+            source.close()
+    return ready, unfinished
+
+
+class ImageSource(object):
+    """Everything needed to deploy an image, looked up once and shared between deploys.
+
+    An ``Ova`` object can only upload one VM at a time, but can be reused once
+    that upload is done. This object opens the OVA file at most ``max_open``
+    times, and lends those out to concurrent deploys.
+
+    :Raises: ValueError if the network does not exist
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ClarityNow to deploy
+    :type image: String
+
+    :param network: The name of the network to connect new VMs to
+    :type network: String
+
+    :param max_open: The most times to open the OVA file
+    :type max_open: Integer
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        image_name = convert_name(image)
-        logger.info(image_name)
+    def __init__(self, vcenter, image, network, max_open=1):
+        self.image = image
+        self.ova_path = os.path.join(const.VLAB_CLARITYNOW_IMAGES_DIR, convert_name(image))
+        self.network = _get_network(vcenter, network)
+        self.mode = const.VLAB_CLARITYNOW_PROVISION_MODE
+        self._max_open = max_open
+        self._opened = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._template_lock = threading.Lock()
+        self._template = None
+        self._template_checked = False
+
+    @contextmanager
+    def ova(self, logger=None):
+        """Borrow an open OVA file
+
+        :Returns: vlab_inf_common.vmware.Ova
+
+        :Raises: ValueError if the OVA does not exist
+
+        :param logger: An object for logging messages
+        :type logger: logging.LoggerAdapter
+        """
         try:
-            ova = Ova(os.path.join(const.VLAB_CLARITYNOW_IMAGES_DIR, image_name))
-        except FileNotFoundError:
-            error = "Invalid version of ClarityNow supplied: {}".format(image)
-            raise ValueError(error)
+            ova = self._idle.get_nowait()
+        except queue.Empty:
+            ova = None
+            with self._lock:
+                if len(self._opened) < self._max_open:
+                    try:
+                        with span('create.ova_open', logger):
+                            ova = ova_cache.open_ova(self.ova_path)
+                    except FileNotFoundError:
+                        error = "Invalid version of ClarityNow supplied: {}".format(self.image)
+                        raise ValueError(error)
+                    self._opened.append(ova)
+            if ova is None:
+                ova = self._idle.get()
         try:
-            network_map = vim.OvfManager.NetworkMapping()
-            network_map.name = ova.networks[0]
-            try:
-                network_map.network = vcenter.networks[network]
-            except KeyError:
-                raise ValueError('No such network named {}'.format(network))
-            the_vm = virtual_machine.deploy_from_ova(vcenter, ova, [network_map],
-                                                     username, machine_name, logger)
+            yield ova
         finally:
-            ova.close()
-        _setup_vm(vcenter, the_vm, logger)
-        meta_data = {'component' : "ClarityNow",
-                     'created': time.time(),
-                     'version': image,
-                     'configured': True,
-                     'generation': 1,
-                    }
+            self._idle.put(ova)
+
+    def template(self, vcenter, logger):
+        """Obtain the linked clone template for the image
+
+        Only the first caller looks it up (and maybe builds it); everyone else
+        waits for, and reuses, that answer.
+
+        :Returns: vim.VirtualMachine, or None if the template is not ready
+
+        :Raises: ValueError if the OVA does not exist
+        """
+        with self._template_lock:
+            if not self._template_checked:
+                try:
+                    self._template = templates.get_template(vcenter, self.image, self.ova_path, self.network, logger)
+                except FileNotFoundError:
+                    error = "Invalid version of ClarityNow supplied: {}".format(self.image)
+                    raise ValueError(error)
+                self._template_checked = True
+            return self._template
+
+    def close(self):
+        """Close every opened OVA file
+
+        :Returns: None
+        """
+        with self._lock:
+            for ova in self._opened:
+                ova.close()
+            self._opened = []
+
+
+def _get_network(vcenter, network):
+    """Lookup a network by name
+
+    :Returns: vim.Network
+
+    :Raises: ValueError if no such network exists
+    """
+    return morefs.get_network(vcenter, network)
+
+
+def _check_name(machine_name):
+    """Raise ValueError unless the machine name is a valid hostname"""
+    if not HOSTNAME_REGEX.match(machine_name):
+        error = 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+        raise ValueError(error)
+
+
+def _provision(vcenter, source, username, machine_name, logger, reporter):
+    """Obtain a new, configured ClarityNow VM from the quickest source available
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if the machine name is not a valid hostname
+    """
+    _check_name(machine_name)
+    started = time.time()
+    the_vm = None
+    mode = None
+    if source.image in warm_pool.pool_sizes():
+        with span('create.claim', logger):
+            the_vm = warm_pool.claim(vcenter, source.image, username, machine_name, source.network, logger)
+        if the_vm is not None:
+            mode = 'warm_pool'
+    if the_vm is None:
+        with span('create.deploy', logger):
+            the_vm, mode = _deploy(vcenter, source, username, machine_name, logger, reporter)
+        needs_setup = True
+    else:
+        needs_setup = False
+    meta_data = {'component' : "ClarityNow",
+                 'created': time.time(),
+                 'version': source.image,
+                 'configured': True,
+                 'generation': 1,
+                }
+    with span('create.set_meta', logger):
         virtual_machine.set_meta(the_vm, meta_data)
-        info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
-        return {the_vm.name: info}
+    if needs_setup:
+        info = _setup_and_wait_for_ip(vcenter, the_vm, username, logger, reporter)
+    else:
+        reporter.update(machine_name, progress.WAITING_FOR_IP)
+        with span('create.ip_wait', logger):
+            info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
+    CREATE_SECONDS.observe(time.time() - started, mode=mode)
+    return {the_vm.name: info}
+
+
+def _setup_and_wait_for_ip(vcenter, the_vm, username, logger, reporter):
+    """Run the guest setup while the new VM is waiting on DHCP, instead of one after the other
+
+    :Returns: Dictionary - the output of ``virtual_machine.get_info``
+
+    :Raises: RuntimeError if a setup command can't be run
+    """
+    machine_name = the_vm.name
+    have_ip = threading.Event()
+    def _setup_done(_):
+        if not have_ip.is_set():
+            reporter.update(machine_name, progress.WAITING_FOR_IP)
+
+    reporter.update(machine_name, progress.CONFIGURING)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        setup = executor.submit(_setup_vm, vcenter, the_vm, logger)
+        setup.add_done_callback(_setup_done)
+        with span('create.ip_wait', logger):
+            info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
+        have_ip.set()
+        # re-raises any error from the setup
+        setup.result()
+    return info
+
+
+def _deploy(vcenter, source, username, machine_name, logger, reporter):
+    """Make a new, powered on ClarityNow VM
+
+    :Returns: Tuple - (vim.VirtualMachine, the provisioning mode actually used)
+    """
+    if source.mode == 'linked_clone':
+        with span('create.template', logger):
+            the_template = source.template(vcenter, logger)
+        if the_template is not None:
+            reporter.update(machine_name, progress.DEPLOYING)
+            with span('create.linked_clone', logger):
+                the_vm = templates.linked_clone(vcenter, the_template, username, machine_name, source.network)
+            return the_vm, 'linked_clone'
+        logger.info('Template for {} is being built; doing a full OVA deploy'.format(source.image))
+    return _create_from_ova(vcenter, source, username, machine_name, logger, reporter), 'ova'
+
+
+def _create_from_ova(vcenter, source, username, machine_name, logger, reporter):
+    """Make a new ClarityNow VM by uploading the entire OVA
+
+    :Returns: vim.VirtualMachine
+    """
+    with source.ova(logger) as ova:
+        reporter.update(machine_name, progress.IMAGE_OPENED)
+        network_map = vim.OvfManager.NetworkMapping()
+        network_map.name = ova.networks[0]
+        network_map.network = source.network
+        with span('create.deploy_from_ova', logger), _report_upload(ova, machine_name, reporter):
+            return virtual_machine.deploy_from_ova(vcenter, ova, [network_map],
+                                                   username, machine_name, logger)
+
+
+@contextmanager
+def _report_upload(ova, machine_name, reporter):
+    """Report how much of the OVA has been uploaded, until the block exits
+
+    The watcher is joined on the way out, so it never reports the upload after
+    a later phase has been reported.
+
+    :Returns: None
+    """
+    done = threading.Event()
+    def _watch():
+        while not done.wait(const.VLAB_CLARITYNOW_PROGRESS_SECONDS):
+            # None until the upload starts, and again once it's finished
+            percent = ova.deploy_progress
+            if percent is not None:
+                reporter.update(machine_name, progress.DEPLOYING, percent)
+
+    reporter.update(machine_name, progress.DEPLOYING, 0)
+    watcher = threading.Thread(target=_watch, name='upload-progress', daemon=True)
+    watcher.start()
+    try:
+        yield
+    finally:
+        done.set()
+        watcher.join()
 
 
 def _setup_vm(vcenter, the_vm, logger):
@@ -116,9 +567,15 @@ def _setup_vm(vcenter, the_vm, logger):
     The license is only good for 60 days, so we have to perform a time hack
     on the new VM until ClarityNow is able to produce a persistent license.
 
+    Every command is run in one guest operations session, so VMware Tools is
+    only waited on, and the process manager only looked up, once.
+
+    A command that fails is logged, not raised, so the user still gets the
+    VM they asked for, the same as before the commands overlapped the IP wait.
+
     :Returns: None
 
-    :Raises: RuntimeError
+    :Raises: RuntimeError if a command can't be run at all
 
     :param vcenter: The instantiated connection to vCenter
     :type vcenter: vlab_inf_common.vmware.vCenter
@@ -129,57 +586,70 @@ def _setup_vm(vcenter, the_vm, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    cmd1 = '/usr/bin/sudo'
-    args1 = '/usr/bin/timedatectl set-ntp 0'
-    logger.info('Disabling NTP on server')
-    result1 = virtual_machine.run_command(vcenter,
-                                         the_vm,
-                                         cmd1,
-                                         user='administrator',
-                                         password='a',
-                                         arguments=args1)
-    logger.info('Setting date to 2018-09-28')
-    cmd2 = '/usr/bin/sudo'
-    args2 = '/usr/bin/timedatectl set-time 2018-09-28'
-    result2 = virtual_machine.run_command(vcenter,
-                                         the_vm,
-                                         cmd2,
-                                         user='administrator',
-                                         password='a',
-                                         arguments=args2)
+    logger.info('Disabling NTP and setting date to 2018-09-28')
+    creds = vim.vm.guest.NamePasswordAuthentication(username='administrator', password='a')
+    process_mgr = vcenter.content.guestOperationsManager.processManager
+    for step, arguments in SETUP_STEPS:
+        with span('create.setup.{}'.format(step), logger):
+            spec = vim.vm.guest.ProcessManager.ProgramSpec(programPath='/usr/bin/sudo', arguments=arguments)
+            pid = _start_in_guest(process_mgr, the_vm, creds, spec)
+            exit_code = _wait_in_guest(process_mgr, the_vm, creds, pid, arguments)
+        if exit_code:
+            logger.error('Setup command "{}" failed with exit code {}'.format(arguments, exit_code))
 
 
-def list_images():
-    """Obtain a list of available versions of ClarityNow that can be created
+def _start_in_guest(process_mgr, the_vm, creds, spec):
+    """Start a command in a VM, waiting on VMware Tools if it's not up yet
 
-    :Returns: List
+    :Returns: Integer - the PID of the command
+
+    :Raises: RuntimeError if VMware Tools doesn't come up in time
     """
-    images = os.listdir(const.VLAB_CLARITYNOW_IMAGES_DIR)
-    images = [convert_name(x, to_version=True) for x in images]
-    return images
+    deadline = time.time() + SETUP_TIMEOUT
+    while True:
+        try:
+            return process_mgr.StartProgramInGuest(the_vm, creds, spec)
+        except vim.fault.GuestOperationsUnavailable:
+            if time.time() > deadline:
+                error = 'VMTools not available within {} seconds'.format(SETUP_TIMEOUT)
+                raise RuntimeError(error)
+            time.sleep(1)
+
+
+def _wait_in_guest(process_mgr, the_vm, creds, pid, arguments):
+    """Block until a command in a VM exits
 
+    :Returns: Integer - the exit code of the command
 
-def convert_name(name, to_version=False):
-    """This function centralizes converting between the name of the OVA, and the
-    version of software it contains.
+    :Raises: RuntimeError if the command doesn't exit in time
+    """
+    deadline = time.time() + SETUP_TIMEOUT
+    while True:
+        info = process_mgr.ListProcessesInGuest(the_vm, creds, [pid])[0]
+        if info.endTime:
+            return info.exitCode
+        if time.time() > deadline:
+            error = 'Command {} took more than {} seconds'.format(arguments, SETUP_TIMEOUT)
+            raise RuntimeError(error)
+        time.sleep(GUEST_POLL_SECONDS)
 
-    TODO - State the naming convention
 
-    :param name: The thing to covert
-    :type name: String
+def list_images():
+    """Obtain a list of available versions of ClarityNow that can be created
 
-    :param to_version: Set to True to covert the name of an OVA to the version
-    :type to_version: Boolean
+    :Returns: List
     """
-    if to_version:
-        return name.split('-')[-1].replace('.ova', '')
-    else:
-        return 'ClarityNow-{}.ova'.format(name)
+    images = os.listdir(const.VLAB_CLARITYNOW_IMAGES_DIR)
+    images = [convert_name(x, to_version=True) for x in images]
+    return images
 
 
-def update_network(username, machine_name, new_network):
+def update_network(vcenter, username, machine_name, new_network, logger):
     """Implements the VM network update
 
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
     :param username: The name of the user who owns the virtual machine
     :type username: String
 
@@ -188,24 +658,22 @@ def update_network(username, machine_name, new_network):
 
     :param new_network: The name of the new network to connect the VM to
     :type new_network: String
-    """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'ClarityNow':
-                    the_vm = entity
-                    break
-        else:
-            error = 'No VM named {} found'.format(machine_name)
-            raise ValueError(error)
 
-        try:
-            network = vcenter.networks[new_network]
-        except KeyError:
-            error = 'No VM named {} found'.format(machine_name)
-            raise ValueError(error)
-        else:
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with span('update_network.lookup', logger):
+        folder = morefs.get_folder(vcenter, username)
+        the_vm = inventory.find_vm(vcenter, folder, machine_name, component='ClarityNow')
+    if the_vm is None:
+        error = 'No VM named {} found'.format(machine_name)
+        raise ValueError(error)
+
+    try:
+        network = morefs.get_network(vcenter, new_network)
+    except ValueError:
+        error = 'No VM named {} found'.format(machine_name)
+        raise ValueError(error)
+    else:
+        with span('update_network.change_network', logger):
             virtual_machine.change_network(the_vm, network)
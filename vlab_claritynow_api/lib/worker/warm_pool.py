@@ -0,0 +1,332 @@
+# -*- coding: UTF-8 -*-
+"""
+A pool of ClarityNow VMs that are deployed and configured before anyone asks.
+
+Deploying, time hacking and waiting on an IP takes minutes. For the images
+listed in ``VLAB_CLARITYNOW_WARM_POOL`` (i.e. ``2.11.0:3,2.10.0:1``), that
+many VMs are kept "parked" in the ``VLAB_CLARITYNOW_WARM_POOL_FOLDER`` folder.
+Creating a ClarityNow then only has to claim one of them, and move, rename and
+re-network it.
+
+Claiming a VM is a compare-and-swap on the VM's ``config.changeVersion``, so two
+workers can never hand the same parked VM to different users. A claimed VM that
+can't be handed over is destroyed, and the create falls back to a full deploy.
+A VM that isn't parked within ``PARK_TIMEOUT`` (i.e. the worker parking it
+died) no longer counts toward the pool, and the next refill destroys it.
+"""
+import time
+import uuid
+import random
+
+import ujson
+from vlab_inf_common.vmware import vim, virtual_machine, consume_task
+
+from vlab_claritynow_api.lib import const, metrics
+from vlab_claritynow_api.lib.worker import inventory, morefs
+
+
+WARM_COMPONENT = 'ClarityNowWarm'
+CLAIMED_COMPONENT = 'ClarityNowWarmClaimed'
+PARKED_PROPERTIES = ['name', 'config.annotation', 'config.changeVersion']
+# How long a claimed VM has to trade the lease from the pool network for one
+# on the user's network
+NEW_IP_TIMEOUT = 300
+# How long parking a VM can take; a VM that isn't parked by then never will be
+PARK_TIMEOUT = 3600
+
+POOL_HITS = metrics.counter('claritynow_warm_pool_hits_total', 'Creates served by a parked VM')
+POOL_MISSES = metrics.counter('claritynow_warm_pool_misses_total', 'Creates for a pooled image that found no parked VM')
+POOL_READY = metrics.gauge('claritynow_warm_pool_ready', 'Parked VMs ready to be claimed, as of the last refill')
+
+
+def pool_sizes():
+    """Obtain how many VMs to keep parked for each image
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if ``VLAB_CLARITYNOW_WARM_POOL`` is malformed
+    """
+    sizes = {}
+    for entry in const.VLAB_CLARITYNOW_WARM_POOL.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            image, count = entry.rsplit(':', 1)
+            sizes[image] = int(count)
+        except ValueError:
+            error = 'Invalid VLAB_CLARITYNOW_WARM_POOL entry: {}'.format(entry)
+            raise ValueError(error)
+    return sizes
+
+
+def parked_name(image):
+    """Make a unique name for a new parked VM
+
+    The name includes when parking started, so a VM that's never marked as
+    ready can be told apart from one that's still being configured.
+
+    :Returns: String
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+    """
+    return '{}{}-{}'.format(_prefix(image), int(time.time()), uuid.uuid4().hex[:8])
+
+
+def _prefix(image):
+    return 'ClarityNow-warm-{}-'.format(image)
+
+
+def _abandoned(name, image, now):
+    """If a VM that isn't ready yet was deployed too long ago to ever be parked"""
+    try:
+        started = int(name[len(_prefix(image)):].split('-')[0])
+    except ValueError:
+        # Named before the start time was part of the name
+        return True
+    return now - started > PARK_TIMEOUT
+
+
+def pool_folder(vcenter):
+    """Obtain the folder that holds the parked VMs, creating it if needed
+
+    :Returns: vim.Folder
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return morefs.get_or_create_folder(vcenter, const.VLAB_CLARITYNOW_WARM_POOL_FOLDER)
+
+
+def _pooled(vcenter, image):
+    """Obtain the VMs in the pool for an image, and if they're ready to be claimed
+
+    VMs that are still being deployed count toward the size of the pool, so
+    refills that overlap don't park more VMs than configured. VMs that were
+    never marked as ready within ``PARK_TIMEOUT`` don't count; see ``reap``.
+
+    :Returns: Tuple - (List of (vim.VirtualMachine, Dictionary, Boolean) tuples,
+              List of the abandoned vim.VirtualMachine)
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+    """
+    now = time.time()
+    pooled = []
+    abandoned = []
+    for the_vm, props in inventory.child_vms(vcenter, pool_folder(vcenter), PARKED_PROPERTIES):
+        name = props.get('name', '')
+        if not name.startswith(_prefix(image)):
+            continue
+        meta = inventory.parse_meta(props.get('config.annotation'))
+        if meta.get('component') == CLAIMED_COMPONENT:
+            continue
+        ready = meta.get('component') == WARM_COMPONENT and meta.get('version') == image
+        if not ready and _abandoned(name, image, now):
+            abandoned.append(the_vm)
+            continue
+        pooled.append((the_vm, props, ready))
+    return pooled, abandoned
+
+
+def reap(vcenter, image, logger):
+    """Destroy the VMs that were never parked, i.e. the worker parking them died
+
+    :Returns: Integer - how many VMs were destroyed
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    _, abandoned = _pooled(vcenter, image)
+    for the_vm in abandoned:
+        logger.info('Destroying {}; it was never parked'.format(the_vm.name))
+        _destroy(the_vm, logger)
+    return len(abandoned)
+
+
+def count(vcenter, image):
+    """Obtain how many VMs are parked, or being parked, for an image
+
+    :Returns: Tuple - (total, ready)
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+    """
+    pooled, _ = _pooled(vcenter, image)
+    ready = len([x for x in pooled if x[2]])
+    POOL_READY.set(ready, image=image)
+    return len(pooled), ready
+
+
+def park(the_vm, image):
+    """Mark a fully configured VM as ready to be claimed
+
+    :Returns: None
+
+    :param the_vm: The deployed, configured ClarityNow VM
+    :type the_vm: vim.VirtualMachine
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+    """
+    meta_data = {'component' : WARM_COMPONENT,
+                 'created': time.time(),
+                 'version': image,
+                 'configured': True,
+                 'generation': 1,
+                }
+    virtual_machine.set_meta(the_vm, meta_data)
+    POOL_READY.inc(image=image)
+
+
+def _try_claim(the_vm, change_version, image):
+    """Atomically mark a parked VM as claimed
+
+    :Returns: Boolean - False if another worker claimed the VM first
+
+    :param the_vm: The parked VM
+    :type the_vm: vim.VirtualMachine
+
+    :param change_version: The ``config.changeVersion`` the VM had when it was listed
+    :type change_version: String
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+    """
+    meta_data = {'component' : CLAIMED_COMPONENT,
+                 'created': time.time(),
+                 'version': image,
+                 'configured': True,
+                 'generation': 1,
+                }
+    spec = vim.vm.ConfigSpec()
+    spec.changeVersion = change_version
+    spec.annotation = ujson.dumps(meta_data)
+    try:
+        consume_task(the_vm.ReconfigVM_Task(spec))
+    except RuntimeError:
+        # vCenter rejects the change if the VM was modified since we listed it
+        return False
+    return True
+
+
+def claim(vcenter, image, username, machine_name, network, logger):
+    """Hand a parked VM to a user
+
+    :Returns: vim.VirtualMachine, or None if no parked VM is ready, or the one
+              claimed couldn't be handed over
+
+    :Raises: ValueError if the user already has a VM with the name
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ClarityNow
+    :type image: String
+
+    :param username: The name of the user who will own the VM
+    :type username: String
+
+    :param machine_name: The name to give the VM
+    :type machine_name: String
+
+    :param network: The network to connect the VM to
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    folder = morefs.get_folder(vcenter, username)
+    if any(x[1].get('name') == machine_name for x in inventory.child_vms(vcenter, folder, ['name'])):
+        error = 'You already have a VM named {}'.format(machine_name)
+        raise ValueError(error)
+    ready = [x for x in _pooled(vcenter, image)[0] if x[2]]
+    # Spread concurrent claims across the pool, so they rarely collide
+    random.shuffle(ready)
+    for the_vm, props, _ in ready:
+        if _try_claim(the_vm, props.get('config.changeVersion'), image):
+            break
+    else:
+        POOL_MISSES.inc(image=image)
+        return None
+    POOL_HITS.inc(image=image)
+    POOL_READY.dec(image=image)
+    logger.info('Claimed parked VM {}'.format(props['name']))
+    try:
+        old_ips = _guest_ips(vcenter, the_vm)
+        consume_task(folder.MoveIntoFolder_Task([the_vm]))
+        consume_task(the_vm.Rename_Task(machine_name))
+        virtual_machine.change_network(the_vm, network)
+        _wait_for_new_ip(vcenter, the_vm, old_ips)
+    except Exception as doh:
+        # It's claimed, so it'd never be used or refilled; don't leave it behind
+        logger.error('Unable to hand parked VM {} to {}: {}'.format(props['name'], username, doh))
+        _destroy(the_vm, logger)
+        return None
+    return the_vm
+
+
+def _guest_ips(vcenter, the_vm):
+    """Obtain the IPs VMware Tools reports for a VM
+
+    :Returns: List
+    """
+    props = inventory.get_properties(vcenter, the_vm, ['guest.net'])
+    return inventory._get_ips(props.get('guest.net'))
+
+
+def _wait_for_new_ip(vcenter, the_vm, old_ips, timeout=NEW_IP_TIMEOUT):
+    """Block until a re-networked VM no longer reports its old IPs
+
+    Otherwise the IP handed to the user is the stale lease from the pool network.
+
+    :Returns: List
+
+    :Raises: RuntimeError if the VM doesn't get a new IP before the timeout
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The claimed VM
+    :type the_vm: vim.VirtualMachine
+
+    :param old_ips: The IPs the VM had on the pool network
+    :type old_ips: List
+
+    :param timeout: How many seconds to wait
+    :type timeout: Integer
+    """
+    deadline = time.time() + timeout
+    while True:
+        ips = _guest_ips(vcenter, the_vm)
+        if ips and not set(ips) & set(old_ips):
+            return ips
+        if time.time() > deadline:
+            error = 'VM still has IPs {} from the pool network after {} seconds'.format(ips, timeout)
+            raise RuntimeError(error)
+        time.sleep(1)
+
+
+def _destroy(the_vm, logger):
+    """Power off and destroy a VM, logging any failure instead of raising it
+
+    :Returns: None
+    """
+    try:
+        virtual_machine.power(the_vm, state='off')
+        consume_task(the_vm.Destroy_Task())
+    except Exception as doh:
+        logger.error('Unable to destroy VM {}: {}'.format(the_vm, doh))